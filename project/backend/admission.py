@@ -0,0 +1,174 @@
+"""
+Admission control for the API: caps how many expensive requests run at once
+so dashboards cannot starve cashier traffic.
+
+Endpoints are tagged with a cost class through @admission.limit(cost):
+
+  * critical - latency-sensitive staff requests (customer lookup, points
+    adjustment, reward redemption). Never queued or shed; while one is in
+    flight no new heavy request is admitted, so the cashier's statements do
+    not wait behind freshly started scans.
+  * heavy    - full-table scans (customer list, recommendations, transaction
+    history, and snapshot-backed dashboards when no snapshot is available).
+    At most ADMISSION_HEAVY_CONCURRENCY run at once per worker.
+  * standard - cheap reads; counted but not limited.
+
+A heavy request that finds every slot taken waits in a FIFO queue of at most
+ADMISSION_HEAVY_QUEUE entries for up to ADMISSION_QUEUE_TIMEOUT seconds. When
+the queue is full or the wait times out it is shed: limit() raises
+Overloaded, which the app answers with 503 and a Retry-After estimated from
+recent heavy service times. Running requests are never interrupted.
+
+cost may be a callable evaluated per request, for endpoints whose cost
+depends on state (a dashboard served from a snapshot is cheap, computing it
+is not). Limits are per process, like the other in-process state; with
+several gunicorn workers the effective cap is workers * limit.
+ADMISSION_ENABLED=0 turns the controller into a pass-through that still
+counts requests.
+"""
+import os
+import math
+import time
+import logging
+import threading
+from collections import deque
+from functools import wraps
+
+logger = logging.getLogger(__name__)
+
+ADMISSION_ENABLED = os.getenv('ADMISSION_ENABLED', '1') == '1'
+HEAVY_CONCURRENCY = int(os.getenv('ADMISSION_HEAVY_CONCURRENCY', '2'))
+HEAVY_QUEUE = int(os.getenv('ADMISSION_HEAVY_QUEUE', '4'))
+QUEUE_TIMEOUT = float(os.getenv('ADMISSION_QUEUE_TIMEOUT', '10'))
+MAX_RETRY_AFTER = 60
+
+CRITICAL = 'critical'
+HEAVY = 'heavy'
+STANDARD = 'standard'
+
+# Weight of the newest request in each class's moving average service time
+_SERVICE_TIME_WEIGHT = 0.2
+
+
+class Overloaded(Exception):
+    def __init__(self, cost, reason, retry_after):
+        super().__init__(f"Too many {cost} requests ({reason})")
+        self.cost = cost
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _CostClass:
+    def __init__(self, name, concurrency, queue):
+        self.name = name
+        # None: never queued or shed, only counted
+        self.concurrency = concurrency
+        self.queue = queue
+        self.in_flight = 0
+        self.waiters = deque()
+        self.service_seconds = 1.0
+        self.stats = {'admitted': 0, 'queued': 0, 'shed_queue_full': 0, 'shed_timeout': 0}
+        self.wait_seconds = 0.0
+
+
+class AdmissionController:
+    def __init__(self, enabled=ADMISSION_ENABLED, heavy_concurrency=HEAVY_CONCURRENCY, heavy_queue=HEAVY_QUEUE,
+                 queue_timeout=QUEUE_TIMEOUT):
+        self.enabled = enabled
+        self.queue_timeout = queue_timeout
+        self.classes = {
+            CRITICAL: _CostClass(CRITICAL, None, 0),
+            HEAVY: _CostClass(HEAVY, heavy_concurrency, heavy_queue),
+            STANDARD: _CostClass(STANDARD, None, 0),
+        }
+        self._condition = threading.Condition()
+
+    def _can_start(self, cls, ticket):
+        if cls.waiters and cls.waiters[0] is not ticket:
+            return False
+        if cls.in_flight >= cls.concurrency:
+            return False
+        # Staff requests in flight hold back new scans
+        return not (cls.name == HEAVY and self.classes[CRITICAL].in_flight)
+
+    def _retry_after(self, cls):
+        """Seconds until the queue ahead would drain at the recent service rate."""
+        ahead = len(cls.waiters) + cls.in_flight
+        seconds = cls.service_seconds * ahead / max(cls.concurrency or 1, 1)
+        return min(MAX_RETRY_AFTER, max(1, math.ceil(seconds)))
+
+    def acquire(self, cost):
+        """Blocks until a request of this cost may run; raises Overloaded when shed."""
+        cls = self.classes[cost]
+        with self._condition:
+            if not self.enabled or cls.concurrency is None:
+                cls.in_flight += 1
+                cls.stats['admitted'] += 1
+                return
+            ticket = object()
+            if not cls.waiters and self._can_start(cls, ticket):
+                cls.in_flight += 1
+                cls.stats['admitted'] += 1
+                return
+            if len(cls.waiters) >= cls.queue:
+                cls.stats['shed_queue_full'] += 1
+                raise Overloaded(cost, 'queue full', self._retry_after(cls))
+            cls.waiters.append(ticket)
+            cls.stats['queued'] += 1
+            started = time.monotonic()
+            deadline = started + self.queue_timeout
+            try:
+                while not self._can_start(cls, ticket):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        cls.stats['shed_timeout'] += 1
+                        raise Overloaded(cost, 'timed out in queue', self._retry_after(cls))
+                    self._condition.wait(remaining)
+                cls.in_flight += 1
+                cls.stats['admitted'] += 1
+            finally:
+                cls.waiters.remove(ticket)
+                cls.wait_seconds += time.monotonic() - started
+                # The next waiter may now be at the head of the queue
+                self._condition.notify_all()
+
+    def release(self, cost, elapsed):
+        cls = self.classes[cost]
+        with self._condition:
+            cls.in_flight -= 1
+            cls.service_seconds += _SERVICE_TIME_WEIGHT * (elapsed - cls.service_seconds)
+            self._condition.notify_all()
+
+    def limit(self, cost):
+        """Decorator admitting the wrapped view under cost (a class name or a callable returning one)."""
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                resolved = cost() if callable(cost) else cost
+                self.acquire(resolved)
+                start = time.monotonic()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.release(resolved, time.monotonic() - start)
+            return wrapper
+        return decorator
+
+    def metrics(self):
+        with self._condition:
+            classes = [(name, dict(cls.stats), cls.in_flight, len(cls.waiters), cls.wait_seconds, cls.service_seconds)
+                       for name, cls in self.classes.items()]
+        return [
+            ('loyalty_admission_requests_total', 'counter', 'Admission decisions, by cost class and result.', [
+                ({'class': name, 'result': result}, count)
+                for name, stats, *_ in classes for result, count in stats.items()
+            ]),
+            ('loyalty_admission_in_flight', 'gauge', 'Admitted requests running, by cost class.',
+             [({'class': name}, in_flight) for name, _, in_flight, *_ in classes]),
+            ('loyalty_admission_queued', 'gauge', 'Requests waiting for admission, by cost class.',
+             [({'class': name}, waiting) for name, _, _, waiting, *_ in classes]),
+            ('loyalty_admission_wait_seconds_total', 'counter', 'Time requests spent queued, by cost class.',
+             [({'class': name}, round(wait, 6)) for name, _, _, _, wait, _ in classes]),
+            ('loyalty_admission_service_seconds', 'gauge', 'Moving average request time, by cost class.',
+             [({'class': name}, round(service, 6)) for name, *_, service in classes]),
+        ]
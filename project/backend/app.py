@@ -1,4 +1,4 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 from flask_socketio import SocketIO, emit
 from flask_cors import CORS
 from typing import List, Dict, Any
@@ -6,6 +6,7 @@ from datetime import datetime, timedelta
 import pytz
 import logging
 import os
+import threading
 import uuid
 import json
 from dotenv import load_dotenv
@@ -15,21 +16,40 @@ from dateutil.relativedelta import relativedelta
 import random
 import psycopg2
 from psycopg2.extras import RealDictCursor
+import instrumentation
+import profiling
+from serialization import FastJSONProvider, compress_response, json_response
+from jobs import JobScheduler
+from segmentation import SegmentEngine
+from tiers import TierEngine, tier_progress
+from campaigns import CampaignEngine
+from ingestion import IngestionBuffer, BufferFull, MAX_BATCH_EVENTS
+from changefeed import ChangeFeed
+from replica import ReplicaRouter, ReplicaBusy, prefer_replica
+from querycache import QueryCache
+from cohorts import RetentionEngine, DEFAULT_MONTHS as RETENTION_MONTHS
+from referral_graph import ReferralGraph, RANKINGS as REFERRAL_RANKINGS, top_referrers, referral_tree
+import rollups
+from sketches import SketchStore
+from partitions import PartitionedCompute
+from admission import AdmissionController, Overloaded, CRITICAL, HEAVY, STANDARD
+from dataversions import DataVersions, unversioned
+from dispatch import PromotionDispatcher, DispatchRunning
+from predictions import PredictionLoader
 
 # Initialize Flask app
 app = Flask(__name__)
-socketio = SocketIO(app, cors_allowed_origins="https://loyaltyanalytics.netlify.app")
+app.json = FastJSONProvider(app)
+FRONTEND_ORIGIN = "https://loyaltyanalytics.netlify.app"
+socketio = SocketIO(app, cors_allowed_origins=FRONTEND_ORIGIN)
 load_dotenv()
 
 # Configure minimal logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
-logging.getLogger('supabase').setLevel(logging.WARNING)
-logging.getLogger('httpx').setLevel(logging.WARNING)
-logging.getLogger('httpcore').setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 # Enable CORS for HTTP requests
-CORS(app, resources={r"/*": {"origins": "https://loyaltyanalytics.netlify.app"}}, methods=["GET", "POST", "PATCH", "DELETE", "OPTIONS"], allow_headers=["Content-Type", "X-User-ID"])
+CORS(app, resources={r"/*": {"origins": FRONTEND_ORIGIN}}, methods=["GET", "POST", "PATCH", "DELETE", "OPTIONS"], allow_headers=["Content-Type", "X-User-ID", "X-Profile-Token", "Idempotency-Key", "If-None-Match", "If-Modified-Since"], expose_headers=["Server-Timing", "X-Profile-Id", "Retry-After", "ETag"])
 
 # Configuration
 app.config['CACHE_TYPE'] = 'simple'
@@ -38,57 +58,154 @@ app.config['CACHE_TYPE'] = 'simple'
 def debug():
     return f"""
     DATABASE_URL: {'✅ FOUND' if os.getenv('DATABASE_URL') else '❌ MISSING'}
-    supabase: {'✅ READY' if supabase else '❌ NONE'}
+    READ_DATABASE_URL: {'✅ FOUND' if os.getenv('READ_DATABASE_URL') else '➖ PRIMARY ONLY'}
+    supabase: {'✅ READY' if supabase and not supabase.closed else '➖ CONNECTS ON FIRST QUERY'}
     """
 
-# 🔥 CREATE psycopg2 CONNECTION (REPLACES SUPABASE)
+# 🔥 psycopg2 CONNECTION (REPLACES SUPABASE), opened on first use rather than at import:
+# worker boot never waits on the database, and an outage fails requests instead of crash-looping workers
+DB_CONNECT_TIMEOUT = int(os.getenv('DB_CONNECT_TIMEOUT', '5'))
+supabase = None
+_connection_lock = threading.Lock()
+
 def create_supabase_client():
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            DATABASE_URL = os.getenv('DATABASE_URL')
-            if not DATABASE_URL:
-                raise ValueError("DATABASE_URL not set")
-            
-            client = psycopg2.connect(
-                DATABASE_URL,
-                cursor_factory=RealDictCursor
-            )
-            
-            # Test connection
-            with client.cursor() as cur:
-                cur.execute("SELECT id FROM users LIMIT 1")
-                cur.fetchone()
-            
-            logger.info("✅ psycopg2 connected!")
-            return client
-        except Exception as e:
-            if attempt < max_retries - 1:
-                time.sleep(2)
-            else:
-                raise e
+    DATABASE_URL = os.getenv('DATABASE_URL')
+    if not DATABASE_URL:
+        raise ValueError("DATABASE_URL not set")
+    client = psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor, connect_timeout=DB_CONNECT_TIMEOUT)
+    logger.info("✅ psycopg2 connected!")
+    return client
+
+def get_connection():
+    """
+    The shared connection; (re)connects when it has not been opened yet or
+    was closed by a failure.
+    """
+    global supabase
+    if supabase is None or supabase.closed:
+        with _connection_lock:
+            if supabase is None or supabase.closed:
+                supabase = create_supabase_client()
+    return supabase
+
+# Analytics reads (@prefer_replica) go to READ_DATABASE_URL when it is set and current
+replica_router = ReplicaRouter()
+instrumentation.register_collector(replica_router.metrics)
+
+# Memoized reads of reference tables (rewards, segments, campaigns), invalidated by writes below
+query_cache = QueryCache()
+instrumentation.register_collector(query_cache.metrics)
 
-supabase = create_supabase_client()
+# Dedicated connection for batch engines, which stream with server-side cursors and commit on their own
+def open_connection():
+    return psycopg2.connect(os.getenv('DATABASE_URL'), cursor_factory=RealDictCursor, connect_timeout=DB_CONNECT_TIMEOUT)
+
+# Per-customer endpoints computed per hash partition, on a process pool when PARTITION_WORKERS > 0
+partitioned = PartitionedCompute(record_query=instrumentation.record_query)
+instrumentation.register_collector(partitioned.metrics)
+
+def partitioned_json(kernel_name):
+    """
+    Kernel output from partitions.py, read from the replica when run_query()
+    would route there (call inside @prefer_replica); a replica failure is
+    retried on the primary.
+    """
+    primary = os.getenv('DATABASE_URL')
+    dsn = replica_router.read_dsn(primary)
+    try:
+        return partitioned.json_array(kernel_name, dsn=dsn)
+    except psycopg2.OperationalError as e:
+        if dsn == primary:
+            raise
+        replica_router.mark_down(e)
+        return partitioned.json_array(kernel_name, dsn=primary)
 
 # 🔥 UNIVERSAL run_query FUNCTION - REPLACES ALL SUPABASE CALLS
-def run_query(sql, params=None):
+def run_query(sql, params=None, commit=False):
     """
     EXECUTE ANY SQL QUERY WITH ONE LINE!
     RETURNS: {'data': [...], 'count': N}
+    commit=True also commits statements that return rows (UPDATE ... RETURNING)
+    SELECTs inside @prefer_replica may run on the read replica (replica.py)
+    Reads of reference tables may return shared, read-only rows (querycache.py)
     """
+    cache_key, cached = query_cache.lookup(sql, params)
+    if cached is not None:
+        return {'data': cached, 'count': len(cached)}
+    start = time.perf_counter()
+    rows = 0
     try:
-        cur = supabase.cursor(cursor_factory=RealDictCursor)
+        if not commit and replica_router.should_use(sql):
+            try:
+                result = replica_router.fetch(sql, params)
+                if cache_key is not None:
+                    result = query_cache.store(cache_key, result)
+                rows = len(result)
+                return {'data': result, 'count': len(result)}
+            except ReplicaBusy:
+                pass
+            except psycopg2.Error as e:
+                logger.warning(f"Replica query failed, retrying on the primary: {str(e)}")
+        conn = get_connection()
+        cur = conn.cursor(cursor_factory=RealDictCursor)
         cur.execute(sql, params)
         
         if cur.description:  # SELECT
             result = cur.fetchall()
+            rows = len(result)
+            if commit:
+                conn.commit()
+                replica_router.note_write()
+                query_cache.note_write(sql)
+            elif cache_key is not None:
+                result = query_cache.store(cache_key, result)
             return {'data': result, 'count': len(result)}
         else:  # INSERT/UPDATE/DELETE
-            supabase.commit()
+            conn.commit()
+            replica_router.note_write()
+            query_cache.note_write(sql)
             return {'data': [], 'count': cur.rowcount, 'success': True}
     except Exception as e:
         logger.error(f"Query error: {str(e)}")
+        try:
+            supabase.rollback()  # leave the shared connection usable after a failed statement
+        except Exception:
+            pass
         return {'data': [], 'count': 0, 'error': str(e)}
+    finally:
+        instrumentation.record_query(sql, time.perf_counter() - start, rows)
+
+# Admission control (see admission.py): heavy endpoints are capped and shed with 503 under load
+admission = AdmissionController()
+instrumentation.register_collector(admission.metrics)
+
+@app.errorhandler(Overloaded)
+def overloaded(e):
+    response = jsonify({'error': 'Server is busy, retry later', 'retryAfter': e.retry_after})
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response, 503
+
+def snapshot_cost(name):
+    """Cost of a precomputed() dashboard: cheap while its snapshot is current, a scan otherwise."""
+    return lambda: STANDARD if PRECOMPUTED_ENABLED and scheduler.get_result(name) is not None else HEAVY
+
+# Conditional GET (see dataversions.py): ETag / Last-Modified from trigger-maintained data versions
+data_versions = DataVersions(run_query, on_change=query_cache.invalidate)
+instrumentation.register_collector(data_versions.metrics)
+
+# Per-request query metrics (Server-Timing header, /metrics)
+@app.before_request
+def start_request_metrics():
+    instrumentation.start_request()
+    profiling.start_request()
+
+@app.after_request
+def finish_request_metrics(response):
+    response = profiling.finish_request(response)
+    response = compress_response(response)
+    response = instrumentation.finish_request(response)
+    response.headers['Timing-Allow-Origin'] = FRONTEND_ORIGIN
+    return response
 
 # Timezone configuration
 UTC = pytz.UTC
@@ -105,32 +222,65 @@ def require_auth(f):
     return decorated
 
 # Schema validation
-def validate_schema():
+REQUIRED_COLUMNS = {
+    'transactions': ['date', 'points', 'customer_id', 'type', 'context', 'amount'],
+    'orders': ['date', 'total', 'customer_id'],
+    'referrals': ['date', 'id'],
+    'campaigns': ['start_date', 'id', 'name', 'type', 'rules', 'end_date', 'status'],
+    'users': ['id', 'last_activity', 'tier', 'name', 'email', 'phone', 'created_at', 'points_balance', 'points_earned'],
+    'rewards': ['id', 'name', 'points_cost'],
+    'campaign_participants': ['id', 'campaign_id', 'customer_id', 'joined_at'],
+    'ml_predictions': ['id', 'customer_id', 'clv_predicted', 'prediction_date'],
+    'pred_rew': ['ml_prediction_id', 'reward_id'],
+    'promotions': ['id', 'title', 'message', 'type', 'status', 'sent_date'],
+    'segments': ['id', 'name', 'description', 'count', 'avg_spend', 'avg_points', 'retention_rate', 'color']
+}
+SCHEMA_CACHE_TTL = int(os.getenv('SCHEMA_CACHE_TTL', '300'))
+READINESS_MIN_INTERVAL = float(os.getenv('READINESS_MIN_INTERVAL', '10'))
+_schema_cache = {'checked_at': 0.0, 'result': None}
+_readiness_cache = {'checked_at': 0.0, 'response': None}
+_health_lock = threading.Lock()
+
+def validate_schema(force=False):
+    """
+    Checks REQUIRED_COLUMNS against information_schema in a single query.
+    Successful results are cached for SCHEMA_CACHE_TTL seconds.
+    """
+    with _health_lock:
+        cached = _schema_cache['result']
+        if not force and cached is not None and time.monotonic() - _schema_cache['checked_at'] < SCHEMA_CACHE_TTL:
+            return cached
     try:
-        required_columns = {
-            'transactions': ['date', 'points', 'customer_id', 'type', 'context', 'amount'],
-            'orders': ['date', 'total', 'customer_id'],
-            'referrals': ['date', 'id'],
-            'campaigns': ['start_date', 'id', 'name', 'type', 'rules', 'end_date', 'status'],
-            'users': ['id', 'last_activity', 'tier', 'name', 'email', 'phone', 'created_at', 'points_balance', 'points_earned'],
-            'rewards': ['id', 'name', 'points_cost'],
-            'campaign_participants': ['id', 'campaign_id', 'customer_id', 'joined_at'],
-            'ml_predictions': ['id', 'customer_id', 'clv_predicted', 'prediction_date'],
-            'pred_rew': ['ml_prediction_id', 'reward_id'],
-            'promotions': ['id', 'title', 'message', 'type', 'status', 'sent_date'],
-            'segments': ['id', 'name', 'description', 'count', 'avg_spend', 'avg_points', 'retention_rate', 'color']
-        }
+        response = run_query("""
+            SELECT table_name, column_name
+            FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = ANY(%s)
+        """, (list(REQUIRED_COLUMNS.keys()),))
+        if 'error' in response:
+            return False, {'error': f"Schema validation failed: {response['error']}"}
+
+        present = {}
+        for row in response['data']:
+            present.setdefault(row['table_name'], set()).add(row['column_name'])
+
         schema_status = {}
-        for table, columns in required_columns.items():
-            schema_status[table] = {}
-            for column in columns:
-                result = run_query(f"SELECT {column} FROM {table} LIMIT 1")
-                schema_status[table][column] = "Accessible" if result['data'] else f"Error: Empty table"
+        for table, columns in REQUIRED_COLUMNS.items():
+            if table not in present:
+                schema_status[table] = {column: "Error: Missing table" for column in columns}
+                continue
+            schema_status[table] = {
+                column: "Accessible" if column in present[table] else "Error: Missing column"
+                for column in columns
+            }
         is_valid = all(
             'Error' not in status
             for table, cols in schema_status.items()
             for column, status in cols.items()
         )
+        with _health_lock:
+            # A failure is re-checked on the next call, so a fixed schema reports ready straight away
+            _schema_cache['result'] = (is_valid, schema_status) if is_valid else None
+            _schema_cache['checked_at'] = time.monotonic()
         return is_valid, schema_status
     except Exception as e:
         logger.error(f"Schema validation error: {str(e)}")
@@ -145,7 +295,8 @@ def sanitize_input(value):
 # Parse ISO datetime
 def parse_iso_datetime(date_str):
     try:
-        dt = datetime.fromisoformat(date_str.replace('Z', '+00:00'))
+        # psycopg2 returns timestamptz columns as datetime objects, text columns as ISO strings
+        dt = date_str if isinstance(date_str, datetime) else datetime.fromisoformat(date_str.replace('Z', '+00:00'))
         return dt if dt.tzinfo else dt.replace(tzinfo=UTC)
     except Exception as e:
         logger.error(f"Failed to parse datetime {date_str}: {str(e)}")
@@ -153,25 +304,71 @@ def parse_iso_datetime(date_str):
 
 # 🔥 ALL ENDPOINTS BELOW - 100% CONVERTED TO run_query()
 
-# Health check endpoint
+# Liveness probe: no database access, safe to poll every few seconds
+@app.route('/health/live', methods=['GET'])
+def liveness_check():
+    return jsonify({'status': 'ok', 'timestamp': datetime.now(UTC).isoformat()}), 200
+
+# Health check endpoint (readiness): deep check, rate-limited to one run per READINESS_MIN_INTERVAL
 @app.route('/health', methods=['GET'])
+@app.route('/health/ready', methods=['GET'])
 def health_check():
+    with _health_lock:
+        cached = _readiness_cache['response']
+        if cached is not None and time.monotonic() - _readiness_cache['checked_at'] < READINESS_MIN_INTERVAL:
+            body, status = cached
+            return jsonify(body), status
+    body, status = _readiness_check()
+    with _health_lock:
+        _readiness_cache['response'] = (body, status)
+        _readiness_cache['checked_at'] = time.monotonic()
+    return jsonify(body), status
+
+def _readiness_check():
     try:
-        if not supabase:
-            return jsonify({'status': 'error', 'message': 'Database client not initialized'}), 500
+        try:
+            get_connection()
+        except Exception as e:
+            return {'status': 'error', 'message': f'Database unavailable: {str(e)}'}, 500
         is_valid, schema_status = validate_schema()
         if not is_valid:
-            return jsonify({'status': 'error', 'message': 'Schema validation failed', 'details': schema_status}), 500
+            return {'status': 'error', 'message': 'Schema validation failed', 'details': schema_status}, 500
         response = run_query("SELECT id FROM users LIMIT 1")
-        return jsonify({
+        if 'error' in response:
+            return {'status': 'error', 'message': response['error']}, 500
+        return {
             'status': 'ok',
             'database': f'Connected, found {len(response["data"])} users',
             'schema': schema_status,
+            'replica': replica_router.status(),
             'timestamp': datetime.now(UTC).isoformat()
-        }), 200
+        }, 200
     except Exception as e:
         logger.error(f"Health check failed: {str(e)}")
-        return jsonify({'status': 'error', 'message': str(e)}), 500
+        return {'status': 'error', 'message': str(e)}, 500
+
+# Prometheus metrics
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(instrumentation.render_metrics(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+# Admin: request profiles (see profiling.py)
+@app.route('/admin/profiles', methods=['GET'])
+def list_request_profiles():
+    if not profiling.is_authorized():
+        return jsonify({'error': 'Forbidden'}), 403
+    return jsonify(profiling.list_profiles())
+
+@app.route('/admin/profiles/<profile_id>', methods=['GET'])
+def get_request_profile(profile_id):
+    if not profiling.is_authorized():
+        return jsonify({'error': 'Forbidden'}), 403
+    profile = profiling.load_profile(profile_id)
+    if not profile:
+        return jsonify({'error': 'Profile not found'}), 404
+    if request.args.get('format') == 'json':
+        return jsonify(profile)
+    return Response(profiling.folded(profile), mimetype='text/plain')
 
 # Login API
 @app.route('/login', methods=['POST', 'OPTIONS'])
@@ -198,218 +395,250 @@ def login():
         logger.error(f"Login error: {str(e)}")
         return jsonify({'error': 'Admin table not available, use demo credentials'}), 503
 
+# Financial year quarters (FY starts in April)
+def get_financial_quarter_dates(date):
+    if date.month >= 4:
+        fy_start_year = date.year
+    else:
+        fy_start_year = date.year - 1
+        
+    if date.month in [4, 5, 6]:
+        quarter = 1
+        quarter_start_month = 4
+        quarter_end_month = 6
+    elif date.month in [7, 8, 9]:
+        quarter = 2
+        quarter_start_month = 7
+        quarter_end_month = 9
+    elif date.month in [10, 11, 12]:
+        quarter = 3
+        quarter_start_month = 10
+        quarter_end_month = 12
+    else:
+        quarter = 4
+        quarter_start_month = 1
+        quarter_end_month = 3
+        
+    if quarter == 4:
+        current_q_start = datetime(fy_start_year + 1, quarter_start_month, 1, tzinfo=UTC)
+        current_q_end = datetime(fy_start_year + 1, quarter_end_month + 1, 1, tzinfo=UTC) - timedelta(days=1)
+    else:
+        current_q_start = datetime(fy_start_year, quarter_start_month, 1, tzinfo=UTC)
+        if quarter_end_month == 12:
+            current_q_end = datetime(fy_start_year + 1, 1, 1, tzinfo=UTC) - timedelta(days=1)
+        else:
+            current_q_end = datetime(fy_start_year, quarter_end_month + 1, 1, tzinfo=UTC) - timedelta(days=1)
+            
+    if quarter == 1:
+        last_q_start = datetime(fy_start_year - 1, 10, 1, tzinfo=UTC)
+        last_q_end = datetime(fy_start_year, 1, 1, tzinfo=UTC) - timedelta(days=1)
+    else:
+        last_quarter = quarter - 1
+        if last_quarter == 1:
+            last_q_start = datetime(fy_start_year, 4, 1, tzinfo=UTC)
+            last_q_end = datetime(fy_start_year, 7, 1, tzinfo=UTC) - timedelta(days=1)
+        elif last_quarter == 2:
+            last_q_start = datetime(fy_start_year, 7, 1, tzinfo=UTC)
+            last_q_end = datetime(fy_start_year, 10, 1, tzinfo=UTC) - timedelta(days=1)
+        else:
+            last_q_start = datetime(fy_start_year, 10, 1, tzinfo=UTC)
+            last_q_end = datetime(fy_start_year + 1, 1, 1, tzinfo=UTC) - timedelta(days=1)
+            
+    return current_q_start, current_q_end, last_q_start, last_q_end
+
 # Dashboard: KPIs (HTTP)
-@app.route('/dashboard/kpis', methods=['GET', 'OPTIONS'])
-@require_auth
-def kpis():
-    if request.method == 'OPTIONS':
-        return jsonify({}), 204
-    try:
-        now = datetime.now(UTC)
-        
-        def get_financial_quarter_dates(date):
-            if date.month >= 4:
-                fy_start_year = date.year
-            else:
-                fy_start_year = date.year - 1
-                
-            if date.month in [4, 5, 6]:
-                quarter = 1
-                quarter_start_month = 4
-                quarter_end_month = 6
-            elif date.month in [7, 8, 9]:
-                quarter = 2
-                quarter_start_month = 7
-                quarter_end_month = 9
-            elif date.month in [10, 11, 12]:
-                quarter = 3
-                quarter_start_month = 10
-                quarter_end_month = 12
-            else:
-                quarter = 4
-                quarter_start_month = 1
-                quarter_end_month = 3
-                
-            if quarter == 4:
-                current_q_start = datetime(fy_start_year + 1, quarter_start_month, 1, tzinfo=UTC)
-                current_q_end = datetime(fy_start_year + 1, quarter_end_month + 1, 1, tzinfo=UTC) - timedelta(days=1)
-            else:
-                current_q_start = datetime(fy_start_year, quarter_start_month, 1, tzinfo=UTC)
-                if quarter_end_month == 12:
-                    current_q_end = datetime(fy_start_year + 1, 1, 1, tzinfo=UTC) - timedelta(days=1)
-                else:
-                    current_q_end = datetime(fy_start_year, quarter_end_month + 1, 1, tzinfo=UTC) - timedelta(days=1)
-                    
-            if quarter == 1:
-                last_q_start = datetime(fy_start_year - 1, 10, 1, tzinfo=UTC)
-                last_q_end = datetime(fy_start_year, 1, 1, tzinfo=UTC) - timedelta(days=1)
-            else:
-                last_quarter = quarter - 1
-                if last_quarter == 1:
-                    last_q_start = datetime(fy_start_year, 4, 1, tzinfo=UTC)
-                    last_q_end = datetime(fy_start_year, 7, 1, tzinfo=UTC) - timedelta(days=1)
-                elif last_quarter == 2:
-                    last_q_start = datetime(fy_start_year, 7, 1, tzinfo=UTC)
-                    last_q_end = datetime(fy_start_year, 10, 1, tzinfo=UTC) - timedelta(days=1)
-                else:
-                    last_q_start = datetime(fy_start_year, 10, 1, tzinfo=UTC)
-                    last_q_end = datetime(fy_start_year + 1, 1, 1, tzinfo=UTC) - timedelta(days=1)
-                    
-            return current_q_start, current_q_end, last_q_start, last_q_end
+# KPI_SKETCHES=1 serves active customers and average CLV from mergeable daily sketches (sketches.py)
+KPI_SKETCHES = os.getenv('KPI_SKETCHES', '0') == '1'
+sketch_store = SketchStore(open_connection, run_query)
 
-        current_q_start, current_q_end, last_q_start, last_q_end = get_financial_quarter_dates(now)
-        
-        # 🔥 ALL QUERIES CONVERTED
-        current_users_response = run_query("SELECT points_balance, points_earned, tier FROM users")
-        current_orders_response = run_query(
-            "SELECT total, date, customer_id FROM orders WHERE date >= %s AND date <= %s",
-            (current_q_start.isoformat(), current_q_end.isoformat())
-        )
-        current_transactions_response = run_query(
-            "SELECT points, type, date FROM transactions WHERE date >= %s AND date <= %s",
-            (current_q_start.isoformat(), current_q_end.isoformat())
-        )
+@prefer_replica
+def compute_kpis():
+    now = datetime.now(UTC)
+    current_q_start, current_q_end, last_q_start, last_q_end = get_financial_quarter_dates(now)
+    
+    # 🔥 ALL QUERIES CONVERTED
+    current_users_response = run_query("SELECT points_balance, points_earned, tier FROM users")
+    # Orders and points come from the daily rollups (rollups.py)
+    current_totals = rollups.period_totals(run_query, current_q_start, current_q_end)
+    current_campaigns_response = run_query("SELECT id, status FROM campaigns")
+    last_totals = rollups.period_totals(run_query, last_q_start, last_q_end)
+    if KPI_SKETCHES:
+        # Approximate mode (sketches.py): distinct active customers and mean CLV from merged daily sketches
+        current_sketches = sketch_store.period_summary(current_q_start, current_q_end)
+        last_sketches = sketch_store.period_summary(last_q_start, last_q_end)
+    else:
         current_ml_response = run_query(
             "SELECT clv_predicted, prediction_date FROM ml_predictions WHERE prediction_date >= %s AND prediction_date <= %s",
             (current_q_start.isoformat(), current_q_end.isoformat())
         )
-        current_campaigns_response = run_query("SELECT id, status FROM campaigns")
-        
-        last_orders_response = run_query(
-            "SELECT total, date, customer_id FROM orders WHERE date >= %s AND date <= %s",
-            (last_q_start.isoformat(), last_q_end.isoformat())
-        )
-        last_transactions_response = run_query(
-            "SELECT points, type, date FROM transactions WHERE date >= %s AND date <= %s",
-            (last_q_start.isoformat(), last_q_end.isoformat())
-        )
         last_ml_response = run_query(
             "SELECT clv_predicted, prediction_date FROM ml_predictions WHERE prediction_date >= %s AND prediction_date <= %s",
             (last_q_start.isoformat(), last_q_end.isoformat())
         )
-        
-        # ALL CALCULATIONS UNCHANGED
-        total_customers = len(current_users_response['data'])
-        total_points = sum(user['points_balance'] for user in current_users_response['data'])
-        avg_points = total_points / total_customers if total_customers > 0 else 0
-        total_spend = sum(order['total'] for order in current_orders_response['data'])
-        order_count = len(current_orders_response['data'])
-        avg_order_value = total_spend / order_count if order_count > 0 else 0
-        points_earned = sum(abs(t['points']) for t in current_transactions_response['data'] if t['points'] > 0)
-        points_redeemed = sum(abs(t['points']) for t in current_transactions_response['data'] if t['points'] < 0)
-        
+    
+    # ALL CALCULATIONS UNCHANGED
+    total_customers = len(current_users_response['data'])
+    total_points = sum(user['points_balance'] for user in current_users_response['data'])
+    avg_points = total_points / total_customers if total_customers > 0 else 0
+    total_spend = current_totals['orderTotal']
+    order_count = current_totals['orders']
+    avg_order_value = total_spend / order_count if order_count > 0 else 0
+    points_earned = current_totals['pointsEarned']
+    points_redeemed = current_totals['pointsRedeemed']
+    
+    if KPI_SKETCHES:
+        avg_clv = current_sketches['clv']['mean']
+        active_customers = current_sketches['activeCustomers']
+    else:
         avg_clv = sum(ml['clv_predicted'] for ml in current_ml_response['data']) / len(current_ml_response['data']) if current_ml_response['data'] else 0
-        active_customers = len(set(order['customer_id'] for order in current_orders_response['data']))
-        retention_rate = (active_customers / total_customers * 100) if total_customers > 0 else 0
-        active_campaigns = len([c for c in current_campaigns_response['data'] if c['status'] == 'active'])
-        
-        last_total_customers = total_customers
-        last_total_points = total_points
-        last_avg_points = last_total_points / last_total_customers if last_total_customers > 0 else 0
-        last_total_spend = sum(order['total'] for order in last_orders_response['data'])
-        last_order_count = len(last_orders_response['data'])
-        last_avg_order_value = last_total_spend / last_order_count if last_order_count > 0 else 0
-        last_points_earned = sum(abs(t['points']) for t in last_transactions_response['data'] if t['points'] > 0)
-        last_points_redeemed = sum(abs(t['points']) for t in last_transactions_response['data'] if t['points'] < 0)
-        
+        active_customers = current_totals['activeCustomers']
+    retention_rate = (active_customers / total_customers * 100) if total_customers > 0 else 0
+    active_campaigns = len([c for c in current_campaigns_response['data'] if c['status'] == 'active'])
+    
+    last_total_customers = total_customers
+    last_total_points = total_points
+    last_avg_points = last_total_points / last_total_customers if last_total_customers > 0 else 0
+    last_total_spend = last_totals['orderTotal']
+    last_order_count = last_totals['orders']
+    last_avg_order_value = last_total_spend / last_order_count if last_order_count > 0 else 0
+    last_points_earned = last_totals['pointsEarned']
+    last_points_redeemed = last_totals['pointsRedeemed']
+    
+    if KPI_SKETCHES:
+        last_avg_clv = last_sketches['clv']['mean']
+        last_active_customers = last_sketches['activeCustomers']
+    else:
         last_avg_clv = sum(ml['clv_predicted'] for ml in last_ml_response['data']) / len(last_ml_response['data']) if last_ml_response['data'] else 0
-        last_active_customers = len(set(order['customer_id'] for order in last_orders_response['data']))
-        last_retention_rate = (last_active_customers / last_total_customers * 100) if last_total_customers > 0 else 0
-        last_active_campaigns = active_campaigns
-        
-        def calculate_change(current, last):
-            if last == 0:
-                return 0 if current == 0 else 100
-            return ((current - last) / last) * 100
-        
-        customers_change = calculate_change(total_customers, last_total_customers)
-        avg_points_change = calculate_change(avg_points, last_avg_points)
-        avg_order_value_change = calculate_change(avg_order_value, last_avg_order_value)
-        points_earned_change = calculate_change(points_earned, last_points_earned)
-        points_redeemed_change = calculate_change(points_redeemed, last_points_redeemed)
-        retention_rate_change = retention_rate - last_retention_rate
-        clv_change = calculate_change(avg_clv, last_avg_clv) if last_avg_clv != 0 else 0
-        campaigns_change = active_campaigns - last_active_campaigns
-        
-        def get_trend(change):
-            if change > 0:
-                return 'up'
-            elif change < 0:
-                return 'down'
-            else:
-                return 'neutral'
-        
-        kpis_data = [
-            {
-                'title': 'Total Customers',
-                'value': total_customers,
-                'change': f"{'+' if customers_change > 0 else ''}{round(customers_change, 2)}% from last quarter",
-                'trend': get_trend(customers_change),
-                'icon': 'Users',
-                'color': 'blue'
-            },
-            {
-                'title': 'Average Points Balance',
-                'value': round(avg_points, 2),
-                'change': f"{'+' if avg_points_change > 0 else ''}{round(avg_points_change, 2)}% from last quarter",
-                'trend': get_trend(avg_points_change),
-                'icon': 'Gift',
-                'color': 'green'
-            },
-            {
-                'title': 'Average Order Value',
-                'value': f"${round(avg_order_value, 2)}",
-                'change': f"{'+' if avg_order_value_change > 0 else ''}{round(avg_order_value_change, 2)}% from last quarter",
-                'trend': get_trend(avg_order_value_change),
-                'icon': 'DollarSign',
-                'color': 'yellow'
-            },
-            {
-                'title': 'Points Earned',
-                'value': points_earned,
-                'change': f"{'+' if points_earned_change > 0 else ''}{round(points_earned_change, 2)}% from last quarter",
-                'trend': get_trend(points_earned_change),
-                'icon': 'TrendingUp',
-                'color': 'cyan'
-            },
-            {
-                'title': 'Points Redeemed',
-                'value': points_redeemed,
-                'change': f"{'+' if points_redeemed_change > 0 else ''}{round(points_redeemed_change, 2)}% from last quarter",
-                'trend': get_trend(points_redeemed_change),
-                'icon': 'Award',
-                'color': 'purple'
-            },
-            {
-                'title': 'Retention Rate',
-                'value': f"{round(retention_rate, 2)}%",
-                'change': f"{'+' if retention_rate_change > 0 else ''}{round(retention_rate_change, 2)}% from last quarter",
-                'trend': get_trend(retention_rate_change),
-                'icon': 'Percent',
-                'color': 'teal'
-            },
-            {
-                'title': 'Average CLV',
-                'value': f"${round(avg_clv, 2)}",
-                'change': f"{'+' if clv_change > 0 else ''}{round(clv_change, 2)}% from last quarter",
-                'trend': get_trend(clv_change),
-                'icon': 'DollarSign',
-                'color': 'orange'
-            },
-            {
-                'title': 'Active Campaigns',
-                'value': active_campaigns,
-                'change': f"{'+' if campaigns_change > 0 else ''}{campaigns_change} from last quarter",
-                'trend': get_trend(campaigns_change),
-                'icon': 'Megaphone',
-                'color': 'blue'
-            }
-        ]
-        return jsonify(kpis_data)
+        last_active_customers = last_totals['activeCustomers']
+    last_retention_rate = (last_active_customers / last_total_customers * 100) if last_total_customers > 0 else 0
+    last_active_campaigns = active_campaigns
+    
+    def calculate_change(current, last):
+        if last == 0:
+            return 0 if current == 0 else 100
+        return ((current - last) / last) * 100
+    
+    customers_change = calculate_change(total_customers, last_total_customers)
+    avg_points_change = calculate_change(avg_points, last_avg_points)
+    avg_order_value_change = calculate_change(avg_order_value, last_avg_order_value)
+    points_earned_change = calculate_change(points_earned, last_points_earned)
+    points_redeemed_change = calculate_change(points_redeemed, last_points_redeemed)
+    retention_rate_change = retention_rate - last_retention_rate
+    clv_change = calculate_change(avg_clv, last_avg_clv) if last_avg_clv != 0 else 0
+    campaigns_change = active_campaigns - last_active_campaigns
+    
+    def get_trend(change):
+        if change > 0:
+            return 'up'
+        elif change < 0:
+            return 'down'
+        else:
+            return 'neutral'
+    
+    kpis_data = [
+        {
+            'title': 'Total Customers',
+            'value': total_customers,
+            'change': f"{'+' if customers_change > 0 else ''}{round(customers_change, 2)}% from last quarter",
+            'trend': get_trend(customers_change),
+            'icon': 'Users',
+            'color': 'blue'
+        },
+        {
+            'title': 'Average Points Balance',
+            'value': round(avg_points, 2),
+            'change': f"{'+' if avg_points_change > 0 else ''}{round(avg_points_change, 2)}% from last quarter",
+            'trend': get_trend(avg_points_change),
+            'icon': 'Gift',
+            'color': 'green'
+        },
+        {
+            'title': 'Average Order Value',
+            'value': f"${round(avg_order_value, 2)}",
+            'change': f"{'+' if avg_order_value_change > 0 else ''}{round(avg_order_value_change, 2)}% from last quarter",
+            'trend': get_trend(avg_order_value_change),
+            'icon': 'DollarSign',
+            'color': 'yellow'
+        },
+        {
+            'title': 'Points Earned',
+            'value': points_earned,
+            'change': f"{'+' if points_earned_change > 0 else ''}{round(points_earned_change, 2)}% from last quarter",
+            'trend': get_trend(points_earned_change),
+            'icon': 'TrendingUp',
+            'color': 'cyan'
+        },
+        {
+            'title': 'Points Redeemed',
+            'value': points_redeemed,
+            'change': f"{'+' if points_redeemed_change > 0 else ''}{round(points_redeemed_change, 2)}% from last quarter",
+            'trend': get_trend(points_redeemed_change),
+            'icon': 'Award',
+            'color': 'purple'
+        },
+        {
+            'title': 'Retention Rate',
+            'value': f"{round(retention_rate, 2)}%",
+            'change': f"{'+' if retention_rate_change > 0 else ''}{round(retention_rate_change, 2)}% from last quarter",
+            'trend': get_trend(retention_rate_change),
+            'icon': 'Percent',
+            'color': 'teal'
+        },
+        {
+            'title': 'Average CLV',
+            'value': f"${round(avg_clv, 2)}",
+            'change': f"{'+' if clv_change > 0 else ''}{round(clv_change, 2)}% from last quarter",
+            'trend': get_trend(clv_change),
+            'icon': 'DollarSign',
+            'color': 'orange'
+        },
+        {
+            'title': 'Active Campaigns',
+            'value': active_campaigns,
+            'change': f"{'+' if campaigns_change > 0 else ''}{campaigns_change} from last quarter",
+            'trend': get_trend(campaigns_change),
+            'icon': 'Megaphone',
+            'color': 'blue'
+        }
+    ]
+    return kpis_data
+
+@app.route('/dashboard/kpis', methods=['GET', 'OPTIONS'])
+@require_auth
+@admission.limit(snapshot_cost('kpis'))
+def kpis():
+    if request.method == 'OPTIONS':
+        return jsonify({}), 204
+    try:
+        return jsonify(precomputed('kpis', compute_kpis))
     except Exception as e:
         logger.error(f"KPIs error: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+MAX_SKETCH_DAYS = 731
+
+@app.route('/dashboard/kpis/distribution', methods=['GET', 'OPTIONS'])
+@require_auth
+@admission.limit(HEAVY)
+def kpi_distribution():
+    if request.method == 'OPTIONS':
+        return jsonify({}), 204
+    try:
+        if request.args.get('start') or request.args.get('end'):
+            start = parse_iso_datetime(request.args['start']) if request.args.get('start') else None
+            end = parse_iso_datetime(request.args['end']) if request.args.get('end') else datetime.now(UTC)
+            if start is None or end is None or end < start or (end - start).days >= MAX_SKETCH_DAYS:
+                return jsonify({'error': f'start and end must be ISO dates at most {MAX_SKETCH_DAYS} days apart'}), 400
+            return jsonify(sketch_store.period_summary(start, end))
+        current_q_start, current_q_end, last_q_start, last_q_end = get_financial_quarter_dates(datetime.now(UTC))
+        return jsonify({
+            'currentQuarter': sketch_store.period_summary(current_q_start, current_q_end),
+            'lastQuarter': sketch_store.period_summary(last_q_start, last_q_end),
+        })
+    except Exception as e:
+        logger.error(f"KPI distribution error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
 # Dashboard: KPIs (WebSocket)
 @socketio.on('connect', namespace='/dashboard/kpis')
 def kpis_connect():
@@ -422,9 +651,16 @@ def kpis_connect():
 def kpis_disconnect():
     logger.info("WebSocket client disconnected from /dashboard/kpis")
 
+# Tier changes (WebSocket): one 'tier_changed' message per batch of changes
+def broadcast_tier_changes(events):
+    socketio.emit('tier_changed', events, namespace='/dashboard/tiers')
+
+tier_engine = TierEngine(connect=open_connection, run_query=run_query, on_change=broadcast_tier_changes)
+
 # Campaigns
 @app.route('/campaigns', methods=['GET', 'OPTIONS'])
 @require_auth
+@data_versions.conditional('campaigns', 'campaign_participants')
 def campaigns():
     if request.method == 'OPTIONS':
         return jsonify({}), 204
@@ -461,6 +697,7 @@ def campaigns():
 # Promotions
 @app.route('/promotions', methods=['GET', 'OPTIONS'])
 @require_auth
+@data_versions.conditional('promotions')
 def promotions():
     if request.method == 'OPTIONS':
         return jsonify({}), 204
@@ -471,6 +708,9 @@ def promotions():
         """)
         
         promotions_data = []
+        if any(not promo['sent_date'] for promo in promotions_response['data']):
+            # An unsent promotion's dates count from now, which the data versions cannot validate
+            unversioned()
         for promo in promotions_response['data']:
             sent_date = parse_iso_datetime(promo['sent_date']) if promo['sent_date'] else datetime.now(UTC)
             end_date = (sent_date + timedelta(days=30)).isoformat() if sent_date else None
@@ -488,9 +728,45 @@ def promotions():
         logger.error(f"Promotions error: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+# Promotion dispatch (see dispatch.py): audience resolved and delivered in batches by a background task
+promotion_dispatcher = PromotionDispatcher(open_connection)
+
+def run_dispatch(promotion_id):
+    try:
+        promotion_dispatcher.run(promotion_id)
+    except Exception as e:
+        logger.error(f"Promotion dispatch error: {str(e)}")
+
+@app.route('/promotions/<promotion_id>/dispatch', methods=['GET', 'POST', 'OPTIONS'])
+@require_auth
+def promotion_dispatch(promotion_id):
+    if request.method == 'OPTIONS':
+        return jsonify({}), 204
+    try:
+        if request.method == 'GET':
+            state = promotion_dispatcher.status(promotion_id)
+            if state is None:
+                return jsonify({'error': 'Promotion has not been dispatched'}), 404
+            return jsonify(state)
+
+        data = request.get_json(silent=True) or {}
+        try:
+            state = promotion_dispatcher.start(promotion_id, rerun=bool(data.get('rerun')))
+        except DispatchRunning as e:
+            return jsonify({'error': str(e), 'dispatch': promotion_dispatcher.status(promotion_id)}), 409
+        if state is None:
+            return jsonify({'error': 'Promotion not found'}), 404
+        if state['status'] != 'completed':
+            socketio.start_background_task(run_dispatch, promotion_id)
+        return jsonify(state), 202
+    except Exception as e:
+        logger.error(f"Promotion dispatch error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
 # Transactions
 @app.route('/transactions', methods=['GET', 'OPTIONS'])
 @require_auth
+@admission.limit(HEAVY)
 def transactions():
     if request.method == 'OPTIONS':
         return jsonify({}), 204
@@ -595,7 +871,7 @@ def transactions():
             'totalValue': round(total_value, 2),
         }
         
-        return jsonify({'transactions': transactions_data, 'stats': stats})
+        return json_response({'transactions': transactions_data, 'stats': stats})
     except Exception as e:
         logger.error(f"Transactions error: {str(e)}")
         return jsonify({'error': str(e)}), 500
@@ -603,374 +879,262 @@ def transactions():
 # Dashboard: Customers
 @app.route('/dashboard/customers', methods=['GET', 'OPTIONS'])
 @require_auth
+@admission.limit(HEAVY)
+@prefer_replica
 def customers():
     if request.method == 'OPTIONS':
         return jsonify({}), 204
     try:
-        users_response = run_query("""
-            SELECT id, email, name, tier, points_balance 
-            FROM users
-        """)
-        
-        transactions_response = run_query("""
-            SELECT customer_id, amount, date 
-            FROM transactions
-        """)
-        
-        user_segments_response = run_query("""
-            SELECT customer_id, segment_id 
-            FROM user_segments
-        """)
-        
-        segments_response = run_query("""
-            SELECT id, name 
-            FROM segments
-        """)
-
-        customer_data = []
-        for user in users_response['data']:
-            customer_id = user['id']
-            
-            # Get segment name
-            segment_id = next(
-                (us['segment_id'] for us in user_segments_response['data'] if us['customer_id'] == customer_id),
-                None
-            )
-            segment_name = next(
-                (s['name'] for s in segments_response['data'] if s['id'] == segment_id),
-                'Unknown'
-            )
-            
-            # Calculate total spend
-            customer_transactions = [
-                t for t in transactions_response['data']
-                if t['customer_id'] == customer_id
-            ]
-            total_spend = sum(t['amount'] for t in customer_transactions if t['amount'] is not None and t['amount'] > 0)
-            
-            # Get last activity
-            valid_dates = [parse_iso_datetime(t['date']) for t in customer_transactions if t['date'] is not None and parse_iso_datetime(t['date'])]
-            last_activity = max(valid_dates, default=datetime.now(UTC)).isoformat() if valid_dates else datetime.now(UTC).isoformat()
-            
-            # Churn risk and retention
-            recent_activity = len([
-                t for t in customer_transactions
-                if t['date'] is not None and (dt := parse_iso_datetime(t['date'])) and dt >= datetime.now(UTC) - timedelta(days=90)
-            ])
-            churn_risk = round(100 - (recent_activity / max(len(customer_transactions), 1) * 100), 2) if customer_transactions else 50
-            retention_rate = round(recent_activity / max(len(customer_transactions), 1) * 100, 2) if customer_transactions else 50
-            
-            customer_data.append({
-                'id': user['id'],
-                'name': user['name'],
-                'email': user['email'],
-                'tier': user['tier'],
-                'points': user['points_balance'],
-                'spend': total_spend,
-                'lastActivity': last_activity,
-                'segment': segment_name,
-                'churnRisk': churn_risk,
-                'retentionRate': retention_rate
-            })
-        return jsonify(customer_data)
+        # Per-customer metrics are computed per hash partition (see partitions.py), in customer id order
+        return Response(partitioned_json('customer_activity'), mimetype='application/json')
     except Exception as e:
         logger.error(f"Customers error: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
 # Dashboard: Additional KPIs
+@prefer_replica
+def compute_additional_kpis():
+    now = datetime.now(UTC)
+    current_q_start, current_q_end, last_q_start, last_q_end = get_financial_quarter_dates(now)
+    
+    # 🔥 ALL QUERIES CONVERTED
+    current_feedback_response = run_query("""
+        SELECT nps_score, date FROM feedback 
+        WHERE date >= %s AND date <= %s
+    """, (current_q_start.isoformat(), current_q_end.isoformat()))
+    
+    current_users_response = run_query("""
+        SELECT id, created_at FROM users 
+        WHERE created_at >= %s AND created_at <= %s
+    """, (current_q_start.isoformat(), current_q_end.isoformat()))
+    
+    current_ml_response = run_query("""
+        SELECT churn_probability, prediction_date FROM ml_predictions 
+        WHERE prediction_date >= %s AND prediction_date <= %s
+    """, (current_q_start.isoformat(), current_q_end.isoformat()))
+    
+    # Referrals and repeat purchases come from the daily rollups (rollups.py)
+    current_totals = rollups.period_totals(run_query, current_q_start, current_q_end)
+    
+    # Last quarter queries (same pattern)
+    last_feedback_response = run_query("""
+        SELECT nps_score, date FROM feedback 
+        WHERE date >= %s AND date <= %s
+    """, (last_q_start.isoformat(), last_q_end.isoformat()))
+    
+    last_users_response = run_query("""
+        SELECT id, created_at FROM users 
+        WHERE created_at >= %s AND created_at <= %s
+    """, (last_q_start.isoformat(), last_q_end.isoformat()))
+    
+    last_ml_response = run_query("""
+        SELECT churn_probability, prediction_date FROM ml_predictions 
+        WHERE prediction_date >= %s AND prediction_date <= %s
+    """, (last_q_start.isoformat(), last_q_end.isoformat()))
+    
+    last_totals = rollups.period_totals(run_query, last_q_start, last_q_end)
+    
+    # ALL CALCULATIONS UNCHANGED
+    current_avg_nps = sum(f['nps_score'] for f in current_feedback_response['data']) / len(current_feedback_response['data']) if current_feedback_response['data'] else 0
+    last_avg_nps = sum(f['nps_score'] for f in last_feedback_response['data']) / len(last_feedback_response['data']) if last_feedback_response['data'] else 0
+    nps_change = ((current_avg_nps - last_avg_nps) / last_avg_nps * 100) if last_avg_nps != 0 else 0
+    
+    current_referral_customers = current_totals['referrals']
+    current_total_new_customers = len(current_users_response['data'])
+    current_referral_rate = (current_referral_customers / current_total_new_customers * 100) if current_total_new_customers > 0 else 0
+    
+    last_referral_customers = last_totals['referrals']
+    last_total_new_customers = len(last_users_response['data'])
+    last_referral_rate = (last_referral_customers / last_total_new_customers * 100) if last_total_new_customers > 0 else 0
+    
+    current_avg_churn = sum(ml['churn_probability'] for ml in current_ml_response['data']) / len(current_ml_response['data']) if current_ml_response['data'] else 0
+    last_avg_churn = sum(ml['churn_probability'] for ml in last_ml_response['data']) / len(last_ml_response['data']) if last_ml_response['data'] else 0
+    
+    # Repeat purchase rate
+    current_repeat_customers = current_totals['repeatCustomers']
+    current_repeat_rate = (current_repeat_customers / current_totals['activeCustomers'] * 100) if current_totals['activeCustomers'] else 0
+    
+    last_repeat_customers = last_totals['repeatCustomers']
+    last_repeat_rate = (last_repeat_customers / last_totals['activeCustomers'] * 100) if last_totals['activeCustomers'] else 0
+    
+    # Trends
+    nps_trend = 'up' if nps_change > 0 else 'down' if nps_change < 0 else 'neutral'
+    referral_rate_change = current_referral_rate - last_referral_rate
+    referral_rate_trend = 'up' if referral_rate_change > 0 else 'down' if referral_rate_change < 0 else 'neutral'
+    churn_change = ((current_avg_churn - last_avg_churn) / last_avg_churn * 100) if last_avg_churn != 0 else 0
+    churn_trend = 'up' if churn_change > 0 else 'down' if churn_change < 0 else 'neutral'
+    repeat_rate_change = current_repeat_rate - last_repeat_rate
+    repeat_rate_trend = 'up' if repeat_rate_change > 0 else 'down' if repeat_rate_change < 0 else 'neutral'
+    
+    additional_kpis_data = [
+        {
+            'title': 'Average NPS Score',
+            'value': round(current_avg_nps, 2),
+            'change': f"{'+' if nps_change > 0 else ''}{round(nps_change, 2)}% from last quarter",
+            'trend': nps_trend,
+            'icon': 'Smile',
+            'color': 'green'
+        },
+        {
+            'title': 'Referral Rate',
+            'value': f"{round(current_referral_rate, 2)}%",
+            'change': f"{'+' if referral_rate_change > 0 else ''}{round(referral_rate_change, 2)}% from last quarter",
+            'trend': referral_rate_trend,
+            'icon': 'Share2',
+            'color': 'blue'
+        },
+        {
+            'title': 'Average Churn Risk',
+            'value': f"{round(current_avg_churn * 100, 2)}%",
+            'change': f"{'+' if churn_change > 0 else ''}{round(churn_change, 2)}% from last quarter",
+            'trend': churn_trend,
+            'icon': 'AlertTriangle',
+            'color': 'red'
+        },
+        {
+            'title': 'Repeat Purchase Rate',
+            'value': f"{round(current_repeat_rate, 2)}%",
+            'change': f"{'+' if repeat_rate_change > 0 else ''}{round(repeat_rate_change, 2)}% from last quarter",
+            'trend': repeat_rate_trend,
+            'icon': 'Repeat',
+            'color': 'purple'
+        }
+    ]
+    
+    return additional_kpis_data
+
 @app.route('/dashboard/kpis/additional', methods=['GET', 'OPTIONS'])
 @require_auth
+@admission.limit(snapshot_cost('additional_kpis'))
 def additional_kpis():
     if request.method == 'OPTIONS':
         return jsonify({}), 204
     try:
-        now = datetime.now(UTC)
-        current_q_start, current_q_end, last_q_start, last_q_end = get_financial_quarter_dates(now)
-        
-        # 🔥 ALL QUERIES CONVERTED
-        current_feedback_response = run_query("""
-            SELECT nps_score, date FROM feedback 
-            WHERE date >= %s AND date <= %s
-        """, (current_q_start.isoformat(), current_q_end.isoformat()))
-        
-        current_referrals_response = run_query("""
-            SELECT id, date FROM referrals 
-            WHERE date >= %s AND date <= %s
-        """, (current_q_start.isoformat(), current_q_end.isoformat()))
-        
-        current_users_response = run_query("""
-            SELECT id, created_at FROM users 
-            WHERE created_at >= %s AND created_at <= %s
-        """, (current_q_start.isoformat(), current_q_end.isoformat()))
-        
-        current_ml_response = run_query("""
-            SELECT churn_probability, prediction_date FROM ml_predictions 
-            WHERE prediction_date >= %s AND prediction_date <= %s
-        """, (current_q_start.isoformat(), current_q_end.isoformat()))
-        
-        current_orders_response = run_query("""
-            SELECT id, customer_id, date FROM orders 
-            WHERE date >= %s AND date <= %s
-        """, (current_q_start.isoformat(), current_q_end.isoformat()))
-        
-        # Last quarter queries (same pattern)
-        last_feedback_response = run_query("""
-            SELECT nps_score, date FROM feedback 
-            WHERE date >= %s AND date <= %s
-        """, (last_q_start.isoformat(), last_q_end.isoformat()))
-        
-        last_referrals_response = run_query("""
-            SELECT id, date FROM referrals 
-            WHERE date >= %s AND date <= %s
-        """, (last_q_start.isoformat(), last_q_end.isoformat()))
-        
-        last_users_response = run_query("""
-            SELECT id, created_at FROM users 
-            WHERE created_at >= %s AND created_at <= %s
-        """, (last_q_start.isoformat(), last_q_end.isoformat()))
-        
-        last_ml_response = run_query("""
-            SELECT churn_probability, prediction_date FROM ml_predictions 
-            WHERE prediction_date >= %s AND prediction_date <= %s
-        """, (last_q_start.isoformat(), last_q_end.isoformat()))
-        
-        last_orders_response = run_query("""
-            SELECT id, customer_id, date FROM orders 
-            WHERE date >= %s AND date <= %s
-        """, (last_q_start.isoformat(), last_q_end.isoformat()))
-        
-        # ALL CALCULATIONS UNCHANGED
-        current_avg_nps = sum(f['nps_score'] for f in current_feedback_response['data']) / len(current_feedback_response['data']) if current_feedback_response['data'] else 0
-        last_avg_nps = sum(f['nps_score'] for f in last_feedback_response['data']) / len(last_feedback_response['data']) if last_feedback_response['data'] else 0
-        nps_change = ((current_avg_nps - last_avg_nps) / last_avg_nps * 100) if last_avg_nps != 0 else 0
-        
-        current_referral_customers = len(set(r['id'] for r in current_referrals_response['data']))
-        current_total_new_customers = len(current_users_response['data'])
-        current_referral_rate = (current_referral_customers / current_total_new_customers * 100) if current_total_new_customers > 0 else 0
-        
-        last_referral_customers = len(set(r['id'] for r in last_referrals_response['data']))
-        last_total_new_customers = len(last_users_response['data'])
-        last_referral_rate = (last_referral_customers / last_total_new_customers * 100) if last_total_new_customers > 0 else 0
-        
-        current_avg_churn = sum(ml['churn_probability'] for ml in current_ml_response['data']) / len(current_ml_response['data']) if current_ml_response['data'] else 0
-        last_avg_churn = sum(ml['churn_probability'] for ml in last_ml_response['data']) / len(last_ml_response['data']) if last_ml_response['data'] else 0
-        
-        # Repeat purchase rate
-        current_customer_orders = {}
-        for order in current_orders_response['data']:
-            customer_id = order['customer_id']
-            current_customer_orders[customer_id] = current_customer_orders.get(customer_id, 0) + 1
-        current_repeat_customers = sum(1 for count in current_customer_orders.values() if count > 1)
-        current_repeat_rate = (current_repeat_customers / len(current_customer_orders) * 100) if current_customer_orders else 0
-        
-        last_customer_orders = {}
-        for order in last_orders_response['data']:
-            customer_id = order['customer_id']
-            last_customer_orders[customer_id] = last_customer_orders.get(customer_id, 0) + 1
-        last_repeat_customers = sum(1 for count in last_customer_orders.values() if count > 1)
-        last_repeat_rate = (last_repeat_customers / len(last_customer_orders) * 100) if last_customer_orders else 0
-        
-        # Trends
-        nps_trend = 'up' if nps_change > 0 else 'down' if nps_change < 0 else 'neutral'
-        referral_rate_change = current_referral_rate - last_referral_rate
-        referral_rate_trend = 'up' if referral_rate_change > 0 else 'down' if referral_rate_change < 0 else 'neutral'
-        churn_change = ((current_avg_churn - last_avg_churn) / last_avg_churn * 100) if last_avg_churn != 0 else 0
-        churn_trend = 'up' if churn_change > 0 else 'down' if churn_change < 0 else 'neutral'
-        repeat_rate_change = current_repeat_rate - last_repeat_rate
-        repeat_rate_trend = 'up' if repeat_rate_change > 0 else 'down' if repeat_rate_change < 0 else 'neutral'
-        
-        additional_kpis_data = [
-            {
-                'title': 'Average NPS Score',
-                'value': round(current_avg_nps, 2),
-                'change': f"{'+' if nps_change > 0 else ''}{round(nps_change, 2)}% from last quarter",
-                'trend': nps_trend,
-                'icon': 'Smile',
-                'color': 'green'
-            },
-            {
-                'title': 'Referral Rate',
-                'value': f"{round(current_referral_rate, 2)}%",
-                'change': f"{'+' if referral_rate_change > 0 else ''}{round(referral_rate_change, 2)}% from last quarter",
-                'trend': referral_rate_trend,
-                'icon': 'Share2',
-                'color': 'blue'
-            },
-            {
-                'title': 'Average Churn Risk',
-                'value': f"{round(current_avg_churn * 100, 2)}%",
-                'change': f"{'+' if churn_change > 0 else ''}{round(churn_change, 2)}% from last quarter",
-                'trend': churn_trend,
-                'icon': 'AlertTriangle',
-                'color': 'red'
-            },
-            {
-                'title': 'Repeat Purchase Rate',
-                'value': f"{round(current_repeat_rate, 2)}%",
-                'change': f"{'+' if repeat_rate_change > 0 else ''}{round(repeat_rate_change, 2)}% from last quarter",
-                'trend': repeat_rate_trend,
-                'icon': 'Repeat',
-                'color': 'purple'
-            }
-        ]
-        
-        return jsonify(additional_kpis_data)
+        return jsonify(precomputed('additional_kpis', compute_additional_kpis))
     except Exception as e:
         logger.error(f"Additional KPIs error: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
 # Dashboard: Charts
+@prefer_replica
+def compute_charts():
+    # Generate months
+    months = [(datetime.now(UTC) - relativedelta(months=i)).strftime('%b %Y') for i in range(11, -1, -1)]
+    
+    # 🔥 ALL QUERIES CONVERTED
+    users_response = run_query("""
+        SELECT tier, points_balance, id 
+        FROM users
+    """)
+    
+    campaigns_response = run_query("""
+        SELECT id, name 
+        FROM campaigns
+    """)
+    
+    campaign_participants_response = run_query("""
+        SELECT campaign_id, joined_at 
+        FROM campaign_participants
+    """)
+    
+    segments_response = run_query("""
+        SELECT id, name 
+        FROM segments
+    """)
+    
+    rewards_response = run_query("""
+        SELECT id, name 
+        FROM rewards
+    """)
+    
+    user_segments_response = run_query("""
+        SELECT customer_id, segment_id 
+        FROM user_segments
+    """)
+    
+    # Points Activity and Total Sales, re-aggregated from the daily rollups
+    monthly = rollups.monthly_series(run_query, [datetime.strptime(month, '%b %Y').date() for month in months])
+    earned = [m['earned'] for m in monthly]
+    redeemed = [m['redeemed'] for m in monthly]
+    sales = [m['sales'] for m in monthly]
+
+    # Tier Distribution
+    tier_counts = {'Bronze': 0, 'Silver': 0, 'Gold': 0}
+    for user in users_response['data']:
+        if user['tier'] in tier_counts:
+            tier_counts[user['tier']] += 1
+
+    # Customer Segments
+    segment_labels = [s['name'] for s in segments_response['data']]
+    segment_data = []
+    for segment in segments_response['data']:
+        count = len([
+            us for us in user_segments_response['data'] 
+            if us['segment_id'] == segment['id']
+        ])
+        segment_data.append(count)
+
+    # Reward Popularity
+    reward_counts = rollups.reward_redemptions(run_query)
+    
+    reward_popularity = [
+        {'name': r['name'], 'score': reward_counts.get(r['id'], 0)}
+        for r in rewards_response['data']
+    ]
+
+    # Campaign Engagement
+    campaign_engagement = []
+    for campaign in campaigns_response['data']:
+        participants = len([
+            p for p in campaign_participants_response['data'] 
+            if p['campaign_id'] == campaign['id']
+        ])
+        campaign_engagement.append({'name': campaign['name'], 'participants': participants})
+
+    # ALL OTHER CHARTS (same pattern - abbreviated for space)
+    charts_data = {
+        'transactionsByType': {'labels': ['Earned', 'Redeemed', 'Welcome', 'Referral'], 'data': [0, 0, 0, 0]},
+        'customerSegments': {
+            'labels': segment_labels,
+            'data': segment_data,
+            'colors': ['#34D399', '#EF4444', '#3B82F6', '#A855F7', '#F59E0B'][:len(segment_labels)]
+        },
+        'tierDistribution': {
+            'labels': list(tier_counts.keys()),
+            'data': list(tier_counts.values())
+        },
+        'pointsActivity': {
+            'labels': months,
+            'earned': earned,
+            'redeemed': redeemed
+        },
+        'totalSalesOverTime': {
+            'labels': months,
+            'datasets': [{
+                'label': 'Total Sales',
+                'data': [round(s, 2) for s in sales],
+                'backgroundColor': 'rgba(59, 130, 246, 0.8)',
+                'borderColor': 'rgb(59, 130, 246)',
+                'borderWidth': 1
+            }]
+        },
+        'rewardPopularity': reward_popularity,
+        'campaignEngagement': {
+            'labels': [c['name'] for c in campaign_engagement],
+            'data': [c['participants'] for c in campaign_engagement]
+        }
+    }
+    
+    return charts_data
+
 @app.route('/dashboard/charts', methods=['GET', 'OPTIONS'])
 @require_auth
+@admission.limit(snapshot_cost('charts'))
 def charts():
     if request.method == 'OPTIONS':
         return jsonify({}), 204
     try:
-        # Generate months
-        months = [(datetime.now(UTC) - relativedelta(months=i)).strftime('%b %Y') for i in range(11, -1, -1)]
-        
-        # 🔥 ALL QUERIES CONVERTED
-        transactions_response = run_query("""
-            SELECT points, type, date, context, customer_id 
-            FROM transactions
-        """)
-        
-        users_response = run_query("""
-            SELECT tier, points_balance, id 
-            FROM users
-        """)
-        
-        campaigns_response = run_query("""
-            SELECT id, name 
-            FROM campaigns
-        """)
-        
-        campaign_participants_response = run_query("""
-            SELECT campaign_id, joined_at 
-            FROM campaign_participants
-        """)
-        
-        segments_response = run_query("""
-            SELECT id, name 
-            FROM segments
-        """)
-        
-        rewards_response = run_query("""
-            SELECT id, name 
-            FROM rewards
-        """)
-        
-        orders_response = run_query("""
-            SELECT subtotal, date 
-            FROM orders
-        """)
-        
-        referrals_response = run_query("""
-            SELECT reward_points, date 
-            FROM referrals
-        """)
-        
-        user_segments_response = run_query("""
-            SELECT customer_id, segment_id 
-            FROM user_segments
-        """)
-        
-        # Points Activity
-        earned = []
-        redeemed = []
-        for month in months:
-            month_start = datetime.strptime(month, '%b %Y').replace(day=1, tzinfo=UTC)
-            month_end = month_start + relativedelta(months=1) - timedelta(seconds=1)
-            month_transactions = [
-                t for t in transactions_response['data']
-                if (dt := parse_iso_datetime(t['date'])) and month_start <= dt <= month_end
-            ]
-            earned.append(sum(t['points'] for t in month_transactions if t['type'].lower() in ['earn_points', 'welcome_bonus'] and t['points'] > 0))
-            redeemed.append(abs(sum(t['points'] for t in month_transactions if t['type'].lower() == 'redeem_points' and t['points'] < 0)))
-
-        # Total Sales
-        sales = [0.0] * 12
-        for order in orders_response['data']:
-            order_date = parse_iso_datetime(order['date'])
-            if order_date and (month_str := order_date.strftime('%b %Y')) in months:
-                month_idx = months.index(month_str)
-                sales[month_idx] += float(order['subtotal'] or 0)
-
-        # Tier Distribution
-        tier_counts = {'Bronze': 0, 'Silver': 0, 'Gold': 0}
-        for user in users_response['data']:
-            if user['tier'] in tier_counts:
-                tier_counts[user['tier']] += 1
-
-        # Customer Segments
-        segment_labels = [s['name'] for s in segments_response['data']]
-        segment_data = []
-        for segment in segments_response['data']:
-            count = len([
-                us for us in user_segments_response['data'] 
-                if us['segment_id'] == segment['id']
-            ])
-            segment_data.append(count)
-
-        # Reward Popularity
-        reward_counts = {}
-        for t in transactions_response['data']:
-            if t['type'] == 'redeem_points' and t['context']:
-                try:
-                    reward_id = t['context'].split()[-1]
-                    reward_counts[reward_id] = reward_counts.get(reward_id, 0) + 1
-                except:
-                    continue
-        
-        reward_popularity = [
-            {'name': r['name'], 'score': reward_counts.get(r['id'], 0)}
-            for r in rewards_response['data']
-        ]
-
-        # Campaign Engagement
-        campaign_engagement = []
-        for campaign in campaigns_response['data']:
-            participants = len([
-                p for p in campaign_participants_response['data'] 
-                if p['campaign_id'] == campaign['id']
-            ])
-            campaign_engagement.append({'name': campaign['name'], 'participants': participants})
-
-        # ALL OTHER CHARTS (same pattern - abbreviated for space)
-        charts_data = {
-            'transactionsByType': {'labels': ['Earned', 'Redeemed', 'Welcome', 'Referral'], 'data': [0, 0, 0, 0]},
-            'customerSegments': {
-                'labels': segment_labels,
-                'data': segment_data,
-                'colors': ['#34D399', '#EF4444', '#3B82F6', '#A855F7', '#F59E0B'][:len(segment_labels)]
-            },
-            'tierDistribution': {
-                'labels': list(tier_counts.keys()),
-                'data': list(tier_counts.values())
-            },
-            'pointsActivity': {
-                'labels': months,
-                'earned': earned,
-                'redeemed': redeemed
-            },
-            'totalSalesOverTime': {
-                'labels': months,
-                'datasets': [{
-                    'label': 'Total Sales',
-                    'data': [round(s, 2) for s in sales],
-                    'backgroundColor': 'rgba(59, 130, 246, 0.8)',
-                    'borderColor': 'rgb(59, 130, 246)',
-                    'borderWidth': 1
-                }]
-            },
-            'rewardPopularity': reward_popularity,
-            'campaignEngagement': {
-                'labels': [c['name'] for c in campaign_engagement],
-                'data': [c['participants'] for c in campaign_engagement]
-            }
-        }
-        
-        return jsonify(charts_data)
+        return jsonify(precomputed('charts', compute_charts))
     except Exception as e:
         logger.error(f"Charts error: {str(e)}")
         return jsonify({'error': str(e)}), 500
@@ -978,6 +1142,7 @@ def charts():
 # Staff: Customer Lookup
 @app.route('/staff/customer-lookup', methods=['GET', 'OPTIONS'])
 @require_auth
+@admission.limit(CRITICAL)
 def customer_lookup():
     if request.method == 'OPTIONS':
         return '', 204
@@ -1027,13 +1192,11 @@ def customer_lookup():
         # ML Prediction
         ml_response = run_query("""
             SELECT clv_predicted 
-            FROM ml_predictions 
-            WHERE customer_id = %s 
-            ORDER BY prediction_date DESC 
-            LIMIT 1
+            FROM latest_predictions 
+            WHERE customer_id = %s
         """, (customer_id,))
         
-        churn_probability = ml_response['data'][0]['clv_predicted'] * 0.1 if ml_response['data'] else 0.1
+        churn_probability = float(ml_response['data'][0]['clv_predicted']) * 0.1 if ml_response['data'] else 0.1
         
         # RFM
         recency = (datetime.now(UTC) - max(
@@ -1043,12 +1206,8 @@ def customer_lookup():
         frequency = order_count
         monetary = total_spend
         
-        # Tier progress
-        tier_progress = {
-            'nextTier': 'Silver' if customer['tier'] == 'Bronze' else 'Gold' if customer['tier'] == 'Silver' else None,
-            'pointsToNext': max(0, 1000 - customer['points_balance']) if customer['tier'] == 'Bronze' else max(0, 2000 - customer['points_balance']) if customer['tier'] == 'Silver' else 0,
-            'progressPercentage': min(100, (customer['points_balance'] / 1000 * 100)) if customer['tier'] == 'Bronze' else min(100, (customer['points_balance'] / 2000 * 100)) if customer['tier'] == 'Silver' else 100
-        }
+        # Tier progress (thresholds from TIER_THRESHOLDS, see tiers.py)
+        progress = tier_progress(customer['points_earned'])
         
         purchase_frequency = order_count / 12 if order_count > 0 else 0
         
@@ -1069,7 +1228,7 @@ def customer_lookup():
             'avgOrderValue': avg_order_value,
             'lastPurchaseDate': last_purchase.isoformat() if last_purchase else None,
             'purchaseFrequency': purchase_frequency,
-            'tierProgress': tier_progress
+            'tierProgress': progress
         })
     except Exception as e:
         logger.error(f"Customer lookup error: {str(e)}")
@@ -1078,6 +1237,7 @@ def customer_lookup():
 # Staff: Points Adjustment
 @app.route('/staff/points-adjustment', methods=['POST', 'OPTIONS'])
 @require_auth
+@admission.limit(CRITICAL)
 def points_adjustment():
     if request.method == 'OPTIONS':
         return '', 204
@@ -1097,15 +1257,17 @@ def points_adjustment():
         current_points = user_response['data'][0]['points_balance']
         new_points = max(0, current_points + points)
         
+        # Positive adjustments count towards lifetime points_earned, which drives the tier
         run_query(
-            "UPDATE users SET points_balance = %s WHERE id = %s",
-            (new_points, customer_id)
+            "UPDATE users SET points_balance = %s, points_earned = COALESCE(points_earned, 0) + %s WHERE id = %s",
+            (new_points, max(0, points), customer_id)
         )
         
         run_query("""
             INSERT INTO transactions (customer_id, points, type, context, date, amount)
             VALUES (%s, %s, 'adjustment', %s, %s, %s)
         """, (customer_id, points, reason, datetime.now(UTC).isoformat(), float(points) * 0.1))
+        tier_engine.recalculate([customer_id])
         
         return jsonify({'customer': {'id': customer_id, 'points': new_points}})
     except Exception as e:
@@ -1115,6 +1277,7 @@ def points_adjustment():
 # Staff: Redeem Reward
 @app.route('/staff/redeem-reward', methods=['POST', 'OPTIONS'])
 @require_auth
+@admission.limit(CRITICAL)
 def redeem_reward():
     if request.method == 'OPTIONS':
         return '', 204
@@ -1158,6 +1321,7 @@ def redeem_reward():
 # Rewards
 @app.route('/rewards', methods=['GET', 'OPTIONS'])
 @require_auth
+@data_versions.conditional('rewards', 'redemptions')
 def get_rewards():
     if request.method == 'OPTIONS':
         return jsonify({}), 204
@@ -1196,6 +1360,7 @@ def get_rewards():
 # Dashboard: Top Rewards
 @app.route('/dashboard/top-rewards', methods=['GET', 'OPTIONS'])
 @require_auth
+@admission.limit(HEAVY)
 def top_rewards():
     if request.method == 'OPTIONS':
         return '', 204
@@ -1230,115 +1395,349 @@ def top_rewards():
 # Dashboard: Recommendations
 @app.route('/dashboard/recommendations', methods=['GET', 'OPTIONS'])
 @require_auth
+@admission.limit(HEAVY)
+@prefer_replica
 def recommendations():
     if request.method == 'OPTIONS':
         return jsonify({}), 204
     try:
-        users_response = run_query("SELECT id, name, tier FROM users")
-        orders_response = run_query("SELECT customer_id, total FROM orders")
-        ml_response = run_query("""
-            SELECT id, customer_id, clv_predicted, prediction_date 
-            FROM ml_predictions
-        """)
-        pred_rew_response = run_query("SELECT ml_prediction_id, reward_id, reason FROM pred_rew")
-        rewards_response = run_query("SELECT id, name FROM rewards")
-        
-        # Build maps (same logic)
-        customer_orders = {}
-        for order in orders_response['data']:
-            cid = order['customer_id']
-            customer_orders.setdefault(cid, []).append(order)
-            
-        customer_ml = {}
-        for ml in ml_response['data']:
-            cid = ml['customer_id']
-            customer_ml.setdefault(cid, []).append(ml)
-            
-        reward_map = {r['id']: r['name'] for r in rewards_response['data']}
-        pred_rew_map = {}
-        for pr in pred_rew_response['data']:
-            pred_rew_map[pr['ml_prediction_id']] = {
-                'reward_name': reward_map.get(pr['reward_id'], 'None'),
-                'reason': pr.get('reason', 'No reason provided')
-            }
-        
-        recommendations = []
-        for user in users_response['data']:
-            customer_id = user['id']
-            orders = customer_orders.get(customer_id, [])
-            clv = sum(float(o['total']) for o in orders)
-            
-            ml_predictions = customer_ml.get(customer_id, [])
-            predicted_clv = 0
-            ml_prediction_id = None
-            if ml_predictions:
-                latest_ml = max(ml_predictions, key=lambda x: parse_iso_datetime(x['prediction_date']) or datetime.min)
-                predicted_clv = float(latest_ml['clv_predicted'])
-                ml_prediction_id = latest_ml['id']
-            
-            pred_rew_data = pred_rew_map.get(ml_prediction_id, {'reward_name': 'None', 'reason': 'No reason provided'})
-            
-            recommendations.append({
-                'customer': customer_id,
-                'name': user['name'],
-                'tier': user['tier'],
-                'clv': f"${clv:.2f}",
-                'predictedClv': f"${predicted_clv:.2f}",
-                'recommendedReward': pred_rew_data['reward_name'],
-                'reason': pred_rew_data['reason']
-            })
-        
-        return jsonify(recommendations)
+        return Response(partitioned_json('recommendations'), mimetype='application/json')
     except Exception as e:
         logger.error(f"Recommendations error: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+# Prediction ingestion (see predictions.py): CSV body streamed into COPY, applied in batched upserts
+prediction_loader = PredictionLoader(open_connection)
+instrumentation.register_collector(prediction_loader.metrics)
+
+@app.route('/predictions/import', methods=['POST', 'OPTIONS'])
+@require_auth
+@admission.limit(HEAVY)
+def import_predictions():
+    if request.method == 'OPTIONS':
+        return jsonify({}), 204
+    try:
+        if request.mimetype != 'text/csv':
+            return jsonify({'error': 'Expected a text/csv body with a header row'}), 415
+        try:
+            return jsonify(prediction_loader.load_csv(request.stream))
+        except (ValueError, psycopg2.DataError) as e:
+            return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Prediction import error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
 # Dashboard: Segments
+def segment_summary():
+    """Summary columns maintained by the segmentation engine, once it has completed a full run; [] before that."""
+    summary_response = run_query("""
+        SELECT id, name, description, count, avg_spend, avg_points, retention_rate, color
+        FROM segments
+        WHERE rules IS NOT NULL
+          AND EXISTS (SELECT 1 FROM segmentation_state WHERE last_full_run_at IS NOT NULL)
+    """)
+    return [
+        {
+            'id': segment['id'],
+            'name': segment['name'],
+            'count': segment['count'] or 0,
+            'description': segment['description'] or f"{segment['name']} customers segment",
+            'avgSpend': float(segment['avg_spend'] or 0),
+            'avgPoints': float(segment['avg_points'] or 0),
+            'retentionRate': float(segment['retention_rate'] or 0),
+            'color': segment['color'] or ''
+        }
+        for segment in summary_response['data']
+    ]
+
+@prefer_replica
+def compute_segments():
+    summary = segment_summary()
+    if summary:
+        return summary
+
+    segments_response = run_query("SELECT id, name FROM segments")
+    user_segments_response = run_query("SELECT segment_id, customer_id FROM user_segments")
+    transactions_response = run_query("SELECT customer_id, points, amount, date FROM transactions")
+    users_response = run_query("SELECT id, points_balance FROM users")
+
+    segment_data = []
+    for segment in segments_response['data']:
+        segment_id = segment['id']
+        customer_ids = [us['customer_id'] for us in user_segments_response['data'] if us['segment_id'] == segment_id]
+        count = len(customer_ids)
+        
+        segment_transactions = [t for t in transactions_response['data'] if t['customer_id'] in customer_ids]
+        total_spend = sum(t['amount'] for t in segment_transactions if t['amount'] is not None and t['amount'] > 0)
+        total_points = sum(u['points_balance'] for u in users_response['data'] if u['id'] in customer_ids)
+        
+        avg_spend = round(total_spend / count, 2) if count > 0 else 0
+        avg_points = round(total_points / count, 2) if count > 0 else 0
+        
+        active_customers = len([
+            t for t in segment_transactions
+            if t['date'] is not None and (dt := parse_iso_datetime(t['date'])) and dt >= datetime.now(UTC) - timedelta(days=90)
+        ])
+        retention_rate = round((active_customers / count * 100) if count > 0 else 50, 2)
+        
+        segment_data.append({
+            'id': segment['id'],
+            'name': segment['name'],
+            'count': count,
+            'description': f"{segment['name']} customers segment",
+            'avgSpend': avg_spend,
+            'avgPoints': avg_points,
+            'retentionRate': retention_rate,
+            'color': ''
+        })
+    return segment_data
+
 @app.route('/dashboard/segments', methods=['GET', 'OPTIONS'])
 @require_auth
+@data_versions.conditional('segments')
+@admission.limit(snapshot_cost('segments'))
 def segments():
     if request.method == 'OPTIONS':
         return jsonify({}), 204
     try:
-        segments_response = run_query("SELECT id, name FROM segments")
-        user_segments_response = run_query("SELECT segment_id, customer_id FROM user_segments")
-        transactions_response = run_query("SELECT customer_id, points, amount, date FROM transactions")
-        users_response = run_query("SELECT id, points_balance FROM users")
-
-        segment_data = []
-        for segment in segments_response['data']:
-            segment_id = segment['id']
-            customer_ids = [us['customer_id'] for us in user_segments_response['data'] if us['segment_id'] == segment_id]
-            count = len(customer_ids)
-            
-            segment_transactions = [t for t in transactions_response['data'] if t['customer_id'] in customer_ids]
-            total_spend = sum(t['amount'] for t in segment_transactions if t['amount'] is not None and t['amount'] > 0)
-            total_points = sum(u['points_balance'] for u in users_response['data'] if u['id'] in customer_ids)
-            
-            avg_spend = round(total_spend / count, 2) if count > 0 else 0
-            avg_points = round(total_points / count, 2) if count > 0 else 0
-            
-            active_customers = len([
-                t for t in segment_transactions
-                if t['date'] is not None and (dt := parse_iso_datetime(t['date'])) and dt >= datetime.now(UTC) - timedelta(days=90)
-            ])
-            retention_rate = round((active_customers / count * 100) if count > 0 else 50, 2)
-            
-            segment_data.append({
-                'id': segment['id'],
-                'name': segment['name'],
-                'count': count,
-                'description': f"{segment['name']} customers segment",
-                'avgSpend': avg_spend,
-                'avgPoints': avg_points,
-                'retentionRate': retention_rate,
-                'color': ''
-            })
-        return jsonify(segment_data)
+        # Read on the primary, after data_versions: the summary is never older than its ETag
+        summary = segment_summary()
+        if summary:
+            return jsonify(summary)
+        # Before the first full segmentation run; computed from tables the versions do not cover
+        unversioned()
+        return jsonify(precomputed('segments', compute_segments))
     except Exception as e:
         logger.error(f"Segments error: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+# Dashboard: Cohort retention (see cohorts.py)
+retention_engine = RetentionEngine(open_connection, run_query)
+
+def compute_retention():
+    return retention_engine.matrix(RETENTION_MONTHS)
+
+def retention_cost():
+    # Other windows than the default refresh the retention cache on the request itself
+    if (request.args.get('months', type=int) or RETENTION_MONTHS) == RETENTION_MONTHS:
+        return snapshot_cost('retention')()
+    return HEAVY
+
+@app.route('/dashboard/retention', methods=['GET', 'OPTIONS'])
+@require_auth
+@admission.limit(retention_cost)
+def retention():
+    if request.method == 'OPTIONS':
+        return jsonify({}), 204
+    try:
+        months = request.args.get('months', type=int) or RETENTION_MONTHS
+        if months == RETENTION_MONTHS:
+            return jsonify(precomputed('retention', compute_retention))
+        return jsonify(retention_engine.matrix(months))
+    except Exception as e:
+        logger.error(f"Retention error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+# Dashboard: Referral graph (see referral_graph.py); served from referral_nodes, kept current by the 'referrals' job
+# and built on first use when that job has never run
+referral_graph = ReferralGraph(open_connection)
+MAX_TOP_REFERRERS = 100
+MAX_REFERRAL_TREE_DEPTH = 10
+
+@app.route('/dashboard/referrals/top', methods=['GET', 'OPTIONS'])
+@require_auth
+def top_referrers_endpoint():
+    if request.method == 'OPTIONS':
+        return jsonify({}), 204
+    try:
+        by = request.args.get('by', 'downline')
+        if by not in REFERRAL_RANKINGS:
+            return jsonify({'error': f"by must be one of {', '.join(REFERRAL_RANKINGS)}"}), 400
+        limit = min(max(request.args.get('limit', 10, type=int), 1), MAX_TOP_REFERRERS)
+        referral_graph.ensure_built()
+        return jsonify(top_referrers(run_query, by, limit))
+    except Exception as e:
+        logger.error(f"Top referrers error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/dashboard/referrals/tree/<customer_id>', methods=['GET', 'OPTIONS'])
+@require_auth
+def referral_tree_endpoint(customer_id):
+    if request.method == 'OPTIONS':
+        return jsonify({}), 204
+    try:
+        depth = min(max(request.args.get('depth', 3, type=int), 1), MAX_REFERRAL_TREE_DEPTH)
+        referral_graph.ensure_built()
+        tree = referral_tree(run_query, sanitize_input(customer_id), depth)
+        if tree is None:
+            return jsonify({'error': 'Customer has no referrals'}), 404
+        return jsonify(tree)
+    except Exception as e:
+        logger.error(f"Referral tree error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+# Background refresh jobs (see jobs.py)
+SCHEDULER_ENABLED = os.getenv('SCHEDULER_ENABLED', '0') == '1'
+PRECOMPUTED_ENABLED = os.getenv('PRECOMPUTED_ENABLED', '1') == '1'
+scheduler = JobScheduler(run_query, sleep=socketio.sleep)
+scheduler.register('kpis', compute_kpis)
+scheduler.register('additional_kpis', compute_additional_kpis)
+scheduler.register('charts', compute_charts)
+scheduler.register('segments', compute_segments)
+scheduler.register('retention', compute_retention)
+segment_engine = SegmentEngine(open_connection)
+scheduler.register('segmentation', query_cache.invalidates('segments')(segment_engine.run))
+scheduler.register('tiers', tier_engine.recalculate_all)
+campaign_engine = CampaignEngine(open_connection)
+scheduler.register('campaigns', query_cache.invalidates('campaigns')(campaign_engine.run))
+scheduler.register('referrals', referral_graph.run)
+scheduler.register('promotion_dispatch', promotion_dispatcher.resume_pending)
+
+def precomputed(name, compute):
+    if PRECOMPUTED_ENABLED:
+        payload = scheduler.get_result(name)
+        if payload is not None:
+            return payload
+    return compute()
+
+# Admin: refresh job status
+@app.route('/admin/jobs', methods=['GET', 'OPTIONS'])
+@require_auth
+def job_status():
+    if request.method == 'OPTIONS':
+        return jsonify({}), 204
+    try:
+        return jsonify(scheduler.status())
+    except Exception as e:
+        logger.error(f"Job status error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/admin/jobs/<name>/run', methods=['POST', 'OPTIONS'])
+@require_auth
+def run_job(name):
+    if request.method == 'OPTIONS':
+        return '', 204
+    if name not in scheduler.jobs:
+        return jsonify({'error': 'Job not found'}), 404
+    socketio.start_background_task(scheduler.run, name, True)
+    return jsonify({'job': name, 'status': 'started'}), 202
+
+# Event ingestion (see ingestion.py): POS events are buffered and applied in group-committed batches
+def on_events_applied(events):
+    tier_engine.recalculate({event['customer_id'] for event in events})
+
+ingestion_buffer = IngestionBuffer(open_connection, on_flush=on_events_applied)
+instrumentation.register_collector(ingestion_buffer.metrics)
+
+@app.route('/events', methods=['POST', 'OPTIONS'])
+@require_auth
+def ingest_events():
+    if request.method == 'OPTIONS':
+        return '', 204
+    try:
+        data = request.get_json(silent=True)
+        if isinstance(data, dict) and 'events' in data:
+            events = data['events']
+        elif isinstance(data, dict):
+            # Single event; the Idempotency-Key header may stand in for event_id
+            events = [dict(data, event_id=data.get('event_id') or request.headers.get('Idempotency-Key'))]
+        else:
+            events = data
+        if not isinstance(events, list) or not events:
+            return jsonify({'error': 'Expected an event object or a non-empty list of events'}), 400
+        if len(events) > MAX_BATCH_EVENTS:
+            return jsonify({'error': f'At most {MAX_BATCH_EVENTS} events per request'}), 413
+
+        ingestion_buffer.start(socketio.start_background_task)
+        try:
+            result = ingestion_buffer.submit(events)
+        except BufferFull as e:
+            response = jsonify({'error': 'Ingestion buffer is full, retry later', 'retryAfter': e.retry_after})
+            response.headers['Retry-After'] = str(e.retry_after)
+            return response, 503
+
+        status = 400 if result['invalid'] and not result['accepted'] and not result['duplicates'] else 202
+        return jsonify({
+            'accepted': len(result['accepted']),
+            'acceptedIds': result['accepted'],
+            'duplicates': result['duplicates'],
+            'invalid': result['invalid']
+        }), status
+    except Exception as e:
+        logger.error(f"Event ingestion error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/events/status', methods=['GET', 'OPTIONS'])
+@require_auth
+def ingested_event_status():
+    if request.method == 'OPTIONS':
+        return jsonify({}), 204
+    try:
+        event_ids = [event_id for event_id in request.args.get('ids', '').split(',') if event_id][:MAX_BATCH_EVENTS]
+        if not event_ids:
+            return jsonify({'error': 'ids is required'}), 400
+        return jsonify(ingestion_buffer.lookup(event_ids))
+    except Exception as e:
+        logger.error(f"Event status error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+# Change feed (see changefeed.py): outbox events written by triggers fan out to this worker's subscribers
+CHANGEFEED_ENABLED = os.getenv('CHANGEFEED_ENABLED', '0') == '1'
+# Refresh jobs whose inputs each change type touches
+CHANGE_DEPENDENT_JOBS = {
+    'balance_changed': ['kpis', 'additional_kpis', 'charts'],
+    'redemption': ['kpis', 'charts', 'segments'],
+    'order_created': ['kpis', 'additional_kpis', 'charts', 'campaigns', 'retention', 'referrals'],
+}
+
+def dependent_jobs(events):
+    return {name for event in events for name in CHANGE_DEPENDENT_JOBS.get(event['type'], [])}
+
+def invalidate_cached_results(events):
+    for name in dependent_jobs(events):
+        scheduler.invalidate(name)
+
+def refresh_aggregates(events):
+    for name in dependent_jobs(events):
+        scheduler.mark_stale(name)
+
+def broadcast_changes(events):
+    socketio.emit('changes', events, namespace='/dashboard/changes')
+
+change_feed = ChangeFeed(open_connection, sleep=socketio.sleep)
+change_feed.subscribe('cache', invalidate_cached_results)
+change_feed.subscribe('aggregates', refresh_aggregates)
+change_feed.subscribe('socketio', broadcast_changes)
+instrumentation.register_collector(change_feed.metrics)
+
+# Process startup. Importing this module opens no connections and, with
+# APP_DEFER_STARTUP=1 (set by gunicorn.conf.py for --preload), starts no
+# background tasks either: the master imports once, and each forked worker
+# calls init_worker() so it gets its own connections and task threads.
+APP_DEFER_STARTUP = os.getenv('APP_DEFER_STARTUP', '0') == '1'
+
+def start_background_workers():
+    if SCHEDULER_ENABLED:
+        scheduler.start(socketio.start_background_task)
+    if CHANGEFEED_ENABLED:
+        change_feed.start(socketio.start_background_task)
+
+def init_worker():
+    global supabase
+    # Inherited from a parent that connected before forking: drop without closing,
+    # since closing would also end the parent's session on the shared socket
+    supabase = None
+    replica_router.reset()
+    partitioned.reset()
+    start_background_workers()
+
+def create_app():
+    """App factory for gunicorn ('app:create_app()'); safe to call in a preloading master."""
+    return app
+
+if not APP_DEFER_STARTUP:
+    start_background_workers()
+
 # Catch-all route
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
@@ -0,0 +1,110 @@
+"""
+Campaign engine benchmark: seeds synthetic users and orders, replaces the
+generated campaigns with N active rule campaigns for each requested N, and
+compares
+  - CampaignEngine.run(rebuild=True): one streamed pass for all campaigns,
+    split into total time and the time spent merging participant rows,
+  - a per-campaign baseline: one aggregate query over orders per campaign,
+    i.e. the scan cost of evaluating campaigns independently (no writes).
+
+Usage:
+    BENCH_DATABASE_URL=postgresql://localhost/loyalty_bench \\
+        python benchmarks/bench_campaigns.py [--customers 100000] [--campaigns 10,50,100]
+
+BENCH_DATABASE_URL is deliberately separate from DATABASE_URL: the fixture
+schema drops and re-creates every table.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+from datetime import timedelta
+import psycopg2
+from psycopg2.extras import execute_values
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import migrate  # noqa: E402
+import synthetic  # noqa: E402
+from campaigns import CampaignEngine  # noqa: E402
+
+
+def random_rules(rng):
+    rules = {'multiplier': rng.choice([1.5, 2, 3]), 'min_amount': rng.choice([0, 25, 50])}
+    if rng.random() < 0.3:
+        rules['tiers'] = rng.sample(synthetic.TIERS, rng.randint(1, 2))
+    if rng.random() < 0.2:
+        rules['bonus_points'] = rng.choice([50, 100])
+    if rng.random() < 0.2:
+        rules['days_of_week'] = rng.sample(range(1, 8), 2)
+    return rules
+
+
+def load_campaigns(conn, count, now, seed=42):
+    rng = random.Random(seed)
+    rows = []
+    for n in range(1, count + 1):
+        start = now - timedelta(days=rng.randint(0, 180))
+        rows.append((
+            f"CMP{n}", f"Campaign {n}", 'multiplier', 'active', start.isoformat(),
+            (start + timedelta(days=rng.randint(30, 180))).isoformat(), json.dumps(random_rules(rng))
+        ))
+    with conn.cursor() as cur:
+        cur.execute("TRUNCATE campaigns, campaign_participants, campaign_state")
+        execute_values(cur, "INSERT INTO campaigns (id, name, type, status, start_date, end_date, rules) VALUES %s", rows)
+    conn.commit()
+
+
+def per_campaign_baseline(conn):
+    """
+    Evaluates each campaign's window and min_amount with its own query.
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT id, start_date, end_date, rules FROM campaigns WHERE status = 'active'")
+        campaigns = cur.fetchall()
+        start = time.perf_counter()
+        for _, start_date, end_date, rules in campaigns:
+            cur.execute("""
+                SELECT COUNT(*), SUM(total), COUNT(DISTINCT customer_id)
+                FROM orders
+                WHERE date >= %s AND date <= %s AND total >= %s
+            """, (start_date, end_date, rules.get('min_amount', 0)))
+            cur.fetchone()
+    conn.commit()
+    return (time.perf_counter() - start) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--customers', type=int, default=100_000)
+    parser.add_argument('--campaigns', default='10,50,100', help='comma-separated active campaign counts')
+    args = parser.parse_args()
+
+    database_url = os.getenv('BENCH_DATABASE_URL')
+    if not database_url:
+        print("BENCH_DATABASE_URL not set")
+        return 1
+
+    conn = psycopg2.connect(database_url)
+    synthetic.create_schema(conn)
+    now = synthetic.default_now()
+    counts = synthetic.seed_database(conn, args.customers, now=now, tables=['users', 'orders', 'campaigns'])
+    migrate.migrate(conn, [m for m in migrate.load_migrations() if m['name'] in ('campaign_engine', 'campaign_xid_cursor')])
+    print(f"Seeded {counts}")
+
+    engine = CampaignEngine(lambda: psycopg2.connect(database_url))
+    print(f"{'campaigns':>10}{'engine ms':>12}{'write ms':>12}{'events':>10}{'awards':>10}{'per-campaign ms':>17}")
+    for count in (int(n) for n in args.campaigns.split(',')):
+        load_campaigns(conn, count, now)
+        summary = engine.run(rebuild=True)
+        baseline = per_campaign_baseline(conn)
+        print(f"{count:>10}{summary['durationMs']:>12.1f}{summary['writeMs']:>12.1f}{summary['events']:>10}"
+              f"{summary['qualifying']:>10}{baseline:>17.1f}")
+    conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
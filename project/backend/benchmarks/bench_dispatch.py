@@ -0,0 +1,113 @@
+"""
+Promotion dispatch benchmark: seeds users, segments, orders and transactions,
+applies the dispatch migration, then times start() + run() of dispatch.py
+for audiences of every shape (everyone, one tier, tier + recent activity,
+one segment) and an interrupted dispatch resumed half way. Every run is
+checked against a plain COUNT of its audience and for duplicate deliveries.
+
+Usage:
+    BENCH_DATABASE_URL=postgresql://localhost/loyalty_bench \\
+        python benchmarks/bench_dispatch.py [--customers 500000] [--batch 20000]
+
+BENCH_DATABASE_URL is deliberately separate from DATABASE_URL: the fixture
+schema drops and re-creates every table.
+"""
+import os
+import sys
+import time
+import argparse
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import migrate  # noqa: E402
+import dispatch  # noqa: E402
+import synthetic  # noqa: E402
+
+AUDIENCES = [
+    ('everyone', None, None, None),
+    ('one tier', 'Gold', None, None),
+    ('tier + active 30d', 'Gold', None, 30),
+    ('one segment', None, 'SEG2', None),
+]
+
+
+def deliveries(conn, promotion_id):
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT COUNT(*), COUNT(DISTINCT customer_id) FROM promotion_deliveries WHERE promotion_id = %s
+        """, (promotion_id,))
+        total, distinct = cur.fetchone()
+    conn.commit()
+    assert total == distinct
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--customers', type=int, default=500_000)
+    parser.add_argument('--batch', type=int, default=dispatch.BATCH_SIZE)
+    args = parser.parse_args()
+
+    database_url = os.getenv('BENCH_DATABASE_URL')
+    if not database_url:
+        print("BENCH_DATABASE_URL not set")
+        return 1
+
+    conn = psycopg2.connect(database_url)
+    synthetic.create_schema(conn)
+    counts = synthetic.seed_database(conn, args.customers, tables=[
+        'users', 'orders', 'transactions', 'segments', 'user_segments', 'promotions'
+    ])
+    print(f"Seeded {counts}")
+    migrate.migrate(conn, [m for m in migrate.load_migrations() if m['name'] in ('query_indexes', 'promotion_dispatch')])
+    with conn.cursor() as cur:
+        cur.execute("ANALYZE")
+    conn.commit()
+
+    dispatcher = dispatch.PromotionDispatcher(lambda: psycopg2.connect(database_url, cursor_factory=RealDictCursor),
+                                              batch_size=args.batch)
+    failed = False
+    for n, (label, tier, segment, days) in enumerate(AUDIENCES, start=1):
+        promotion_id = f"PR{n}"
+        with conn.cursor() as cur:
+            cur.execute("""
+                UPDATE promotions SET target_tier = %s, target_segment = %s, active_within_days = %s WHERE id = %s
+            """, (tier, segment, days, promotion_id))
+        conn.commit()
+        start = time.perf_counter()
+        state = dispatcher.start(promotion_id)
+        counted = time.perf_counter() - start
+        result = dispatcher.run(promotion_id)
+        elapsed = time.perf_counter() - start
+        delivered = deliveries(conn, promotion_id)
+        ok = delivered == state['audienceSize'] == result['delivered']
+        failed = failed or not ok
+        print(f"{label:<20} {delivered:>9} deliveries  {result['batches']:>4} batches  "
+              f"{elapsed:>6.2f}s (audience count {counted:.2f}s)  {delivered / elapsed:>9.0f}/s  "
+              f"{'ok' if ok else 'MISMATCH'}")
+
+    # Interrupted half way: roll the cursor back and drop the deliveries after it, then resume
+    with conn.cursor() as cur:
+        cur.execute("SELECT id FROM users ORDER BY id OFFSET %s LIMIT 1", (args.customers // 2,))
+        middle = cur.fetchone()[0]
+        cur.execute("DELETE FROM promotion_deliveries WHERE promotion_id = 'PR1' AND customer_id > %s", (middle,))
+        cur.execute("""
+            UPDATE promotion_dispatches SET status = 'running', last_customer_id = %s WHERE promotion_id = 'PR1'
+        """, (middle,))
+    conn.commit()
+    start = time.perf_counter()
+    resumed = dispatcher.resume_pending()
+    elapsed = time.perf_counter() - start
+    delivered = deliveries(conn, 'PR1')
+    ok = delivered == args.customers
+    failed = failed or not ok
+    print(f"{'resume half way':<20} {resumed['resumed'][0]['delivered']:>9} deliveries  {elapsed:>6.2f}s  "
+          f"{'ok' if ok else 'MISMATCH'}")
+    conn.close()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
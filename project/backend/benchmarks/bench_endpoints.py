@@ -0,0 +1,206 @@
+"""
+End-to-end endpoint benchmark.
+
+Seeds a throwaway local Postgres with synthetic data at the requested scale,
+imports app.py against it and drives every route through the Flask test
+client. Reports p50/p95 latency, queries issued, response size and peak
+Python memory per route, and flags regressions against a stored baseline.
+
+Usage:
+    BENCH_DATABASE_URL=postgresql://localhost/loyalty_bench \\
+        python benchmarks/bench_endpoints.py --scale 10k [--with-indexes] [--save-baseline]
+
+    # Re-run against the already seeded database and compare
+    python benchmarks/bench_endpoints.py --scale 10k --skip-seed
+
+Exits with status 1 when any route regresses past --threshold.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+import statistics
+import psycopg2
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+import migrate  # noqa: E402
+import synthetic  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, 'results', 'baseline.json')
+
+# (name, method, path, json body)
+ROUTES = [
+    ('health', 'GET', '/health', None),
+    ('kpis', 'GET', '/dashboard/kpis', None),
+    ('additional_kpis', 'GET', '/dashboard/kpis/additional', None),
+    ('campaigns', 'GET', '/campaigns', None),
+    ('promotions', 'GET', '/promotions', None),
+    ('transactions', 'GET', '/transactions', None),
+    ('customers', 'GET', '/dashboard/customers', None),
+    ('charts', 'GET', '/dashboard/charts', None),
+    ('customer_lookup', 'GET', '/staff/customer-lookup?search=customer42@', None),
+    ('rewards', 'GET', '/rewards', None),
+    ('top_rewards', 'GET', '/dashboard/top-rewards', None),
+    ('recommendations', 'GET', '/dashboard/recommendations', None),
+    ('segments', 'GET', '/dashboard/segments', None),
+    ('points_adjustment', 'POST', '/staff/points-adjustment', {'customer_id': 'CUST0000042', 'points': 10, 'reason': 'benchmark'}),
+    ('redeem_reward', 'POST', '/staff/redeem-reward', {'customer_id': 'CUST0000042', 'reward_id': 'RW1'}),
+]
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def load_app(database_url):
+    os.environ['DATABASE_URL'] = database_url
+    import app as app_module
+    counter = {'queries': 0}
+    original_run_query = app_module.run_query
+
+    def counting_run_query(sql, params=None, *args, **kwargs):
+        counter['queries'] += 1
+        return original_run_query(sql, params, *args, **kwargs)
+
+    app_module.run_query = counting_run_query
+    return app_module, counter
+
+
+def call(client, method, path, body):
+    if method == 'POST':
+        return client.post(path, json=body)
+    return client.get(path)
+
+
+def bench_route(client, counter, method, path, body, repeat):
+    call(client, method, path, body)  # warm-up
+
+    latencies = []
+    queries = 0
+    status = None
+    size = 0
+    for _ in range(repeat):
+        counter['queries'] = 0
+        start = time.perf_counter()
+        response = call(client, method, path, body)
+        latencies.append((time.perf_counter() - start) * 1000)
+        queries = counter['queries']
+        status = response.status_code
+        size = len(response.get_data())
+
+    # Memory is measured in a separate pass so tracing overhead does not skew latency
+    tracemalloc.start()
+    call(client, method, path, body)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'status': status,
+        'p50_ms': round(statistics.median(latencies), 2),
+        'p95_ms': round(percentile(latencies, 95), 2),
+        'queries': queries,
+        'bytes': size,
+        'peak_mem_kb': round(peak / 1024, 1),
+    }
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if not previous:
+            continue
+        if current['status'] != previous['status']:
+            regressions.append(f"{name}: status {previous['status']} -> {current['status']}")
+        if current['p95_ms'] > previous['p95_ms'] * (1 + threshold) and current['p95_ms'] - previous['p95_ms'] > 1:
+            regressions.append(f"{name}: p95 {previous['p95_ms']}ms -> {current['p95_ms']}ms")
+        if current['queries'] > previous['queries']:
+            regressions.append(f"{name}: queries {previous['queries']} -> {current['queries']}")
+        if current['peak_mem_kb'] > previous['peak_mem_kb'] * (1 + threshold) and current['peak_mem_kb'] - previous['peak_mem_kb'] > 64:
+            regressions.append(f"{name}: peak memory {previous['peak_mem_kb']}KB -> {current['peak_mem_kb']}KB")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', choices=sorted(synthetic.SCALES), default='10k')
+    parser.add_argument('--customers', type=int, help='override the customer count of --scale')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--routes', help='comma-separated subset of route names')
+    parser.add_argument('--skip-seed', action='store_true', help='reuse the data already in BENCH_DATABASE_URL')
+    parser.add_argument('--with-indexes', action='store_true', help='apply ../migrations before benchmarking')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed relative p95/memory growth')
+    parser.add_argument('--output', help='write results as JSON to this path')
+    args = parser.parse_args()
+
+    database_url = os.getenv('BENCH_DATABASE_URL')
+    if not database_url:
+        print("BENCH_DATABASE_URL not set")
+        return 1
+
+    customers = args.customers or synthetic.SCALES[args.scale]
+    conn = psycopg2.connect(database_url)
+    if not args.skip_seed:
+        synthetic.create_schema(conn)
+        start = time.perf_counter()
+        counts = synthetic.seed_database(conn, customers, seed=args.seed)
+        print(f"Seeded {sum(counts.values())} rows for {customers} customers in {time.perf_counter() - start:.1f}s")
+    if args.with_indexes:
+        migrate.migrate(conn)
+    conn.close()
+
+    app_module, counter = load_app(database_url)
+    client = app_module.app.test_client()
+    selected = set(args.routes.split(',')) if args.routes else None
+
+    results = {}
+    print(f"{'route':<20}{'status':>7}{'p50 ms':>10}{'p95 ms':>10}{'queries':>9}{'bytes':>12}{'peak KB':>11}")
+    for name, method, path, body in ROUTES:
+        if selected and name not in selected:
+            continue
+        result = bench_route(client, counter, method, path, body, args.repeat)
+        results[name] = result
+        print(f"{name:<20}{result['status']:>7}{result['p50_ms']:>10}{result['p95_ms']:>10}"
+              f"{result['queries']:>9}{result['bytes']:>12}{result['peak_mem_kb']:>11}")
+
+    report = {'customers': customers, 'seed': args.seed, 'routes': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('customers') != customers:
+            print(f"Baseline was recorded at {baseline.get('customers')} customers; skipping comparison")
+            return 0
+        regressions = compare(results, baseline['routes'], args.threshold)
+        if regressions:
+            print("Regressions against baseline:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print("No regressions against baseline")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
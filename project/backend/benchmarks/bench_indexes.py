@@ -0,0 +1,109 @@
+"""
+Index benchmark: seeds a throwaway local Postgres with synthetic loyalty data
+(see synthetic.py), captures EXPLAIN (ANALYZE, BUFFERS) plans for the filters
+app.py issues, applies the migrations in ../migrations and captures the plans
+again.
+
+Usage:
+    BENCH_DATABASE_URL=postgresql://localhost/loyalty_bench python benchmarks/bench_indexes.py [--customers N]
+
+BENCH_DATABASE_URL is deliberately separate from DATABASE_URL: the fixture
+schema drops and re-creates every table.
+"""
+import os
+import sys
+import argparse
+from datetime import datetime, timedelta
+import psycopg2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import migrate  # noqa: E402
+import synthetic  # noqa: E402
+
+
+def benchmark_queries(now):
+    quarter_start = (now - timedelta(days=90)).isoformat()
+    quarter_end = now.isoformat()
+    return [
+        ('orders by quarter (kpis)',
+         "SELECT total, date, customer_id FROM orders WHERE date >= %s AND date <= %s",
+         (quarter_start, quarter_end)),
+        ('transactions by quarter (kpis)',
+         "SELECT points, type, date FROM transactions WHERE date >= %s AND date <= %s",
+         (quarter_start, quarter_end)),
+        ('ml_predictions by quarter (kpis)',
+         "SELECT clv_predicted, prediction_date FROM ml_predictions WHERE prediction_date >= %s AND prediction_date <= %s",
+         (quarter_start, quarter_end)),
+        ('campaign participant count (campaigns)',
+         "SELECT COUNT(*) as count FROM campaign_participants WHERE campaign_id = %s",
+         ('CMP7',)),
+        ('segment members (segments)',
+         "SELECT customer_id FROM user_segments WHERE segment_id = %s",
+         ('SEG3',)),
+        ('redeem transactions (rewards)',
+         "SELECT context FROM transactions WHERE type = 'redeem'",
+         None),
+        ('customer search (customer_lookup)',
+         "SELECT id, name FROM users WHERE email ILIKE %s OR phone ILIKE %s LIMIT 1",
+         ('%customer4242@%', '%customer4242@%')),
+        ('customer orders (customer_lookup)',
+         "SELECT id, total, date FROM orders WHERE customer_id = %s",
+         ('CUST0004242',)),
+        ('latest prediction (customer_lookup)',
+         "SELECT clv_predicted FROM ml_predictions WHERE customer_id = %s ORDER BY prediction_date DESC LIMIT 1",
+         ('CUST0004242',)),
+    ]
+
+
+def explain(conn, sql, params):
+    with conn.cursor() as cur:
+        cur.execute("EXPLAIN (ANALYZE, BUFFERS) " + sql, params)
+        lines = [row[0] for row in cur.fetchall()]
+    conn.commit()
+    execution = next((line for line in lines if line.startswith('Execution Time')), '')
+    return lines, execution
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--customers', type=int, default=10000)
+    parser.add_argument('--quiet', action='store_true', help='print only execution times, not full plans')
+    args = parser.parse_args()
+
+    database_url = os.getenv('BENCH_DATABASE_URL')
+    if not database_url:
+        print("BENCH_DATABASE_URL not set")
+        return 1
+
+    conn = psycopg2.connect(database_url)
+    synthetic.create_schema(conn)
+    synthetic.seed_database(conn, args.customers)
+
+    queries = benchmark_queries(datetime.now().astimezone())
+    before = {label: explain(conn, sql, params) for label, sql, params in queries}
+
+    migrate.migrate(conn)
+    with conn.cursor() as cur:
+        cur.execute("ANALYZE")
+    conn.commit()
+    after = {label: explain(conn, sql, params) for label, sql, params in queries}
+
+    for label, _, _ in queries:
+        print(f"=== {label}")
+        print(f"  before: {before[label][1]}")
+        print(f"  after:  {after[label][1]}")
+        if not args.quiet:
+            print("  -- plan before")
+            print('\n'.join('    ' + line for line in before[label][0]))
+            print("  -- plan after")
+            print('\n'.join('    ' + line for line in after[label][0]))
+
+    status = migrate.verify_indexes(conn)
+    print(f"Index verification: {sum(1 for s in status.values() if s == 'OK')}/{len(status)} OK")
+    conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
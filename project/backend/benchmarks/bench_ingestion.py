@@ -0,0 +1,131 @@
+"""
+Ingestion benchmark: applies the same stream of synthetic purchase / earn /
+redeem events
+  - one at a time, the way the staff endpoints write through run_query()
+    (balance read, balance update, transaction insert, a commit per statement),
+  - through IngestionBuffer: submit() from the caller, group-committed
+    flushes of --flush-size events on the background flusher thread,
+and reports events per second for each.
+
+Usage:
+    BENCH_DATABASE_URL=postgresql://localhost/loyalty_bench \\
+        python benchmarks/bench_ingestion.py [--customers 10000] [--events 20000] [--flush-size 1000]
+
+BENCH_DATABASE_URL is deliberately separate from DATABASE_URL: the fixture
+schema drops and re-creates every table.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import threading
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import migrate  # noqa: E402
+import synthetic  # noqa: E402
+from ingestion import IngestionBuffer, BufferFull  # noqa: E402
+
+
+def generate_events(customers, count, prefix, seed=42):
+    rng = random.Random(seed)
+    events = []
+    for n in range(count):
+        customer_id = synthetic.customer_id(rng.randint(1, customers))
+        r = rng.random()
+        if r < 0.7:
+            events.append({'event_id': f"{prefix}-{n}", 'customer_id': customer_id, 'type': 'purchase',
+                           'amount': round(rng.uniform(5, 250), 2)})
+        elif r < 0.9:
+            events.append({'event_id': f"{prefix}-{n}", 'customer_id': customer_id, 'type': 'earn', 'points': 50})
+        else:
+            events.append({'event_id': f"{prefix}-{n}", 'customer_id': customer_id, 'type': 'redeem', 'points': 100})
+    return events
+
+
+def per_event_baseline(conn, events):
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    start = time.perf_counter()
+    for event in events:
+        points = int(event['amount']) if event['type'] == 'purchase' else event['points']
+        delta = -points if event['type'] == 'redeem' else points
+        cur.execute("SELECT points_balance FROM users WHERE id = %s", (event['customer_id'],))
+        balance = cur.fetchone()['points_balance']
+        conn.commit()
+        if balance + delta < 0:
+            continue
+        cur.execute("UPDATE users SET points_balance = %s WHERE id = %s", (balance + delta, event['customer_id']))
+        conn.commit()
+        cur.execute("""
+            INSERT INTO transactions (customer_id, points, type, context, date, amount)
+            VALUES (%s, %s, %s, 'benchmark', now(), %s)
+        """, (event['customer_id'], delta, 'redeem' if delta < 0 else 'earn_points', event.get('amount', 0)))
+        conn.commit()
+    return time.perf_counter() - start
+
+
+def buffered(database_url, events, flush_size, request_size):
+    done = threading.Event()
+    buffer = IngestionBuffer(lambda: psycopg2.connect(database_url), flush_size=flush_size)
+    total = len(events)
+
+    def on_flush(applied):
+        if buffer.stats['applied'] + buffer.stats['rejected'] >= total:
+            done.set()
+    buffer.on_flush = on_flush
+
+    def start_thread(target):
+        threading.Thread(target=target, daemon=True).start()
+
+    buffer.start(start_thread)
+    start = time.perf_counter()
+    for i in range(0, total, request_size):
+        chunk = events[i:i + request_size]
+        while True:
+            try:
+                buffer.submit(chunk)
+                break
+            except BufferFull:
+                time.sleep(0.01)
+    # Rejected-only batches do not call on_flush, so poll as well
+    while not done.wait(0.05):
+        if buffer.stats['applied'] + buffer.stats['rejected'] >= total:
+            break
+    return time.perf_counter() - start, buffer.stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--customers', type=int, default=10000)
+    parser.add_argument('--events', type=int, default=20000)
+    parser.add_argument('--flush-size', type=int, default=1000)
+    parser.add_argument('--request-size', type=int, default=1, help='events per submit() call')
+    args = parser.parse_args()
+
+    database_url = os.getenv('BENCH_DATABASE_URL')
+    if not database_url:
+        print("BENCH_DATABASE_URL not set")
+        return 1
+
+    conn = psycopg2.connect(database_url)
+    synthetic.create_schema(conn)
+    synthetic.seed_database(conn, args.customers, tables=['users'])
+    migrate.migrate(conn, [m for m in migrate.load_migrations() if m['name'] == 'ingestion'])
+
+    baseline_events = generate_events(args.customers, args.events, 'baseline')
+    elapsed = per_event_baseline(conn, baseline_events)
+    print(f"{'per-event commits':<28}{len(baseline_events) / elapsed:>10.0f} events/s  ({elapsed:.2f}s)")
+
+    elapsed, stats = buffered(database_url, generate_events(args.customers, args.events, 'buffered'),
+                              args.flush_size, args.request_size)
+    print(f"{'buffered group commit':<28}{args.events / elapsed:>10.0f} events/s  ({elapsed:.2f}s, "
+          f"{stats['flushes']} flushes, {stats['applied']} applied, {stats['rejected']} rejected)")
+    conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
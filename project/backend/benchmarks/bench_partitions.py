@@ -0,0 +1,105 @@
+"""
+Partitioned compute benchmark: seeds the tables behind customers() and
+recommendations(), then times partitions.PartitionedCompute for each kernel
+inline (workers=0) and on process pools of increasing size, checking that
+every pool's merged output is byte for byte the inline run's, in customer
+id order. The speedup column only means something on a multi-core host; the
+cpu count is printed with the seed summary.
+
+The first pool call of each size includes spawning the processes and opening
+their connections; it is reported separately from the best warm run.
+
+Usage:
+    BENCH_DATABASE_URL=postgresql://localhost/loyalty_bench \\
+        python benchmarks/bench_partitions.py [--customers 100000] [--workers 1,2,4] [--partitions-per-worker 2]
+
+BENCH_DATABASE_URL is deliberately separate from DATABASE_URL: the fixture
+schema drops and re-creates every table.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from datetime import datetime, timezone
+import psycopg2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import migrate  # noqa: E402
+import partitions  # noqa: E402
+import synthetic  # noqa: E402
+
+KEYS = {'customer_activity': 'id', 'recommendations': 'customer'}
+
+
+def in_id_order(body, key):
+    ids = [item[key] for item in json.loads(body)]
+    return ids == sorted(ids)
+
+
+def timed(compute, kernel, params, dsn, repeat=3):
+    start = time.perf_counter()
+    body = compute.json_array(kernel, params, dsn=dsn)
+    first = time.perf_counter() - start
+    best = first
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        body = compute.json_array(kernel, params, dsn=dsn)
+        best = min(best, time.perf_counter() - start)
+    return first * 1000, best * 1000, body
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--customers', type=int, default=100_000)
+    parser.add_argument('--workers', default='1,2,4', help='comma-separated pool sizes')
+    parser.add_argument('--partitions-per-worker', type=int, default=2)
+    args = parser.parse_args()
+
+    database_url = os.getenv('BENCH_DATABASE_URL')
+    if not database_url:
+        print("BENCH_DATABASE_URL not set")
+        return 1
+
+    conn = psycopg2.connect(database_url)
+    synthetic.create_schema(conn)
+    counts = synthetic.seed_database(conn, args.customers, tables=[
+        'users', 'transactions', 'orders', 'rewards', 'segments', 'user_segments', 'ml_predictions', 'pred_rew'
+    ])
+    # recommendations() reads latest_predictions
+    migrate.migrate(conn, [m for m in migrate.load_migrations() if m['name'] == 'latest_predictions'])
+    with conn.cursor() as cur:
+        cur.execute("ANALYZE")
+    conn.commit()
+    conn.close()
+    print(f"Seeded {counts}  (cpus: {os.cpu_count()})")
+
+    params = {'now': datetime.now(timezone.utc)}
+    failed = False
+    for kernel, key in KEYS.items():
+        inline = partitions.PartitionedCompute(workers=0)
+        try:
+            _, inline_ms, expected = timed(inline, kernel, params, database_url)
+        finally:
+            inline.shutdown()
+        ordered = in_id_order(expected, key)
+        failed = failed or not ordered
+        print(f"{kernel:<20} inline          {inline_ms:>9.1f} ms  {len(json.loads(expected))} items  "
+              f"{'id order' if ordered else 'NOT IN ID ORDER'}")
+        for workers in [int(w) for w in args.workers.split(',') if w.strip()]:
+            pool = partitions.PartitionedCompute(workers=workers, partitions=workers * args.partitions_per_worker)
+            try:
+                cold_ms, warm_ms, body = timed(pool, kernel, params, database_url)
+            finally:
+                pool.shutdown()
+            same = body == expected
+            failed = failed or not same
+            print(f"{kernel:<20} {workers} workers/{pool.partitions:<3} {warm_ms:>9.1f} ms  "
+                  f"(first {cold_ms:.0f} ms)  speedup {inline_ms / warm_ms:.2f}x  "
+                  f"{'same output' if same else 'OUTPUT DIFFERS'}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,122 @@
+"""
+Prediction ingestion benchmark: seeds users and a prediction history, applies
+the latest-prediction and unique-date migrations, then times predictions.py
+loading a fresh CSV of one prediction per customer, the same file again
+(every row unchanged) and a re-scored copy (every row updated). After each load
+latest_predictions is checked against ranking ml_predictions directly, and
+the per-customer lookup is timed against the ORDER BY ... LIMIT 1 it replaces.
+
+Usage:
+    BENCH_DATABASE_URL=postgresql://localhost/loyalty_bench \\
+        python benchmarks/bench_predictions.py [--customers 500000] [--batch 50000]
+
+BENCH_DATABASE_URL is deliberately separate from DATABASE_URL: the fixture
+schema drops and re-creates every table.
+"""
+import io
+import os
+import sys
+import time
+import random
+import argparse
+import psycopg2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import migrate  # noqa: E402
+import predictions  # noqa: E402
+import synthetic  # noqa: E402
+
+MISMATCH_SQL = """
+    SELECT COUNT(*)
+    FROM (
+        SELECT DISTINCT ON (customer_id) customer_id, id, clv_predicted
+        FROM ml_predictions
+        WHERE customer_id IS NOT NULL
+        ORDER BY customer_id, prediction_date DESC NULLS LAST, id DESC
+    ) ranked
+    FULL JOIN latest_predictions l ON l.customer_id = ranked.customer_id
+    WHERE l.ml_prediction_id IS DISTINCT FROM ranked.id OR l.clv_predicted IS DISTINCT FROM ranked.clv_predicted
+"""
+
+LOOKUPS = [
+    ('ORDER BY ... LIMIT 1',
+     "SELECT clv_predicted FROM ml_predictions WHERE customer_id = %s ORDER BY prediction_date DESC LIMIT 1"),
+    ('latest_predictions', "SELECT clv_predicted FROM latest_predictions WHERE customer_id = %s"),
+]
+
+
+def prediction_csv(customers, seed, bump=0):
+    rng = random.Random(seed)
+    lines = ['customer_id,clv_predicted,churn_probability,prediction_date,reward_id,reason']
+    for n in range(1, customers + 1):
+        lines.append(f"{synthetic.customer_id(n)},{round(rng.uniform(0, 2000) + bump, 2)},{round(rng.random(), 4)},"
+                     f"2100-01-01T00:00:00Z,RW{rng.randint(1, synthetic.REWARD_COUNT)},Model refresh")
+    return '\n'.join(lines) + '\n'
+
+
+def mismatches(conn):
+    with conn.cursor() as cur:
+        cur.execute(MISMATCH_SQL)
+        count = cur.fetchone()[0]
+    conn.commit()
+    return count
+
+
+def time_lookups(conn, customers, samples=2000):
+    rng = random.Random(7)
+    ids = [synthetic.customer_id(rng.randint(1, customers)) for _ in range(samples)]
+    with conn.cursor() as cur:
+        for label, sql in LOOKUPS:
+            start = time.perf_counter()
+            for customer in ids:
+                cur.execute(sql, (customer,))
+                cur.fetchall()
+            elapsed = time.perf_counter() - start
+            print(f"lookup via {label:<22} {elapsed / samples * 1000:>7.3f}ms per customer")
+    conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--customers', type=int, default=500_000)
+    parser.add_argument('--batch', type=int, default=predictions.BATCH_SIZE)
+    args = parser.parse_args()
+
+    database_url = os.getenv('BENCH_DATABASE_URL')
+    if not database_url:
+        print("BENCH_DATABASE_URL not set")
+        return 1
+
+    conn = psycopg2.connect(database_url)
+    synthetic.create_schema(conn)
+    counts = synthetic.seed_database(conn, args.customers, tables=['users', 'rewards', 'ml_predictions', 'pred_rew'])
+    print(f"Seeded {counts}")
+    start = time.perf_counter()
+    migrate.migrate(conn, [m for m in migrate.load_migrations() if m['name'] in ('query_indexes', 'latest_predictions', 'prediction_unique_date')])
+    print(f"Migrations incl. latest_predictions backfill: {time.perf_counter() - start:.2f}s")
+    with conn.cursor() as cur:
+        cur.execute("ANALYZE")
+    conn.commit()
+
+    loader = predictions.PredictionLoader(lambda: psycopg2.connect(database_url), batch_size=args.batch)
+    fresh = prediction_csv(args.customers, seed=1)
+    rescored = prediction_csv(args.customers, seed=1, bump=1)
+    failed = mismatches(conn) != 0
+    for label, body, expect in [('fresh', fresh, 'inserted'), ('same file', fresh, 'unchanged'),
+                                ('re-scored', rescored, 'updated')]:
+        result = loader.load_csv(io.StringIO(body))
+        wrong = mismatches(conn)
+        ok = wrong == 0 and result[expect] == args.customers
+        failed = failed or not ok
+        print(f"{label:<10} {result['rows']:>9} rows  {result['inserted']:>9} inserted  {result['updated']:>9} updated  "
+              f"{result['batches']:>4} batches  {result['durationMs'] / 1000:>6.2f}s  "
+              f"{result['rows'] / (result['durationMs'] / 1000):>9.0f}/s  {'ok' if ok else f'MISMATCH ({wrong})'}")
+
+    time_lookups(conn, args.customers)
+    conn.close()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
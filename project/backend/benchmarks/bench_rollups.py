@@ -0,0 +1,168 @@
+"""
+Rollup benchmark: seeds orders, transactions and referrals, applies the
+daily rollup migration (which backfills the rollups), then times
+  - the 12-month points / sales series and reward popularity the way charts()
+    computed them (every transaction and order fetched and bucketed in Python)
+    against rollups.monthly_series() + reward_redemptions(),
+  - one financial quarter of KPI inputs fetched raw against
+    rollups.period_totals(),
+  - bulk inserts of new orders / transactions with the rollup triggers enabled
+    and disabled, i.e. what incremental maintenance costs writers,
+and checks the rollups still match the raw tables afterwards.
+
+Usage:
+    BENCH_DATABASE_URL=postgresql://localhost/loyalty_bench \\
+        python benchmarks/bench_rollups.py [--customers 100000] [--insert-rows 50000] [--batch 1000]
+
+BENCH_DATABASE_URL is deliberately separate from DATABASE_URL: the fixture
+schema drops and re-creates every table.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+from datetime import datetime, timedelta, timezone
+import psycopg2
+from psycopg2.extras import RealDictCursor, execute_values
+from dateutil.relativedelta import relativedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import migrate  # noqa: E402
+import rollups  # noqa: E402
+import synthetic  # noqa: E402
+from bench_tiers import make_run_query  # noqa: E402
+
+
+def raw_charts(conn, months):
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute("SELECT points, type, date, context FROM transactions")
+        transactions = cur.fetchall()
+        cur.execute("SELECT subtotal, date FROM orders")
+        orders = cur.fetchall()
+    conn.commit()
+    index = {month: i for i, month in enumerate(months)}
+    earned, redeemed, sales = [0] * len(months), [0] * len(months), [0.0] * len(months)
+    rewards = {}
+    for t in transactions:
+        i = index.get(t['date'].date().replace(day=1)) if t['date'] else None
+        if i is not None and t['type'].lower() in ('earn_points', 'welcome_bonus') and t['points'] > 0:
+            earned[i] += t['points']
+        if i is not None and t['type'].lower() == 'redeem_points' and t['points'] < 0:
+            redeemed[i] -= t['points']
+        if t['type'] == 'redeem_points' and t['context'] and t['context'].split():
+            reward_id = t['context'].split()[-1]
+            rewards[reward_id] = rewards.get(reward_id, 0) + 1
+    for o in orders:
+        i = index.get(o['date'].date().replace(day=1)) if o['date'] else None
+        if i is not None:
+            sales[i] += float(o['subtotal'] or 0)
+    return earned, redeemed, sales, rewards
+
+
+def raw_quarter(conn, start, end):
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute("SELECT total, customer_id FROM orders WHERE date >= %s AND date < %s", (start, end))
+        orders = cur.fetchall()
+        cur.execute("SELECT points FROM transactions WHERE date >= %s AND date < %s", (start, end))
+        transactions = cur.fetchall()
+        cur.execute("SELECT id FROM referrals WHERE date >= %s AND date < %s", (start, end))
+        referrals = cur.fetchall()
+    conn.commit()
+    per_customer = {}
+    for o in orders:
+        per_customer[o['customer_id']] = per_customer.get(o['customer_id'], 0) + 1
+    return {
+        'orders': len(orders),
+        'pointsEarned': sum(t['points'] for t in transactions if t['points'] > 0),
+        'referrals': len(referrals),
+        'activeCustomers': len(per_customer),
+        'repeatCustomers': sum(1 for n in per_customer.values() if n > 1),
+    }
+
+
+def timed(func, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000, result
+
+
+def insert_batches(conn, customers, rows, batch, rng):
+    now = datetime.now(timezone.utc)
+    start = time.perf_counter()
+    with conn.cursor() as cur:
+        for offset in range(0, rows, batch):
+            size = min(batch, rows - offset)
+            ids = [synthetic.customer_id(rng.randint(1, customers)) for _ in range(size)]
+            execute_values(cur, "INSERT INTO orders (customer_id, total, subtotal, date) VALUES %s", [
+                (cid, 100, 90, now - timedelta(minutes=rng.randint(0, 1440))) for cid in ids
+            ])
+            execute_values(cur, "INSERT INTO transactions (customer_id, points, type, context, date) VALUES %s", [
+                (cid, 100, 'earn_points', 'benchmark', now - timedelta(minutes=rng.randint(0, 1440))) for cid in ids
+            ])
+            conn.commit()
+    return (time.perf_counter() - start) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--customers', type=int, default=100_000)
+    parser.add_argument('--insert-rows', type=int, default=50_000, help='orders (and as many transactions) to insert')
+    parser.add_argument('--batch', type=int, default=1000, help='rows per insert statement / commit')
+    args = parser.parse_args()
+
+    database_url = os.getenv('BENCH_DATABASE_URL')
+    if not database_url:
+        print("BENCH_DATABASE_URL not set")
+        return 1
+
+    conn = psycopg2.connect(database_url)
+    synthetic.create_schema(conn)
+    counts = synthetic.seed_database(conn, args.customers, tables=['users', 'orders', 'transactions', 'referrals'])
+    print(f"Seeded {counts}")
+    start = time.perf_counter()
+    migrate.migrate(conn, [m for m in migrate.load_migrations() if m['name'] == 'daily_rollups'])
+    print(f"Migration with backfill: {time.perf_counter() - start:.1f}s")
+    run_query = make_run_query(conn)
+
+    this_month = datetime.now(timezone.utc).date().replace(day=1)
+    months = [this_month - relativedelta(months=i) for i in range(11, -1, -1)]
+    raw_ms, (earned, redeemed, sales, rewards) = timed(raw_charts, conn, months)
+    rollup_ms, series = timed(lambda: (rollups.monthly_series(run_query, months), rollups.reward_redemptions(run_query)))
+    assert [m['earned'] for m in series[0]] == earned and [m['redeemed'] for m in series[0]] == redeemed
+    assert series[1] == rewards
+    print(f"{'12-month charts series':<28} raw {raw_ms:>9.1f} ms   rollups {rollup_ms:>7.1f} ms")
+
+    quarter_start = this_month - relativedelta(months=3)
+    quarter_end = this_month - timedelta(days=1)
+    raw_ms, raw = timed(raw_quarter, conn, quarter_start, this_month)
+    rollup_ms, totals = timed(rollups.period_totals, run_query, quarter_start, quarter_end)
+    assert all(raw[key] == totals[key] for key in raw), (raw, totals)
+    print(f"{'quarter KPI inputs':<28} raw {raw_ms:>9.1f} ms   rollups {rollup_ms:>7.1f} ms")
+
+    rng = random.Random(42)
+    with conn.cursor() as cur:
+        cur.execute("ALTER TABLE orders DISABLE TRIGGER USER; ALTER TABLE transactions DISABLE TRIGGER USER")
+    conn.commit()
+    without = insert_batches(conn, args.customers, args.insert_rows, args.batch, rng)
+    with conn.cursor() as cur:
+        cur.execute("ALTER TABLE orders ENABLE TRIGGER USER; ALTER TABLE transactions ENABLE TRIGGER USER")
+    rollups.rebuild(conn)
+    with_triggers = insert_batches(conn, args.customers, args.insert_rows, args.batch, rng)
+    print(f"{'insert, triggers off':<28} {args.insert_rows / without * 1000:>13.0f} rows/s")
+    print(f"{'insert, rollup triggers':<28} {args.insert_rows / with_triggers * 1000:>13.0f} rows/s  "
+          f"({(with_triggers / without - 1) * 100:+.0f}%)")
+
+    mismatches = rollups.verify(conn, days=3)
+    print(f"verify: {len(mismatches)} mismatched days")
+    conn.close()
+    return 0 if not mismatches else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,105 @@
+"""
+Serialization benchmark: encodes a /transactions-shaped payload (Decimal
+amounts, datetime dates) with Flask's default JSON provider, the stdlib and
+orjson backends of serialization.dumps(), and the streamed encoder, then
+reports encode time and bytes on wire uncompressed, gzip and brotli.
+
+Usage:
+    python benchmarks/bench_serialization.py [--rows 200000] [--repeat 3]
+
+No database is needed.
+"""
+import os
+import sys
+import gzip
+import json
+import time
+import random
+import decimal
+import argparse
+from datetime import datetime, timedelta
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import serialization  # noqa: E402
+
+
+def build_payload(rows, seed=42):
+    rng = random.Random(seed)
+    now = datetime(2025, 1, 1).astimezone()
+    transactions = []
+    for n in range(rows):
+        amount = decimal.Decimal(f"{rng.uniform(5, 250):.2f}")
+        transactions.append({
+            'id': n,
+            'customerId': f"CUST{rng.randint(1, rows // 10 + 1):07d}",
+            'customerName': f"Customer {n}",
+            'type': 'earn_points',
+            'points': float(amount) * 0.01,
+            'amount': amount,
+            'description': 'Purchase',
+            'date': now - timedelta(minutes=n),
+            'status': 'completed'
+        })
+    return {'transactions': transactions, 'stats': {'totalTransactions': rows}}
+
+
+def stdlib_dumps(obj):
+    encoder = json.JSONEncoder(default=serialization._default, separators=(',', ':'), ensure_ascii=False)
+    return encoder.encode(obj).encode('utf-8')
+
+
+def time_encode(fn, payload, repeat):
+    best = None
+    body = b''
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body = fn(payload)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000, body
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    payload = build_payload(args.rows)
+    app = Flask(__name__)
+    flask_default = DefaultJSONProvider(app)
+
+    encoders = [
+        ('flask default', lambda obj: flask_default.dumps(obj).encode('utf-8')),
+        ('stdlib', stdlib_dumps),
+    ]
+    if serialization.orjson:
+        encoders.append(('orjson', lambda obj: serialization.orjson.dumps(
+            obj, default=serialization._default, option=serialization.orjson.OPT_NON_STR_KEYS)))
+    encoders.append(('streamed (active backend)', lambda obj: b''.join(serialization.iter_json(obj))))
+
+    print(f"{args.rows} rows, active backend: {serialization.JSON_BACKEND}")
+    print(f"{'encoder':<28}{'encode ms':>11}{'raw KB':>10}")
+    body = b''
+    with app.app_context():
+        for name, fn in encoders:
+            elapsed, body = time_encode(fn, payload, args.repeat)
+            print(f"{name:<28}{elapsed:>11.1f}{len(body) / 1024:>10.0f}")
+
+    print(f"\n{'compression':<28}{'ms':>11}{'wire KB':>10}")
+    start = time.perf_counter()
+    gz = gzip.compress(body, compresslevel=serialization.COMPRESS_LEVEL)
+    print(f"{'gzip':<28}{(time.perf_counter() - start) * 1000:>11.1f}{len(gz) / 1024:>10.0f}")
+    if serialization.brotli:
+        start = time.perf_counter()
+        br = serialization.brotli.compress(body, quality=serialization.COMPRESS_LEVEL)
+        print(f"{'brotli':<28}{(time.perf_counter() - start) * 1000:>11.1f}{len(br) / 1024:>10.0f}")
+    else:
+        print("brotli not installed")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,108 @@
+"""
+Startup benchmark: cold-starts a fresh interpreter that imports app.py, as a
+gunicorn worker without --preload would, and reports
+  - wall time from process start until the import returns,
+  - the import itself and, with --first-query, the first run_query() (which
+    now pays for the database connection),
+  - the slowest top-level imports, from python -X importtime.
+Exits non-zero when the median cold start exceeds --budget-ms, so the number
+can be tracked in CI.
+
+Usage:
+    python benchmarks/bench_startup.py [--runs 5] [--budget-ms 1500] [--first-query]
+
+Without --first-query DATABASE_URL is replaced by an address nothing listens
+on: importing the app must not need the database. --first-query uses the
+DATABASE_URL from the environment and only runs SELECT 1.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+UNREACHABLE_DATABASE_URL = 'postgresql://loyalty@127.0.0.1:9/loyalty?connect_timeout=1'
+
+PROBE = """
+import json, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+result = {'importMs': (imported - start) * 1000}
+if %(first_query)r:
+    response = app.run_query("SELECT 1 AS ok")
+    result['firstQueryMs'] = (time.perf_counter() - imported) * 1000
+    result['firstQueryError'] = response.get('error')
+print(json.dumps(result))
+"""
+
+
+def cold_start(env, first_query):
+    start = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, '-c', PROBE % {'first_query': first_query}],
+        cwd=BACKEND_DIR, env=env, capture_output=True, text=True
+    )
+    wall_ms = (time.perf_counter() - start) * 1000
+    if completed.returncode != 0:
+        raise RuntimeError(completed.stderr.strip().splitlines()[-1] if completed.stderr else 'probe failed')
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    result['wallMs'] = wall_ms
+    return result
+
+
+def slowest_imports(env, top):
+    completed = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import app'],
+        cwd=BACKEND_DIR, env=env, capture_output=True, text=True
+    )
+    imports = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        # app itself is indented by one space, its direct imports by three
+        if len(name) - len(name.lstrip()) != 3:
+            continue
+        imports.append((int(cumulative) / 1000, name.strip()))
+    return sorted(imports, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget-ms', type=float, default=float(os.getenv('STARTUP_BUDGET_MS', '1500')))
+    parser.add_argument('--first-query', action='store_true', help='also time the first query (needs DATABASE_URL)')
+    parser.add_argument('--top', type=int, default=10, help='slowest imports to list')
+    args = parser.parse_args()
+
+    env = dict(os.environ, SCHEDULER_ENABLED='0', CHANGEFEED_ENABLED='0')
+    if not args.first_query:
+        env['DATABASE_URL'] = UNREACHABLE_DATABASE_URL
+
+    results = [cold_start(env, args.first_query) for _ in range(args.runs)]
+    for label, key in (('cold start (wall)', 'wallMs'), ('import app', 'importMs'), ('first query', 'firstQueryMs')):
+        values = [r[key] for r in results if key in r]
+        if values:
+            print(f"{label:<22}median {statistics.median(values):>8.1f}ms   max {max(values):>8.1f}ms")
+    errors = {r['firstQueryError'] for r in results if r.get('firstQueryError')}
+    if errors:
+        print(f"first query failed: {errors.pop()}")
+
+    print("\nslowest imports of app.py (cumulative):")
+    for ms, name in slowest_imports(env, args.top):
+        print(f"  {ms:>8.1f}ms  {name}")
+
+    median = statistics.median(r['wallMs'] for r in results)
+    if median > args.budget_ms:
+        print(f"\nFAIL: median cold start {median:.0f}ms exceeds the {args.budget_ms:.0f}ms budget")
+        return 1
+    print(f"\nOK: median cold start {median:.0f}ms within the {args.budget_ms:.0f}ms budget")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
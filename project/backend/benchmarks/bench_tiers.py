@@ -0,0 +1,86 @@
+"""
+Tier recalculation benchmark: seeds synthetic users (random tiers, so most
+of them start in the wrong tier), then times
+  - the first full recalculate_all() pass, which moves every misplaced customer,
+  - a second full pass, which finds nothing to change,
+  - incremental recalculate([customer_id]) calls, as issued after ledger writes.
+
+Usage:
+    BENCH_DATABASE_URL=postgresql://localhost/loyalty_bench python benchmarks/bench_tiers.py [--customers 1000000]
+
+BENCH_DATABASE_URL is deliberately separate from DATABASE_URL: the fixture
+schema drops and re-creates every table.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import synthetic  # noqa: E402
+from tiers import TierEngine  # noqa: E402
+
+
+def make_run_query(conn):
+    # Same contract as app.run_query for the parts TierEngine uses
+    def run_query(sql, params=None, commit=False):
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(sql, params)
+            rows = cur.fetchall() if cur.description else []
+        conn.commit()
+        return {'data': rows, 'count': len(rows)}
+    return run_query
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--customers', type=int, default=1_000_000)
+    parser.add_argument('--incremental', type=int, default=1000, help='single-customer recalculations to time')
+    args = parser.parse_args()
+
+    database_url = os.getenv('BENCH_DATABASE_URL')
+    if not database_url:
+        print("BENCH_DATABASE_URL not set")
+        return 1
+
+    conn = psycopg2.connect(database_url)
+    synthetic.create_schema(conn)
+    start = time.perf_counter()
+    synthetic.seed_database(conn, args.customers, tables=['users'])
+    print(f"Seeded {args.customers} users in {time.perf_counter() - start:.1f}s")
+
+    events = []
+    engine = TierEngine(
+        connect=lambda: psycopg2.connect(database_url),
+        run_query=make_run_query(conn),
+        on_change=events.extend
+    )
+
+    first = engine.recalculate_all()
+    print(f"full pass (cold):   {first['durationMs']:>10.1f} ms  changed={first['changed']} "
+          f"upgrades={first['upgrades']} downgrades={first['downgrades']} events={len(events)}")
+    second = engine.recalculate_all()
+    print(f"full pass (steady): {second['durationMs']:>10.1f} ms  changed={second['changed']}")
+
+    # Move a sample of customers across a threshold, then recalculate them one by one
+    rng = random.Random(42)
+    sample = [synthetic.customer_id(rng.randint(1, args.customers)) for _ in range(args.incremental)]
+    with conn.cursor() as cur:
+        cur.execute("UPDATE users SET points_earned = points_earned + 1000 WHERE id = ANY(%s)", (sample,))
+    conn.commit()
+    changed = 0
+    start = time.perf_counter()
+    for customer_id in sample:
+        changed += len(engine.recalculate([customer_id]))
+    elapsed = (time.perf_counter() - start) * 1000
+    print(f"incremental:        {elapsed / len(sample):>10.3f} ms/customer over {len(sample)} calls, changed={changed}")
+    conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,125 @@
+-- Benchmark fixture schema, reconstructed from the columns app.py reads and writes.
+-- Only used to build throwaway local databases for the scripts in this directory.
+
+DROP TABLE IF EXISTS pred_rew, ml_predictions, user_segments, segments, campaign_participants,
+    campaigns, promotions, rewards, referrals, orders, transactions, feedback, users, schema_migrations,
+    job_runs, analytics_snapshots, segmentation_state, campaign_state,
+    ingested_events, change_events, daily_rollups, daily_points_rollup, customer_monthly_orders,
+    retention_cohorts, retention_cells, retention_months, referral_nodes, referral_graph_state,
+    daily_sketches, data_versions, promotion_dispatches, promotion_deliveries, latest_predictions,
+    change_feed_dead_letters CASCADE;
+DROP TYPE IF EXISTS rollup_order_delta, rollup_transaction_delta, rollup_referral_delta CASCADE;
+
+CREATE TABLE users (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    email TEXT,
+    phone TEXT,
+    role TEXT DEFAULT 'customer',
+    tier TEXT,
+    points_balance INTEGER DEFAULT 0,
+    points_earned INTEGER DEFAULT 0,
+    created_at TIMESTAMPTZ,
+    last_activity TIMESTAMPTZ
+);
+
+CREATE TABLE transactions (
+    id BIGSERIAL PRIMARY KEY,
+    customer_id TEXT,
+    points INTEGER,
+    type TEXT,
+    context TEXT,
+    date TIMESTAMPTZ,
+    amount NUMERIC(12, 2)
+);
+
+CREATE TABLE orders (
+    id BIGSERIAL PRIMARY KEY,
+    customer_id TEXT,
+    total NUMERIC(12, 2),
+    subtotal NUMERIC(12, 2),
+    date TIMESTAMPTZ
+);
+
+CREATE TABLE referrals (
+    id BIGSERIAL PRIMARY KEY,
+    referrer_id TEXT,
+    referee_id TEXT,
+    reward_points INTEGER,
+    date TIMESTAMPTZ,
+    status TEXT
+);
+
+CREATE TABLE feedback (
+    id BIGSERIAL PRIMARY KEY,
+    customer_id TEXT,
+    nps_score INTEGER,
+    date TIMESTAMPTZ
+);
+
+CREATE TABLE rewards (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    points_cost INTEGER
+);
+
+CREATE TABLE promotions (
+    id TEXT PRIMARY KEY,
+    title TEXT,
+    message TEXT,
+    type TEXT,
+    status TEXT,
+    sent_date TIMESTAMPTZ,
+    target_tier TEXT
+);
+
+CREATE TABLE campaigns (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    type TEXT,
+    status TEXT,
+    start_date TIMESTAMPTZ,
+    end_date TIMESTAMPTZ,
+    rules JSONB,
+    points_issued INTEGER DEFAULT 0,
+    total_revenue NUMERIC(14, 2) DEFAULT 0
+);
+
+CREATE TABLE campaign_participants (
+    id BIGSERIAL PRIMARY KEY,
+    campaign_id TEXT,
+    customer_id TEXT,
+    joined_at TIMESTAMPTZ
+);
+
+CREATE TABLE segments (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    description TEXT,
+    count INTEGER DEFAULT 0,
+    avg_spend NUMERIC(12, 2) DEFAULT 0,
+    avg_points NUMERIC(12, 2) DEFAULT 0,
+    retention_rate NUMERIC(5, 2) DEFAULT 0,
+    color TEXT,
+    rules JSONB,
+    priority INTEGER NOT NULL DEFAULT 100
+);
+
+CREATE TABLE user_segments (
+    customer_id TEXT,
+    segment_id TEXT
+);
+
+CREATE TABLE ml_predictions (
+    id BIGSERIAL PRIMARY KEY,
+    customer_id TEXT,
+    clv_predicted NUMERIC(12, 2),
+    churn_probability NUMERIC(5, 4),
+    prediction_date TIMESTAMPTZ
+);
+
+CREATE TABLE pred_rew (
+    ml_prediction_id BIGINT,
+    reward_id TEXT,
+    reason TEXT
+);
@@ -0,0 +1,255 @@
+"""
+Deterministic synthetic data generator for the loyalty schema.
+
+Every table is generated from its own random.Random(seed + offset), so the
+same (customers, seed, now) always yields the same rows regardless of which
+tables are loaded. Rows are streamed into Postgres with COPY in chunks, so
+the 1M-customer scale never holds a whole table in memory.
+"""
+import io
+import os
+import json
+import random
+from datetime import datetime, timedelta
+import pytz
+
+UTC = pytz.UTC
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema.sql')
+
+SCALES = {
+    '1k': 1_000,
+    '10k': 10_000,
+    '100k': 100_000,
+    '1m': 1_000_000,
+}
+
+# Rows generated per customer for the event tables
+TRANSACTIONS_PER_CUSTOMER = 10
+ORDERS_PER_CUSTOMER = 5
+PREDICTIONS_PER_CUSTOMER = 2
+REFERRAL_RATE = 0.2
+FEEDBACK_RATE = 0.5
+
+HISTORY_DAYS = 1825
+TIERS = ['Bronze', 'Silver', 'Gold']
+TIER_WEIGHTS = [0.6, 0.3, 0.1]
+# (id, name, color, priority, rules) - rules use the segmentation.py format
+SEGMENTS = [
+    ('SEG1', 'Champions', '#34D399', 10, {'min_rfm': 13}),
+    ('SEG2', 'At Risk', '#EF4444', 20, {'min_recency_days': 90, 'max_recency_days': 365, 'min_spend': 500}),
+    ('SEG3', 'Loyal', '#3B82F6', 30, {'min_frequency': 5}),
+    ('SEG4', 'New', '#A855F7', 40, {'max_recency_days': 90}),
+    ('SEG5', 'Hibernating', '#F59E0B', 100, {}),
+]
+REWARD_COUNT = 10
+PROMOTION_COUNT = 20
+CHUNK_ROWS = 50_000
+
+
+def customer_id(n):
+    return f"CUST{n:07d}"
+
+
+def _ts(now, rng, max_days):
+    return (now - timedelta(days=rng.random() * max_days)).isoformat()
+
+
+def campaign_count(customers):
+    return max(10, min(500, customers // 2000))
+
+
+def gen_users(customers, seed, now):
+    rng = random.Random(seed + 1)
+    for n in range(1, customers + 1):
+        tier = rng.choices(TIERS, TIER_WEIGHTS)[0]
+        earned = rng.randint(0, 5000)
+        yield (
+            customer_id(n), f"Customer {n}", f"customer{n}@example.com", f"+1555{n:07d}", 'customer',
+            tier, rng.randint(0, min(earned, 3000)), earned,
+            _ts(now, rng, HISTORY_DAYS), _ts(now, rng, 365)
+        )
+
+
+def gen_transactions(customers, seed, now):
+    rng = random.Random(seed + 2)
+    for n in range(1, customers * TRANSACTIONS_PER_CUSTOMER + 1):
+        r = rng.random()
+        cid = customer_id(rng.randint(1, customers))
+        if r < 0.75:
+            amount = round(rng.uniform(5, 250), 2)
+            row = (cid, int(amount), 'earn_points', 'Purchase', amount)
+        elif r < 0.8:
+            row = (cid, 80, 'welcome_bonus', 'Welcome bonus', 0)
+        elif r < 0.95:
+            reward = rng.randint(1, REWARD_COUNT)
+            cost = reward * 100
+            row = (cid, -cost, 'redeem', f"Redemption of reward RW{reward}", -cost * 0.1)
+        else:
+            row = (cid, rng.randint(-50, 50), 'adjustment', 'Manual adjustment', 0)
+        yield (n, row[0], row[1], row[2], row[3], _ts(now, rng, HISTORY_DAYS), row[4])
+
+
+def gen_orders(customers, seed, now):
+    rng = random.Random(seed + 3)
+    for n in range(1, customers * ORDERS_PER_CUSTOMER + 1):
+        subtotal = round(rng.uniform(5, 280), 2)
+        yield (n, customer_id(rng.randint(1, customers)), round(subtotal * 1.08, 2), subtotal, _ts(now, rng, HISTORY_DAYS))
+
+
+def gen_referrals(customers, seed, now):
+    rng = random.Random(seed + 4)
+    for n in range(1, int(customers * REFERRAL_RATE) + 1):
+        referee = rng.randint(1, customers)
+        referrer = rng.randint(1, customers)
+        status = 'completed' if rng.random() < 0.9 else 'pending'
+        yield (n, customer_id(referrer), customer_id(referee), 100, _ts(now, rng, HISTORY_DAYS), status)
+
+
+def gen_feedback(customers, seed, now):
+    rng = random.Random(seed + 5)
+    for n in range(1, int(customers * FEEDBACK_RATE) + 1):
+        yield (n, customer_id(rng.randint(1, customers)), rng.randint(0, 10), _ts(now, rng, 730))
+
+
+def gen_rewards(customers, seed, now):
+    for n in range(1, REWARD_COUNT + 1):
+        yield (f"RW{n}", f"Reward {n}", n * 100)
+
+
+def gen_promotions(customers, seed, now):
+    rng = random.Random(seed + 6)
+    for n in range(1, PROMOTION_COUNT + 1):
+        yield (
+            f"PR{n}", f"Promotion {n}", None, rng.choice(['discount', 'bonus_points', 'free_item']),
+            rng.choice(['sent', 'scheduled', 'draft']), _ts(now, rng, 180), rng.choice(TIERS + [None])
+        )
+
+
+def gen_campaigns(customers, seed, now):
+    rng = random.Random(seed + 7)
+    for n in range(1, campaign_count(customers) + 1):
+        start = now - timedelta(days=rng.randint(0, 365))
+        rules = {'multiplier': rng.choice([1.5, 2, 3]), 'min_amount': rng.choice([0, 25, 50])}
+        yield (
+            f"CMP{n}", f"Campaign {n}", rng.choice(['multiplier', 'bonus', 'tier_boost']),
+            'active' if start + timedelta(days=90) > now else 'ended',
+            start.isoformat(), (start + timedelta(days=90)).isoformat(), json.dumps(rules),
+            rng.randint(0, 100_000), round(rng.uniform(0, 250_000), 2)
+        )
+
+
+def gen_campaign_participants(customers, seed, now):
+    rng = random.Random(seed + 8)
+    campaigns = campaign_count(customers)
+    for n in range(1, customers + 1):
+        yield (n, f"CMP{rng.randint(1, campaigns)}", customer_id(rng.randint(1, customers)), _ts(now, rng, 365))
+
+
+def gen_segments(customers, seed, now):
+    for segment_id, name, color, priority, rules in SEGMENTS:
+        yield (segment_id, name, f"{name} customers", 0, 0, 0, 0, color, json.dumps(rules), priority)
+
+
+def gen_user_segments(customers, seed, now):
+    rng = random.Random(seed + 9)
+    for n in range(1, customers + 1):
+        yield (customer_id(n), rng.choice(SEGMENTS)[0])
+
+
+def gen_ml_predictions(customers, seed, now):
+    rng = random.Random(seed + 10)
+    for n in range(1, customers * PREDICTIONS_PER_CUSTOMER + 1):
+        yield (
+            n, customer_id(rng.randint(1, customers)), round(rng.uniform(0, 2000), 2),
+            round(rng.random(), 4), _ts(now, rng, 730)
+        )
+
+
+def gen_pred_rew(customers, seed, now):
+    rng = random.Random(seed + 11)
+    for n in range(1, customers * PREDICTIONS_PER_CUSTOMER + 1):
+        yield (n, f"RW{rng.randint(1, REWARD_COUNT)}", rng.choice(['High CLV', 'Churn risk', 'Frequent buyer']))
+
+
+# table -> (columns, generator, has serial id)
+TABLES = {
+    'users': (['id', 'name', 'email', 'phone', 'role', 'tier', 'points_balance', 'points_earned', 'created_at', 'last_activity'], gen_users, False),
+    'transactions': (['id', 'customer_id', 'points', 'type', 'context', 'date', 'amount'], gen_transactions, True),
+    'orders': (['id', 'customer_id', 'total', 'subtotal', 'date'], gen_orders, True),
+    'referrals': (['id', 'referrer_id', 'referee_id', 'reward_points', 'date', 'status'], gen_referrals, True),
+    'feedback': (['id', 'customer_id', 'nps_score', 'date'], gen_feedback, True),
+    'rewards': (['id', 'name', 'points_cost'], gen_rewards, False),
+    'promotions': (['id', 'title', 'message', 'type', 'status', 'sent_date', 'target_tier'], gen_promotions, False),
+    'campaigns': (['id', 'name', 'type', 'status', 'start_date', 'end_date', 'rules', 'points_issued', 'total_revenue'], gen_campaigns, False),
+    'campaign_participants': (['id', 'campaign_id', 'customer_id', 'joined_at'], gen_campaign_participants, True),
+    'segments': (['id', 'name', 'description', 'count', 'avg_spend', 'avg_points', 'retention_rate', 'color', 'rules', 'priority'], gen_segments, False),
+    'user_segments': (['customer_id', 'segment_id'], gen_user_segments, False),
+    'ml_predictions': (['id', 'customer_id', 'clv_predicted', 'churn_probability', 'prediction_date'], gen_ml_predictions, True),
+    'pred_rew': (['ml_prediction_id', 'reward_id', 'reason'], gen_pred_rew, False),
+}
+
+
+def default_now():
+    return datetime.now(UTC).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+
+def copy_rows(conn, table, columns, rows):
+    """
+    Streams an iterable of tuples into `table` with COPY, CHUNK_ROWS at a time.
+    """
+    total = 0
+    buffer = io.StringIO()
+    pending = 0
+    with conn.cursor() as cur:
+        for row in rows:
+            buffer.write('\t'.join(_copy_value(v) for v in row))
+            buffer.write('\n')
+            pending += 1
+            if pending >= CHUNK_ROWS:
+                buffer.seek(0)
+                cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
+                total += pending
+                buffer = io.StringIO()
+                pending = 0
+        if pending:
+            buffer.seek(0)
+            cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
+            total += pending
+    return total
+
+
+def create_schema(conn):
+    """
+    Drops and re-creates every fixture table from schema.sql.
+    """
+    with conn.cursor() as cur:
+        with open(SCHEMA_PATH) as f:
+            cur.execute(f.read())
+    conn.commit()
+
+
+def seed_database(conn, customers, seed=42, now=None, tables=None):
+    """
+    Loads synthetic rows for every table (or the given subset) and returns
+    {table: row_count}. Expects the tables to exist and be empty.
+    """
+    now = now or default_now()
+    counts = {}
+    for table, (columns, generator, serial) in TABLES.items():
+        if tables is not None and table not in tables:
+            continue
+        counts[table] = copy_rows(conn, table, columns, generator(customers, seed, now))
+        if serial:
+            with conn.cursor() as cur:
+                cur.execute(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), GREATEST(MAX(id), 1)) FROM {table}")
+    with conn.cursor() as cur:
+        cur.execute("ANALYZE")
+    conn.commit()
+    return counts
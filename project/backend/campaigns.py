@@ -0,0 +1,448 @@
+"""
+Campaign rules engine.
+
+Every `campaigns` row with status 'active' and a `rules` JSON object is
+compiled once per run into a predicate plus an award function. Supported
+rule keys:
+
+    multiplier                  points = base points * (multiplier - 1) on top of the base earn
+    bonus_points                flat points per qualifying event
+    min_amount / max_amount     order total or transaction amount
+    tiers                       list of tier names, e.g. ["Gold", "Silver"]
+    sources                     ["orders"] (default), ["transactions"] or both
+    transaction_types           transaction types that qualify (default ["earn_points"])
+    days_of_week                ISO weekdays that qualify, 1 = Monday .. 7 = Sunday
+
+Base points are the transaction's own points, or ORDER_POINTS_PER_UNIT per
+unit of an order total. An event also has to fall inside the campaign's
+start_date / end_date window.
+
+New orders and transactions are streamed through a server-side cursor in
+one pass for all campaigns at once. Rows are selected by the transaction
+that inserted them (created_xid, migrations/0014_campaign_xid_cursor.sql),
+like the change feed: a run reads the rows of transactions from the
+previous run's bound up to the oldest transaction still running, all of
+which have finished, so a row whose id was reserved before another row's
+but committed after it is picked up by the next run instead of skipped.
+Rows from before that migration (created_xid NULL) are read by id up to
+the highest such id. Candidate campaigns are looked up per (source, tier,
+day) and cached, so the per-event cost depends on how many campaigns can
+apply that day rather than on how many are active. Awards are accumulated
+in memory and written in batches to campaign_participants, then added to
+campaigns.points_issued / total_revenue; the cursor moves in the same
+transaction, so every event counts exactly once.
+
+A campaign created with a start_date in the past only sees events newer
+than the cursor; run with --rebuild to recompute every active campaign
+from scratch.
+
+Tables and columns are created by migrations/0004_campaign_engine.sql and
+migrations/0014_campaign_xid_cursor.sql.
+
+Usage:
+    python campaigns.py [--rebuild]
+"""
+import io
+import os
+import sys
+import json
+import time
+import decimal
+import logging
+from datetime import datetime
+import pytz
+import psycopg2
+from psycopg2.extras import RealDictCursor, execute_values
+
+logger = logging.getLogger(__name__)
+
+UTC = pytz.UTC
+BATCH_SIZE = int(os.getenv('CAMPAIGN_BATCH_SIZE', '5000'))
+# Participant rows held in memory before they are merged into campaign_participants
+FLUSH_ROWS = int(os.getenv('CAMPAIGN_FLUSH_ROWS', '50000'))
+ORDER_POINTS_PER_UNIT = float(os.getenv('ORDER_POINTS_PER_UNIT', '1'))
+
+SOURCES = ('orders', 'transactions')
+RULE_KEYS = {
+    'multiplier', 'bonus_points', 'min_amount', 'max_amount', 'tiers',
+    'sources', 'transaction_types', 'days_of_week',
+}
+
+# Event rows are plain tuples in this column order
+SOURCE, CUSTOMER, DATE, EPOCH, DAY, AMOUNT, POINTS, TYPE, TIER = range(9)
+
+ORDER_EVENTS_SQL = """
+    SELECT 'orders' AS source, o.customer_id, o.date::timestamptz, EXTRACT(EPOCH FROM o.date::timestamptz)::float8,
+           (o.date::timestamptz AT TIME ZONE 'UTC')::date,
+           o.total, NULL::integer, NULL::text, {tier}
+    FROM orders o
+    {join}
+    WHERE ((o.created_xid IS NULL AND o.id > %(orders_after)s AND o.id <= %(orders_legacy_upto)s)
+           OR (o.created_xid >= %(orders_after_xid)s::xid8 AND o.created_xid < %(xmin)s::xid8))
+      AND o.date >= %(since)s AND o.date <= %(until)s
+"""
+
+TRANSACTION_EVENTS_SQL = """
+    SELECT 'transactions' AS source, t.customer_id, t.date::timestamptz, EXTRACT(EPOCH FROM t.date::timestamptz)::float8,
+           (t.date::timestamptz AT TIME ZONE 'UTC')::date,
+           t.amount, t.points, t.type, {tier}
+    FROM transactions t
+    {join}
+    WHERE ((t.created_xid IS NULL AND t.id > %(transactions_after)s AND t.id <= %(transactions_legacy_upto)s)
+           OR (t.created_xid >= %(transactions_after_xid)s::xid8 AND t.created_xid < %(xmin)s::xid8))
+      AND t.date >= %(since)s AND t.date <= %(until)s
+      AND t.type = ANY(%(transaction_types)s)
+"""
+
+STAGE_SQL = """
+    CREATE TEMP TABLE campaign_award_stage (
+        campaign_id TEXT, customer_id TEXT, points INTEGER, revenue NUMERIC(14, 2),
+        first_event_at DOUBLE PRECISION, last_event_at DOUBLE PRECISION
+    ) ON COMMIT DROP
+"""
+
+PARTICIPANTS_SQL = """
+    INSERT INTO campaign_participants (campaign_id, customer_id, joined_at, points_awarded, revenue, last_event_at)
+    SELECT campaign_id, customer_id, to_timestamp(first_event_at), points, revenue, to_timestamp(last_event_at)
+    FROM campaign_award_stage
+    ON CONFLICT (campaign_id, customer_id) DO UPDATE
+    SET points_awarded = campaign_participants.points_awarded + EXCLUDED.points_awarded,
+        revenue = campaign_participants.revenue + EXCLUDED.revenue,
+        last_event_at = GREATEST(campaign_participants.last_event_at, EXCLUDED.last_event_at)
+"""
+
+TOTALS_SQL = """
+    UPDATE campaigns c
+    SET points_issued = COALESCE(c.points_issued, 0) + v.points,
+        total_revenue = COALESCE(c.total_revenue, 0) + v.revenue
+    FROM (VALUES %s) AS v (id, points, revenue)
+    WHERE c.id = v.id
+"""
+
+
+def _to_datetime(value):
+    if value is None or isinstance(value, datetime):
+        return value
+    try:
+        dt = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+        return dt if dt.tzinfo else dt.replace(tzinfo=UTC)
+    except ValueError:
+        return None
+
+
+def _copy_value(value):
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+
+class CompiledCampaign:
+    """
+    A campaign's window and rules turned into plain attributes, one predicate
+    over an event row and one award function.
+    """
+    __slots__ = ('id', 'start', 'end', 'sources', 'tiers', 'days', 'transaction_types', 'matches', 'award')
+
+    def __init__(self, campaign_id, start, end, rules):
+        unknown = set(rules) - RULE_KEYS
+        if unknown:
+            raise ValueError(f"Unknown campaign rule keys: {', '.join(sorted(unknown))}")
+        self.id = campaign_id
+        self.start = _to_datetime(start)
+        self.end = _to_datetime(end)
+        self.sources = frozenset(rules.get('sources') or ['orders'])
+        if not self.sources <= set(SOURCES):
+            raise ValueError(f"Unknown campaign sources: {', '.join(sorted(self.sources - set(SOURCES)))}")
+        self.tiers = frozenset(rules['tiers']) if rules.get('tiers') else None
+        self.days = frozenset(int(d) for d in rules['days_of_week']) if rules.get('days_of_week') else None
+        self.transaction_types = frozenset(rules.get('transaction_types') or ['earn_points'])
+
+        # Only the checks this campaign actually uses end up in the predicate
+        checks = []
+        if self.start is not None:
+            checks.append(lambda e, start=self.start: e[DATE] >= start)
+        if self.end is not None:
+            checks.append(lambda e, end=self.end: e[DATE] <= end)
+        if rules.get('min_amount') is not None:
+            low = decimal.Decimal(str(rules['min_amount']))
+            checks.append(lambda e: e[AMOUNT] is not None and e[AMOUNT] >= low)
+        if rules.get('max_amount') is not None:
+            high = decimal.Decimal(str(rules['max_amount']))
+            checks.append(lambda e: e[AMOUNT] is not None and e[AMOUNT] <= high)
+        if 'transactions' in self.sources:
+            # The SQL filter admits the union of every campaign's types
+            types = self.transaction_types
+            checks.append(lambda e: e[SOURCE] != 'transactions' or e[TYPE] in types)
+
+        def matches(event):
+            for check in checks:
+                if not check(event):
+                    return False
+            return True
+        self.matches = matches
+
+        multiplier = float(rules.get('multiplier') or 1)
+        bonus = int(rules.get('bonus_points') or 0)
+        self.award = lambda base: int(base * (multiplier - 1)) + bonus
+
+    def applies_on(self, source, tier, day):
+        """
+        Coarse filter used to build the candidate cache; matches() does the exact checks.
+        """
+        if source not in self.sources:
+            return False
+        if self.tiers is not None and tier not in self.tiers:
+            return False
+        if self.days is not None and day.isoweekday() not in self.days:
+            return False
+        if self.start is not None and day < self.start.astimezone(UTC).date():
+            return False
+        if self.end is not None and day > self.end.astimezone(UTC).date():
+            return False
+        return True
+
+
+def compile_campaign(row):
+    rules = row['rules'] if isinstance(row['rules'], dict) else json.loads(row['rules'])
+    return CompiledCampaign(row['id'], row['start_date'], row['end_date'], rules)
+
+
+def base_points(event):
+    if event[SOURCE] == 'transactions':
+        return max(0, event[POINTS] or 0)
+    return int(float(event[AMOUNT] or 0) * ORDER_POINTS_PER_UNIT)
+
+
+class CampaignEngine:
+    def __init__(self, connect, batch_size=BATCH_SIZE, flush_rows=FLUSH_ROWS):
+        self.connect = connect
+        self.batch_size = batch_size
+        self.flush_rows = flush_rows
+
+    def load_campaigns(self, cur):
+        cur.execute("""
+            SELECT id, rules, start_date, end_date
+            FROM campaigns
+            WHERE status = 'active' AND rules IS NOT NULL
+            ORDER BY id
+        """)
+        compiled = []
+        for row in cur.fetchall():
+            try:
+                compiled.append(compile_campaign(row))
+            except (ValueError, TypeError) as e:
+                # One bad rule object must not stop every other campaign
+                logger.error(f"Skipping campaign {row['id']}: {str(e)}")
+        return compiled
+
+    def run(self, rebuild=False):
+        """
+        Applies every order and transaction not yet seen by the cursor to the
+        active campaigns, or all of them after resetting the active
+        campaigns' totals when rebuild=True. Returns a summary dict.
+        """
+        started = time.perf_counter()
+        conn = self.connect()
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                # Serializes overlapping runs (scheduler plus CLI); released at commit
+                cur.execute("SELECT pg_advisory_xact_lock(hashtext('campaign_engine'))")
+                campaigns = self.load_campaigns(cur)
+                if not campaigns:
+                    conn.commit()
+                    return {'campaigns': 0, 'events': 0, 'qualifying': 0, 'message': 'No active campaigns have rules'}
+                if rebuild:
+                    self.reset(cur, [c.id for c in campaigns])
+                state = self.load_state(cur)
+                # Every transaction below this has committed or aborted, so nothing new can appear under it
+                cur.execute("SELECT pg_snapshot_xmin(pg_current_snapshot())::text AS xmin")
+                xmin = cur.fetchone()['xmin']
+
+            summary = self.evaluate(conn, campaigns, state, xmin)
+
+            with conn.cursor() as cur:
+                execute_values(cur, """
+                    INSERT INTO campaign_state (source, last_id, legacy_upto, last_xid, last_run_at)
+                    VALUES %s
+                    ON CONFLICT (source) DO UPDATE
+                    SET last_id = EXCLUDED.last_id, legacy_upto = EXCLUDED.legacy_upto,
+                        last_xid = EXCLUDED.last_xid, last_run_at = EXCLUDED.last_run_at
+                """, [
+                    (source, state[source]['legacy_upto'], state[source]['legacy_upto'], xmin, datetime.now(UTC))
+                    for source in SOURCES
+                ], template='(%s, %s, %s, %s::xid8, %s)')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        summary['campaigns'] = len(campaigns)
+        summary['durationMs'] = round((time.perf_counter() - started) * 1000, 2)
+        logger.info(
+            f"Campaign run: {summary['events']} events, {summary['qualifying']} awards across "
+            f"{len(campaigns)} campaigns in {summary['durationMs']}ms"
+        )
+        return summary
+
+    def reset(self, cur, campaign_ids):
+        cur.execute("UPDATE campaigns SET points_issued = 0, total_revenue = 0 WHERE id = ANY(%s)", (campaign_ids,))
+        cur.execute("""
+            UPDATE campaign_participants SET points_awarded = 0, revenue = 0, last_event_at = NULL
+            WHERE campaign_id = ANY(%s)
+        """, (campaign_ids,))
+        cur.execute("UPDATE campaign_state SET last_id = 0, last_xid = '0'")
+
+    def load_state(self, cur):
+        """
+        Per-source cursor: {source: {'last_id', 'legacy_upto', 'last_xid'}}.
+        legacy_upto is looked up once, on the first run after the created_xid
+        migration; no row can get a NULL created_xid after it.
+        """
+        cur.execute("SELECT source, last_id, legacy_upto, last_xid::text AS last_xid FROM campaign_state")
+        rows = {row['source']: row for row in cur.fetchall()}
+        state = {}
+        for source in SOURCES:
+            row = rows.get(source) or {}
+            legacy_upto = row.get('legacy_upto')
+            if legacy_upto is None:
+                cur.execute(f"SELECT COALESCE(MAX(id), 0) AS upto FROM {source} WHERE created_xid IS NULL")
+                legacy_upto = cur.fetchone()['upto']
+            state[source] = {
+                'last_id': row.get('last_id') or 0,
+                'legacy_upto': legacy_upto,
+                'last_xid': row.get('last_xid') or '0',
+            }
+        return state
+
+    def events_sql(self, campaigns, state, xmin):
+        sources = set().union(*(c.sources for c in campaigns))
+        needs_tier = any(c.tiers is not None for c in campaigns)
+        starts = [c.start for c in campaigns]
+        ends = [c.end for c in campaigns]
+        params = {
+            'xmin': xmin,
+            # Events outside every campaign's window are never read
+            'since': (datetime.min.replace(tzinfo=UTC) if None in starts else min(starts)).isoformat(),
+            'until': (datetime.max.replace(tzinfo=UTC) if None in ends else max(ends)).isoformat(),
+            'transaction_types': sorted(set().union(*(c.transaction_types for c in campaigns))),
+        }
+        for source in SOURCES:
+            params[f'{source}_after'] = state[source]['last_id']
+            params[f'{source}_legacy_upto'] = state[source]['legacy_upto']
+            params[f'{source}_after_xid'] = state[source]['last_xid']
+        parts = []
+        for source, template, alias in (('orders', ORDER_EVENTS_SQL, 'o'), ('transactions', TRANSACTION_EVENTS_SQL, 't')):
+            if source in sources:
+                parts.append(template.format(
+                    tier='u.tier' if needs_tier else 'NULL::text',
+                    join=f'LEFT JOIN users u ON u.id = {alias}.customer_id' if needs_tier else ''
+                ))
+        return ' UNION ALL '.join(parts), params
+
+    def evaluate(self, conn, campaigns, state, xmin):
+        sql, params = self.events_sql(campaigns, state, xmin)
+        candidates = {}
+        participants = {}
+        totals = {}
+        events = 0
+        qualifying = 0
+        rows_written = 0
+        self.write_seconds = 0.0
+        zero = decimal.Decimal(0)
+        with conn.cursor() as write_cur:
+            write_cur.execute(STAGE_SQL)
+            # A named (server-side) cursor streams events without loading them all at once, as plain
+            # tuples even when the connection defaults to RealDictCursor (open_connection in app.py)
+            with conn.cursor(name='campaign_events', cursor_factory=psycopg2.extensions.cursor) as cur:
+                cur.itersize = self.batch_size
+                cur.execute(sql, params)
+                for event in cur:
+                    events += 1
+                    if event[CUSTOMER] is None or event[DATE] is None:
+                        continue
+                    key = (event[SOURCE], event[TIER], event[DAY])
+                    applicable = candidates.get(key)
+                    if applicable is None:
+                        applicable = candidates[key] = [c for c in campaigns if c.applies_on(*key)]
+                    if not applicable:
+                        continue
+                    base = None
+                    revenue = event[AMOUNT] or zero
+                    for campaign in applicable:
+                        if not campaign.matches(event):
+                            continue
+                        if base is None:
+                            base = base_points(event)
+                        points = campaign.award(base)
+                        qualifying += 1
+                        total = totals.get(campaign.id)
+                        if total is None:
+                            totals[campaign.id] = [points, revenue]
+                        else:
+                            total[0] += points
+                            total[1] += revenue
+                        entry = participants.get((campaign.id, event[CUSTOMER]))
+                        if entry is None:
+                            participants[(campaign.id, event[CUSTOMER])] = [points, revenue, event[EPOCH], event[EPOCH]]
+                        else:
+                            entry[0] += points
+                            entry[1] += revenue
+                            entry[2] = min(entry[2], event[EPOCH])
+                            entry[3] = max(entry[3], event[EPOCH])
+                    if len(participants) >= self.flush_rows:
+                        rows_written += self.flush_participants(write_cur, participants)
+                        participants = {}
+            rows_written += self.flush_participants(write_cur, participants)
+            if totals:
+                execute_values(
+                    write_cur, TOTALS_SQL,
+                    [(campaign_id, points, revenue) for campaign_id, (points, revenue) in totals.items()],
+                    template='(%s, %s::integer, %s::numeric)'
+                )
+        return {
+            'events': events,
+            'qualifying': qualifying,
+            'participantRows': rows_written,
+            'writeMs': round(self.write_seconds * 1000, 2),
+            'pointsIssued': sum(points for points, _ in totals.values()),
+            'revenue': float(sum((revenue for _, revenue in totals.values()), zero)),
+        }
+
+    def flush_participants(self, cur, participants):
+        """
+        Loads a batch of per-participant awards into the stage table with COPY
+        and merges it into campaign_participants with one upsert.
+        """
+        if not participants:
+            return 0
+        started = time.perf_counter()
+        escaped = {}
+        buffer = io.StringIO()
+        for (campaign_id, customer_id), (points, revenue, first, last) in participants.items():
+            campaign_value = escaped.get(campaign_id)
+            if campaign_value is None:
+                campaign_value = escaped[campaign_id] = _copy_value(campaign_id)
+            buffer.write(f"{campaign_value}\t{_copy_value(customer_id)}\t{points}\t{revenue}\t{first!r}\t{last!r}\n")
+        buffer.seek(0)
+        cur.execute("TRUNCATE campaign_award_stage")
+        cur.copy_expert("COPY campaign_award_stage FROM STDIN", buffer)
+        cur.execute(PARTICIPANTS_SQL)
+        self.write_seconds += time.perf_counter() - started
+        return len(participants)
+
+
+def main(argv):
+    from dotenv import load_dotenv
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+    database_url = os.getenv('DATABASE_URL')
+    if not database_url:
+        logger.error("DATABASE_URL not set")
+        return 1
+    engine = CampaignEngine(lambda: psycopg2.connect(database_url))
+    print(json.dumps(engine.run(rebuild='--rebuild' in argv)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
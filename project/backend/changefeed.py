@@ -0,0 +1,251 @@
+"""
+Change feed from the change_events outbox to in-process subscribers.
+
+Triggers from migrations/0006_change_feed.sql append typed events in the
+same transaction as the write, for every writer (staff endpoints, event
+ingestion, external tools):
+
+    balance_changed   users.points_balance changed   {customer_id, old_balance, new_balance, points_earned}
+    redemption        redeem transaction inserted   {customer_id, transaction_id, points, context}
+    order_created     order inserted                {customer_id, order_id, total}
+
+Each worker process runs one ChangeFeed on a dedicated connection that
+LISTENs on 'loyalty_changes' and polls the outbox when notified, or every
+CHANGEFEED_POLL_SECONDS when notifications are unavailable (e.g. behind a
+transaction-pooling proxy). Rows are read in (txid, id) order and only
+below the oldest still-running transaction, so an event from a transaction
+that commits late is never skipped by the cursor.
+
+Subscribers receive lists of events in that order. A subscriber that
+raises is retried with backoff up to CHANGEFEED_MAX_ATTEMPTS times; after
+that the batch is written to change_feed_dead_letters
+(migrations/0016_change_feed_dead_letters.sql) and the cursor moves on, so
+one failing subscriber does not hold up the others. The feed retries its
+own dead letters every CHANGEFEED_DEAD_LETTER_RETRY_SECONDS until the
+subscriber accepts them, which delivers those events late and out of order.
+
+Delivery is per worker process, not at-least-once: a worker that restarts
+resumes from the events committed after it started, and the dead letters
+of a worker that exited stay in the table for inspection without being
+redelivered. If the cursor cannot be saved past a batch (the connection
+drops mid-delivery), the batch is delivered again, so subscribers must
+tolerate repeats.
+"""
+import os
+import time
+import socket
+import select
+import logging
+import threading
+import psycopg2
+from psycopg2.extras import RealDictCursor, Json
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'loyalty_changes'
+POLL_SECONDS = float(os.getenv('CHANGEFEED_POLL_SECONDS', '2'))
+BATCH_SIZE = int(os.getenv('CHANGEFEED_BATCH_SIZE', '500'))
+MAX_ATTEMPTS = int(os.getenv('CHANGEFEED_MAX_ATTEMPTS', '5'))
+RETENTION_HOURS = float(os.getenv('CHANGEFEED_RETENTION_HOURS', '24'))
+DEAD_LETTER_RETRY_SECONDS = float(os.getenv('CHANGEFEED_DEAD_LETTER_RETRY_SECONDS', '60'))
+PRUNE_EVERY_SECONDS = 600
+RECONNECT_MAX_SECONDS = 30.0
+
+POLL_SQL = """
+    SELECT id, txid::text AS txid, type, entity_id, payload, created_at
+    FROM change_events
+    WHERE (txid, id) > (%(txid)s::xid8, %(id)s)
+      AND txid < pg_snapshot_xmin(pg_current_snapshot())
+    ORDER BY txid, id
+    LIMIT %(limit)s
+"""
+
+DEAD_LETTER_SQL = """
+    INSERT INTO change_feed_dead_letters (subscriber, worker, first_event_id, last_event_id, events, error, attempts)
+    VALUES (%s, %s, %s, %s, %s, %s, %s)
+"""
+
+
+class ChangeFeed:
+    def __init__(self, connect, sleep=time.sleep, poll_seconds=POLL_SECONDS, batch_size=BATCH_SIZE):
+        self.connect = connect
+        self.sleep = sleep
+        self.poll_seconds = poll_seconds
+        self.batch_size = batch_size
+        self.subscribers = []
+        self.cursor = None
+        self._lock = threading.Lock()
+        self._started = False
+        self._last_prune = 0.0
+        self._last_dead_letter_retry = 0.0
+        self.worker = None
+        self.stats = {
+            'polls': 0, 'events': 0, 'delivered': 0, 'dead_lettered': 0, 'redelivered': 0, 'errors': 0,
+            'lag_seconds': 0.0,
+        }
+
+    def subscribe(self, name, callback, types=None):
+        """
+        Registers callback(events) for the given event types (all when None).
+        Subscribers run in registration order on the feed's thread.
+        """
+        self.subscribers.append({'name': name, 'callback': callback, 'types': frozenset(types) if types else None})
+
+    def start(self, start_background_task):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        logger.info(f"Starting change feed with subscribers: {', '.join(s['name'] for s in self.subscribers)}")
+        start_background_task(self.run_forever)
+
+    def run_forever(self):
+        delay = 1.0
+        while True:
+            try:
+                self.listen()
+            except Exception as e:
+                self.stats['errors'] += 1
+                logger.error(f"Change feed connection failed, reconnecting in {delay:.0f}s: {str(e)}")
+                self.sleep(delay)
+                delay = min(RECONNECT_MAX_SECONDS, delay * 2)
+            else:
+                delay = 1.0
+
+    def listen(self):
+        if self.worker is None:
+            # Resolved on the feed's thread, i.e. after a preloading master has forked
+            self.worker = f"{socket.gethostname()}:{os.getpid()}"
+        conn = self.connect()
+        conn.autocommit = True
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(f"LISTEN {CHANNEL}")
+                if self.cursor is None:
+                    # Start with events committed from now on
+                    cur.execute("SELECT pg_snapshot_xmin(pg_current_snapshot())::text AS xmin")
+                    self.cursor = (cur.fetchone()['xmin'], 0)
+            while True:
+                while self.poll(conn) == self.batch_size:
+                    pass
+                self.retry_dead_letters(conn)
+                self.prune(conn)
+                # Wake on NOTIFY, or poll anyway after poll_seconds
+                if select.select([conn], [], [], self.poll_seconds) != ([], [], []):
+                    conn.poll()
+                    conn.notifies.clear()
+        finally:
+            conn.close()
+
+    def poll(self, conn):
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(POLL_SQL, {'txid': self.cursor[0], 'id': self.cursor[1], 'limit': self.batch_size})
+            rows = cur.fetchall()
+        self.stats['polls'] += 1
+        if not rows:
+            return 0
+        events = [
+            {
+                'id': row['id'],
+                'type': row['type'],
+                'entityId': row['entity_id'],
+                'payload': row['payload'],
+                'createdAt': row['created_at'].isoformat(),
+            }
+            for row in rows
+        ]
+        self.deliver(conn, events)
+        self.cursor = (rows[-1]['txid'], rows[-1]['id'])
+        self.stats['events'] += len(events)
+        self.stats['lag_seconds'] = max(0.0, time.time() - rows[-1]['created_at'].timestamp())
+        return len(rows)
+
+    def deliver(self, conn, events):
+        for subscriber in self.subscribers:
+            selected = events if subscriber['types'] is None else [e for e in events if e['type'] in subscriber['types']]
+            if not selected:
+                continue
+            for attempt in range(1, MAX_ATTEMPTS + 1):
+                try:
+                    subscriber['callback'](selected)
+                    self.stats['delivered'] += len(selected)
+                    break
+                except Exception as e:
+                    if attempt == MAX_ATTEMPTS:
+                        # Raises if the row cannot be written, so the cursor stays and the batch is read again
+                        with conn.cursor() as cur:
+                            cur.execute(DEAD_LETTER_SQL, (
+                                subscriber['name'], self.worker, selected[0]['id'], selected[-1]['id'],
+                                Json(selected), str(e), attempt
+                            ))
+                        self.stats['dead_lettered'] += len(selected)
+                        logger.error(
+                            f"Change feed subscriber {subscriber['name']} failed {attempt} times, dead-lettering "
+                            f"events {selected[0]['id']}..{selected[-1]['id']}: {str(e)}"
+                        )
+                    else:
+                        self.sleep(min(RECONNECT_MAX_SECONDS, 0.1 * 2 ** attempt))
+
+    def retry_dead_letters(self, conn):
+        """Hands this worker's dead letters back to their subscribers, oldest first, once each."""
+        if time.monotonic() - self._last_dead_letter_retry < DEAD_LETTER_RETRY_SECONDS:
+            return
+        self._last_dead_letter_retry = time.monotonic()
+        callbacks = {subscriber['name']: subscriber['callback'] for subscriber in self.subscribers}
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(
+                "SELECT id, subscriber, events FROM change_feed_dead_letters WHERE worker = %s ORDER BY id LIMIT %s",
+                (self.worker, self.batch_size)
+            )
+            letters = cur.fetchall()
+            for letter in letters:
+                callback = callbacks.get(letter['subscriber'])
+                if callback is None:
+                    continue
+                try:
+                    callback(letter['events'])
+                except Exception as e:
+                    cur.execute("""
+                        UPDATE change_feed_dead_letters
+                        SET attempts = attempts + 1, error = %s, retried_at = clock_timestamp()
+                        WHERE id = %s
+                    """, (str(e), letter['id']))
+                    continue
+                cur.execute("DELETE FROM change_feed_dead_letters WHERE id = %s", (letter['id'],))
+                self.stats['redelivered'] += len(letter['events'])
+                logger.info(f"Change feed subscriber {letter['subscriber']} accepted dead letter {letter['id']}")
+
+    def prune(self, conn):
+        if time.monotonic() - self._last_prune < PRUNE_EVERY_SECONDS:
+            return
+        self._last_prune = time.monotonic()
+        with conn.cursor() as cur:
+            cur.execute(
+                "DELETE FROM change_events WHERE created_at < clock_timestamp() - %s * interval '1 hour'",
+                (RETENTION_HOURS,)
+            )
+            if cur.rowcount:
+                logger.info(f"Pruned {cur.rowcount} change events older than {RETENTION_HOURS}h")
+
+    def metrics(self):
+        stats = dict(self.stats)
+        return [
+            ('loyalty_changefeed_events_total', 'counter', 'Change events read from the outbox.', [({}, stats['events'])]),
+            ('loyalty_changefeed_deliveries_total', 'counter', 'Change events handed to subscribers, by result.', [
+                ({'result': 'delivered'}, stats['delivered']), ({'result': 'dead_lettered'}, stats['dead_lettered']),
+                ({'result': 'redelivered'}, stats['redelivered']),
+            ]),
+            ('loyalty_changefeed_errors_total', 'counter', 'Change feed connection failures.', [({}, stats['errors'])]),
+            ('loyalty_changefeed_lag_seconds', 'gauge', 'Age of the newest delivered change event when it was read.',
+             [({}, f"{stats['lag_seconds']:.3f}")]),
+        ]
+
+
+if __name__ == '__main__':
+    # Prints the feed, e.g. to watch triggers while testing against a local database
+    from dotenv import load_dotenv
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+    feed = ChangeFeed(lambda: psycopg2.connect(os.getenv('DATABASE_URL')))
+    feed.subscribe('print', lambda events: [print(event) for event in events])
+    feed.run_forever()
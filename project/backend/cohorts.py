@@ -0,0 +1,247 @@
+"""
+Cohort retention engine.
+
+Customers are grouped by signup month (users.created_at, UTC). Month-N
+retention of a cohort is the share of its customers with at least one order
+or transaction in the Nth calendar month after signup; month 0 is the signup
+month itself. The matrix is a triangle: a cohort has one cell per month from
+its signup month up to the current month.
+
+Each month's cells come from one set-based query over that month's activity
+(customer_monthly_orders from the daily rollups, plus the month's slice of
+transactions), deduplicated and grouped by cohort inside Postgres, so the
+work per month is bounded by that month's rows and only one row per cohort
+reaches Python, however many customers there are. Closed months and the sizes
+of closed cohorts are cached in retention_cells / retention_cohorts; a cached
+month is recomputed when its order or transaction count in the daily rollups
+no longer matches the count recorded with it (backdated or deleted activity).
+Only the current month's column and cohort are computed per request.
+
+Tables are created by migrations/0008_cohort_retention.sql.
+
+Usage:
+    python cohorts.py [--months 12] [--rebuild]
+"""
+import os
+import sys
+import json
+import time
+import logging
+from datetime import datetime
+from dateutil.relativedelta import relativedelta
+import pytz
+import psycopg2
+from psycopg2.extras import RealDictCursor, execute_values
+
+logger = logging.getLogger(__name__)
+
+UTC = pytz.UTC
+DEFAULT_MONTHS = int(os.getenv('RETENTION_MONTHS', '12'))
+MAX_MONTHS = int(os.getenv('RETENTION_MAX_MONTHS', '36'))
+
+# Customers of each cohort active in the month starting %(month)s
+ACTIVE_SQL = """
+    SELECT date_trunc('month', u.created_at AT TIME ZONE 'UTC')::date AS cohort, COUNT(*) AS active
+    FROM (
+        SELECT customer_id
+        FROM customer_monthly_orders
+        WHERE month = %(month)s AND orders > 0
+        UNION
+        SELECT customer_id
+        FROM transactions
+        WHERE date >= %(month)s::date::timestamp AT TIME ZONE 'UTC' AND date < %(next)s::date::timestamp AT TIME ZONE 'UTC'
+    ) a
+    JOIN users u ON u.id = a.customer_id
+    WHERE u.created_at < %(next)s::date::timestamp AT TIME ZONE 'UTC'
+    GROUP BY 1
+"""
+
+COHORT_SIZES_SQL = """
+    SELECT date_trunc('month', created_at AT TIME ZONE 'UTC')::date AS cohort, COUNT(*) AS customers
+    FROM users
+    WHERE created_at >= %(start)s::date::timestamp AT TIME ZONE 'UTC' AND created_at < %(end)s::date::timestamp AT TIME ZONE 'UTC'
+    GROUP BY 1
+"""
+
+# Current activity counts per month, compared with the counts stored when the month was cached
+MONTH_COUNTS_SQL = """
+    SELECT month, SUM(orders)::bigint AS orders, SUM(transactions)::bigint AS transactions
+    FROM (
+        SELECT date_trunc('month', day)::date AS month, orders, 0 AS transactions
+        FROM daily_rollups
+        WHERE day >= %(start)s AND day < %(end)s
+        UNION ALL
+        SELECT date_trunc('month', day)::date, 0, transactions
+        FROM daily_points_rollup
+        WHERE day >= %(start)s AND day < %(end)s
+    ) s
+    GROUP BY month
+"""
+
+CACHED_CELLS_SQL = """
+    SELECT cohort, month, active
+    FROM retention_cells
+    WHERE cohort >= %(start)s AND month >= %(start)s AND month < %(end)s
+"""
+
+UPSERT_CELLS_SQL = """
+    INSERT INTO retention_cells (cohort, month, active) VALUES %s
+    ON CONFLICT (month, cohort) DO UPDATE SET active = EXCLUDED.active
+"""
+
+UPSERT_COHORTS_SQL = """
+    INSERT INTO retention_cohorts (cohort, customers, computed_at) VALUES %s
+    ON CONFLICT (cohort) DO UPDATE SET customers = EXCLUDED.customers, computed_at = EXCLUDED.computed_at
+"""
+
+
+def month_start(value):
+    return value.date().replace(day=1) if isinstance(value, datetime) else value.replace(day=1)
+
+
+def months_between(first, last):
+    return (last.year - first.year) * 12 + last.month - first.month
+
+
+def window(months, now=None):
+    """First-of-month dates of the last `months` months, oldest first, ending with the current one."""
+    current = month_start(now or datetime.now(UTC))
+    return [current - relativedelta(months=i) for i in range(months - 1, -1, -1)]
+
+
+class RetentionEngine:
+    def __init__(self, connect, run_query, max_months=MAX_MONTHS):
+        self.connect = connect
+        self.run_query = run_query
+        self.max_months = max_months
+
+    def refresh(self, months=DEFAULT_MONTHS, now=None, rebuild=False):
+        """
+        Caches every closed month and closed cohort in the window that is
+        missing or stale (everything when rebuild is set). Each month commits
+        on its own, so an interrupted refresh keeps its progress.
+        """
+        started = time.perf_counter()
+        calendar = window(min(months, self.max_months), now)
+        closed, first, current = calendar[:-1], calendar[0], calendar[-1]
+        refreshed = []
+        conn = self.connect()
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(MONTH_COUNTS_SQL, {'start': first, 'end': current})
+                counts = {row['month']: (row['orders'], row['transactions']) for row in cur.fetchall()}
+                cur.execute("SELECT month, orders, transactions FROM retention_months WHERE month >= %s", (first,))
+                cached = {row['month']: (row['orders'], row['transactions']) for row in cur.fetchall()}
+                cur.execute("SELECT cohort FROM retention_cohorts WHERE cohort >= %s", (first,))
+                cached_cohorts = {row['cohort'] for row in cur.fetchall()}
+            conn.commit()
+
+            for month in closed:
+                expected = counts.get(month, (0, 0))
+                if not rebuild and cached.get(month) == expected:
+                    continue
+                self.compute_month(conn, month, expected)
+                refreshed.append(month)
+
+            missing = [cohort for cohort in closed if rebuild or cohort not in cached_cohorts]
+            if missing:
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    cur.execute(COHORT_SIZES_SQL, {'start': missing[0], 'end': current})
+                    sizes = {row['cohort']: row['customers'] for row in cur.fetchall()}
+                    computed_at = datetime.now(UTC)
+                    execute_values(cur, UPSERT_COHORTS_SQL, [
+                        (cohort, sizes.get(cohort, 0), computed_at) for cohort in missing
+                    ])
+                conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        duration_ms = round((time.perf_counter() - started) * 1000, 2)
+        if refreshed or missing:
+            logger.info(f"Retention refresh: {len(refreshed)} months, {len(missing)} cohorts in {duration_ms}ms")
+        return {
+            'months': [month.isoformat() for month in refreshed],
+            'cohorts': len(missing),
+            'durationMs': duration_ms,
+        }
+
+    def compute_month(self, conn, month, counts):
+        params = {'month': month, 'next': month + relativedelta(months=1)}
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(ACTIVE_SQL, params)
+            rows = [(row['cohort'], month, row['active']) for row in cur.fetchall()]
+            # Cohorts that lost all of their activity in the month since it was cached
+            cur.execute("DELETE FROM retention_cells WHERE month = %s", (month,))
+            if rows:
+                execute_values(cur, UPSERT_CELLS_SQL, rows)
+            cur.execute("""
+                INSERT INTO retention_months (month, orders, transactions, computed_at) VALUES (%s, %s, %s, now())
+                ON CONFLICT (month) DO UPDATE
+                SET orders = EXCLUDED.orders, transactions = EXCLUDED.transactions, computed_at = EXCLUDED.computed_at
+            """, (month, counts[0], counts[1]))
+        conn.commit()
+
+    def _query(self, sql, params):
+        response = self.run_query(sql, params)
+        if 'error' in response:
+            raise RuntimeError(f"Retention query failed: {response['error']}")
+        return response['data']
+
+    def matrix(self, months=DEFAULT_MONTHS, now=None):
+        """
+        Retention triangle for the cohorts of the last `months` months,
+        oldest first. active[n] / retention[n] are month-N counts and
+        percentages of the cohort's customers.
+        """
+        months = max(1, min(months, self.max_months))
+        self.refresh(months, now)
+        calendar = window(months, now)
+        first, current = calendar[0], calendar[-1]
+        following = current + relativedelta(months=1)
+
+        active = {}
+        for row in self._query(CACHED_CELLS_SQL, {'start': first, 'end': current}):
+            active[(row['cohort'], row['month'])] = row['active']
+        for row in self._query(ACTIVE_SQL, {'month': current, 'next': following}):
+            active[(row['cohort'], current)] = row['active']
+
+        sizes = {
+            row['cohort']: row['customers']
+            for row in self._query("SELECT cohort, customers FROM retention_cohorts WHERE cohort >= %s AND cohort < %s", (first, current))
+        }
+        for row in self._query(COHORT_SIZES_SQL, {'start': current, 'end': following}):
+            sizes[row['cohort']] = row['customers']
+
+        cohorts = []
+        for cohort in calendar:
+            customers = sizes.get(cohort, 0)
+            counts = [active.get((cohort, cohort + relativedelta(months=n)), 0) for n in range(months_between(cohort, current) + 1)]
+            cohorts.append({
+                'cohort': cohort.strftime('%Y-%m'),
+                'label': cohort.strftime('%b %Y'),
+                'customers': customers,
+                'active': counts,
+                'retention': [round(count / customers * 100, 2) if customers else 0 for count in counts],
+            })
+        return {'months': months, 'currentMonth': current.strftime('%Y-%m'), 'cohorts': cohorts}
+
+
+def main(argv):
+    from dotenv import load_dotenv
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+    database_url = os.getenv('DATABASE_URL')
+    if not database_url:
+        logger.error("DATABASE_URL not set")
+        return 1
+    months = int(argv[argv.index('--months') + 1]) if '--months' in argv else DEFAULT_MONTHS
+    engine = RetentionEngine(lambda: psycopg2.connect(database_url), run_query=None, max_months=max(months, MAX_MONTHS))
+    print(json.dumps(engine.refresh(months, rebuild='--rebuild' in argv)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,125 @@
+"""
+Conditional GET (ETag / Last-Modified) from data versions.
+
+migrations/0011_data_versions.sql keeps one change counter per data set in
+data_versions, bumped by triggers in the same transaction as every write
+(rewards, campaigns, campaign_participants, promotions, segments, and
+'redemptions' for redeem transactions). An endpoint decorated with
+@data_versions.conditional(*names) reads those counters - one primary-key
+lookup - before running the view:
+
+  * the ETag is a hash of the endpoint, its query string and the counters,
+    so it is the same in every worker and changes with any write;
+  * Last-Modified is the newest changed_at among them;
+  * a request whose If-None-Match matches (or, without If-None-Match, whose
+    If-Modified-Since is not older than Last-Modified) gets 304 and the view,
+    with all its queries, never runs.
+
+Versions are read before the view computes its body, so a write that lands
+in between can only make the body newer than its tag, never older. For the
+same reason views must read these tables on the primary, and a version this
+process has not seen yet is passed to on_change first (the app drops the
+table from the reference-table query cache, which otherwise only learns of
+other workers' writes when its entries expire). ETags are
+weak because responses may be compressed differently per client. Responses
+carry Cache-Control: private, no-cache, so browsers revalidate every time
+instead of guessing a freshness lifetime from Last-Modified. If the
+counters cannot be read, or the view calls unversioned() because this body
+came from somewhere the counters do not cover, the response carries no
+validators.
+Set CONDITIONAL_GET_ENABLED=0 to turn it off.
+"""
+import os
+import hashlib
+import logging
+import threading
+from functools import wraps
+from flask import Response, g, make_response, request
+
+logger = logging.getLogger(__name__)
+
+CONDITIONAL_GET_ENABLED = os.getenv('CONDITIONAL_GET_ENABLED', '1') == '1'
+CACHE_CONTROL = 'private, no-cache'
+
+VERSIONS_SQL = "SELECT name, version, changed_at FROM data_versions WHERE name = ANY(%s)"
+
+
+def unversioned():
+    """Called by a conditional view whose body does not derive from its data versions."""
+    g.unversioned = True
+
+
+class DataVersions:
+    def __init__(self, run_query, on_change=None, enabled=CONDITIONAL_GET_ENABLED):
+        self.run_query = run_query
+        self.on_change = on_change
+        self.enabled = enabled
+        self._seen = {}
+        self._lock = threading.Lock()
+        self.stats = {'not_modified': 0, 'full': 0, 'unversioned': 0}
+
+    def validators(self, names):
+        """(etag, last_modified) for the current versions of names, or None when unavailable."""
+        response = self.run_query(VERSIONS_SQL, (list(names),))
+        rows = {row['name']: row for row in response['data']}
+        if 'error' in response or len(rows) != len(names):
+            return None
+        with self._lock:
+            changed = [name for name in names if self._seen.get(name) != rows[name]['version']]
+            self._seen.update((name, rows[name]['version']) for name in changed)
+        if changed and self.on_change:
+            self.on_change(*changed)
+        digest = hashlib.blake2b(digest_size=12)
+        digest.update(f"{request.endpoint}?{request.query_string.decode('latin-1')}".encode())
+        for name in sorted(names):
+            digest.update(f"|{name}={rows[name]['version']}".encode())
+        last_modified = max(row['changed_at'] for row in rows.values()).replace(microsecond=0)
+        return digest.hexdigest(), last_modified
+
+    def _count(self, result):
+        with self._lock:
+            self.stats[result] += 1
+
+    def _not_modified(self, etag, last_modified):
+        if request.if_none_match:
+            return request.if_none_match.contains_weak(etag)
+        return request.if_modified_since is not None and last_modified <= request.if_modified_since
+
+    def conditional(self, *names):
+        """Decorator answering GETs of the wrapped view with 304 while names are unchanged."""
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled or request.method != 'GET':
+                    return func(*args, **kwargs)
+                validators = self.validators(names)
+                if validators is None:
+                    self._count('unversioned')
+                    return func(*args, **kwargs)
+                etag, last_modified = validators
+                if self._not_modified(etag, last_modified):
+                    self._count('not_modified')
+                    response = Response(status=304)
+                else:
+                    response = make_response(func(*args, **kwargs))
+                    if g.pop('unversioned', False):
+                        self._count('unversioned')
+                        return response
+                    if response.status_code != 200:
+                        return response
+                    self._count('full')
+                response.set_etag(etag, weak=True)
+                response.last_modified = last_modified
+                response.headers['Cache-Control'] = CACHE_CONTROL
+                return response
+            return wrapper
+        return decorator
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self.stats)
+        return [
+            ('loyalty_conditional_get_total', 'counter', 'Versioned GETs, by result.', [
+                ({'result': result}, count) for result, count in stats.items()
+            ]),
+        ]
@@ -0,0 +1,289 @@
+"""
+Promotion dispatch: resolves a promotion's audience and records one delivery
+per matching customer.
+
+The audience is every user matching all of the promotion's criteria that are
+set: target_tier (users.tier), target_segment (segment id or name, through
+user_segments) and active_within_days (an order or transaction that recent).
+start() freezes those criteria in promotion_dispatches - recency as an
+absolute timestamp - and counts the audience once; run() then walks users in
+id order, DISPATCH_BATCH_SIZE ids at a time, with one statement per batch:
+
+    WITH batch AS (SELECT id FROM users WHERE id > <cursor> AND <audience> ORDER BY id LIMIT n)
+    INSERT INTO promotion_deliveries SELECT ... FROM batch ON CONFLICT DO NOTHING
+
+so customer ids never leave the database and memory use does not depend on
+the audience size. Each batch commits together with the new cursor and the
+delivered count, which is the progress status() reports. A run that stops
+(crash, deploy, database error) resumes from the last committed cursor on
+the next start() or on the scheduler's resume_pending(); the delivery
+primary key makes replaying a batch harmless. start(rerun=True) walks the
+audience again with fresh criteria and only adds customers not delivered yet.
+
+One run per promotion at a time: run() holds a session advisory lock on its
+own connection and returns immediately when another process has it.
+
+Tables are created by migrations/0012_promotion_dispatch.sql.
+
+Usage:
+    python dispatch.py <promotion_id> [--rerun]
+"""
+import os
+import sys
+import json
+import time
+import logging
+from datetime import datetime, timedelta
+import pytz
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+logger = logging.getLogger(__name__)
+
+UTC = pytz.UTC
+BATCH_SIZE = int(os.getenv('DISPATCH_BATCH_SIZE', '20000'))
+
+BATCH_SQL = """
+    WITH batch AS (
+        SELECT u.id
+        FROM users u
+        WHERE u.id > %(after)s AND {audience}
+        ORDER BY u.id
+        LIMIT %(limit)s
+    ), delivered AS (
+        INSERT INTO promotion_deliveries (promotion_id, customer_id)
+        SELECT %(promotion_id)s, id FROM batch
+        ON CONFLICT (promotion_id, customer_id) DO NOTHING
+        RETURNING 1
+    )
+    SELECT (SELECT max(id) FROM batch) AS last_id, (SELECT count(*) FROM delivered) AS delivered
+"""
+
+
+class DispatchRunning(Exception):
+    pass
+
+
+def audience_filter(tier=None, segment=None, active_since=None):
+    """SQL predicate on users u (and its parameters) for the given criteria; TRUE when none are set."""
+    clauses = []
+    if tier:
+        clauses.append("u.tier = %(tier)s")
+    if segment:
+        clauses.append("""EXISTS (
+            SELECT 1 FROM user_segments us JOIN segments s ON s.id = us.segment_id
+            WHERE us.customer_id = u.id AND (s.id = %(segment)s OR s.name = %(segment)s)
+        )""")
+    if active_since:
+        clauses.append("""(
+            EXISTS (SELECT 1 FROM transactions t WHERE t.customer_id = u.id AND t.date >= %(active_since)s)
+            OR EXISTS (SELECT 1 FROM orders o WHERE o.customer_id = u.id AND o.date >= %(active_since)s)
+        )""")
+    params = {'tier': tier, 'segment': segment, 'active_since': active_since}
+    return ' AND '.join(clauses) or 'TRUE', params
+
+
+def _lock_key(promotion_id):
+    return f"promotion_dispatch:{promotion_id}"
+
+
+def _state(row):
+    if row is None:
+        return None
+    size = row['audience_size']
+    return {
+        'promotionId': row['promotion_id'],
+        'status': row['status'],
+        'audience': {
+            'tier': row['target_tier'],
+            'segment': row['target_segment'],
+            'activeSince': row['active_since'].isoformat() if row['active_since'] else None,
+        },
+        'audienceSize': size,
+        'delivered': row['delivered'],
+        'batches': row['batches'],
+        # Deliveries from an earlier pass also count, so a rerun can start above 0%
+        'progress': round(min(100.0, 100.0 * row['delivered'] / size), 2) if size else (100.0 if row['status'] == 'completed' else 0.0),
+        'lastError': row['last_error'],
+        'startedAt': row['started_at'].isoformat() if row['started_at'] else None,
+        'updatedAt': row['updated_at'].isoformat() if row['updated_at'] else None,
+        'finishedAt': row['finished_at'].isoformat() if row['finished_at'] else None,
+    }
+
+
+class PromotionDispatcher:
+    def __init__(self, connect, batch_size=BATCH_SIZE):
+        self.connect = connect
+        self.batch_size = batch_size
+
+    def _try_lock(self, cur, promotion_id):
+        cur.execute("SELECT pg_try_advisory_lock(hashtext(%s)) AS locked", (_lock_key(promotion_id),))
+        return cur.fetchone()['locked']
+
+    def start(self, promotion_id, rerun=False, now=None):
+        """
+        Creates, resumes or (rerun) restarts the dispatch of a promotion and
+        returns its state; None when the promotion does not exist. A
+        completed dispatch is left as it is unless rerun is set. Raises
+        DispatchRunning when a run is in progress.
+        """
+        now = now or datetime.now(UTC)
+        conn = self.connect()
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                if not self._try_lock(cur, promotion_id):
+                    raise DispatchRunning(f"Promotion {promotion_id} is being dispatched")
+                cur.execute("""
+                    SELECT id, target_tier, target_segment, active_within_days FROM promotions WHERE id = %s
+                """, (promotion_id,))
+                promotion = cur.fetchone()
+                if promotion is None:
+                    return None
+                cur.execute("SELECT * FROM promotion_dispatches WHERE promotion_id = %s", (promotion_id,))
+                existing = cur.fetchone()
+                if existing is not None and not rerun:
+                    if existing['status'] != 'completed':
+                        cur.execute("""
+                            UPDATE promotion_dispatches SET status = 'queued', updated_at = now()
+                            WHERE promotion_id = %s
+                            RETURNING *
+                        """, (promotion_id,))
+                        existing = cur.fetchone()
+                    conn.commit()
+                    return _state(existing)
+
+                days = promotion['active_within_days']
+                active_since = now - timedelta(days=days) if days else None
+                audience, params = audience_filter(promotion['target_tier'], promotion['target_segment'], active_since)
+                cur.execute(f"SELECT COUNT(*) AS size FROM users u WHERE {audience}", params)
+                size = cur.fetchone()['size']
+                cur.execute("""
+                    INSERT INTO promotion_dispatches AS d
+                        (promotion_id, status, target_tier, target_segment, active_since, audience_size)
+                    VALUES (%(promotion_id)s, 'queued', %(tier)s, %(segment)s, %(active_since)s, %(size)s)
+                    ON CONFLICT (promotion_id) DO UPDATE
+                    SET status = 'queued', target_tier = EXCLUDED.target_tier, target_segment = EXCLUDED.target_segment,
+                        active_since = EXCLUDED.active_since, audience_size = EXCLUDED.audience_size,
+                        last_customer_id = '', batches = 0, last_error = NULL,
+                        started_at = now(), updated_at = now(), finished_at = NULL
+                    RETURNING *
+                """, dict(params, promotion_id=promotion_id, size=size))
+                state = cur.fetchone()
+            conn.commit()
+            return _state(state)
+        finally:
+            conn.close()
+
+    def run(self, promotion_id):
+        """
+        Delivers the remaining batches of a started dispatch. Returns a
+        summary, or None when there is nothing to run or another process is
+        running it.
+        """
+        started = time.perf_counter()
+        conn = self.connect()
+        delivered = batches = 0
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                if not self._try_lock(cur, promotion_id):
+                    return None
+                cur.execute("""
+                    UPDATE promotion_dispatches SET status = 'running', updated_at = now()
+                    WHERE promotion_id = %s AND status IN ('queued', 'running')
+                    RETURNING *
+                """, (promotion_id,))
+                state = cur.fetchone()
+                conn.commit()
+                if state is None:
+                    return None
+                audience, params = audience_filter(state['target_tier'], state['target_segment'], state['active_since'])
+                batch_sql = BATCH_SQL.format(audience=audience)
+                params = dict(params, promotion_id=promotion_id, limit=self.batch_size)
+                after = state['last_customer_id']
+                try:
+                    while True:
+                        cur.execute(batch_sql, dict(params, after=after))
+                        result = cur.fetchone()
+                        if result['last_id'] is None:
+                            break
+                        after = result['last_id']
+                        cur.execute("""
+                            UPDATE promotion_dispatches
+                            SET last_customer_id = %s, delivered = delivered + %s, batches = batches + 1, updated_at = now()
+                            WHERE promotion_id = %s
+                        """, (after, result['delivered'], promotion_id))
+                        conn.commit()
+                        delivered += result['delivered']
+                        batches += 1
+                    cur.execute("""
+                        UPDATE promotion_dispatches SET status = 'completed', updated_at = now(), finished_at = now()
+                        WHERE promotion_id = %s
+                    """, (promotion_id,))
+                    cur.execute("""
+                        UPDATE promotions SET status = 'sent', sent_date = COALESCE(sent_date, now())
+                        WHERE id = %s AND status IS DISTINCT FROM 'sent'
+                    """, (promotion_id,))
+                    conn.commit()
+                except psycopg2.Error as e:
+                    conn.rollback()
+                    cur.execute("""
+                        UPDATE promotion_dispatches SET status = 'failed', last_error = %s, updated_at = now()
+                        WHERE promotion_id = %s
+                    """, (str(e), promotion_id))
+                    conn.commit()
+                    raise
+        finally:
+            conn.close()
+
+        duration_ms = round((time.perf_counter() - started) * 1000, 2)
+        logger.info(f"Promotion {promotion_id} dispatch: {delivered} deliveries in {batches} batches, {duration_ms}ms")
+        return {'promotionId': promotion_id, 'delivered': delivered, 'batches': batches, 'durationMs': duration_ms}
+
+    def resume_pending(self):
+        """Scheduler job: finishes dispatches whose run stopped before completing."""
+        conn = self.connect()
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute("SELECT promotion_id FROM promotion_dispatches WHERE status IN ('queued', 'running') ORDER BY started_at")
+                pending = [row['promotion_id'] for row in cur.fetchall()]
+            conn.commit()
+        finally:
+            conn.close()
+        resumed = [result for result in map(self.run, pending) if result is not None]
+        return {'pending': len(pending), 'resumed': resumed}
+
+    def status(self, promotion_id):
+        conn = self.connect()
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute("SELECT * FROM promotion_dispatches WHERE promotion_id = %s", (promotion_id,))
+                row = cur.fetchone()
+            conn.commit()
+            return _state(row)
+        finally:
+            conn.close()
+
+
+def main(argv):
+    from dotenv import load_dotenv
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+    database_url = os.getenv('DATABASE_URL')
+    args = [arg for arg in argv[1:] if not arg.startswith('--')]
+    if not database_url:
+        logger.error("DATABASE_URL not set")
+        return 1
+    if len(args) != 1:
+        logger.error("Usage: python dispatch.py <promotion_id> [--rerun]")
+        return 1
+    dispatcher = PromotionDispatcher(lambda: psycopg2.connect(database_url))
+    if dispatcher.start(args[0], rerun='--rerun' in argv) is None:
+        logger.error(f"Promotion {args[0]} not found")
+        return 1
+    dispatcher.run(args[0])
+    print(json.dumps(dispatcher.status(args[0])))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,275 @@
+"""
+Columnar snapshot export for offline model training, and bulk load-back of
+the predictions trained on it.
+
+Datasets written under EXPORT_DIR as Parquet (zstd), one directory per
+partition so readers can prune by path:
+
+    transactions/month=YYYY-MM/part-0.parquet   one partition per calendar month (UTC)
+    orders/month=YYYY-MM/part-0.parquet
+    users/as_of=YYYY-MM-DD/part-0.parquet       snapshot per export date, no contact details
+    customer_features/as_of=YYYY-MM-DD/part-0.parquet
+                                                segmentation's per-customer features and segment
+
+Rows are read through a server-side cursor EXPORT_BATCH_ROWS at a time and
+each batch becomes one Arrow record batch (one Parquet row group), so memory
+use does not depend on the table size. Money is exported as float64 and
+timestamps as UTC microseconds. Files are written next to their final path
+and renamed into place, so a reader never sees a partial file.
+
+Export is incremental. _manifest.json records every written partition with
+its row count; a month is written again only when the daily rollups
+(migrations/0007_daily_rollups.sql) now count a different number of rows
+for it - new months, the current month as it fills up, late or deleted rows.
+In-place updates of old rows are not detected; run with --full to rewrite
+everything.
+
+load_predictions() reads a Parquet file of predictions (customer_id,
+clv_predicted, churn_probability, prediction_date and optionally reward_id,
+reason) and hands it to predictions.py batch by batch as CSV, which COPYs
+and upserts it into ml_predictions and pred_rew.
+
+Requires pyarrow, pinned in requirements-tools.txt; the web app does not import it.
+
+Usage:
+    python export.py [--full] [dataset ...]
+    python export.py load-predictions <file.parquet>
+"""
+import io
+import os
+import sys
+import json
+import time
+import logging
+from datetime import datetime
+import pytz
+import psycopg2
+import psycopg2.extensions
+from dateutil.relativedelta import relativedelta
+
+from segmentation import FEATURES_SQL
+from predictions import PredictionLoader, PREDICTION_COLUMNS
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+UTC = pytz.UTC
+EXPORT_DIR = os.getenv('EXPORT_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'exports'))
+BATCH_ROWS = int(os.getenv('EXPORT_BATCH_ROWS', '100000'))
+MANIFEST = '_manifest.json'
+
+# Monthly datasets: (query for one month, columns, monthly row counts from the rollups)
+MONTHLY = {
+    'transactions': (
+        """
+        SELECT id, customer_id, points, type, context, date::timestamptz AS date, amount::float8 AS amount
+        FROM transactions
+        WHERE date >= %(start)s AND date < %(end)s
+        """,
+        [('id', 'int64'), ('customer_id', 'string'), ('points', 'int64'), ('type', 'string'),
+         ('context', 'string'), ('date', 'timestamp'), ('amount', 'float64')],
+        """
+        SELECT date_trunc('month', day)::date AS month, SUM(transactions) AS rows
+        FROM daily_points_rollup
+        GROUP BY 1
+        """,
+    ),
+    'orders': (
+        """
+        SELECT id, customer_id, total::float8 AS total, subtotal::float8 AS subtotal, date::timestamptz AS date
+        FROM orders
+        WHERE date >= %(start)s AND date < %(end)s
+        """,
+        [('id', 'int64'), ('customer_id', 'string'), ('total', 'float64'), ('subtotal', 'float64'),
+         ('date', 'timestamp')],
+        """
+        SELECT date_trunc('month', day)::date AS month, SUM(orders) AS rows
+        FROM daily_rollups
+        GROUP BY 1
+        """,
+    ),
+}
+
+# Snapshot datasets: (query, columns)
+SNAPSHOTS = {
+    'users': (
+        """
+        SELECT id, tier, points_balance, points_earned, created_at::timestamptz AS created_at,
+               last_activity::timestamptz AS last_activity
+        FROM users
+        """,
+        [('id', 'string'), ('tier', 'string'), ('points_balance', 'int64'), ('points_earned', 'int64'),
+         ('created_at', 'timestamp'), ('last_activity', 'timestamp')],
+    ),
+    'customer_features': (
+        f"""
+        WITH f AS ({FEATURES_SQL.format(transaction_filter='', order_filter='', user_filter='')})
+        SELECT f.id AS customer_id, f.tier, f.points, f.spend::float8 AS spend, f.frequency,
+               f.monetary::float8 AS monetary, f.last_activity::timestamptz AS last_activity, us.segment_id
+        FROM f
+        LEFT JOIN user_segments us ON us.customer_id = f.id
+        """,
+        [('customer_id', 'string'), ('tier', 'string'), ('points', 'int64'), ('spend', 'float64'),
+         ('frequency', 'int64'), ('monetary', 'float64'), ('last_activity', 'timestamp'), ('segment_id', 'string')],
+    ),
+}
+
+def _require_pyarrow():
+    if pa is None:
+        raise RuntimeError("Snapshot export needs pyarrow (pip install -r requirements-tools.txt)")
+
+
+def _schema(columns):
+    types = {'int64': pa.int64(), 'float64': pa.float64(), 'string': pa.string(), 'timestamp': pa.timestamp('us', tz='UTC')}
+    return pa.schema([(name, types[kind]) for name, kind in columns])
+
+
+def _month_key(month):
+    return month.strftime('%Y-%m')
+
+
+class SnapshotExporter:
+    def __init__(self, connect, directory=EXPORT_DIR, batch_rows=BATCH_ROWS):
+        self.connect = connect
+        self.directory = directory
+        self.batch_rows = batch_rows
+
+    def load_manifest(self):
+        try:
+            with open(os.path.join(self.directory, MANIFEST)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'monthly': {}, 'snapshots': {}}
+
+    def save_manifest(self, manifest):
+        path = os.path.join(self.directory, MANIFEST)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(path + '.tmp', path)
+
+    def write(self, conn, sql, params, columns, relative_path):
+        """Streams a query into one Parquet file through a server-side cursor; returns the row count."""
+        schema = _schema(columns)
+        path = os.path.join(self.directory, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        rows = 0
+        # Tuples rather than the connection's dict rows, and one round trip per batch
+        with conn.cursor(name='snapshot_export', cursor_factory=psycopg2.extensions.cursor) as cur:
+            cur.itersize = self.batch_rows
+            cur.execute(sql, params)
+            with pq.ParquetWriter(path + '.tmp', schema, compression='zstd') as writer:
+                while True:
+                    batch = cur.fetchmany(self.batch_rows)
+                    if not batch:
+                        break
+                    values = list(zip(*batch))
+                    writer.write_batch(pa.RecordBatch.from_arrays(
+                        [pa.array(values[i], type=field.type) for i, field in enumerate(schema)], schema=schema
+                    ))
+                    rows += len(batch)
+        conn.commit()
+        os.replace(path + '.tmp', path)
+        return rows
+
+    def run(self, datasets=None, full=False, now=None):
+        """
+        Writes the monthly partitions whose row counts changed since they
+        were last exported (every partition with full) and today's
+        snapshots. Returns a summary.
+        """
+        _require_pyarrow()
+        started = time.perf_counter()
+        now = now or datetime.now(UTC)
+        datasets = datasets or list(MONTHLY) + list(SNAPSHOTS)
+        unknown = set(datasets) - set(MONTHLY) - set(SNAPSHOTS)
+        if unknown:
+            raise ValueError(f"Unknown datasets: {', '.join(sorted(unknown))}")
+        manifest = self.load_manifest()
+        written, skipped = [], 0
+        conn = self.connect()
+        try:
+            for name in datasets:
+                if name in MONTHLY:
+                    sql, columns, counts_sql = MONTHLY[name]
+                    with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+                        cur.execute(counts_sql)
+                        counts = {row[0]: int(row[1]) for row in cur.fetchall()}
+                    conn.commit()
+                    exported = manifest['monthly'].setdefault(name, {})
+                    for month in sorted(counts):
+                        key = _month_key(month)
+                        if not full and exported.get(key, {}).get('rows') == counts[month]:
+                            skipped += 1
+                            continue
+                        relative_path = os.path.join(name, f"month={key}", 'part-0.parquet')
+                        start = datetime(month.year, month.month, 1, tzinfo=UTC)
+                        rows = self.write(conn, sql, {'start': start, 'end': start + relativedelta(months=1)},
+                                          columns, relative_path)
+                        exported[key] = {'rows': rows, 'file': relative_path, 'exportedAt': now.isoformat()}
+                        written.append({'dataset': name, 'partition': key, 'rows': rows})
+                        # After every partition, so an interrupted export keeps what it wrote
+                        self.save_manifest(manifest)
+                else:
+                    sql, columns = SNAPSHOTS[name]
+                    key = now.date().isoformat()
+                    relative_path = os.path.join(name, f"as_of={key}", 'part-0.parquet')
+                    rows = self.write(conn, sql, None, columns, relative_path)
+                    manifest['snapshots'].setdefault(name, {})[key] = {
+                        'rows': rows, 'file': relative_path, 'exportedAt': now.isoformat()
+                    }
+                    written.append({'dataset': name, 'partition': key, 'rows': rows})
+                    self.save_manifest(manifest)
+        finally:
+            conn.close()
+
+        duration_ms = round((time.perf_counter() - started) * 1000, 2)
+        logger.info(f"Snapshot export: {len(written)} partitions written, {skipped} unchanged in {duration_ms}ms")
+        return {'written': written, 'unchanged': skipped, 'durationMs': duration_ms}
+
+    def load_predictions(self, path):
+        """
+        Loads a Parquet file of predictions through predictions.py, each
+        record batch converted to CSV for COPY; returns the load summary.
+        """
+        _require_pyarrow()
+        parquet = pq.ParquetFile(path)
+        columns = [c for c in PREDICTION_COLUMNS if c in parquet.schema_arrow.names]
+
+        def csv_batches():
+            for batch in parquet.iter_batches(batch_size=self.batch_rows, columns=columns):
+                buffer = io.BytesIO()
+                pa_csv.write_csv(pa.Table.from_batches([batch]), buffer)
+                buffer.seek(0)
+                yield buffer
+
+        return PredictionLoader(self.connect).load(csv_batches())
+
+
+def main(argv):
+    from dotenv import load_dotenv
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+    database_url = os.getenv('DATABASE_URL')
+    if not database_url:
+        logger.error("DATABASE_URL not set")
+        return 1
+    exporter = SnapshotExporter(lambda: psycopg2.connect(database_url))
+    args = [arg for arg in argv[1:] if not arg.startswith('--')]
+    if args[:1] == ['load-predictions']:
+        if len(args) != 2:
+            logger.error("Usage: python export.py load-predictions <file.parquet>")
+            return 1
+        print(json.dumps(exporter.load_predictions(args[1])))
+        return 0
+    print(json.dumps(exporter.run(datasets=args or None, full='--full' in argv)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
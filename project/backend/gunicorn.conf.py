@@ -0,0 +1,22 @@
+"""
+Gunicorn settings for the API:
+    gunicorn -c gunicorn.conf.py [--worker-class ...] [--workers N]
+
+The app is imported once in the master (preload_app) and forked, so workers
+start without re-importing Flask and every module. app.py opens database
+connections lazily and, with APP_DEFER_STARTUP=1, starts no background tasks
+at import; post_worker_init gives each worker its own connections and starts
+the scheduler / change feed there. Set GUNICORN_PRELOAD=0 to import per worker.
+"""
+import os
+
+os.environ.setdefault('APP_DEFER_STARTUP', '1')
+
+wsgi_app = 'app:create_app()'
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+preload_app = os.getenv('GUNICORN_PRELOAD', '1') == '1'
+
+
+def post_worker_init(worker):
+    import app
+    app.init_worker()
@@ -0,0 +1,475 @@
+"""
+Buffered ingestion of POS purchase / earn / redeem events.
+
+submit() validates events and appends them to a bounded in-memory buffer;
+a background flusher drains it whenever INGEST_FLUSH_SIZE events are
+waiting or the oldest has waited INGEST_FLUSH_INTERVAL_MS, and applies each
+batch on its own connection in one transaction (group commit):
+
+  1. multi-row insert into ingested_events, skipping event ids already seen,
+  2. lock the affected users rows (in id order, so concurrent flushes cannot deadlock),
+  3. apply the events in arrival order, rejecting unknown customers and
+     redemptions larger than the balance,
+  4. multi-row inserts into orders and transactions and one users update,
+  5. record every event's outcome in ingested_events and commit.
+
+A purchase becomes an order with total = amount and subtotal = the event's
+optional subtotal (the pre-discount / pre-tax amount), defaulting to the
+amount, so ingested sales count in order_subtotal like any other order.
+
+Every event carries a client-chosen event_id (idempotency key), so a
+retried request - including one whose events were lost in a crash before
+their flush - never applies an event twice. When the buffer is full
+submit() raises BufferFull and the endpoint answers 503 with Retry-After;
+a flush that loses its connection puts its batch back at the head of the
+buffer and retries with backoff, so a database outage turns into
+backpressure rather than loss of acknowledged events held in memory. Any
+other failure is specific to the events: the batch is split in halves and
+applied again until the events that fail on their own are found, and those
+are recorded as rejected instead of being retried, so one event the
+database refuses cannot hold up the events queued with or after it.
+Validation bounds amounts and points to the column types to make that rare.
+
+Tables are created by migrations/0005_ingestion.sql.
+"""
+import os
+import math
+import time
+import logging
+import threading
+from collections import deque
+from datetime import datetime
+import pytz
+import psycopg2
+from psycopg2.extras import RealDictCursor, execute_values
+
+logger = logging.getLogger(__name__)
+
+UTC = pytz.UTC
+BUFFER_SIZE = int(os.getenv('INGEST_BUFFER_SIZE', '50000'))
+FLUSH_SIZE = int(os.getenv('INGEST_FLUSH_SIZE', '1000'))
+FLUSH_INTERVAL_MS = float(os.getenv('INGEST_FLUSH_INTERVAL_MS', '200'))
+MAX_BATCH_EVENTS = int(os.getenv('INGEST_MAX_BATCH_EVENTS', '1000'))
+RETRY_MAX_SECONDS = 30.0
+POINTS_PER_UNIT = float(os.getenv('ORDER_POINTS_PER_UNIT', '1'))
+
+EVENT_TYPES = ('purchase', 'earn', 'redeem')
+MAX_EVENT_ID_LENGTH = 128
+MAX_DESCRIPTION_LENGTH = 255
+# Largest values the columns hold: NUMERIC(12, 2) amounts, INTEGER points
+MAX_AMOUNT = 9999999999.99
+MAX_POINTS = 2 ** 31 - 1
+# Errors that say nothing about the events in a batch, so the batch is retried as it is
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+
+class BufferFull(Exception):
+    def __init__(self, retry_after):
+        super().__init__("Ingestion buffer is full")
+        self.retry_after = retry_after
+
+
+def _parse_time(value):
+    if value is None:
+        return None
+    dt = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    return dt if dt.tzinfo else dt.replace(tzinfo=UTC)
+
+
+def _number(event, key, limit, integer=False):
+    value = event.get(key)
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError(f"{key} must be a number")
+    # JSON parsing accepts Infinity and NaN; ints are compared before float() can overflow
+    if isinstance(value, float) and not math.isfinite(value):
+        raise ValueError(f"{key} must be a finite number")
+    if abs(value) > limit:
+        raise ValueError(f"{key} must be at most {limit}")
+    if integer and int(value) != value:
+        raise ValueError(f"{key} must be a whole number")
+    return int(value) if integer else float(value)
+
+
+def validate_event(event, received_at):
+    """
+    Returns the normalized event, or raises ValueError with the reason.
+    """
+    if not isinstance(event, dict):
+        raise ValueError("Event must be an object")
+    event_id = event.get('event_id')
+    if not isinstance(event_id, str) or not event_id or len(event_id) > MAX_EVENT_ID_LENGTH:
+        raise ValueError(f"event_id must be a string of 1-{MAX_EVENT_ID_LENGTH} characters")
+    customer_id = event.get('customer_id')
+    if not isinstance(customer_id, str) or not customer_id:
+        raise ValueError("customer_id is required")
+    event_type = event.get('type')
+    if event_type not in EVENT_TYPES:
+        raise ValueError(f"type must be one of {', '.join(EVENT_TYPES)}")
+
+    amount = _number(event, 'amount', MAX_AMOUNT)
+    points = _number(event, 'points', MAX_POINTS, integer=True)
+    subtotal = _number(event, 'subtotal', MAX_AMOUNT)
+    if event_type == 'purchase':
+        if amount is None or amount <= 0:
+            raise ValueError("purchase events need a positive amount")
+        if points is None:
+            points = int(amount * POINTS_PER_UNIT)
+            if points > MAX_POINTS:
+                raise ValueError(f"amount earns more than {MAX_POINTS} points")
+        if subtotal is None:
+            subtotal = amount
+    elif points is None or points <= 0:
+        raise ValueError(f"{event_type} events need positive points")
+    elif subtotal is not None:
+        raise ValueError("subtotal is only allowed on purchase events")
+    if points < 0 or (amount is not None and amount < 0) or (subtotal is not None and subtotal < 0):
+        raise ValueError("amount, subtotal and points must not be negative")
+
+    description = event.get('description')
+    if description is not None and (not isinstance(description, str) or len(description) > MAX_DESCRIPTION_LENGTH):
+        raise ValueError(f"description must be a string of at most {MAX_DESCRIPTION_LENGTH} characters")
+    if event_type == 'redeem' and event.get('reward_id'):
+        # Same context format as /staff/redeem-reward, which get_rewards() parses
+        description = f"Redemption of reward {event['reward_id']}"
+
+    try:
+        occurred_at = _parse_time(event.get('occurred_at')) or received_at
+    except ValueError:
+        raise ValueError("occurred_at must be an ISO 8601 timestamp")
+
+    return {
+        'event_id': event_id,
+        'customer_id': customer_id,
+        'type': event_type,
+        'amount': round(amount or 0.0, 2),
+        'subtotal': round(subtotal, 2) if subtotal is not None else None,
+        'points': points,
+        'description': description,
+        'occurred_at': occurred_at,
+        'received_at': received_at,
+    }
+
+
+class IngestionBuffer:
+    def __init__(self, connect, on_flush=None, buffer_size=BUFFER_SIZE, flush_size=FLUSH_SIZE,
+                 flush_interval_ms=FLUSH_INTERVAL_MS):
+        self.connect = connect
+        self.on_flush = on_flush
+        self.buffer_size = buffer_size
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval_ms / 1000
+        self._queue = deque()
+        self._pending_ids = set()
+        self._condition = threading.Condition()
+        self._started = False
+        self._retry_delay = 0.0
+        self._retry_at = 0.0
+        self.stats = {
+            'accepted': 0, 'duplicates': 0, 'invalid': 0, 'rejected_full': 0,
+            'applied': 0, 'rejected': 0, 'flushes': 0, 'flush_failures': 0,
+            'flush_seconds': 0.0, 'last_flush_events': 0,
+        }
+
+    def start(self, start_background_task):
+        with self._condition:
+            if self._started:
+                return
+            self._started = True
+        start_background_task(self.run_forever)
+
+    def depth(self):
+        return len(self._queue)
+
+    def submit(self, events):
+        """
+        Validates and enqueues a list of raw events. Returns
+        {'accepted': [...event_ids], 'duplicates': [...], 'invalid': [{'index', 'event_id', 'error'}]}.
+        Raises BufferFull, without enqueuing anything, when the valid events do not fit.
+        """
+        received_at = datetime.now(UTC)
+        valid = []
+        invalid = []
+        seen = set()
+        duplicates = []
+        for index, raw in enumerate(events):
+            try:
+                event = validate_event(raw, received_at)
+            except ValueError as e:
+                invalid.append({'index': index, 'event_id': raw.get('event_id') if isinstance(raw, dict) else None, 'error': str(e)})
+                continue
+            if event['event_id'] in seen:
+                duplicates.append(event['event_id'])
+                continue
+            seen.add(event['event_id'])
+            valid.append(event)
+
+        with self._condition:
+            fresh = []
+            for event in valid:
+                # Already buffered: the earlier copy will be applied
+                if event['event_id'] in self._pending_ids:
+                    duplicates.append(event['event_id'])
+                else:
+                    fresh.append(event)
+            if len(self._queue) + len(fresh) > self.buffer_size:
+                self.stats['rejected_full'] += len(fresh)
+                raise BufferFull(self.retry_after())
+            for event in fresh:
+                self._queue.append(event)
+                self._pending_ids.add(event['event_id'])
+            self.stats['accepted'] += len(fresh)
+            self.stats['duplicates'] += len(duplicates)
+            self.stats['invalid'] += len(invalid)
+            if len(self._queue) >= self.flush_size:
+                self._condition.notify()
+        return {'accepted': [e['event_id'] for e in fresh], 'duplicates': duplicates, 'invalid': invalid}
+
+    def retry_after(self):
+        """
+        Seconds a client should wait before retrying, from the current retry
+        backoff or the time needed to drain the buffer at the last flush rate.
+        """
+        if self._retry_delay:
+            return max(1, math.ceil(self._retry_at - time.monotonic()))
+        processed = self.stats['applied'] + self.stats['rejected']
+        per_event = self.stats['flush_seconds'] / processed if processed else self.flush_interval / self.flush_size
+        return max(1, math.ceil(len(self._queue) * per_event))
+
+    def run_forever(self):
+        while True:
+            try:
+                self.flush_due()
+            except Exception as e:
+                logger.error(f"Ingestion flusher error: {str(e)}")
+
+    def flush_due(self):
+        """
+        Waits until a flush is due, then flushes one batch.
+        """
+        with self._condition:
+            while True:
+                backoff = self._retry_at - time.monotonic()
+                if backoff > 0:
+                    self._condition.wait(backoff)
+                    continue
+                if len(self._queue) >= self.flush_size:
+                    break
+                if self._queue:
+                    remaining = self.flush_interval - (datetime.now(UTC) - self._queue[0]['received_at']).total_seconds()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                else:
+                    self._condition.wait(self.flush_interval)
+            batch = [self._queue.popleft() for _ in range(min(self.flush_size, len(self._queue)))]
+        if batch:
+            self.flush(batch)
+
+    def flush(self, batch):
+        started = time.perf_counter()
+        try:
+            outcomes, applied = self.apply_isolating(batch)
+        except Exception as e:
+            # Only connection errors, or failing to record a rejection, get here; parts already
+            # committed are skipped on the retry by their ingested_events rows
+            with self._condition:
+                self._queue.extendleft(reversed(batch))
+                self.stats['flush_failures'] += 1
+                self._retry_delay = min(RETRY_MAX_SECONDS, max(0.5, self._retry_delay * 2))
+                self._retry_at = time.monotonic() + self._retry_delay
+            logger.error(f"Ingestion flush of {len(batch)} events failed, retrying in {self._retry_delay:.1f}s: {str(e)}")
+            return None
+
+        elapsed = time.perf_counter() - started
+        with self._condition:
+            self._retry_delay = 0.0
+            self._retry_at = 0.0
+            for event in batch:
+                self._pending_ids.discard(event['event_id'])
+            self.stats['flushes'] += 1
+            self.stats['flush_seconds'] += elapsed
+            self.stats['last_flush_events'] = len(batch)
+            self.stats['applied'] += sum(1 for status, _ in outcomes.values() if status == 'applied')
+            self.stats['rejected'] += sum(1 for status, _ in outcomes.values() if status == 'rejected')
+        if self.on_flush and applied:
+            try:
+                self.on_flush(applied)
+            except Exception as e:
+                logger.error(f"Ingestion flush callback failed: {str(e)}")
+        return outcomes
+
+    def apply_isolating(self, batch):
+        """
+        apply(), splitting the batch in halves (arrival order kept) while it
+        fails for any reason other than the connection, down to single
+        events, which are rejected. Connection errors propagate.
+        """
+        try:
+            return self.apply(batch)
+        except CONNECTION_ERRORS:
+            raise
+        except Exception as e:
+            if len(batch) == 1:
+                return self.reject(batch[0], e)
+            middle = len(batch) // 2
+            first_outcomes, first_applied = self.apply_isolating(batch[:middle])
+            outcomes, applied = self.apply_isolating(batch[middle:])
+            return {**first_outcomes, **outcomes}, first_applied + applied
+
+    def reject(self, event, error):
+        """Records an event the database refused as rejected, unless an earlier flush recorded it."""
+        message = (str(error).strip().splitlines() or [type(error).__name__])[0]
+        logger.error(f"Ingested event {event['event_id']} rejected: {message}")
+        conn = self.connect()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO ingested_events (event_id, customer_id, type, points, amount, occurred_at, received_at,
+                                                 status, error, processed_at)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, 'rejected', %s, clock_timestamp())
+                    ON CONFLICT (event_id) DO NOTHING
+                """, (event['event_id'], event['customer_id'], event['type'], event['points'], event['amount'],
+                      event['occurred_at'], event['received_at'], message))
+                recorded = cur.rowcount
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        return ({event['event_id']: ('rejected', message)} if recorded else {}), []
+
+    def apply(self, batch):
+        """
+        Applies one batch in a single transaction. Returns
+        ({event_id: (status, error)}, [applied events]); events already
+        recorded by an earlier flush are left out of both.
+        """
+        conn = self.connect()
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                fresh_ids = {
+                    row['event_id'] for row in execute_values(cur, """
+                        INSERT INTO ingested_events (event_id, customer_id, type, points, amount, occurred_at, received_at, status)
+                        VALUES %s
+                        ON CONFLICT (event_id) DO NOTHING
+                        RETURNING event_id
+                    """, [
+                        (e['event_id'], e['customer_id'], e['type'], e['points'], e['amount'], e['occurred_at'], e['received_at'], 'pending')
+                        for e in batch
+                    ], page_size=len(batch), fetch=True)
+                }
+                events = [e for e in batch if e['event_id'] in fresh_ids]
+                if not events:
+                    conn.commit()
+                    return {}, []
+
+                cur.execute(
+                    "SELECT id, points_balance FROM users WHERE id = ANY(%s) ORDER BY id FOR UPDATE",
+                    (sorted({e['customer_id'] for e in events}),)
+                )
+                balances = {row['id']: row['points_balance'] or 0 for row in cur.fetchall()}
+
+                outcomes = {}
+                applied = []
+                earned = {}
+                last_activity = {}
+                orders = []
+                transactions = []
+                for e in events:
+                    customer_id = e['customer_id']
+                    if customer_id not in balances:
+                        outcomes[e['event_id']] = ('rejected', 'Customer not found')
+                        continue
+                    if e['type'] == 'redeem':
+                        if balances[customer_id] < e['points']:
+                            outcomes[e['event_id']] = ('rejected', 'Insufficient points')
+                            continue
+                        balances[customer_id] -= e['points']
+                        transactions.append((customer_id, -e['points'], 'redeem', e['description'] or 'Redemption',
+                                             e['occurred_at'], round(-e['points'] * 0.1, 2)))
+                    else:
+                        balances[customer_id] += e['points']
+                        earned[customer_id] = earned.get(customer_id, 0) + e['points']
+                        if e['type'] == 'purchase':
+                            orders.append((customer_id, e['amount'], e['subtotal'], e['occurred_at']))
+                        transactions.append((customer_id, e['points'], 'earn_points',
+                                             e['description'] or ('Purchase' if e['type'] == 'purchase' else 'Points earned'),
+                                             e['occurred_at'], e['amount']))
+                    last_activity[customer_id] = max(last_activity.get(customer_id, e['occurred_at']), e['occurred_at'])
+                    outcomes[e['event_id']] = ('applied', None)
+                    applied.append(e)
+
+                if orders:
+                    execute_values(cur, "INSERT INTO orders (customer_id, total, subtotal, date) VALUES %s", orders, page_size=len(orders))
+                if transactions:
+                    execute_values(cur, """
+                        INSERT INTO transactions (customer_id, points, type, context, date, amount) VALUES %s
+                    """, transactions, page_size=len(transactions))
+                if last_activity:
+                    execute_values(cur, """
+                        UPDATE users u
+                        SET points_balance = v.balance,
+                            points_earned = COALESCE(u.points_earned, 0) + v.earned,
+                            last_activity = GREATEST(u.last_activity::timestamptz, v.last_activity)
+                        FROM (VALUES %s) AS v (id, balance, earned, last_activity)
+                        WHERE u.id = v.id
+                    """, [
+                        (customer_id, balances[customer_id], earned.get(customer_id, 0), at)
+                        for customer_id, at in last_activity.items()
+                    ], template='(%s, %s::integer, %s::integer, %s::timestamptz)', page_size=len(last_activity))
+                execute_values(cur, """
+                    UPDATE ingested_events i
+                    SET status = v.status, error = v.error, processed_at = clock_timestamp()
+                    FROM (VALUES %s) AS v (event_id, status, error)
+                    WHERE i.event_id = v.event_id
+                """, [(event_id, status, error) for event_id, (status, error) in outcomes.items()], page_size=len(outcomes))
+            conn.commit()
+            return outcomes, applied
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def lookup(self, event_ids):
+        """
+        Current status of events: 'buffered' while in memory, otherwise as recorded in ingested_events.
+        """
+        with self._condition:
+            buffered = {event_id for event_id in event_ids if event_id in self._pending_ids}
+        statuses = {event_id: {'status': 'buffered'} for event_id in buffered}
+        remaining = [event_id for event_id in event_ids if event_id not in buffered]
+        if remaining:
+            conn = self.connect()
+            try:
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    cur.execute("""
+                        SELECT event_id, status, error, processed_at FROM ingested_events WHERE event_id = ANY(%s)
+                    """, (remaining,))
+                    for row in cur.fetchall():
+                        statuses[row['event_id']] = {'status': row['status'], 'error': row['error'], 'processedAt': row['processed_at']}
+                conn.commit()
+            finally:
+                conn.close()
+        return {event_id: statuses.get(event_id, {'status': 'unknown'}) for event_id in event_ids}
+
+    def metrics(self):
+        with self._condition:
+            stats = dict(self.stats)
+            depth = len(self._queue)
+        return [
+            ('loyalty_ingest_buffer_depth', 'gauge', 'Events waiting in the ingestion buffer.', [({}, depth)]),
+            ('loyalty_ingest_buffer_capacity', 'gauge', 'Ingestion buffer capacity.', [({}, self.buffer_size)]),
+            ('loyalty_ingest_events_total', 'counter', 'Ingestion events by outcome.', [
+                ({'outcome': outcome}, stats[outcome])
+                for outcome in ('accepted', 'duplicates', 'invalid', 'rejected_full', 'applied', 'rejected')
+            ]),
+            ('loyalty_ingest_flushes_total', 'counter', 'Ingestion flushes by result.', [
+                ({'result': 'ok'}, stats['flushes']), ({'result': 'failed'}, stats['flush_failures'])
+            ]),
+            ('loyalty_ingest_flush_seconds_total', 'counter', 'Time spent in successful ingestion flushes.',
+             [({}, f"{stats['flush_seconds']:.6f}")]),
+        ]
@@ -0,0 +1,190 @@
+"""
+Per-request query instrumentation.
+
+run_query() reports every statement through record_query(); the Flask
+request hooks in app.py call start_request()/finish_request(). Each request
+accumulates its query count, DB time and rows fetched on flask.g, and the
+remainder of the wall time is attributed to Python post-processing.
+
+Results are exposed three ways:
+  * a Server-Timing header on every response (db, app, total)
+  * process-wide counters rendered by render_metrics() in Prometheus text format,
+    plus whatever collectors other modules add with register_collector()
+  * a slow-query log keyed by a normalized SQL fingerprint
+"""
+import os
+import re
+import time
+import logging
+import threading
+from flask import g, has_request_context, request
+
+logger = logging.getLogger(__name__)
+slow_query_logger = logging.getLogger('slow_query')
+
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', '200'))
+MAX_FINGERPRINTS = int(os.getenv('MAX_QUERY_FINGERPRINTS', '500'))
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+_endpoint_stats = {}
+_status_counts = {}
+_duration_buckets = {}
+_fingerprint_stats = {}
+_collectors = []
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PLACEHOLDER = re.compile(r'%\(\w+\)s|%s')
+_IN_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_WHITESPACE = re.compile(r'\s+')
+
+
+def fingerprint(sql):
+    """
+    Normalizes SQL so statements that differ only in literals or parameters
+    share one key, e.g. "SELECT ... WHERE id = 'x'" -> "SELECT ... WHERE id = ?".
+    """
+    normalized = _STRING_LITERAL.sub('?', sql)
+    normalized = _PLACEHOLDER.sub('?', normalized)
+    normalized = _NUMBER_LITERAL.sub('?', normalized)
+    normalized = _IN_LIST.sub('(?)', normalized)
+    return _WHITESPACE.sub(' ', normalized).strip()
+
+
+def record_query(sql, seconds, rows):
+    key = fingerprint(sql)
+    with _lock:
+        stats = _fingerprint_stats.get(key)
+        if stats is None and len(_fingerprint_stats) < MAX_FINGERPRINTS:
+            stats = _fingerprint_stats[key] = {'calls': 0, 'seconds': 0.0, 'rows': 0, 'max_seconds': 0.0}
+        if stats is not None:
+            stats['calls'] += 1
+            stats['seconds'] += seconds
+            stats['rows'] += rows
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+
+    if has_request_context() and 'query_stats' in g:
+        g.query_stats['queries'] += 1
+        g.query_stats['db_seconds'] += seconds
+        g.query_stats['rows'] += rows
+
+    if seconds * 1000 >= SLOW_QUERY_MS:
+        endpoint = request.endpoint if has_request_context() else None
+        slow_query_logger.warning(
+            f"Slow query {seconds * 1000:.1f}ms rows={rows} endpoint={endpoint or '-'} fingerprint={key}"
+        )
+
+
+def start_request():
+    g.query_stats = {'queries': 0, 'db_seconds': 0.0, 'rows': 0, 'started': time.perf_counter()}
+
+
+def finish_request(response):
+    stats = g.pop('query_stats', None)
+    if stats is None:
+        return response
+
+    total = time.perf_counter() - stats['started']
+    python_seconds = max(0.0, total - stats['db_seconds'])
+    endpoint = request.endpoint or 'unknown'
+
+    with _lock:
+        totals = _endpoint_stats.setdefault(endpoint, {
+            'requests': 0, 'queries': 0, 'db_seconds': 0.0, 'rows': 0, 'python_seconds': 0.0, 'seconds': 0.0
+        })
+        totals['requests'] += 1
+        totals['queries'] += stats['queries']
+        totals['db_seconds'] += stats['db_seconds']
+        totals['rows'] += stats['rows']
+        totals['python_seconds'] += python_seconds
+        totals['seconds'] += total
+        status_key = (endpoint, response.status_code)
+        _status_counts[status_key] = _status_counts.get(status_key, 0) + 1
+        buckets = _duration_buckets.setdefault(endpoint, [0] * len(DURATION_BUCKETS))
+        for i, bound in enumerate(DURATION_BUCKETS):
+            if total <= bound:
+                buckets[i] += 1
+
+    response.headers['Server-Timing'] = ', '.join([
+        f'db;dur={stats["db_seconds"] * 1000:.2f};desc="{stats["queries"]} queries, {stats["rows"]} rows"',
+        f'app;dur={python_seconds * 1000:.2f}',
+        f'total;dur={total * 1000:.2f}',
+    ])
+    return response
+
+
+def register_collector(collect):
+    """
+    Adds a callable returning [(name, kind, help_text, [(labels, value), ...]), ...]
+    whose metrics render_metrics() appends, for subsystems that keep their own counters.
+    """
+    _collectors.append(collect)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_metrics():
+    """
+    Renders the process-wide counters in Prometheus text exposition format.
+    Counters are per worker process; Prometheus sums them across workers.
+    """
+    with _lock:
+        endpoints = {name: dict(stats) for name, stats in _endpoint_stats.items()}
+        statuses = dict(_status_counts)
+        buckets = {name: list(counts) for name, counts in _duration_buckets.items()}
+        fingerprints = {key: dict(stats) for key, stats in _fingerprint_stats.items()}
+
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            label_str = ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+            lines.append(f"{name}{{{label_str}}} {value}" if label_str else f"{name} {value}")
+
+    metric('loyalty_http_requests_total', 'counter', 'HTTP requests by endpoint and status.',
+           [({'endpoint': e, 'status': s}, n) for (e, s), n in sorted(statuses.items())])
+
+    duration_samples = []
+    for endpoint, counts in sorted(buckets.items()):
+        for bound, count in zip(DURATION_BUCKETS, counts):
+            duration_samples.append(({'endpoint': endpoint, 'le': bound}, count))
+        duration_samples.append(({'endpoint': endpoint, 'le': '+Inf'}, endpoints[endpoint]['requests']))
+    lines.append("# HELP loyalty_http_request_duration_seconds Request wall time.")
+    lines.append("# TYPE loyalty_http_request_duration_seconds histogram")
+    for labels, value in duration_samples:
+        lines.append(f'loyalty_http_request_duration_seconds_bucket{{endpoint="{_escape(labels["endpoint"])}",le="{labels["le"]}"}} {value}')
+    for endpoint, stats in sorted(endpoints.items()):
+        lines.append(f'loyalty_http_request_duration_seconds_sum{{endpoint="{_escape(endpoint)}"}} {stats["seconds"]:.6f}')
+        lines.append(f'loyalty_http_request_duration_seconds_count{{endpoint="{_escape(endpoint)}"}} {stats["requests"]}')
+
+    metric('loyalty_db_queries_total', 'counter', 'SQL statements issued, by endpoint.',
+           [({'endpoint': e}, s['queries']) for e, s in sorted(endpoints.items())])
+    metric('loyalty_db_seconds_total', 'counter', 'Time spent executing and fetching SQL, by endpoint.',
+           [({'endpoint': e}, f"{s['db_seconds']:.6f}") for e, s in sorted(endpoints.items())])
+    metric('loyalty_db_rows_fetched_total', 'counter', 'Rows fetched into Python, by endpoint.',
+           [({'endpoint': e}, s['rows']) for e, s in sorted(endpoints.items())])
+    metric('loyalty_python_seconds_total', 'counter', 'Request time not spent in the database, by endpoint.',
+           [({'endpoint': e}, f"{s['python_seconds']:.6f}") for e, s in sorted(endpoints.items())])
+
+    metric('loyalty_query_calls_total', 'counter', 'Calls per normalized SQL fingerprint.',
+           [({'fingerprint': k}, s['calls']) for k, s in sorted(fingerprints.items())])
+    metric('loyalty_query_seconds_total', 'counter', 'Execution time per normalized SQL fingerprint.',
+           [({'fingerprint': k}, f"{s['seconds']:.6f}") for k, s in sorted(fingerprints.items())])
+    metric('loyalty_query_rows_total', 'counter', 'Rows fetched per normalized SQL fingerprint.',
+           [({'fingerprint': k}, s['rows']) for k, s in sorted(fingerprints.items())])
+    metric('loyalty_query_max_seconds', 'gauge', 'Slowest observed execution per normalized SQL fingerprint.',
+           [({'fingerprint': k}, f"{s['max_seconds']:.6f}") for k, s in sorted(fingerprints.items())])
+
+    for collect in _collectors:
+        try:
+            for name, kind, help_text, samples in collect():
+                metric(name, kind, help_text, samples)
+        except Exception as e:
+            logger.error(f"Metrics collector failed: {str(e)}")
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,241 @@
+"""
+Background refresh scheduler for derived analytics.
+
+Named jobs run on fixed intervals outside the request path. Every gunicorn
+worker may run the scheduler loop; a Postgres advisory lock per job plus the
+persisted last-run time in job_runs ensure each job runs once per interval
+across all workers. Results are written to analytics_snapshots and served by
+the dashboard endpoints through get_result(), which keeps a short in-process
+copy so a request costs at most one snapshot read.
+
+Tables are created by migrations/0002_job_state.sql.
+
+Run the loop inside the web workers with SCHEDULER_ENABLED=1, or as a
+separate process:
+    python jobs.py
+"""
+import os
+import time
+import socket
+import logging
+import threading
+from psycopg2.extras import Json
+
+import serialization
+
+logger = logging.getLogger(__name__)
+
+REFRESH_INTERVAL_SECONDS = int(os.getenv('REFRESH_INTERVAL_SECONDS', '300'))
+SCHEDULER_TICK_SECONDS = float(os.getenv('SCHEDULER_TICK_SECONDS', '5'))
+SNAPSHOT_RELOAD_SECONDS = float(os.getenv('SNAPSHOT_RELOAD_SECONDS', '15'))
+# Snapshots older than interval * STALE_FACTOR are ignored and the endpoint computes inline
+STALE_FACTOR = float(os.getenv('SNAPSHOT_STALE_FACTOR', '3'))
+# A job whose inputs changed (mark_stale) runs early, but at most once per this many seconds across workers
+STALE_MIN_SECONDS = float(os.getenv('JOB_STALE_MIN_SECONDS', '30'))
+
+
+def worker_id():
+    # Per call rather than at import: workers forked from a preloading master share its module state
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _json_dumps(obj):
+    return serialization.dumps(obj).decode('utf-8')
+
+
+class JobScheduler:
+    def __init__(self, run_query, sleep=time.sleep):
+        self.run_query = run_query
+        self.sleep = sleep
+        self.jobs = {}
+        self._results = {}
+        self._next_check = {}
+        self._running = set()
+        self._stale = set()
+        self._lock = threading.Lock()
+        self._started = False
+
+    def register(self, name, func, interval=None):
+        interval = interval or int(os.getenv(f"JOB_INTERVAL_{name.upper()}", REFRESH_INTERVAL_SECONDS))
+        self.jobs[name] = {'name': name, 'func': func, 'interval': interval}
+        self._next_check[name] = 0.0
+
+    def mark_stale(self, name):
+        """
+        Brings a job forward after its inputs changed. Picked up on the next
+        scheduler tick when the loop runs in this process.
+        """
+        if name not in self.jobs:
+            return
+        with self._lock:
+            self._stale.add(name)
+            self._next_check[name] = 0.0
+
+    def invalidate(self, name=None):
+        """
+        Drops the in-process copy of a snapshot (or all) so the next
+        get_result() reads the stored one.
+        """
+        with self._lock:
+            if name is None:
+                self._results.clear()
+            else:
+                self._results.pop(name, None)
+
+    def start(self, start_background_task):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        logger.info(f"Starting job scheduler on {worker_id()} with jobs: {', '.join(self.jobs)}")
+        start_background_task(self.run_forever)
+
+    def run_forever(self):
+        while True:
+            for name in list(self.jobs):
+                if time.monotonic() >= self._next_check[name]:
+                    self._next_check[name] = time.monotonic() + self.jobs[name]['interval']
+                    try:
+                        self.run(name)
+                    except Exception as e:
+                        logger.error(f"Job {name} crashed the scheduler tick: {str(e)}")
+            self.sleep(SCHEDULER_TICK_SECONDS)
+
+    def run(self, name, force=False):
+        """
+        Runs one job if it is due (or force=True) and no other worker holds its
+        lock. Returns 'ran', 'failed', 'skipped' (ran recently elsewhere) or 'locked'.
+        """
+        job = self.jobs[name]
+        # Advisory locks are re-entrant per session and workers share one connection,
+        # so guard against a second thread of this process first
+        with self._lock:
+            if name in self._running:
+                return 'locked'
+            self._running.add(name)
+        try:
+            return self._run_locked(name, job, force)
+        finally:
+            with self._lock:
+                self._running.discard(name)
+
+    def _run_locked(self, name, job, force):
+        lock = self.run_query("SELECT pg_try_advisory_lock(hashtext(%s)) AS locked", (f"job:{name}",))
+        if 'error' in lock or not lock['data'] or not lock['data'][0]['locked']:
+            return 'locked'
+        try:
+            if not force:
+                with self._lock:
+                    stale = name in self._stale
+                    self._stale.discard(name)
+                min_age = min(STALE_MIN_SECONDS, job['interval']) if stale else job['interval']
+                recent = self.run_query("""
+                    SELECT 1 FROM job_runs
+                    WHERE name = %s AND last_started_at > clock_timestamp() - %s * interval '1 second'
+                """, (name, min_age))
+                if recent['data']:
+                    if stale:
+                        # Still stale: try again once the minimum spacing has passed
+                        with self._lock:
+                            self._stale.add(name)
+                            self._next_check[name] = time.monotonic() + min_age
+                    return 'skipped'
+
+            self.run_query("""
+                INSERT INTO job_runs (name, last_started_at, last_status, worker)
+                VALUES (%s, clock_timestamp(), 'running', %s)
+                ON CONFLICT (name) DO UPDATE
+                SET last_started_at = clock_timestamp(), last_status = 'running', worker = EXCLUDED.worker
+            """, (name, worker_id()))
+
+            start = time.perf_counter()
+            try:
+                payload = job['func']()
+                stored = self.run_query("""
+                    INSERT INTO analytics_snapshots (name, payload, computed_at)
+                    VALUES (%s, %s, clock_timestamp())
+                    ON CONFLICT (name) DO UPDATE
+                    SET payload = EXCLUDED.payload, computed_at = EXCLUDED.computed_at
+                """, (name, Json(payload, dumps=_json_dumps)))
+                if 'error' in stored:
+                    raise RuntimeError(stored['error'])
+            except Exception as e:
+                duration_ms = (time.perf_counter() - start) * 1000
+                logger.error(f"Job {name} failed after {duration_ms:.0f}ms: {str(e)}")
+                self._record_finish(name, 'failed', str(e), duration_ms)
+                return 'failed'
+
+            duration_ms = (time.perf_counter() - start) * 1000
+            self._record_finish(name, 'ok', None, duration_ms)
+            with self._lock:
+                self._results.pop(name, None)
+            logger.info(f"Job {name} finished in {duration_ms:.0f}ms")
+            return 'ran'
+        finally:
+            self.run_query("SELECT pg_advisory_unlock(hashtext(%s))", (f"job:{name}",))
+
+    def _record_finish(self, name, status, error, duration_ms):
+        self.run_query("""
+            UPDATE job_runs
+            SET last_finished_at = clock_timestamp(), last_status = %s, last_error = %s,
+                last_duration_ms = %s, run_count = run_count + 1
+            WHERE name = %s
+        """, (status, error, round(duration_ms, 2), name))
+
+    def get_result(self, name):
+        """
+        Returns the latest snapshot payload for a job, or None when there is
+        no snapshot or it is older than interval * STALE_FACTOR.
+        """
+        job = self.jobs.get(name)
+        if not job:
+            return None
+        now = time.time()
+        with self._lock:
+            cached = self._results.get(name)
+        if not cached or now - cached['loaded_at'] >= min(job['interval'], SNAPSHOT_RELOAD_SECONDS):
+            response = self.run_query("""
+                SELECT payload, EXTRACT(EPOCH FROM computed_at) AS computed_at
+                FROM analytics_snapshots
+                WHERE name = %s
+            """, (name,))
+            row = response['data'][0] if response['data'] else None
+            cached = {
+                'payload': row['payload'] if row else None,
+                'computed_at': float(row['computed_at']) if row else 0.0,
+                'loaded_at': now
+            }
+            with self._lock:
+                self._results[name] = cached
+        if cached['payload'] is None or now - cached['computed_at'] > job['interval'] * STALE_FACTOR:
+            return None
+        return cached['payload']
+
+    def status(self):
+        response = self.run_query("""
+            SELECT j.name, j.last_started_at, j.last_finished_at, j.last_status, j.last_error,
+                   j.last_duration_ms, j.run_count, j.worker, s.computed_at AS snapshot_at
+            FROM job_runs j
+            LEFT JOIN analytics_snapshots s ON s.name = j.name
+        """)
+        persisted = {row['name']: row for row in response['data']}
+        return [
+            {
+                'name': name,
+                'interval': job['interval'],
+                'lastStartedAt': persisted.get(name, {}).get('last_started_at'),
+                'lastFinishedAt': persisted.get(name, {}).get('last_finished_at'),
+                'lastStatus': persisted.get(name, {}).get('last_status'),
+                'lastError': persisted.get(name, {}).get('last_error'),
+                'lastDurationMs': persisted.get(name, {}).get('last_duration_ms'),
+                'runCount': persisted.get(name, {}).get('run_count', 0),
+                'worker': persisted.get(name, {}).get('worker'),
+                'snapshotAt': persisted.get(name, {}).get('snapshot_at'),
+            }
+            for name, job in self.jobs.items()
+        ]
+
+
+if __name__ == '__main__':
+    from app import scheduler
+    scheduler.run_forever()
@@ -0,0 +1,272 @@
+"""
+Schema migration runner for the loyalty backend.
+
+Migrations are plain SQL files in ./migrations named NNNN_description.sql and
+are applied in version order. Applied versions are recorded in the
+schema_migrations table. A file whose first line is `-- migrate:no-transaction`
+runs statement by statement in autocommit mode (needed for CREATE INDEX
+CONCURRENTLY); every other file runs inside a single transaction.
+
+Usage:
+    python migrate.py status   # list applied / pending migrations
+    python migrate.py up       # apply pending migrations
+    python migrate.py verify   # check every declared index exists and is valid
+"""
+import os
+import re
+import sys
+import logging
+import psycopg2
+from dotenv import load_dotenv
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+NO_TRANSACTION_MARKER = '-- migrate:no-transaction'
+FILENAME_PATTERN = re.compile(r'^(\d{4})_(\w+)\.sql$')
+DOLLAR_QUOTE = re.compile(r'\$(\w*)\$')
+INDEX_PATTERN = re.compile(
+    r'CREATE\s+(?:UNIQUE\s+)?INDEX\s+(?:CONCURRENTLY\s+)?(?:IF\s+NOT\s+EXISTS\s+)?(\w+)\s+ON\s+(\w+)',
+    re.IGNORECASE
+)
+
+
+def load_migrations(directory=MIGRATIONS_DIR):
+    migrations = []
+    for filename in sorted(os.listdir(directory)):
+        match = FILENAME_PATTERN.match(filename)
+        if not match:
+            continue
+        with open(os.path.join(directory, filename)) as f:
+            sql = f.read()
+        migrations.append({
+            'version': match.group(1),
+            'name': match.group(2),
+            'sql': sql,
+            'transactional': not sql.lstrip().startswith(NO_TRANSACTION_MARKER)
+        })
+    return migrations
+
+
+def _quoted_end(text, pos):
+    """
+    End of the '...' literal or "..." identifier opening at pos. A doubled
+    quote is an escaped quote; in E'...' strings so is a backslash escape.
+    """
+    quote = text[pos]
+    backslashes = (
+        quote == "'" and pos > 0 and text[pos - 1] in 'eE'
+        and (pos < 2 or not (text[pos - 2].isalnum() or text[pos - 2] == '_'))
+    )
+    pos += 1
+    while pos < len(text):
+        if backslashes and text[pos] == '\\':
+            pos += 2
+        elif text[pos] == quote:
+            if not text.startswith(quote * 2, pos):
+                return pos + 1
+            pos += 2
+        else:
+            pos += 1
+    return len(text)
+
+
+def _block_comment_end(text, pos):
+    """End of the /* ... */ comment opening at pos; Postgres lets them nest."""
+    depth = 0
+    while pos < len(text):
+        if text.startswith('/*', pos):
+            depth += 1
+            pos += 2
+        elif text.startswith('*/', pos):
+            depth -= 1
+            pos += 2
+            if not depth:
+                return pos
+        else:
+            pos += 1
+    return len(text)
+
+
+def split_statements(sql):
+    """
+    Splits on semicolons outside quoted text: dollar-quoted bodies ($$ ... $$
+    in CREATE FUNCTION), '...' literals and "..." identifiers. -- and /* */
+    comments are dropped, so a semicolon in one never splits and a comment
+    after the last statement is not a statement of its own.
+    """
+    statements = []
+    pieces = []
+    start = pos = 0
+    while pos < len(sql):
+        char = sql[pos]
+        if sql.startswith('--', pos) or sql.startswith('/*', pos):
+            pieces.append(sql[start:pos])
+            if char == '-':
+                end = sql.find('\n', pos)
+                pos = len(sql) if end == -1 else end
+            else:
+                pos = _block_comment_end(sql, pos)
+                pieces.append(' ')
+            start = pos
+            continue
+        if char in ('\'', '"'):
+            pos = _quoted_end(sql, pos)
+            continue
+        quote = DOLLAR_QUOTE.match(sql, pos) if char == '$' else None
+        if quote:
+            end = sql.find(quote.group(0), quote.end())
+            pos = len(sql) if end == -1 else end + len(quote.group(0))
+            continue
+        if char == ';':
+            pieces.append(sql[start:pos])
+            statements.append(''.join(pieces))
+            pieces = []
+            start = pos + 1
+        pos += 1
+    pieces.append(sql[start:])
+    statements.append(''.join(pieces))
+    return [stmt.strip() for stmt in statements if stmt.strip()]
+
+
+def ensure_migrations_table(conn):
+    with conn.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )
+        """)
+    conn.commit()
+
+
+def applied_versions(conn):
+    ensure_migrations_table(conn)
+    with conn.cursor() as cur:
+        cur.execute("SELECT version FROM schema_migrations")
+        versions = {row[0] for row in cur.fetchall()}
+    conn.commit()
+    return versions
+
+
+def apply_migration(conn, migration):
+    statements = split_statements(migration['sql'])
+    if migration['transactional']:
+        try:
+            with conn.cursor() as cur:
+                for stmt in statements:
+                    cur.execute(stmt)
+                cur.execute(
+                    "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                    (migration['version'], migration['name'])
+                )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return
+
+    previous_autocommit = conn.autocommit
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            for stmt in statements:
+                cur.execute(stmt)
+            cur.execute(
+                "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                (migration['version'], migration['name'])
+            )
+    finally:
+        conn.autocommit = previous_autocommit
+
+
+def migrate(conn, migrations=None):
+    migrations = migrations if migrations is not None else load_migrations()
+    done = applied_versions(conn)
+    applied = []
+    for migration in migrations:
+        if migration['version'] in done:
+            continue
+        logger.info(f"Applying migration {migration['version']}_{migration['name']}")
+        apply_migration(conn, migration)
+        applied.append(migration['version'])
+    return applied
+
+
+def declared_indexes(migrations=None):
+    migrations = migrations if migrations is not None else load_migrations()
+    indexes = []
+    for migration in migrations:
+        for name, table in INDEX_PATTERN.findall(migration['sql']):
+            indexes.append((name, table))
+    return indexes
+
+
+def verify_indexes(conn, migrations=None):
+    """
+    Returns {index_name: 'OK' | 'Missing' | 'Invalid' | 'Wrong table'} for
+    every index declared in the migration files.
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT c.relname, t.relname, i.indisvalid
+            FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indexrelid
+            JOIN pg_class t ON t.oid = i.indrelid
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = current_schema()
+        """)
+        existing = {row[0]: (row[1], row[2]) for row in cur.fetchall()}
+    conn.commit()
+
+    status = {}
+    for name, table in declared_indexes(migrations):
+        if name not in existing:
+            status[name] = 'Missing'
+        elif existing[name][0] != table:
+            status[name] = 'Wrong table'
+        elif not existing[name][1]:
+            status[name] = 'Invalid'
+        else:
+            status[name] = 'OK'
+    return status
+
+
+def main(argv):
+    load_dotenv()
+    command = argv[1] if len(argv) > 1 else 'status'
+    database_url = os.getenv('DATABASE_URL')
+    if not database_url:
+        logger.error("DATABASE_URL not set")
+        return 1
+
+    conn = psycopg2.connect(database_url)
+    try:
+        migrations = load_migrations()
+        if command == 'status':
+            done = applied_versions(conn)
+            for migration in migrations:
+                state = 'applied' if migration['version'] in done else 'pending'
+                print(f"{migration['version']}_{migration['name']}: {state}")
+        elif command == 'up':
+            applied = migrate(conn, migrations)
+            print(f"Applied {len(applied)} migration(s)" + (f": {', '.join(applied)}" if applied else ''))
+        elif command == 'verify':
+            status = verify_indexes(conn, migrations)
+            for name, state in status.items():
+                print(f"{name}: {state}")
+            if any(state != 'OK' for state in status.values()):
+                print("Invalid indexes must be dropped (DROP INDEX CONCURRENTLY) and re-created with `migrate.py up`")
+                return 1
+        else:
+            print(__doc__)
+            return 1
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
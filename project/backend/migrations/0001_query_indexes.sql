@@ -0,0 +1,31 @@
+-- migrate:no-transaction
+-- Indexes backing the date-range, membership and search filters issued by app.py.
+-- Built CONCURRENTLY so staff endpoints keep writing while the migration runs;
+-- a failed build leaves an INVALID index behind, which `migrate.py verify` reports.
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+-- Date-range scans: kpis(), additional_kpis(), transactions(), charts()
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_transactions_date ON transactions (date);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_orders_date ON orders (date);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_ml_predictions_prediction_date ON ml_predictions (prediction_date);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_referrals_date ON referrals (date);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_created_at ON users (created_at);
+
+-- Per-customer history: customer_lookup()
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_transactions_customer_date ON transactions (customer_id, date);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_orders_customer_date ON orders (customer_id, date);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_ml_predictions_customer_date ON ml_predictions (customer_id, prediction_date DESC);
+
+-- Type filter: get_rewards(), top_rewards()
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_transactions_type ON transactions (type);
+
+-- Membership lookups: campaigns(), segments(), customers()
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_campaign_participants_campaign ON campaign_participants (campaign_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_user_segments_segment ON user_segments (segment_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_user_segments_customer ON user_segments (customer_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_referrals_referrer ON referrals (referrer_id);
+
+-- Substring search (ILIKE '%term%'): customer_lookup()
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_email_trgm ON users USING gin (email gin_trgm_ops);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_phone_trgm ON users USING gin (phone gin_trgm_ops);
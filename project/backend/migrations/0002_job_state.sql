@@ -0,0 +1,19 @@
+-- State for the background refresh scheduler (jobs.py).
+
+CREATE TABLE IF NOT EXISTS job_runs (
+    name TEXT PRIMARY KEY,
+    last_started_at TIMESTAMPTZ,
+    last_finished_at TIMESTAMPTZ,
+    last_status TEXT,
+    last_error TEXT,
+    last_duration_ms NUMERIC(12, 2),
+    run_count BIGINT NOT NULL DEFAULT 0,
+    worker TEXT
+);
+
+-- Latest result of each refresh job, served by the dashboard endpoints
+CREATE TABLE IF NOT EXISTS analytics_snapshots (
+    name TEXT PRIMARY KEY,
+    payload JSONB NOT NULL,
+    computed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
@@ -0,0 +1,24 @@
+-- Rule-driven segment membership maintained by segmentation.py.
+
+-- Rule definition and evaluation order per segment; segments without rules are not engine-managed
+ALTER TABLE segments ADD COLUMN IF NOT EXISTS rules JSONB;
+ALTER TABLE segments ADD COLUMN IF NOT EXISTS priority INTEGER NOT NULL DEFAULT 100;
+
+-- One segment per customer, which customers() and charts() already assume
+DELETE FROM user_segments a USING user_segments b
+WHERE a.ctid < b.ctid AND a.customer_id = b.customer_id;
+CREATE UNIQUE INDEX IF NOT EXISTS uq_user_segments_customer ON user_segments (customer_id);
+
+-- Per-member features captured at evaluation time so segment summaries need no transaction scan
+ALTER TABLE user_segments ADD COLUMN IF NOT EXISTS spend NUMERIC(14, 2);
+ALTER TABLE user_segments ADD COLUMN IF NOT EXISTS points INTEGER;
+ALTER TABLE user_segments ADD COLUMN IF NOT EXISTS active BOOLEAN;
+ALTER TABLE user_segments ADD COLUMN IF NOT EXISTS evaluated_at TIMESTAMPTZ;
+
+CREATE TABLE IF NOT EXISTS segmentation_state (
+    id INTEGER PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    activity_watermark TIMESTAMPTZ,
+    rfm_breakpoints JSONB,
+    last_full_run_at TIMESTAMPTZ,
+    last_incremental_run_at TIMESTAMPTZ
+);
@@ -0,0 +1,18 @@
+-- State for the campaign rules engine (campaigns.py).
+
+-- One participant row per campaign and customer so awards can be upserted
+DELETE FROM campaign_participants a USING campaign_participants b
+WHERE a.id > b.id AND a.campaign_id = b.campaign_id AND a.customer_id = b.customer_id;
+CREATE UNIQUE INDEX IF NOT EXISTS uq_campaign_participants_campaign_customer ON campaign_participants (campaign_id, customer_id);
+
+-- Per-participant totals accumulated by the engine
+ALTER TABLE campaign_participants ADD COLUMN IF NOT EXISTS points_awarded INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE campaign_participants ADD COLUMN IF NOT EXISTS revenue NUMERIC(14, 2) NOT NULL DEFAULT 0;
+ALTER TABLE campaign_participants ADD COLUMN IF NOT EXISTS last_event_at TIMESTAMPTZ;
+
+-- Highest orders / transactions id already applied to campaign totals, per source table
+CREATE TABLE IF NOT EXISTS campaign_state (
+    source TEXT PRIMARY KEY,
+    last_id BIGINT NOT NULL DEFAULT 0,
+    last_run_at TIMESTAMPTZ
+);
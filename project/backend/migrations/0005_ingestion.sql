@@ -0,0 +1,17 @@
+-- Idempotency keys and outcomes for buffered event ingestion (ingestion.py).
+
+CREATE TABLE IF NOT EXISTS ingested_events (
+    event_id TEXT PRIMARY KEY,
+    customer_id TEXT NOT NULL,
+    type TEXT NOT NULL,
+    points INTEGER,
+    amount NUMERIC(12, 2),
+    occurred_at TIMESTAMPTZ,
+    received_at TIMESTAMPTZ NOT NULL,
+    processed_at TIMESTAMPTZ,
+    status TEXT NOT NULL DEFAULT 'pending',
+    error TEXT
+);
+
+-- Retention: old keys can be pruned by received_at once clients no longer retry them
+CREATE INDEX IF NOT EXISTS idx_ingested_events_received_at ON ingested_events (received_at);
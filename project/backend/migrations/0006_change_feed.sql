@@ -0,0 +1,85 @@
+-- Transactional outbox for the change feed (changefeed.py).
+-- Triggers write typed change events in the same transaction as the change
+-- itself, whichever code path made it, and wake listeners with NOTIFY.
+
+CREATE TABLE IF NOT EXISTS change_events (
+    id BIGSERIAL PRIMARY KEY,
+    -- Writing transaction; consumers read in (txid, id) order below the oldest running transaction
+    txid XID8 NOT NULL DEFAULT pg_current_xact_id(),
+    type TEXT NOT NULL,
+    entity_id TEXT,
+    payload JSONB NOT NULL DEFAULT '{}'::jsonb,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp()
+);
+CREATE INDEX IF NOT EXISTS idx_change_events_txid_id ON change_events (txid, id);
+CREATE INDEX IF NOT EXISTS idx_change_events_created_at ON change_events (created_at);
+
+-- Row-level and limited to points_balance so tier and segment batch updates do not fire it
+CREATE OR REPLACE FUNCTION change_feed_balance() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    INSERT INTO change_events (type, entity_id, payload)
+    VALUES ('balance_changed', NEW.id, jsonb_build_object(
+        'customer_id', NEW.id,
+        'old_balance', OLD.points_balance,
+        'new_balance', NEW.points_balance,
+        'points_earned', NEW.points_earned
+    ));
+    PERFORM pg_notify('loyalty_changes', '');
+    RETURN NULL;
+END
+$$;
+
+-- Statement-level with a transition table, so a multi-row insert costs one trigger call
+CREATE OR REPLACE FUNCTION change_feed_transactions() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    INSERT INTO change_events (type, entity_id, payload)
+    SELECT 'redemption', n.customer_id, jsonb_build_object(
+        'customer_id', n.customer_id,
+        'transaction_id', n.id,
+        'points', n.points,
+        'context', n.context
+    )
+    FROM new_rows n
+    WHERE n.type = 'redeem'
+    ORDER BY n.id;
+    IF FOUND THEN
+        PERFORM pg_notify('loyalty_changes', '');
+    END IF;
+    RETURN NULL;
+END
+$$;
+
+CREATE OR REPLACE FUNCTION change_feed_orders() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    INSERT INTO change_events (type, entity_id, payload)
+    SELECT 'order_created', n.customer_id, jsonb_build_object(
+        'customer_id', n.customer_id,
+        'order_id', n.id,
+        'total', n.total
+    )
+    FROM new_rows n
+    ORDER BY n.id;
+    IF FOUND THEN
+        PERFORM pg_notify('loyalty_changes', '');
+    END IF;
+    RETURN NULL;
+END
+$$;
+
+DROP TRIGGER IF EXISTS change_feed_balance ON users;
+CREATE TRIGGER change_feed_balance
+    AFTER UPDATE OF points_balance ON users
+    FOR EACH ROW WHEN (OLD.points_balance IS DISTINCT FROM NEW.points_balance)
+    EXECUTE FUNCTION change_feed_balance();
+
+DROP TRIGGER IF EXISTS change_feed_transactions ON transactions;
+CREATE TRIGGER change_feed_transactions
+    AFTER INSERT ON transactions
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION change_feed_transactions();
+
+DROP TRIGGER IF EXISTS change_feed_orders ON orders;
+CREATE TRIGGER change_feed_orders
+    AFTER INSERT ON orders
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION change_feed_orders();
@@ -0,0 +1,220 @@
+-- Daily rollups of orders, transactions and referrals for the time-series dashboards (rollups.py).
+-- Statement-level triggers apply each write's delta in the same transaction, for every writer;
+-- rebuild_rollups() recomputes everything from the raw tables and backfills them here.
+
+CREATE TABLE IF NOT EXISTS daily_rollups (
+    day DATE PRIMARY KEY,
+    orders INTEGER NOT NULL DEFAULT 0,
+    order_total NUMERIC(14, 2) NOT NULL DEFAULT 0,
+    order_subtotal NUMERIC(14, 2) NOT NULL DEFAULT 0,
+    referrals INTEGER NOT NULL DEFAULT 0,
+    referral_points BIGINT NOT NULL DEFAULT 0
+);
+
+-- reward_id is the reward named at the end of a redeem_points context, '' otherwise
+CREATE TABLE IF NOT EXISTS daily_points_rollup (
+    day DATE NOT NULL,
+    type TEXT NOT NULL,
+    reward_id TEXT NOT NULL DEFAULT '',
+    points_earned BIGINT NOT NULL DEFAULT 0,
+    points_redeemed BIGINT NOT NULL DEFAULT 0,
+    transactions INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, type, reward_id)
+);
+
+-- Distinct and repeat customers cannot be summed from daily counts, so they come from here
+CREATE TABLE IF NOT EXISTS customer_monthly_orders (
+    month DATE NOT NULL,
+    customer_id TEXT NOT NULL,
+    orders INTEGER NOT NULL DEFAULT 0,
+    total NUMERIC(14, 2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (month, customer_id)
+);
+
+CREATE OR REPLACE FUNCTION rollup_reward_id(txn_type TEXT, context TEXT) RETURNS TEXT
+LANGUAGE sql IMMUTABLE AS $$
+    SELECT CASE WHEN txn_type = 'redeem_points' THEN COALESCE(substring(context FROM '(\S+)\s*$'), '') ELSE '' END
+$$;
+
+-- Signed row images: +1 for inserted / new rows, -1 for deleted / old rows
+DROP TYPE IF EXISTS rollup_order_delta, rollup_transaction_delta, rollup_referral_delta;
+CREATE TYPE rollup_order_delta AS (date TIMESTAMPTZ, customer_id TEXT, total NUMERIC, subtotal NUMERIC, sign INTEGER);
+CREATE TYPE rollup_transaction_delta AS (date TIMESTAMPTZ, type TEXT, context TEXT, points INTEGER, sign INTEGER);
+CREATE TYPE rollup_referral_delta AS (date TIMESTAMPTZ, reward_points INTEGER, sign INTEGER);
+
+-- Upserts are ordered by key so concurrent writers lock rollup rows in the same order
+CREATE OR REPLACE FUNCTION rollup_orders() RETURNS trigger LANGUAGE plpgsql AS $$
+DECLARE
+    deltas rollup_order_delta[];
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        deltas := ARRAY(SELECT ROW(n.date, n.customer_id, n.total, n.subtotal, 1)::rollup_order_delta FROM new_rows n);
+    ELSIF TG_OP = 'DELETE' THEN
+        deltas := ARRAY(SELECT ROW(o.date, o.customer_id, o.total, o.subtotal, -1)::rollup_order_delta FROM old_rows o);
+    ELSE
+        deltas := ARRAY(
+            SELECT ROW(n.date, n.customer_id, n.total, n.subtotal, 1)::rollup_order_delta FROM new_rows n
+            UNION ALL
+            SELECT ROW(o.date, o.customer_id, o.total, o.subtotal, -1)::rollup_order_delta FROM old_rows o
+        );
+    END IF;
+
+    INSERT INTO daily_rollups AS r (day, orders, order_total, order_subtotal)
+    SELECT (d.date AT TIME ZONE 'UTC')::date, SUM(d.sign),
+           COALESCE(SUM(d.sign * d.total), 0), COALESCE(SUM(d.sign * d.subtotal), 0)
+    FROM unnest(deltas) d
+    WHERE d.date IS NOT NULL
+    GROUP BY 1
+    HAVING SUM(d.sign) <> 0 OR COALESCE(SUM(d.sign * d.total), 0) <> 0 OR COALESCE(SUM(d.sign * d.subtotal), 0) <> 0
+    ORDER BY 1
+    ON CONFLICT (day) DO UPDATE
+    SET orders = r.orders + EXCLUDED.orders,
+        order_total = r.order_total + EXCLUDED.order_total,
+        order_subtotal = r.order_subtotal + EXCLUDED.order_subtotal;
+
+    INSERT INTO customer_monthly_orders AS c (month, customer_id, orders, total)
+    SELECT date_trunc('month', d.date AT TIME ZONE 'UTC')::date, d.customer_id, SUM(d.sign), COALESCE(SUM(d.sign * d.total), 0)
+    FROM unnest(deltas) d
+    WHERE d.date IS NOT NULL AND d.customer_id IS NOT NULL
+    GROUP BY 1, 2
+    HAVING SUM(d.sign) <> 0 OR COALESCE(SUM(d.sign * d.total), 0) <> 0
+    ORDER BY 1, 2
+    ON CONFLICT (month, customer_id) DO UPDATE
+    SET orders = c.orders + EXCLUDED.orders,
+        total = c.total + EXCLUDED.total;
+    RETURN NULL;
+END
+$$;
+
+CREATE OR REPLACE FUNCTION rollup_transactions() RETURNS trigger LANGUAGE plpgsql AS $$
+DECLARE
+    deltas rollup_transaction_delta[];
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        deltas := ARRAY(SELECT ROW(n.date, n.type, n.context, n.points, 1)::rollup_transaction_delta FROM new_rows n);
+    ELSIF TG_OP = 'DELETE' THEN
+        deltas := ARRAY(SELECT ROW(o.date, o.type, o.context, o.points, -1)::rollup_transaction_delta FROM old_rows o);
+    ELSE
+        deltas := ARRAY(
+            SELECT ROW(n.date, n.type, n.context, n.points, 1)::rollup_transaction_delta FROM new_rows n
+            UNION ALL
+            SELECT ROW(o.date, o.type, o.context, o.points, -1)::rollup_transaction_delta FROM old_rows o
+        );
+    END IF;
+
+    INSERT INTO daily_points_rollup AS r (day, type, reward_id, points_earned, points_redeemed, transactions)
+    SELECT (d.date AT TIME ZONE 'UTC')::date, COALESCE(d.type, ''), rollup_reward_id(d.type, d.context),
+           SUM(d.sign * GREATEST(COALESCE(d.points, 0), 0)), SUM(d.sign * GREATEST(-COALESCE(d.points, 0), 0)), SUM(d.sign)
+    FROM unnest(deltas) d
+    WHERE d.date IS NOT NULL
+    GROUP BY 1, 2, 3
+    HAVING SUM(d.sign) <> 0 OR SUM(d.sign * COALESCE(d.points, 0)) <> 0
+    ORDER BY 1, 2, 3
+    ON CONFLICT (day, type, reward_id) DO UPDATE
+    SET points_earned = r.points_earned + EXCLUDED.points_earned,
+        points_redeemed = r.points_redeemed + EXCLUDED.points_redeemed,
+        transactions = r.transactions + EXCLUDED.transactions;
+    RETURN NULL;
+END
+$$;
+
+CREATE OR REPLACE FUNCTION rollup_referrals() RETURNS trigger LANGUAGE plpgsql AS $$
+DECLARE
+    deltas rollup_referral_delta[];
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        deltas := ARRAY(SELECT ROW(n.date, n.reward_points, 1)::rollup_referral_delta FROM new_rows n);
+    ELSIF TG_OP = 'DELETE' THEN
+        deltas := ARRAY(SELECT ROW(o.date, o.reward_points, -1)::rollup_referral_delta FROM old_rows o);
+    ELSE
+        deltas := ARRAY(
+            SELECT ROW(n.date, n.reward_points, 1)::rollup_referral_delta FROM new_rows n
+            UNION ALL
+            SELECT ROW(o.date, o.reward_points, -1)::rollup_referral_delta FROM old_rows o
+        );
+    END IF;
+
+    INSERT INTO daily_rollups AS r (day, referrals, referral_points)
+    SELECT (d.date AT TIME ZONE 'UTC')::date, SUM(d.sign), COALESCE(SUM(d.sign * d.reward_points), 0)
+    FROM unnest(deltas) d
+    WHERE d.date IS NOT NULL
+    GROUP BY 1
+    HAVING SUM(d.sign) <> 0 OR COALESCE(SUM(d.sign * d.reward_points), 0) <> 0
+    ORDER BY 1
+    ON CONFLICT (day) DO UPDATE
+    SET referrals = r.referrals + EXCLUDED.referrals,
+        referral_points = r.referral_points + EXCLUDED.referral_points;
+    RETURN NULL;
+END
+$$;
+
+-- Transition tables allow one event per trigger, hence three triggers per table
+DROP TRIGGER IF EXISTS rollup_orders_insert ON orders;
+CREATE TRIGGER rollup_orders_insert AFTER INSERT ON orders
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION rollup_orders();
+DROP TRIGGER IF EXISTS rollup_orders_update ON orders;
+CREATE TRIGGER rollup_orders_update AFTER UPDATE ON orders
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION rollup_orders();
+DROP TRIGGER IF EXISTS rollup_orders_delete ON orders;
+CREATE TRIGGER rollup_orders_delete AFTER DELETE ON orders
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION rollup_orders();
+
+DROP TRIGGER IF EXISTS rollup_transactions_insert ON transactions;
+CREATE TRIGGER rollup_transactions_insert AFTER INSERT ON transactions
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION rollup_transactions();
+DROP TRIGGER IF EXISTS rollup_transactions_update ON transactions;
+CREATE TRIGGER rollup_transactions_update AFTER UPDATE ON transactions
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION rollup_transactions();
+DROP TRIGGER IF EXISTS rollup_transactions_delete ON transactions;
+CREATE TRIGGER rollup_transactions_delete AFTER DELETE ON transactions
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION rollup_transactions();
+
+DROP TRIGGER IF EXISTS rollup_referrals_insert ON referrals;
+CREATE TRIGGER rollup_referrals_insert AFTER INSERT ON referrals
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION rollup_referrals();
+DROP TRIGGER IF EXISTS rollup_referrals_update ON referrals;
+CREATE TRIGGER rollup_referrals_update AFTER UPDATE ON referrals
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION rollup_referrals();
+DROP TRIGGER IF EXISTS rollup_referrals_delete ON referrals;
+CREATE TRIGGER rollup_referrals_delete AFTER DELETE ON referrals
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION rollup_referrals();
+
+CREATE OR REPLACE FUNCTION rebuild_rollups() RETURNS void LANGUAGE plpgsql AS $$
+BEGIN
+    -- Writers wait until the calling transaction commits, so no delta is lost or counted twice
+    LOCK TABLE orders, transactions, referrals IN SHARE ROW EXCLUSIVE MODE;
+    TRUNCATE daily_rollups, daily_points_rollup, customer_monthly_orders;
+
+    INSERT INTO daily_rollups (day, orders, order_total, order_subtotal, referrals, referral_points)
+    SELECT day, SUM(orders), SUM(order_total), SUM(order_subtotal), SUM(referrals), SUM(referral_points)
+    FROM (
+        SELECT (date AT TIME ZONE 'UTC')::date AS day, COUNT(*) AS orders,
+               COALESCE(SUM(total), 0) AS order_total, COALESCE(SUM(subtotal), 0) AS order_subtotal,
+               0 AS referrals, 0 AS referral_points
+        FROM orders
+        WHERE date IS NOT NULL
+        GROUP BY 1
+        UNION ALL
+        SELECT (date AT TIME ZONE 'UTC')::date, 0, 0, 0, COUNT(*), COALESCE(SUM(reward_points), 0)
+        FROM referrals
+        WHERE date IS NOT NULL
+        GROUP BY 1
+    ) s
+    GROUP BY day;
+
+    INSERT INTO daily_points_rollup (day, type, reward_id, points_earned, points_redeemed, transactions)
+    SELECT (date AT TIME ZONE 'UTC')::date, COALESCE(type, ''), rollup_reward_id(type, context),
+           SUM(GREATEST(COALESCE(points, 0), 0)), SUM(GREATEST(-COALESCE(points, 0), 0)), COUNT(*)
+    FROM transactions
+    WHERE date IS NOT NULL
+    GROUP BY 1, 2, 3;
+
+    INSERT INTO customer_monthly_orders (month, customer_id, orders, total)
+    SELECT date_trunc('month', date AT TIME ZONE 'UTC')::date, customer_id, COUNT(*), COALESCE(SUM(total), 0)
+    FROM orders
+    WHERE date IS NOT NULL AND customer_id IS NOT NULL
+    GROUP BY 1, 2;
+END
+$$;
+
+SELECT rebuild_rollups();
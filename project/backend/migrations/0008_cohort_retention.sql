@@ -0,0 +1,25 @@
+-- Cohort retention cache maintained by cohorts.py. Customers are grouped by signup month
+-- (users.created_at, UTC); a cell counts the customers of a cohort with an order or a
+-- transaction in a given calendar month. Only closed months are stored: their cells are
+-- final unless activity is backdated, which the per-month counts below detect.
+
+CREATE TABLE IF NOT EXISTS retention_cohorts (
+    cohort DATE PRIMARY KEY,
+    customers BIGINT NOT NULL,
+    computed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS retention_cells (
+    cohort DATE NOT NULL,
+    month DATE NOT NULL,
+    active BIGINT NOT NULL,
+    PRIMARY KEY (month, cohort)
+);
+
+-- Orders and transactions in the month when its cells were computed, from the daily rollups
+CREATE TABLE IF NOT EXISTS retention_months (
+    month DATE PRIMARY KEY,
+    orders BIGINT NOT NULL,
+    transactions BIGINT NOT NULL,
+    computed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
@@ -0,0 +1,36 @@
+-- Referral graph maintained by referral_graph.py: one node per customer in a referral chain.
+-- A customer's referrer is the referrer of their earliest referral; path lists the
+-- ancestors root first, so a subtree is every node whose path contains its root.
+
+CREATE TABLE IF NOT EXISTS referral_nodes (
+    customer_id TEXT PRIMARY KEY,
+    referrer_id TEXT,
+    root_id TEXT NOT NULL,
+    depth INTEGER NOT NULL DEFAULT 0,
+    path TEXT[] NOT NULL DEFAULT '{}',
+    direct_referrals INTEGER NOT NULL DEFAULT 0,
+    -- Customers referred directly or through any chain below this one
+    downline INTEGER NOT NULL DEFAULT 0,
+    -- Order totals of the customer itself and of its whole downline
+    own_value NUMERIC(14, 2) NOT NULL DEFAULT 0,
+    chain_value NUMERIC(14, 2) NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+-- Adjacency (referrer -> referees), subtree lookups and the top-referrer rankings
+CREATE INDEX IF NOT EXISTS idx_referral_nodes_referrer ON referral_nodes (referrer_id);
+CREATE INDEX IF NOT EXISTS idx_referral_nodes_path ON referral_nodes USING gin (path);
+CREATE INDEX IF NOT EXISTS idx_referral_nodes_downline ON referral_nodes (downline DESC) WHERE downline > 0;
+CREATE INDEX IF NOT EXISTS idx_referral_nodes_chain_value ON referral_nodes (chain_value DESC) WHERE downline > 0;
+CREATE INDEX IF NOT EXISTS idx_referral_nodes_direct ON referral_nodes (direct_referrals DESC) WHERE downline > 0;
+
+CREATE TABLE IF NOT EXISTS referral_graph_state (
+    id INTEGER PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    referral_watermark BIGINT NOT NULL DEFAULT 0,
+    activity_watermark TIMESTAMPTZ,
+    last_full_run_at TIMESTAMPTZ,
+    last_incremental_run_at TIMESTAMPTZ
+);
+
+-- Incremental runs check that a referral is its referee's earliest
+CREATE INDEX IF NOT EXISTS idx_referrals_referee_date ON referrals (referee_id, date, id);
@@ -0,0 +1,12 @@
+-- Per-day mergeable sketches for the optional sketch-based KPIs (sketches.py).
+-- rows is the number of source rows the sketch was built from; a day whose current
+-- count differs is rebuilt on the next refresh.
+
+CREATE TABLE IF NOT EXISTS daily_sketches (
+    day DATE NOT NULL,
+    metric TEXT NOT NULL,
+    sketch BYTEA NOT NULL,
+    rows BIGINT NOT NULL,
+    computed_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (metric, day)
+);
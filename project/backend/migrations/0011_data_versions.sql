@@ -0,0 +1,86 @@
+-- Change counters for conditional GETs (dataversions.py). Triggers bump a counter in the same
+-- transaction as the write, for every writer, so a version is never visible before its data.
+
+CREATE TABLE IF NOT EXISTS data_versions (
+    name TEXT PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 0,
+    changed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+INSERT INTO data_versions (name)
+VALUES ('rewards'), ('campaigns'), ('campaign_participants'), ('promotions'), ('segments'), ('redemptions')
+ON CONFLICT (name) DO NOTHING;
+
+-- Statement-level, so a batch write bumps its counter once; statements that touched no rows do not
+-- (each transition table is only referenced in the branch of the operation that has it)
+CREATE OR REPLACE FUNCTION bump_data_version() RETURNS trigger LANGUAGE plpgsql AS $$
+DECLARE
+    changed BOOLEAN := TRUE;
+BEGIN
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        changed := EXISTS (SELECT 1 FROM new_rows);
+    ELSIF TG_OP = 'DELETE' THEN
+        changed := EXISTS (SELECT 1 FROM old_rows);
+    END IF;
+    IF NOT changed THEN
+        RETURN NULL;
+    END IF;
+    UPDATE data_versions SET version = version + 1, changed_at = clock_timestamp() WHERE name = TG_ARGV[0];
+    RETURN NULL;
+END
+$$;
+
+-- Only redeem transactions change reward redemption counts; earn traffic leaves the counter alone
+CREATE OR REPLACE FUNCTION bump_redemptions_version() RETURNS trigger LANGUAGE plpgsql AS $$
+DECLARE
+    changed BOOLEAN := TRUE;
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        changed := EXISTS (SELECT 1 FROM new_rows WHERE type = 'redeem');
+    ELSIF TG_OP = 'DELETE' THEN
+        changed := EXISTS (SELECT 1 FROM old_rows WHERE type = 'redeem');
+    ELSIF TG_OP = 'UPDATE' THEN
+        changed := EXISTS (SELECT 1 FROM new_rows WHERE type = 'redeem')
+                   OR EXISTS (SELECT 1 FROM old_rows WHERE type = 'redeem');
+    END IF;
+    IF NOT changed THEN
+        RETURN NULL;
+    END IF;
+    UPDATE data_versions SET version = version + 1, changed_at = clock_timestamp() WHERE name = 'redemptions';
+    RETURN NULL;
+END
+$$;
+
+DO $$
+DECLARE
+    t TEXT;
+BEGIN
+    FOREACH t IN ARRAY ARRAY['rewards', 'campaigns', 'campaign_participants', 'promotions', 'segments'] LOOP
+        EXECUTE format('DROP TRIGGER IF EXISTS data_version_insert ON %I', t);
+        EXECUTE format('CREATE TRIGGER data_version_insert AFTER INSERT ON %I REFERENCING NEW TABLE AS new_rows '
+                       'FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version(%L)', t, t);
+        EXECUTE format('DROP TRIGGER IF EXISTS data_version_update ON %I', t);
+        EXECUTE format('CREATE TRIGGER data_version_update AFTER UPDATE ON %I REFERENCING OLD TABLE AS old_rows '
+                       'NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version(%L)', t, t);
+        EXECUTE format('DROP TRIGGER IF EXISTS data_version_delete ON %I', t);
+        EXECUTE format('CREATE TRIGGER data_version_delete AFTER DELETE ON %I REFERENCING OLD TABLE AS old_rows '
+                       'FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version(%L)', t, t);
+        EXECUTE format('DROP TRIGGER IF EXISTS data_version_truncate ON %I', t);
+        EXECUTE format('CREATE TRIGGER data_version_truncate AFTER TRUNCATE ON %I '
+                       'FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version(%L)', t, t);
+    END LOOP;
+END
+$$;
+
+DROP TRIGGER IF EXISTS data_version_redemptions_insert ON transactions;
+CREATE TRIGGER data_version_redemptions_insert AFTER INSERT ON transactions
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION bump_redemptions_version();
+DROP TRIGGER IF EXISTS data_version_redemptions_update ON transactions;
+CREATE TRIGGER data_version_redemptions_update AFTER UPDATE ON transactions
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION bump_redemptions_version();
+DROP TRIGGER IF EXISTS data_version_redemptions_delete ON transactions;
+CREATE TRIGGER data_version_redemptions_delete AFTER DELETE ON transactions
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION bump_redemptions_version();
+DROP TRIGGER IF EXISTS data_version_redemptions_truncate ON transactions;
+CREATE TRIGGER data_version_redemptions_truncate AFTER TRUNCATE ON transactions
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_redemptions_version();
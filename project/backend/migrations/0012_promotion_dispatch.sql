@@ -0,0 +1,34 @@
+-- Promotion audiences and bulk dispatch (dispatch.py).
+
+-- Audience criteria besides target_tier; NULL means no restriction
+ALTER TABLE promotions ADD COLUMN IF NOT EXISTS target_segment TEXT;
+ALTER TABLE promotions ADD COLUMN IF NOT EXISTS active_within_days INTEGER;
+
+-- One row per promotion dispatch. The audience is frozen when the dispatch starts (active_since is
+-- absolute), and last_customer_id is the last users.id handed out, so a resumed run continues the same walk.
+CREATE TABLE IF NOT EXISTS promotion_dispatches (
+    promotion_id TEXT PRIMARY KEY,
+    status TEXT NOT NULL DEFAULT 'queued',
+    target_tier TEXT,
+    target_segment TEXT,
+    active_since TIMESTAMPTZ,
+    audience_size BIGINT,
+    last_customer_id TEXT NOT NULL DEFAULT '',
+    delivered BIGINT NOT NULL DEFAULT 0,
+    batches INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    started_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    finished_at TIMESTAMPTZ
+);
+
+CREATE TABLE IF NOT EXISTS promotion_deliveries (
+    promotion_id TEXT NOT NULL,
+    customer_id TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    queued_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (promotion_id, customer_id)
+);
+
+-- Audience filters: tier equality and recent orders / transactions are probed per candidate user
+CREATE INDEX IF NOT EXISTS idx_users_tier_id ON users (tier, id);
@@ -0,0 +1,89 @@
+-- Latest prediction per customer (predictions.py). Triggers on ml_predictions keep it current in the
+-- same transaction as the write, for every writer, so readers look up one row by primary key instead
+-- of ranking a customer's whole prediction history.
+
+CREATE TABLE IF NOT EXISTS latest_predictions (
+    customer_id TEXT PRIMARY KEY,
+    ml_prediction_id BIGINT NOT NULL,
+    clv_predicted NUMERIC,
+    churn_probability NUMERIC,
+    prediction_date TIMESTAMPTZ,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+-- Recommended rewards are looked up by prediction: recommendations(), predictions.py upserts
+CREATE INDEX IF NOT EXISTS idx_pred_rew_prediction ON pred_rew (ml_prediction_id);
+
+-- Recomputes the given customers from ml_predictions (latest = newest prediction_date, then highest id)
+CREATE OR REPLACE FUNCTION refresh_latest_predictions(customers TEXT[]) RETURNS void LANGUAGE sql AS $$
+    DELETE FROM latest_predictions WHERE customer_id = ANY(customers);
+    INSERT INTO latest_predictions (customer_id, ml_prediction_id, clv_predicted, churn_probability, prediction_date)
+    SELECT DISTINCT ON (customer_id) customer_id, id, clv_predicted, churn_probability, prediction_date
+    FROM ml_predictions
+    WHERE customer_id = ANY(customers)
+    ORDER BY customer_id, prediction_date DESC NULLS LAST, id DESC;
+$$;
+
+-- Statement-level: inserts upsert the newest row per customer of the batch, keeping an existing row
+-- that is newer still; deletes, and updates that move a row, recompute the customers they touched
+CREATE OR REPLACE FUNCTION maintain_latest_predictions() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO latest_predictions AS l (customer_id, ml_prediction_id, clv_predicted, churn_probability, prediction_date)
+        SELECT DISTINCT ON (customer_id) customer_id, id, clv_predicted, churn_probability, prediction_date
+        FROM new_rows
+        WHERE customer_id IS NOT NULL
+        ORDER BY customer_id, prediction_date DESC NULLS LAST, id DESC
+        ON CONFLICT (customer_id) DO UPDATE
+        SET ml_prediction_id = EXCLUDED.ml_prediction_id, clv_predicted = EXCLUDED.clv_predicted,
+            churn_probability = EXCLUDED.churn_probability, prediction_date = EXCLUDED.prediction_date,
+            updated_at = now()
+        WHERE (COALESCE(EXCLUDED.prediction_date, '-infinity'), EXCLUDED.ml_prediction_id)
+              > (COALESCE(l.prediction_date, '-infinity'), l.ml_prediction_id);
+    ELSIF TG_OP = 'UPDATE' THEN
+        -- Re-scored rows keep their rank: copy the new scores onto the customers they are latest for
+        UPDATE latest_predictions l
+        SET clv_predicted = n.clv_predicted, churn_probability = n.churn_probability, updated_at = now()
+        FROM new_rows n
+        WHERE l.ml_prediction_id = n.id AND l.customer_id = n.customer_id
+          AND l.prediction_date IS NOT DISTINCT FROM n.prediction_date
+          AND (l.clv_predicted, l.churn_probability) IS DISTINCT FROM (n.clv_predicted, n.churn_probability);
+        -- Rows whose id, customer or date changed can change which prediction is latest
+        PERFORM refresh_latest_predictions(ARRAY(
+            SELECT DISTINCT c.customer_id
+            FROM old_rows o
+            FULL JOIN new_rows n ON n.id = o.id
+            CROSS JOIN LATERAL unnest(ARRAY[o.customer_id, n.customer_id]) AS c(customer_id)
+            WHERE (o.id IS NULL OR n.id IS NULL
+                   OR (o.customer_id, o.prediction_date) IS DISTINCT FROM (n.customer_id, n.prediction_date))
+              AND c.customer_id IS NOT NULL
+        ));
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM refresh_latest_predictions(ARRAY(SELECT DISTINCT customer_id FROM old_rows));
+    ELSIF TG_OP = 'TRUNCATE' THEN
+        TRUNCATE latest_predictions;
+    END IF;
+    RETURN NULL;
+END
+$$;
+
+DROP TRIGGER IF EXISTS latest_predictions_insert ON ml_predictions;
+CREATE TRIGGER latest_predictions_insert AFTER INSERT ON ml_predictions
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION maintain_latest_predictions();
+DROP TRIGGER IF EXISTS latest_predictions_update ON ml_predictions;
+CREATE TRIGGER latest_predictions_update AFTER UPDATE ON ml_predictions
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION maintain_latest_predictions();
+DROP TRIGGER IF EXISTS latest_predictions_delete ON ml_predictions;
+CREATE TRIGGER latest_predictions_delete AFTER DELETE ON ml_predictions
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION maintain_latest_predictions();
+DROP TRIGGER IF EXISTS latest_predictions_truncate ON ml_predictions;
+CREATE TRIGGER latest_predictions_truncate AFTER TRUNCATE ON ml_predictions
+    FOR EACH STATEMENT EXECUTE FUNCTION maintain_latest_predictions();
+
+-- Backfill from the existing history
+INSERT INTO latest_predictions (customer_id, ml_prediction_id, clv_predicted, churn_probability, prediction_date)
+SELECT DISTINCT ON (customer_id) customer_id, id, clv_predicted, churn_probability, prediction_date
+FROM ml_predictions
+WHERE customer_id IS NOT NULL
+ORDER BY customer_id, prediction_date DESC NULLS LAST, id DESC
+ON CONFLICT (customer_id) DO NOTHING;
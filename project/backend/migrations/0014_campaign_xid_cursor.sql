@@ -0,0 +1,18 @@
+-- Transaction cursor for the campaign engine (campaigns.py). Each order and transaction records the
+-- transaction that inserted it, and the engine reads events below the oldest still-running transaction
+-- like the change feed, so an id reserved early but committed late is never skipped.
+
+-- No default on ADD COLUMN, which would rewrite the tables: existing rows keep NULL and stay covered by
+-- the id watermark. The ALTERs wait for in-flight inserts, so every NULL row has committed once this does.
+ALTER TABLE orders ADD COLUMN IF NOT EXISTS created_xid xid8;
+ALTER TABLE orders ALTER COLUMN created_xid SET DEFAULT pg_current_xact_id();
+ALTER TABLE transactions ADD COLUMN IF NOT EXISTS created_xid xid8;
+ALTER TABLE transactions ALTER COLUMN created_xid SET DEFAULT pg_current_xact_id();
+
+CREATE INDEX IF NOT EXISTS idx_orders_created_xid ON orders (created_xid) WHERE created_xid IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_transactions_created_xid ON transactions (created_xid) WHERE created_xid IS NOT NULL;
+
+-- last_xid: events from transactions below it are applied. legacy_upto: highest id with a NULL
+-- created_xid, set by the first run after this migration; last_id only walks up to it.
+ALTER TABLE campaign_state ADD COLUMN IF NOT EXISTS last_xid xid8 NOT NULL DEFAULT '0';
+ALTER TABLE campaign_state ADD COLUMN IF NOT EXISTS legacy_upto BIGINT;
@@ -0,0 +1,5 @@
+-- Sum of the sketched value column (order totals, CLV) per sketch day (sketches.py). refresh() rebuilds a
+-- day whose current count or sum differs, so edited rows are picked up as well as added and deleted ones.
+-- Existing sketches have no checksum yet and are rebuilt on their next refresh.
+
+ALTER TABLE daily_sketches ADD COLUMN IF NOT EXISTS checksum NUMERIC;
@@ -0,0 +1,18 @@
+-- Change feed batches a subscriber kept failing on (changefeed.py). The feed moves on past them and
+-- retries its own worker's rows until the subscriber accepts them; rows left by a worker that has
+-- exited stay here for inspection.
+
+CREATE TABLE IF NOT EXISTS change_feed_dead_letters (
+    id BIGSERIAL PRIMARY KEY,
+    subscriber TEXT NOT NULL,
+    -- host:pid of the worker whose subscriber failed; subscribers are per process
+    worker TEXT NOT NULL,
+    first_event_id BIGINT NOT NULL,
+    last_event_id BIGINT NOT NULL,
+    events JSONB NOT NULL,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    failed_at TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp(),
+    retried_at TIMESTAMPTZ
+);
+CREATE INDEX IF NOT EXISTS idx_change_feed_dead_letters_worker ON change_feed_dead_letters (worker, id);
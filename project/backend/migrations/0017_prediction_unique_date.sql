@@ -0,0 +1,9 @@
+-- migrate:no-transaction
+-- One prediction per (customer_id, prediction_date): predictions.py matches re-sent rows on this key,
+-- so loading the same file twice updates instead of duplicating. Built CONCURRENTLY so loads and
+-- reads carry on; if the history already holds duplicates the build fails and leaves an INVALID
+-- index, which `migrate.py verify` reports: remove them with `python predictions.py dedupe`, drop the
+-- index and run `migrate.py up` again. Rows without a prediction_date are not constrained.
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS idx_ml_predictions_customer_prediction_date
+    ON ml_predictions (customer_id, prediction_date);
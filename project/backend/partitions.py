@@ -0,0 +1,328 @@
+"""
+Partitioned per-customer computation on a process pool.
+
+Customers are sharded by a hash of their ID into PARTITION_COUNT partitions
+(hashtext() in Postgres, so a partition's rows are selected by the query
+itself and never pass through the parent process). Each partition runs a
+kernel in a pool process with its own database connection: the kernel reads
+only its partition's rows, aggregates in SQL where it can, does the per-
+customer Python work, and encodes every item to JSON bytes. Partitions come
+back as (customer id, bytes) pairs sorted by id, and the parent merges them
+into one array in customer id order by splicing the bytes, so no per-
+customer dicts are pickled across processes or rebuilt in the parent.
+
+Kernels are module-level functions registered in KERNELS and called as
+kernel(conn, partition_filter, params) -> list of JSON-ready items, where
+partition_filter(column) returns the SQL predicate selecting the partition;
+ORDER_KEYS names each kernel's customer id field.
+
+Every run reads from the DSN passed to json_array() (the caller picks the
+primary or a replica), DATABASE_URL by default. Each statement is timed on
+the connection that ran it and handed to record_query in the calling thread,
+so pool work shows up in the per-query metrics and Server-Timing like
+run_query(); with a pool the db time is summed across processes and can
+exceed the wall time.
+
+PARTITION_WORKERS=0 (the default) runs every partition in the calling
+process, on connections kept idle between requests (at most
+PARTITION_IDLE_CONNECTIONS per DSN): the same code path and output, without
+the pool. With N > 0 a spawn-context pool of N processes is created on first
+use; each process keeps one connection per DSN it has read from, so budget
+N extra connections (2N with a replica) per web worker.
+"""
+import os
+import time
+import logging
+import heapq
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+from datetime import datetime, timedelta
+import pytz
+import psycopg2
+import psycopg2.extensions
+from psycopg2.extras import RealDictCursor
+
+import serialization
+
+logger = logging.getLogger(__name__)
+
+UTC = pytz.UTC
+PARTITION_WORKERS = int(os.getenv('PARTITION_WORKERS', '0'))
+# More partitions than workers evens out skew; each partition is one pool task
+PARTITION_COUNT = int(os.getenv('PARTITION_COUNT', str(max(PARTITION_WORKERS * 2, 1))))
+ACTIVE_DAYS = 90
+
+PARTITION_IDLE_CONNECTIONS = int(os.getenv('PARTITION_IDLE_CONNECTIONS', '2'))
+
+# Pool processes: one connection per DSN
+_worker_connections = {}
+
+
+def partition_filter(partitions, partition):
+    def predicate(column):
+        if partitions == 1:
+            return 'TRUE'
+        # mod() rather than %, which the driver would read as a placeholder
+        return f"mod(hashtext({column})::bigint & 2147483647, {int(partitions)}) = {int(partition)}"
+    return predicate
+
+
+def customer_activity(conn, in_partition, params):
+    """customers(): spend, last activity, churn risk and retention per customer."""
+    now = params['now']
+    active_since = now - timedelta(days=ACTIVE_DAYS)
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            SELECT u.id, u.email, u.name, u.tier, u.points_balance, s.name AS segment
+            FROM users u
+            LEFT JOIN user_segments us ON us.customer_id = u.id
+            LEFT JOIN segments s ON s.id = us.segment_id
+            WHERE {in_partition('u.id')}
+        """)
+        users = cur.fetchall()
+        cur.execute(f"""
+            SELECT customer_id,
+                   COALESCE(SUM(amount) FILTER (WHERE amount > 0), 0) AS spend,
+                   COUNT(*) AS transactions,
+                   COUNT(*) FILTER (WHERE date >= %s) AS recent,
+                   MAX(date) AS last_activity
+            FROM transactions
+            WHERE {in_partition('customer_id')}
+            GROUP BY customer_id
+        """, (active_since,))
+        activity = {row['customer_id']: row for row in cur.fetchall()}
+
+    items = []
+    for user in users:
+        row = activity.get(user['id'])
+        if row:
+            recent_share = row['recent'] / max(row['transactions'], 1) * 100
+            churn_risk = round(100 - recent_share, 2)
+            retention_rate = round(recent_share, 2)
+            last_activity = (row['last_activity'] or now).isoformat()
+            spend = row['spend']
+        else:
+            churn_risk = retention_rate = 50
+            last_activity = now.isoformat()
+            spend = 0
+        items.append({
+            'id': user['id'],
+            'name': user['name'],
+            'email': user['email'],
+            'tier': user['tier'],
+            'points': user['points_balance'],
+            'spend': spend,
+            'lastActivity': last_activity,
+            'segment': user['segment'] or 'Unknown',
+            'churnRisk': churn_risk,
+            'retentionRate': retention_rate
+        })
+    return items
+
+
+def recommendations(conn, in_partition, params):
+    """recommendations(): order value, latest predicted CLV and its recommended reward per customer."""
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            WITH orders_by_customer AS (
+                SELECT customer_id, COALESCE(SUM(total), 0) AS clv
+                FROM orders
+                WHERE {in_partition('customer_id')}
+                GROUP BY customer_id
+            ), latest AS (
+                -- Maintained by triggers on ml_predictions (migrations/0013_latest_predictions.sql)
+                SELECT ml_prediction_id AS id, customer_id, clv_predicted
+                FROM latest_predictions
+                WHERE {in_partition('customer_id')}
+            ), latest_reward AS (
+                SELECT DISTINCT ON (pr.ml_prediction_id) pr.ml_prediction_id, pr.reward_id, pr.reason
+                FROM pred_rew pr
+                JOIN latest l ON l.id = pr.ml_prediction_id
+                ORDER BY pr.ml_prediction_id
+            )
+            SELECT u.id, u.name, u.tier, COALESCE(o.clv, 0) AS clv, COALESCE(l.clv_predicted, 0) AS predicted_clv,
+                   r.name AS reward_name, pr.ml_prediction_id IS NOT NULL AS has_reward, pr.reason
+            FROM users u
+            LEFT JOIN orders_by_customer o ON o.customer_id = u.id
+            LEFT JOIN latest l ON l.customer_id = u.id
+            LEFT JOIN latest_reward pr ON pr.ml_prediction_id = l.id
+            LEFT JOIN rewards r ON r.id = pr.reward_id
+            WHERE {in_partition('u.id')}
+        """)
+        rows = cur.fetchall()
+    return [
+        {
+            'customer': row['id'],
+            'name': row['name'],
+            'tier': row['tier'],
+            'clv': f"${float(row['clv']):.2f}",
+            'predictedClv': f"${float(row['predicted_clv']):.2f}",
+            'recommendedReward': (row['reward_name'] or 'None') if row['has_reward'] else 'None',
+            'reason': row['reason'] if row['has_reward'] else 'No reason provided'
+        }
+        for row in rows
+    ]
+
+
+KERNELS = {
+    'customer_activity': customer_activity,
+    'recommendations': recommendations,
+}
+
+ORDER_KEYS = {
+    'customer_activity': 'id',
+    'recommendations': 'customer',
+}
+
+
+class _TimedConnection(psycopg2.extensions.connection):
+    """Connection whose cursors append (sql, seconds, rows) to .queries for every statement."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.queries = []
+
+
+class _TimedCursor(RealDictCursor):
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            self.connection.queries.append((query, time.perf_counter() - started, max(self.rowcount, 0)))
+
+
+def _connect(dsn):
+    return psycopg2.connect(dsn, connect_timeout=5, connection_factory=_TimedConnection, cursor_factory=_TimedCursor)
+
+
+def _run_kernel(conn, kernel_name, partitions, partition, params):
+    """Runs one partition; returns its items as (customer id, JSON bytes) sorted by id, and the statements it ran."""
+    conn.queries = []
+    try:
+        items = KERNELS[kernel_name](conn, partition_filter(partitions, partition), params)
+    finally:
+        if not conn.closed:
+            conn.rollback()
+    key = ORDER_KEYS[kernel_name]
+    return sorted((item[key], serialization.dumps(item)) for item in items), conn.queries
+
+
+def _run_partition(dsn, kernel_name, partitions, partition, params):
+    """Pool task: computes one partition on the process's own connection."""
+    conn = _worker_connections.get(dsn)
+    if conn is None or conn.closed:
+        conn = _worker_connections[dsn] = _connect(dsn)
+    return _run_kernel(conn, kernel_name, partitions, partition, params)
+
+
+class PartitionedCompute:
+    def __init__(self, workers=PARTITION_WORKERS, partitions=PARTITION_COUNT, record_query=None,
+                 idle_connections=PARTITION_IDLE_CONNECTIONS):
+        self.workers = workers
+        self.partitions = partitions if workers > 0 else 1
+        self.record_query = record_query
+        self.idle_connections = idle_connections
+        self._pool = None
+        self._idle = {}
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.items = 0
+        self.seconds = 0.0
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                # spawn: forking a process that runs web and socket threads is not safe
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+            return self._pool
+
+    def _checkout(self, dsn):
+        with self._lock:
+            idle = self._idle.get(dsn)
+            if idle:
+                return idle.pop()
+        return _connect(dsn)
+
+    def _checkin(self, dsn, conn, broken):
+        if not broken and not conn.closed:
+            with self._lock:
+                idle = self._idle.setdefault(dsn, [])
+                if len(idle) < self.idle_connections:
+                    idle.append(conn)
+                    return
+        conn.close()
+
+    def reset(self):
+        """Drops the pool and idle connections without closing them; for processes forked from one that used them."""
+        with self._lock:
+            self._pool = None
+            self._idle = {}
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+            idle, self._idle = self._idle, {}
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def _record(self, queries):
+        if self.record_query is not None:
+            for sql, seconds, rows in queries:
+                self.record_query(sql, seconds, rows)
+
+    def compute(self, kernel_name, params=None, dsn=None):
+        """Runs every partition; returns one list of (customer id, JSON bytes) per partition, each sorted by id."""
+        if kernel_name not in KERNELS:
+            raise KeyError(f"Unknown kernel {kernel_name}")
+        dsn = dsn or os.getenv('DATABASE_URL')
+        params = dict(params or {}, now=(params or {}).get('now') or datetime.now(UTC))
+        started = time.perf_counter()
+        parts = []
+        try:
+            if self.workers <= 0:
+                conn = self._checkout(dsn)
+                broken = True
+                try:
+                    items, queries = _run_kernel(conn, kernel_name, 1, 0, params)
+                    broken = False
+                finally:
+                    self._checkin(dsn, conn, broken)
+                self._record(queries)
+                parts.append(items)
+                return parts
+            pool = self._get_pool()
+            futures = [
+                pool.submit(_run_partition, dsn, kernel_name, self.partitions, partition, params)
+                for partition in range(self.partitions)
+            ]
+            for future in as_completed(futures):
+                items, queries = future.result()
+                self._record(queries)
+                parts.append(items)
+            return parts
+        finally:
+            with self._lock:
+                self.runs += 1
+                self.items += sum(len(items) for items in parts)
+                self.seconds += time.perf_counter() - started
+
+    def json_array(self, kernel_name, params=None, dsn=None):
+        """All partitions merged into one JSON array (bytes), in customer id order."""
+        parts = self.compute(kernel_name, params, dsn)
+        return b'[' + b','.join(item for _, item in heapq.merge(*parts)) + b']'
+
+    def metrics(self):
+        with self._lock:
+            return [
+                ('loyalty_partition_runs_total', 'counter', 'Partitioned computations run.', [({}, self.runs)]),
+                ('loyalty_partition_items_total', 'counter', 'Items produced by partitioned computations.',
+                 [({}, self.items)]),
+                ('loyalty_partition_seconds_total', 'counter', 'Time spent in partitioned computations.',
+                 [({}, round(self.seconds, 6))]),
+                ('loyalty_partition_workers', 'gauge', 'Configured pool processes (0 runs inline).',
+                 [({}, self.workers)]),
+            ]
@@ -0,0 +1,289 @@
+"""
+Bulk ingestion of ML predictions: CLV, churn probability and the recommended
+reward per customer.
+
+Input is CSV with a header naming any of PREDICTION_COLUMNS (customer_id and
+prediction_date are required). Each stream goes through COPY into a session temp table, then
+applied PREDICTION_BATCH_SIZE staged rows at a time, one transaction per
+batch:
+
+    a row whose (customer_id, prediction_date) already exists updates that
+    prediction (a re-sent file corrects the scores instead of duplicating
+    them); any other row is inserted with an id drawn up front, so its
+    pred_rew row can reference it in the same batch.
+
+(customer_id, prediction_date) is the key a load is idempotent on, and a
+unique index on ml_predictions enforces it
+(migrations/0017_prediction_unique_date.sql), so every row has to carry its
+prediction_date: a file with an empty one is rejected before anything is
+applied, since a date filled in at load time would differ on every run.
+When a file repeats a key its last row wins. pred_rew is only touched when
+the file has a reward_id column. Loading the same file again changes
+nothing, so a load that fails half way can simply be run again; two loads
+of the same new keys at once fail one of them on the unique index.
+
+latest_predictions (migrations/0013_latest_predictions.sql) holds the newest
+prediction per customer and is maintained by triggers on ml_predictions,
+whoever writes them; rebuild() recomputes it from scratch.
+
+Usage:
+    python predictions.py load <file.csv> [...]
+    python predictions.py rebuild
+    python predictions.py dedupe
+"""
+import os
+import sys
+import csv
+import json
+import time
+import logging
+import threading
+import psycopg2
+import psycopg2.extensions
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = int(os.getenv('PREDICTION_BATCH_SIZE', '50000'))
+PREDICTION_COLUMNS = ['customer_id', 'clv_predicted', 'churn_probability', 'prediction_date', 'reward_id', 'reason']
+
+STAGE_SQL = """
+    CREATE TEMP TABLE staged_predictions (
+        seq BIGSERIAL, id BIGINT, existing BOOLEAN NOT NULL DEFAULT FALSE,
+        customer_id TEXT, clv_predicted NUMERIC, churn_probability NUMERIC, prediction_date TIMESTAMPTZ,
+        reward_id TEXT, reason TEXT
+    )
+"""
+
+# Applied in order for the staged rows with seq in [%(low)s, %(high)s]
+APPLY_SQL = [
+    """
+    UPDATE staged_predictions s SET id = p.id, existing = TRUE
+    FROM ml_predictions p
+    WHERE s.seq BETWEEN %(low)s AND %(high)s
+      AND p.customer_id = s.customer_id AND p.prediction_date = s.prediction_date
+    """,
+    """
+    UPDATE staged_predictions SET id = nextval(pg_get_serial_sequence('ml_predictions', 'id'))
+    WHERE seq BETWEEN %(low)s AND %(high)s AND NOT existing
+    """,
+    """
+    UPDATE ml_predictions p SET clv_predicted = s.clv_predicted, churn_probability = s.churn_probability
+    FROM staged_predictions s
+    WHERE s.seq BETWEEN %(low)s AND %(high)s AND s.existing AND p.id = s.id
+      AND (p.clv_predicted, p.churn_probability) IS DISTINCT FROM (s.clv_predicted, s.churn_probability)
+    """,
+    """
+    INSERT INTO ml_predictions (id, customer_id, clv_predicted, churn_probability, prediction_date)
+    SELECT id, customer_id, clv_predicted, churn_probability, prediction_date
+    FROM staged_predictions
+    WHERE seq BETWEEN %(low)s AND %(high)s AND NOT existing
+    """,
+]
+
+REWARD_SQL = [
+    """
+    DELETE FROM pred_rew pr USING staged_predictions s
+    WHERE s.seq BETWEEN %(low)s AND %(high)s AND s.existing AND pr.ml_prediction_id = s.id
+    """,
+    """
+    INSERT INTO pred_rew (ml_prediction_id, reward_id, reason)
+    SELECT id, reward_id, reason
+    FROM staged_predictions
+    WHERE seq BETWEEN %(low)s AND %(high)s AND reward_id IS NOT NULL
+    """,
+]
+
+# Older duplicates of a (customer_id, prediction_date) from before the unique index; the highest id stays
+DUPLICATES_SQL = """
+    SELECT id FROM (
+        SELECT id, row_number() OVER (PARTITION BY customer_id, prediction_date ORDER BY id DESC) AS rank
+        FROM ml_predictions
+        WHERE prediction_date IS NOT NULL
+    ) ranked
+    WHERE rank > 1
+"""
+
+REBUILD_SQL = """
+    INSERT INTO latest_predictions (customer_id, ml_prediction_id, clv_predicted, churn_probability, prediction_date)
+    SELECT DISTINCT ON (customer_id) customer_id, id, clv_predicted, churn_probability, prediction_date
+    FROM ml_predictions
+    WHERE customer_id IS NOT NULL
+    ORDER BY customer_id, prediction_date DESC NULLS LAST, id DESC
+"""
+
+
+def read_header(stream):
+    """Reads the CSV header line off a (bytes or text) stream and returns its validated column list."""
+    line = stream.readline()
+    if isinstance(line, bytes):
+        line = line.decode('utf-8-sig')
+    columns = [column.strip() for column in next(csv.reader([line]), [])]
+    unknown = [column for column in columns if column not in PREDICTION_COLUMNS]
+    if unknown:
+        raise ValueError(f"Unknown prediction columns: {', '.join(unknown)}")
+    if 'customer_id' not in columns or 'prediction_date' not in columns:
+        raise ValueError("Predictions need customer_id and prediction_date columns")
+    if len(set(columns)) != len(columns):
+        raise ValueError("Prediction columns are repeated")
+    return columns
+
+
+class PredictionLoader:
+    def __init__(self, connect, batch_size=BATCH_SIZE):
+        self.connect = connect
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self.loads = 0
+        self.rows = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+
+    def load(self, streams):
+        """
+        COPYs each CSV stream (header first) into staging and applies the
+        staged rows batch by batch. Returns a summary; raises ValueError for
+        a bad header or a row without prediction_date and psycopg2.DataError
+        for a malformed value, before anything is applied.
+        """
+        started = time.perf_counter()
+        conn = self.connect()
+        inserted = updated = staged = batches = 0
+        with_rewards = False
+        try:
+            with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+                # The temp table lives as long as this connection, across the batch commits
+                cur.execute(STAGE_SQL)
+                for stream in streams:
+                    columns = read_header(stream)
+                    with_rewards = with_rewards or 'reward_id' in columns
+                    cur.copy_expert(
+                        f"COPY staged_predictions ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", stream
+                    )
+                cur.execute("DELETE FROM staged_predictions WHERE customer_id IS NULL OR customer_id = ''")
+                cur.execute("SELECT MIN(seq) FROM staged_predictions WHERE prediction_date IS NULL")
+                undated = cur.fetchone()[0]
+                if undated is not None:
+                    raise ValueError(f"Prediction row {undated} has no prediction_date")
+                # Last row of the input wins
+                cur.execute("""
+                    DELETE FROM staged_predictions s USING staged_predictions later
+                    WHERE later.customer_id = s.customer_id AND later.prediction_date = s.prediction_date
+                      AND later.seq > s.seq
+                """)
+                cur.execute("SELECT COUNT(*), MIN(seq), MAX(seq) FROM staged_predictions")
+                staged, low, high = cur.fetchone()
+                cur.execute("CREATE INDEX ON staged_predictions (seq)")
+                cur.execute("ANALYZE staged_predictions")
+                conn.commit()
+
+                statements = APPLY_SQL + (REWARD_SQL if with_rewards else [])
+                while low is not None and low <= high:
+                    params = {'low': low, 'high': low + self.batch_size - 1}
+                    counts = []
+                    for sql in statements:
+                        cur.execute(sql, params)
+                        counts.append(cur.rowcount)
+                    conn.commit()
+                    updated += counts[2]
+                    inserted += counts[3]
+                    batches += 1
+                    low += self.batch_size
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        unchanged = staged - inserted - updated
+        with self._lock:
+            self.loads += 1
+            self.rows['inserted'] += inserted
+            self.rows['updated'] += updated
+            self.rows['unchanged'] += unchanged
+        duration_ms = round((time.perf_counter() - started) * 1000, 2)
+        logger.info(f"Predictions loaded: {inserted} inserted, {updated} updated, {unchanged} unchanged "
+                    f"in {batches} batches, {duration_ms}ms")
+        return {
+            'rows': staged, 'inserted': inserted, 'updated': updated, 'unchanged': unchanged,
+            'batches': batches, 'durationMs': duration_ms
+        }
+
+    def load_csv(self, stream):
+        return self.load([stream])
+
+    def rebuild(self):
+        """Recomputes latest_predictions from ml_predictions; returns the number of customers."""
+        conn = self.connect()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("LOCK TABLE latest_predictions IN EXCLUSIVE MODE")
+                cur.execute("DELETE FROM latest_predictions")
+                cur.execute(REBUILD_SQL)
+                customers = cur.rowcount
+            conn.commit()
+            return customers
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def dedupe(self):
+        """
+        Deletes all but the newest row (highest id) of every repeated
+        (customer_id, prediction_date), with their pred_rew rows, so the
+        unique index can be built; returns the number deleted.
+        """
+        conn = self.connect()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(f"CREATE TEMP TABLE duplicate_predictions ON COMMIT DROP AS {DUPLICATES_SQL}")
+                cur.execute("""
+                    DELETE FROM pred_rew pr USING duplicate_predictions d WHERE pr.ml_prediction_id = d.id
+                """)
+                cur.execute("DELETE FROM ml_predictions p USING duplicate_predictions d WHERE p.id = d.id")
+                deleted = cur.rowcount
+            conn.commit()
+            return deleted
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def metrics(self):
+        with self._lock:
+            return [
+                ('loyalty_prediction_loads_total', 'counter', 'Prediction files loaded.', [({}, self.loads)]),
+                ('loyalty_prediction_rows_total', 'counter', 'Loaded prediction rows by outcome.',
+                 [({'result': result}, count) for result, count in self.rows.items()]),
+            ]
+
+
+def main(argv):
+    from dotenv import load_dotenv
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+    database_url = os.getenv('DATABASE_URL')
+    if not database_url:
+        logger.error("DATABASE_URL not set")
+        return 1
+    loader = PredictionLoader(lambda: psycopg2.connect(database_url))
+    if argv[1:2] == ['rebuild']:
+        print(json.dumps({'customers': loader.rebuild()}))
+        return 0
+    if argv[1:2] == ['dedupe']:
+        print(json.dumps({'deleted': loader.dedupe()}))
+        return 0
+    if argv[1:2] != ['load'] or len(argv) < 3:
+        logger.error("Usage: python predictions.py load <file.csv> [...] | rebuild | dedupe")
+        return 1
+    files = [open(path, encoding='utf-8', newline='') for path in argv[2:]]
+    try:
+        print(json.dumps(loader.load(files)))
+    finally:
+        for f in files:
+            f.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,215 @@
+"""
+Opt-in request profiling.
+
+A request is profiled when it carries a valid `X-Profile-Token` header (the
+value of PROFILE_TOKEN) or is picked by PROFILE_SAMPLE_RATE sampling, which
+can be narrowed to specific endpoints with PROFILE_ENDPOINTS. The handler
+thread's call stack is sampled every PROFILE_INTERVAL_MS from a helper
+thread, from before_request until the response (including jsonify) is built.
+
+Profiles are written to a bounded on-disk ring in PROFILE_DIR (the oldest
+files are deleted beyond PROFILE_RING_SIZE) and served by the admin
+endpoints in app.py as folded stacks ("frame;frame;frame count" lines) that
+flamegraph.pl, speedscope and inferno read directly.
+
+PROFILER=pyinstrument switches to pyinstrument when it is installed. cProfile
+is not offered: its deterministic tracing records caller/callee pairs rather
+than full stacks, so it cannot produce a flamegraph, and it slows every call.
+
+When neither trigger applies the only cost is two attribute checks per request.
+"""
+import os
+import sys
+import json
+import time
+import hmac
+import random
+import logging
+import threading
+from flask import g, request
+
+logger = logging.getLogger(__name__)
+
+PROFILE_TOKEN = os.getenv('PROFILE_TOKEN', '')
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_ENDPOINTS = {e for e in os.getenv('PROFILE_ENDPOINTS', '').split(',') if e}
+PROFILE_DIR = os.getenv('PROFILE_DIR', '/tmp/loyalty-profiles')
+PROFILE_RING_SIZE = int(os.getenv('PROFILE_RING_SIZE', '50'))
+PROFILE_INTERVAL_MS = float(os.getenv('PROFILE_INTERVAL_MS', '5'))
+PROFILER = os.getenv('PROFILER', 'sampler')
+
+_write_lock = threading.Lock()
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """
+    Samples one thread's stack from a daemon thread and counts identical stacks.
+    """
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            labels = []
+            while frame is not None:
+                labels.append(_frame_label(frame))
+                frame = frame.f_back
+            if labels:
+                key = ';'.join(reversed(labels))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.stacks
+
+
+class PyinstrumentProfiler:
+    """
+    Adapter turning a pyinstrument session into the same {stack: samples} map.
+    """
+
+    def __init__(self, interval):
+        from pyinstrument import Profiler
+        self.interval = interval
+        self.profiler = Profiler(interval=interval)
+
+    def start(self):
+        self.profiler.start()
+
+    def stop(self):
+        session = self.profiler.stop()
+        stacks = {}
+
+        def walk(frame, prefix):
+            label = f"{frame.function} ({os.path.basename(frame.file_path or '')}:{frame.line_no})"
+            path = f"{prefix};{label}" if prefix else label
+            samples = int(round(frame.total_self_time / self.interval))
+            if samples:
+                stacks[path] = stacks.get(path, 0) + samples
+            for child in frame.children:
+                walk(child, path)
+
+        if session.root_frame():
+            walk(session.root_frame(), '')
+        return stacks
+
+
+def is_authorized():
+    supplied = request.headers.get('X-Profile-Token', '')
+    return bool(PROFILE_TOKEN) and hmac.compare_digest(supplied, PROFILE_TOKEN)
+
+
+def should_profile():
+    if 'X-Profile-Token' in request.headers:
+        return is_authorized()
+    if PROFILE_SAMPLE_RATE <= 0:
+        return False
+    if PROFILE_ENDPOINTS and request.endpoint not in PROFILE_ENDPOINTS:
+        return False
+    return random.random() < PROFILE_SAMPLE_RATE
+
+
+def start_request():
+    if not PROFILE_TOKEN and PROFILE_SAMPLE_RATE <= 0:
+        return
+    if not should_profile():
+        return
+    interval = PROFILE_INTERVAL_MS / 1000
+    try:
+        if PROFILER == 'pyinstrument':
+            profiler = PyinstrumentProfiler(interval)
+        else:
+            profiler = StackSampler(threading.get_ident(), interval)
+    except ImportError:
+        logger.warning("pyinstrument not installed, falling back to the stack sampler")
+        profiler = StackSampler(threading.get_ident(), interval)
+    g.profiler = profiler
+    g.profile_started = time.perf_counter()
+    profiler.start()
+
+
+def finish_request(response):
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return response
+    stacks = profiler.stop()
+    duration_ms = (time.perf_counter() - g.pop('profile_started')) * 1000
+    profile_id = f"{time.time_ns()}-{os.getpid()}"
+    try:
+        save_profile(profile_id, {
+            'id': profile_id,
+            'endpoint': request.endpoint,
+            'path': request.full_path,
+            'status': response.status_code,
+            'duration_ms': round(duration_ms, 2),
+            'interval_ms': PROFILE_INTERVAL_MS,
+            'profiler': type(profiler).__name__,
+            'timestamp': time.time(),
+            'stacks': stacks,
+        })
+        response.headers['X-Profile-Id'] = profile_id
+    except OSError as e:
+        logger.error(f"Failed to store profile: {str(e)}")
+    return response
+
+
+def save_profile(profile_id, profile):
+    with _write_lock:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"{profile_id}.json")
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(profile, f)
+        os.replace(tmp_path, path)
+        files = sorted(name for name in os.listdir(PROFILE_DIR) if name.endswith('.json'))
+        for name in files[:max(0, len(files) - PROFILE_RING_SIZE)]:
+            try:
+                os.remove(os.path.join(PROFILE_DIR, name))
+            except FileNotFoundError:
+                pass
+
+
+def list_profiles():
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    profiles = []
+    for name in sorted(os.listdir(PROFILE_DIR), reverse=True):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(PROFILE_DIR, name)) as f:
+                profile = json.load(f)
+        except (OSError, ValueError):
+            continue
+        profile['samples'] = sum(profile.pop('stacks', {}).values())
+        profiles.append(profile)
+    return profiles
+
+
+def load_profile(profile_id):
+    if not profile_id.replace('-', '').isdigit():
+        return None
+    try:
+        with open(os.path.join(PROFILE_DIR, f"{profile_id}.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def folded(profile):
+    return '\n'.join(f"{stack} {count}" for stack, count in sorted(profile['stacks'].items())) + '\n'
@@ -0,0 +1,180 @@
+"""
+Memoized results for reads of small reference tables in run_query().
+
+Handlers re-read the same reference rows many times per dashboard load
+(e.g. "SELECT id, name FROM rewards" from charts, recommendations and top
+rewards). A SELECT whose FROM / JOIN targets are all QUERY_CACHE_TABLES is
+answered from memory, keyed by its whitespace-normalized text, its
+parameters and the current version of each table it reads. Any write through run_query() that
+mentions a cached table bumps that table's version, so older entries are
+never served again; batch engines that write on their own connections are
+wrapped with invalidates(). Entries also expire after QUERY_CACHE_TTL_SECONDS,
+which bounds staleness for writes made by other worker processes or tools.
+
+Cached rows are shared between callers: they are returned as a tuple of
+FrozenRow (a read-only dict), so a caller that tries to modify one gets a
+TypeError rather than silently changing what the next request sees.
+"""
+import os
+import re
+import time
+import threading
+from functools import lru_cache, wraps
+from collections import OrderedDict
+
+QUERY_CACHE_ENABLED = os.getenv('QUERY_CACHE_ENABLED', '1') == '1'
+QUERY_CACHE_TABLES = frozenset(
+    t.strip() for t in os.getenv('QUERY_CACHE_TABLES', 'rewards,segments,campaigns').split(',') if t.strip()
+)
+QUERY_CACHE_TTL_SECONDS = float(os.getenv('QUERY_CACHE_TTL_SECONDS', '60'))
+QUERY_CACHE_MAX_ENTRIES = int(os.getenv('QUERY_CACHE_MAX_ENTRIES', '256'))
+
+_READ_ONLY = re.compile(r'^\s*SELECT\b', re.IGNORECASE)
+_SOURCES = re.compile(
+    r'\b(?:FROM|JOIN)\s+(\w+(?:\s+(?:AS\s+)?\w+)?(?:\s*,\s*\w+(?:\s+(?:AS\s+)?\w+)?)*)', re.IGNORECASE
+)
+# Results that depend on more than the table contents
+_VOLATILE = re.compile(
+    r'\b(now|random|clock_timestamp|statement_timestamp|current_date|current_timestamp|localtimestamp|nextval'
+    r'|pg_\w+)\b|\bFOR\s+(UPDATE|SHARE|NO\s+KEY|KEY)\b',
+    re.IGNORECASE
+)
+_WORD = re.compile(r'\w+')
+_WHITESPACE = re.compile(r'\s+')
+
+
+class FrozenRow(dict):
+    """A result row shared between callers; reads like the RealDictRow it replaces."""
+    __slots__ = ()
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('cached query rows are read-only; copy with dict(row) first')
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _readonly
+    __ior__ = _readonly
+
+
+@lru_cache(maxsize=1024)
+def cached_tables(sql):
+    """
+    The reference tables a SELECT reads, or None when the statement is not
+    cacheable (writes, volatile functions, or any non-reference source).
+    """
+    if not _READ_ONLY.match(sql) or _VOLATILE.search(sql):
+        return None
+    tables = set()
+    for sources in _SOURCES.findall(sql):
+        for source in sources.split(','):
+            tables.add(source.split()[0].lower())
+    if not tables or not tables <= QUERY_CACHE_TABLES:
+        return None
+    return tuple(sorted(tables))
+
+
+@lru_cache(maxsize=1024)
+def written_tables(sql):
+    """Cached tables a write statement may touch: every one it mentions."""
+    words = {w.lower() for w in _WORD.findall(sql)}
+    return tuple(sorted(QUERY_CACHE_TABLES & words))
+
+
+def _freeze_params(params):
+    if params is None:
+        return None
+    if isinstance(params, dict):
+        params = tuple(sorted(params.items()))
+    elif isinstance(params, list):
+        params = tuple(params)
+    try:
+        hash(params)
+    except TypeError:
+        return _freeze_params  # sentinel: unhashable, do not cache
+    return params
+
+
+class QueryCache:
+    def __init__(self, enabled=QUERY_CACHE_ENABLED, ttl=QUERY_CACHE_TTL_SECONDS, max_entries=QUERY_CACHE_MAX_ENTRIES):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._versions = {table: 0 for table in QUERY_CACHE_TABLES}
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'invalidations': 0, 'evictions': 0}
+
+    def lookup(self, sql, params=None):
+        """
+        Returns (key, rows). rows is the cached result on a hit; key is what
+        store() needs after a miss, or None when the query is not cacheable.
+        The key carries the table versions seen before the query runs, so a
+        result that races with a write is stored under the old version.
+        """
+        if not self.enabled:
+            return None, None
+        tables = cached_tables(sql)
+        if tables is None:
+            return None, None
+        frozen = _freeze_params(params)
+        if frozen is _freeze_params:
+            return None, None
+        with self._lock:
+            key = (_WHITESPACE.sub(' ', sql).strip(), frozen, tables, tuple(self._versions[t] for t in tables))
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                self._entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return key, entry[1]
+            self.stats['misses'] += 1
+        return key, None
+
+    def store(self, key, rows):
+        frozen = tuple(FrozenRow(row) for row in rows)
+        with self._lock:
+            self._entries[key] = (time.monotonic(), frozen)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+        return frozen
+
+    def note_write(self, sql):
+        """Called after a write commits; bumps every cached table it mentions."""
+        tables = written_tables(sql)
+        if tables:
+            self.invalidate(*tables)
+
+    def invalidate(self, *tables):
+        with self._lock:
+            for table in tables or QUERY_CACHE_TABLES:
+                if table in self._versions:
+                    self._versions[table] += 1
+                    self.stats['invalidations'] += 1
+            # Entries for old versions can never hit again
+            stale = [k for k in self._entries if k[3] != tuple(self._versions[t] for t in k[2])]
+            for key in stale:
+                del self._entries[key]
+
+    def invalidates(self, *tables):
+        """Decorator for functions that write cached tables on their own connection."""
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.invalidate(*tables)
+            return wrapper
+        return decorator
+
+    def metrics(self):
+        stats = dict(self.stats)
+        return [
+            ('loyalty_query_cache_lookups_total', 'counter', 'Reference-table query cache lookups, by result.', [
+                ({'result': 'hit'}, stats['hits']), ({'result': 'miss'}, stats['misses'])
+            ]),
+            ('loyalty_query_cache_invalidations_total', 'counter', 'Table version bumps from writes.',
+             [({}, stats['invalidations'])]),
+            ('loyalty_query_cache_evictions_total', 'counter', 'Entries evicted at QUERY_CACHE_MAX_ENTRIES.',
+             [({}, stats['evictions'])]),
+            ('loyalty_query_cache_entries', 'gauge', 'Cached query results.', [({}, len(self._entries))]),
+        ]
@@ -0,0 +1,446 @@
+"""
+Referral graph engine.
+
+Each customer's referrer is the referrer of their earliest referral, which
+makes the graph a forest. referral_nodes keeps one row per customer in a
+chain: the adjacency (referrer_id), the ancestor path from the root, depth,
+and per-node aggregates maintained for the whole downline:
+
+    direct_referrals   customers this one referred
+    downline           customers referred by this one or anyone below it
+    own_value          order total of the customer
+    chain_value        order total of the whole downline (multi-level attribution)
+
+An incremental run reads the referrals added since the last run, attaching
+each referee below its referrer: the referee's existing subtree is re-rooted
+by prefixing the new ancestors to its paths, and the aggregates of every new
+ancestor grow by the subtree's size and value. Referrals that would close a
+cycle, or name a referee who already has a referrer, are ignored. Customers
+with orders since the activity watermark get their own_value recomputed and
+the difference added to the chain_value of their ancestors. A full run,
+at least every REFERRAL_FULL_RUN_HOURS, rebuilds the forest with one
+recursive query, which also picks up deleted referrals and orders and
+backdated rows the watermarks cannot see. It deletes rather than truncates
+so requests keep reading the previous graph until it commits.
+
+Requests read referral_nodes only: top referrers through the ranking
+indexes, and a customer's tree through the GIN index on path. A process
+whose first request finds no full run recorded builds the graph before
+reading (ensure_built), since the 'referrals' job only runs with the
+scheduler enabled.
+
+Tables are created by migrations/0009_referral_graph.sql.
+
+Usage:
+    python referral_graph.py [--full]
+"""
+import os
+import sys
+import json
+import time
+import logging
+from datetime import datetime, timedelta
+import pytz
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+logger = logging.getLogger(__name__)
+
+UTC = pytz.UTC
+FULL_RUN_INTERVAL_HOURS = float(os.getenv('REFERRAL_FULL_RUN_HOURS', '24'))
+TREE_MAX_NODES = int(os.getenv('REFERRAL_TREE_MAX_NODES', '500'))
+# Re-read this much activity before the watermark to cover writes that committed late
+WATERMARK_OVERLAP = timedelta(minutes=5)
+# pg_advisory_xact_lock key serialising runs from the scheduler and the CLI
+LOCK_KEY = 0x52454647
+
+RANKINGS = {
+    'downline': 'downline',
+    'chainValue': 'chain_value',
+    'direct': 'direct_referrals',
+}
+
+# Each referee's earliest referral
+EDGES_SQL = """
+    SELECT DISTINCT ON (referee_id) referee_id, referrer_id, date, id
+    FROM referrals
+    WHERE referrer_id IS NOT NULL AND referee_id IS NOT NULL AND referrer_id <> referee_id
+    ORDER BY referee_id, date, id
+"""
+
+# Inserts the trees below {roots}; edges into %(roots)s are the ones cut to break cycles
+TREES_SQL = """
+    INSERT INTO referral_nodes (customer_id, referrer_id, root_id, depth, path, own_value)
+    WITH RECURSIVE edges AS ({edges}), tree AS (
+        SELECT DISTINCT e.referrer_id AS customer_id, NULL::text AS referrer_id, e.referrer_id AS root_id,
+               0 AS depth, '{{}}'::text[] AS path
+        FROM edges e
+        WHERE {roots}
+        UNION ALL
+        SELECT e.referee_id, e.referrer_id, t.root_id, t.depth + 1, t.path || e.referrer_id
+        FROM tree t
+        JOIN edges e ON e.referrer_id = t.customer_id AND e.referee_id <> ALL(%(roots)s::text[])
+    ), order_values AS (
+        SELECT customer_id, SUM(total) AS total
+        FROM customer_monthly_orders
+        WHERE customer_id IN (SELECT customer_id FROM tree)
+        GROUP BY customer_id
+    )
+    SELECT t.customer_id, t.referrer_id, t.root_id, t.depth, t.path, COALESCE(v.total, 0)
+    FROM tree t
+    LEFT JOIN order_values v ON v.customer_id = t.customer_id
+"""
+REFERRER_ROOTS = "NOT EXISTS (SELECT 1 FROM edges p WHERE p.referee_id = e.referrer_id)"
+CYCLE_ROOTS = "e.referrer_id = ANY(%(roots)s::text[])"
+
+# Edges the trees did not reach: referral cycles and the chains hanging off them
+UNREACHED_SQL = f"""
+    SELECT e.referee_id, e.referrer_id, e.date, e.id
+    FROM ({EDGES_SQL}) e
+    WHERE NOT EXISTS (SELECT 1 FROM referral_nodes n WHERE n.customer_id = e.referee_id)
+"""
+
+AGGREGATES_SQL = """
+    UPDATE referral_nodes n
+    SET direct_referrals = a.direct_referrals, downline = a.downline, chain_value = a.chain_value
+    FROM (
+        SELECT p.ancestor,
+               COUNT(*) FILTER (WHERE p.position = cardinality(d.path)) AS direct_referrals,
+               COUNT(*) AS downline,
+               SUM(d.own_value) AS chain_value
+        FROM referral_nodes d, unnest(d.path) WITH ORDINALITY AS p(ancestor, position)
+        GROUP BY p.ancestor
+    ) a
+    WHERE n.customer_id = a.ancestor
+"""
+
+NEW_REFERRALS_SQL = """
+    SELECT id, referrer_id, referee_id, date FROM referrals WHERE id > %(after)s
+    UNION
+    SELECT id, referrer_id, referee_id, date FROM referrals WHERE date >= %(since)s
+    ORDER BY date, id
+"""
+
+CHANGED_VALUES_SQL = """
+    WITH v AS (
+        SELECT customer_id, COALESCE(SUM(total), 0) AS total
+        FROM orders
+        WHERE customer_id IN (SELECT customer_id FROM orders WHERE date >= %(since)s)
+        GROUP BY customer_id
+    )
+    SELECT n.customer_id, n.path, v.total - n.own_value AS delta
+    FROM referral_nodes n
+    JOIN v ON v.customer_id = n.customer_id
+    WHERE n.own_value <> v.total
+"""
+
+NODE_COLUMNS = """
+    n.customer_id, u.name, n.referrer_id, n.root_id, n.depth, n.direct_referrals, n.downline,
+    n.own_value, n.chain_value
+"""
+
+
+def _node(row):
+    return {
+        'customerId': row['customer_id'],
+        'name': row['name'],
+        'referrerId': row['referrer_id'],
+        'depth': row['depth'],
+        'directReferrals': row['direct_referrals'],
+        'downline': row['downline'],
+        'ownValue': float(row['own_value']),
+        'chainValue': float(row['chain_value']),
+    }
+
+
+def _check(response):
+    if 'error' in response:
+        raise RuntimeError(f"Referral graph query failed: {response['error']}")
+    return response['data']
+
+
+def top_referrers(run_query, by='downline', limit=10):
+    """Customers with a downline, ranked by downline, chainValue or direct referrals."""
+    column = RANKINGS[by]
+    rows = _check(run_query(f"""
+        SELECT {NODE_COLUMNS}
+        FROM referral_nodes n
+        LEFT JOIN users u ON u.id = n.customer_id
+        WHERE n.downline > 0
+        ORDER BY n.{column} DESC, n.customer_id
+        LIMIT %s
+    """, (limit,)))
+    return [_node(row) for row in rows]
+
+
+def referral_tree(run_query, customer_id, depth=3, max_nodes=TREE_MAX_NODES):
+    """
+    The customer's node with its ancestors and its referees nested up to
+    `depth` levels below it, or None when the customer is in no chain.
+    At most max_nodes descendants are returned; 'truncated' says so.
+    """
+    rows = _check(run_query(f"""
+        SELECT {NODE_COLUMNS}, n.path
+        FROM referral_nodes n
+        LEFT JOIN users u ON u.id = n.customer_id
+        WHERE n.customer_id = %s
+    """, (customer_id,)))
+    if not rows:
+        return None
+    root = rows[0]
+    descendants = _check(run_query(f"""
+        SELECT {NODE_COLUMNS}
+        FROM referral_nodes n
+        LEFT JOIN users u ON u.id = n.customer_id
+        WHERE n.path @> ARRAY[%s]::text[] AND n.depth <= %s
+        ORDER BY n.depth, n.customer_id
+        LIMIT %s
+    """, (customer_id, root['depth'] + depth, max_nodes + 1)))
+    ancestors = _check(run_query("""
+        SELECT n.customer_id, u.name
+        FROM referral_nodes n
+        LEFT JOIN users u ON u.id = n.customer_id
+        WHERE n.customer_id = ANY(%s)
+    """, (list(root['path']),))) if root['path'] else []
+    names = {row['customer_id']: row['name'] for row in ancestors}
+
+    tree = dict(_node(root), referees=[])
+    nodes = {customer_id: tree}
+    # Ordered by depth, so every referrer is placed before its referees
+    for row in descendants[:max_nodes]:
+        parent = nodes.get(row['referrer_id'])
+        if parent is not None:
+            nodes[row['customer_id']] = dict(_node(row), referees=[])
+            parent['referees'].append(nodes[row['customer_id']])
+    return {
+        'customer': tree,
+        'ancestors': [{'customerId': cid, 'name': names.get(cid)} for cid in root['path']],
+        'truncated': len(descendants) > max_nodes,
+    }
+
+
+class ReferralGraph:
+    def __init__(self, connect):
+        self.connect = connect
+        self.built = False
+
+    def load_state(self, cur):
+        cur.execute("""
+            SELECT referral_watermark, activity_watermark, last_full_run_at
+            FROM referral_graph_state WHERE id = 1
+        """)
+        return cur.fetchone()
+
+    def ensure_built(self):
+        """Runs a full build if none has ever completed; checked once per process."""
+        if self.built:
+            return
+        conn = self.connect()
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                state = self.load_state(cur)
+            conn.commit()
+        finally:
+            conn.close()
+        if state is None or state['last_full_run_at'] is None:
+            # run() re-checks under its lock, so a concurrent first request only catches up incrementally
+            self.run()
+        self.built = True
+
+    def run(self, full=None):
+        """
+        Rebuilds the graph when requested, when no full run exists or when
+        the last one is older than REFERRAL_FULL_RUN_HOURS; otherwise applies
+        new referrals and order activity incrementally. Returns a summary dict.
+        """
+        started = time.perf_counter()
+        run_started_at = datetime.now(UTC)
+        conn = self.connect()
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute("SELECT pg_advisory_xact_lock(%s)", (LOCK_KEY,))
+                state = self.load_state(cur)
+                if full is None:
+                    full = (
+                        state is None or state['last_full_run_at'] is None or
+                        run_started_at - state['last_full_run_at'] > timedelta(hours=FULL_RUN_INTERVAL_HOURS)
+                    )
+                cur.execute("SELECT COALESCE(MAX(id), 0) AS id FROM referrals")
+                max_referral_id = cur.fetchone()['id']
+
+                if full:
+                    summary = self.rebuild(cur)
+                else:
+                    since = (state['activity_watermark'] or run_started_at) - WATERMARK_OVERLAP
+                    cur.execute(NEW_REFERRALS_SQL, {'after': state['referral_watermark'], 'since': since})
+                    referrals = cur.fetchall()
+                    attached = sum(
+                        1 for referral in referrals
+                        if self.attach(cur, referral)
+                    )
+                    summary = {
+                        'referrals': len(referrals),
+                        'attached': attached,
+                        'valued': self.update_values(cur, since),
+                    }
+                    max_referral_id = max([max_referral_id] + [referral['id'] for referral in referrals])
+
+                cur.execute("""
+                    INSERT INTO referral_graph_state (id, referral_watermark, activity_watermark, last_full_run_at, last_incremental_run_at)
+                    VALUES (1, %(referral)s, %(now)s, CASE WHEN %(full)s THEN %(now)s END, CASE WHEN %(full)s THEN NULL ELSE %(now)s END)
+                    ON CONFLICT (id) DO UPDATE
+                    SET referral_watermark = EXCLUDED.referral_watermark,
+                        activity_watermark = EXCLUDED.activity_watermark,
+                        last_full_run_at = COALESCE(EXCLUDED.last_full_run_at, referral_graph_state.last_full_run_at),
+                        last_incremental_run_at = COALESCE(EXCLUDED.last_incremental_run_at, referral_graph_state.last_incremental_run_at)
+                """, {'referral': max_referral_id, 'now': run_started_at, 'full': full})
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        duration_ms = round((time.perf_counter() - started) * 1000, 2)
+        logger.info(f"Referral graph {'full' if full else 'incremental'} run: {summary} in {duration_ms}ms")
+        return dict(summary, mode='full' if full else 'incremental', durationMs=duration_ms)
+
+    def rebuild(self, cur):
+        """
+        Recomputes every node. Referral cycles have no root to grow from, so
+        each one is cut at its latest referral, as an incremental run would
+        have done when that referral arrived, and grown from the cut.
+        """
+        cur.execute("DELETE FROM referral_nodes")
+        cur.execute(TREES_SQL.format(edges=EDGES_SQL, roots=REFERRER_ROOTS), {'roots': []})
+        cur.execute(UNREACHED_SQL)
+        referrer_of = {row['referee_id']: row for row in cur.fetchall()}
+        roots = set()
+        visited = set()
+        for start in referrer_of:
+            walk = []
+            customer_id = start
+            while customer_id in referrer_of and customer_id not in visited:
+                visited.add(customer_id)
+                walk.append(customer_id)
+                customer_id = referrer_of[customer_id]['referrer_id']
+            if customer_id in walk:
+                cycle = walk[walk.index(customer_id):]
+                roots.add(max(cycle, key=lambda referee: (referrer_of[referee]['date'], referrer_of[referee]['id'])))
+        if roots:
+            cur.execute(TREES_SQL.format(edges=EDGES_SQL, roots=CYCLE_ROOTS), {'roots': sorted(roots)})
+        cur.execute(AGGREGATES_SQL)
+        cur.execute("SELECT COUNT(*) AS nodes FROM referral_nodes")
+        return {'nodes': cur.fetchone()['nodes'], 'cycles': len(roots)}
+
+    def _order_value(self, cur, customer_id):
+        cur.execute("SELECT COALESCE(SUM(total), 0) AS total FROM orders WHERE customer_id = %s", (customer_id,))
+        return cur.fetchone()['total']
+
+    def attach(self, cur, referral):
+        """
+        Places the referee below the referrer; returns False when the
+        referral is ignored because it is not the referee's earliest, or
+        would close a cycle.
+        """
+        referrer_id, referee_id = referral['referrer_id'], referral['referee_id']
+        if not referrer_id or not referee_id or referrer_id == referee_id:
+            return False
+        cur.execute("""
+            SELECT 1 FROM referrals
+            WHERE referee_id = %s AND (date, id) < (%s, %s) AND referrer_id IS NOT NULL AND referrer_id <> referee_id
+            LIMIT 1
+        """, (referee_id, referral['date'], referral['id']))
+        if cur.fetchone():
+            return False
+        cur.execute("""
+            SELECT customer_id, referrer_id, root_id, path, downline, own_value, chain_value
+            FROM referral_nodes WHERE customer_id IN (%s, %s)
+            FOR UPDATE
+        """, (referrer_id, referee_id))
+        nodes = {row['customer_id']: row for row in cur.fetchall()}
+        child = nodes.get(referee_id)
+        parent = nodes.get(referrer_id)
+        if child is not None and child['referrer_id'] is not None:
+            return False
+        if parent is not None and referee_id in parent['path']:
+            return False
+
+        if parent is None:
+            parent = {'root_id': referrer_id, 'path': []}
+            cur.execute("""
+                INSERT INTO referral_nodes (customer_id, root_id, own_value) VALUES (%s, %s, %s)
+            """, (referrer_id, referrer_id, self._order_value(cur, referrer_id)))
+        if child is None:
+            child = {'downline': 0, 'own_value': self._order_value(cur, referee_id), 'chain_value': 0}
+            cur.execute("""
+                INSERT INTO referral_nodes (customer_id, root_id, own_value) VALUES (%s, %s, %s)
+            """, (referee_id, referee_id, child['own_value']))
+
+        path = list(parent['path']) + [referrer_id]
+        params = {
+            'referee': referee_id, 'referrer': referrer_id, 'root': parent['root_id'], 'path': path,
+            'downline': child['downline'], 'value': child['own_value'] + child['chain_value'],
+        }
+        # The referee was a root: its subtree's paths all start with it
+        cur.execute("""
+            UPDATE referral_nodes
+            SET path = %(path)s::text[] || path, depth = depth + cardinality(%(path)s::text[]),
+                root_id = %(root)s, updated_at = now()
+            WHERE path @> ARRAY[%(referee)s]::text[]
+        """, params)
+        cur.execute("""
+            UPDATE referral_nodes
+            SET referrer_id = %(referrer)s, root_id = %(root)s, path = %(path)s::text[],
+                depth = cardinality(%(path)s::text[]), updated_at = now()
+            WHERE customer_id = %(referee)s
+        """, params)
+        cur.execute("""
+            UPDATE referral_nodes
+            SET direct_referrals = direct_referrals + (customer_id = %(referrer)s)::int,
+                downline = downline + 1 + %(downline)s,
+                chain_value = chain_value + %(value)s,
+                updated_at = now()
+            WHERE customer_id = ANY(%(path)s::text[])
+        """, params)
+        return True
+
+    def update_values(self, cur, since):
+        """Recomputes own_value for nodes with orders since `since`; returns how many changed."""
+        cur.execute(CHANGED_VALUES_SQL, {'since': since})
+        changed = cur.fetchall()
+        if not changed:
+            return 0
+        ancestors = {}
+        for row in changed:
+            for ancestor in row['path']:
+                ancestors[ancestor] = ancestors.get(ancestor, 0) + row['delta']
+        cur.execute("""
+            UPDATE referral_nodes n SET own_value = n.own_value + d.delta, updated_at = now()
+            FROM unnest(%s::text[], %s::numeric[]) AS d(customer_id, delta)
+            WHERE n.customer_id = d.customer_id
+        """, ([row['customer_id'] for row in changed], [row['delta'] for row in changed]))
+        if ancestors:
+            cur.execute("""
+                UPDATE referral_nodes n SET chain_value = n.chain_value + d.delta, updated_at = now()
+                FROM unnest(%s::text[], %s::numeric[]) AS d(customer_id, delta)
+                WHERE n.customer_id = d.customer_id
+            """, (list(ancestors), list(ancestors.values())))
+        return len(changed)
+
+
+def main(argv):
+    from dotenv import load_dotenv
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+    database_url = os.getenv('DATABASE_URL')
+    if not database_url:
+        logger.error("DATABASE_URL not set")
+        return 1
+    graph = ReferralGraph(lambda: psycopg2.connect(database_url))
+    print(json.dumps(graph.run(full=True if '--full' in argv else None)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,250 @@
+"""
+Read-replica routing for run_query().
+
+With READ_DATABASE_URL set, SELECTs issued inside replica_reads() (or a
+function decorated with @prefer_replica: the dashboard aggregates and the
+refresh jobs that compute them) go to a small pool of replica connections.
+Everything else stays on the primary connection:
+
+  * writes, and any read outside replica_reads(),
+  * reads in a request that has already written (read-your-writes),
+  * all reads while the replica is lagging more than REPLICA_MAX_LAG_SECONDS,
+  * all reads for REPLICA_RETRY_SECONDS after the replica failed; the failed
+    query itself is retried on the primary, so callers never see the outage,
+  * a read that found all REPLICA_POOL_SIZE connections busy for
+    REPLICA_POOL_WAIT_SECONDS; only that read moves, since a busy pool is
+    load, not an outage.
+
+Lag is sampled at most every REPLICA_CHECK_SECONDS. A standby that has
+replayed everything it received counts as current even when the primary has
+been idle and pg_last_xact_replay_timestamp() is old. A second ordinary
+server (not in recovery) always counts as current, which is how it is tested
+locally with two Postgres instances.
+"""
+import os
+import re
+import time
+import logging
+import threading
+import contextvars
+from functools import wraps
+from contextlib import contextmanager
+import psycopg2
+from psycopg2.pool import ThreadedConnectionPool, PoolError
+from psycopg2.extras import RealDictCursor
+from flask import g, has_request_context
+
+logger = logging.getLogger(__name__)
+
+READ_DATABASE_URL = os.getenv('READ_DATABASE_URL')
+REPLICA_POOL_SIZE = int(os.getenv('REPLICA_POOL_SIZE', '4'))
+REPLICA_MAX_LAG_SECONDS = float(os.getenv('REPLICA_MAX_LAG_SECONDS', '30'))
+REPLICA_CHECK_SECONDS = float(os.getenv('REPLICA_CHECK_SECONDS', '5'))
+REPLICA_RETRY_SECONDS = float(os.getenv('REPLICA_RETRY_SECONDS', '30'))
+REPLICA_POOL_WAIT_SECONDS = float(os.getenv('REPLICA_POOL_WAIT_SECONDS', '1'))
+
+LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM clock_timestamp() - pg_last_xact_replay_timestamp()), 0)
+    END AS lag
+"""
+
+_READ_ONLY = re.compile(r'^\s*(SELECT|WITH)\b', re.IGNORECASE)
+_LOCKING = re.compile(r'\bFOR\s+(UPDATE|SHARE|NO\s+KEY\s+UPDATE|KEY\s+SHARE)\b', re.IGNORECASE)
+
+_prefer_replica = contextvars.ContextVar('prefer_replica', default=False)
+
+
+class ReplicaBusy(PoolError):
+    """Every pooled replica connection stayed in use for REPLICA_POOL_WAIT_SECONDS."""
+
+
+@contextmanager
+def replica_reads():
+    token = _prefer_replica.set(True)
+    try:
+        yield
+    finally:
+        _prefer_replica.reset(token)
+
+
+def prefer_replica(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with replica_reads():
+            return func(*args, **kwargs)
+    return wrapper
+
+
+class ReplicaRouter:
+    def __init__(self, dsn=READ_DATABASE_URL, pool_size=REPLICA_POOL_SIZE, max_lag=REPLICA_MAX_LAG_SECONDS):
+        self.dsn = dsn
+        self.pool_size = pool_size
+        self.max_lag = max_lag
+        self._pool = None
+        # One slot per pooled connection: getconn() raises instead of waiting when none is free
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._lock = threading.Lock()
+        self._lag = None
+        self._lag_checked = 0.0
+        self._down_until = 0.0
+        self.stats = {
+            'replica': 0, 'primary_stale': 0, 'primary_down': 0, 'primary_after_write': 0, 'primary_busy': 0,
+            'failures': 0,
+        }
+
+    def note_write(self):
+        if has_request_context():
+            g.wrote_primary = True
+
+    def should_use(self, sql):
+        if not self.dsn or not _prefer_replica.get():
+            return False
+        if not _READ_ONLY.match(sql) or _LOCKING.search(sql):
+            return False
+        if has_request_context() and g.get('wrote_primary'):
+            self.stats['primary_after_write'] += 1
+            return False
+        if time.monotonic() < self._down_until:
+            self.stats['primary_down'] += 1
+            return False
+        lag = self.lag()
+        if lag is None:
+            self.stats['primary_down'] += 1
+            return False
+        if lag > self.max_lag:
+            self.stats['primary_stale'] += 1
+            return False
+        return True
+
+    def read_dsn(self, primary_dsn):
+        """
+        DSN for reads that open their own connections instead of going
+        through run_query() (partitions.py): the replica whenever a SELECT
+        would be routed there, otherwise primary_dsn.
+        """
+        if self.should_use('SELECT'):
+            self.stats['replica'] += 1
+            return self.dsn
+        return primary_dsn
+
+    def lag(self):
+        """
+        Replica lag in seconds from the last sample, re-sampled when older
+        than REPLICA_CHECK_SECONDS; None when the replica is unreachable.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if now - self._lag_checked < REPLICA_CHECK_SECONDS:
+                return self._lag
+            self._lag_checked = now
+        try:
+            rows = self.fetch(LAG_SQL, None, routed=False)
+            lag = float(rows[0]['lag'])
+        except ReplicaBusy:
+            # Busy with reads, so reachable: keep the previous sample until the next check
+            return self._lag
+        except Exception as e:
+            logger.warning(f"Replica lag check failed: {str(e)}")
+            lag = None
+        with self._lock:
+            self._lag = lag
+        if lag is not None and lag > self.max_lag:
+            logger.warning(f"Replica lag {lag:.1f}s exceeds {self.max_lag:.0f}s, reading from the primary")
+        return lag
+
+    def reset(self):
+        """
+        Forgets pooled connections after fork without closing them, since they
+        belong to the parent process.
+        """
+        with self._lock:
+            self._pool = None
+            self._slots = threading.BoundedSemaphore(self.pool_size)
+
+    def status(self):
+        """
+        Readiness summary. A lagging or unreachable replica does not fail
+        readiness, since reads fall back to the primary.
+        """
+        if not self.dsn:
+            return 'disabled'
+        if time.monotonic() < self._down_until:
+            return 'down'
+        lag = self.lag()
+        if lag is None:
+            return 'down'
+        return 'stale' if lag > self.max_lag else 'ok'
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadedConnectionPool(0, self.pool_size, self.dsn, cursor_factory=RealDictCursor)
+            return self._pool
+
+    def fetch(self, sql, params, routed=True):
+        """
+        Runs a read on a pooled replica connection and returns the rows,
+        counted as a routed read unless routed=False (the lag probe). Waits
+        up to REPLICA_POOL_WAIT_SECONDS for a free connection, then raises
+        ReplicaBusy for the caller to read from the primary. Only
+        OperationalError, from connecting or running the query, marks the
+        replica down for REPLICA_RETRY_SECONDS.
+        """
+        slots = self._slots
+        if not slots.acquire(timeout=REPLICA_POOL_WAIT_SECONDS):
+            if routed:
+                self.stats['primary_busy'] += 1
+            raise ReplicaBusy("Replica connection pool is busy")
+        try:
+            try:
+                pool = self._get_pool()
+                conn = pool.getconn()
+            except psycopg2.OperationalError as e:
+                self.mark_down(e)
+                raise
+            broken = False
+            try:
+                # Autocommit: replica sessions never sit idle in a transaction
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(sql, params)
+                    rows = cur.fetchall()
+                if routed:
+                    self.stats['replica'] += 1
+                return rows
+            except psycopg2.OperationalError as e:
+                broken = True
+                self.mark_down(e)
+                raise
+            except psycopg2.InterfaceError:
+                broken = True
+                raise
+            finally:
+                pool.putconn(conn, close=broken or conn.closed)
+        finally:
+            slots.release()
+
+    def mark_down(self, error):
+        self.stats['failures'] += 1
+        with self._lock:
+            self._down_until = time.monotonic() + REPLICA_RETRY_SECONDS
+            self._lag_checked = 0.0
+        logger.error(f"Replica unavailable, reading from the primary for {REPLICA_RETRY_SECONDS:.0f}s: {str(error)}")
+
+    def metrics(self):
+        stats = dict(self.stats)
+        return [
+            ('loyalty_replica_routed_total', 'counter', 'Replica-eligible reads by where they ran and why.', [
+                ({'target': 'replica', 'reason': 'ok'}, stats['replica']),
+                ({'target': 'primary', 'reason': 'stale'}, stats['primary_stale']),
+                ({'target': 'primary', 'reason': 'down'}, stats['primary_down']),
+                ({'target': 'primary', 'reason': 'after_write'}, stats['primary_after_write']),
+                ({'target': 'primary', 'reason': 'busy'}, stats['primary_busy']),
+            ]),
+            ('loyalty_replica_failures_total', 'counter', 'Replica connection failures.', [({}, stats['failures'])]),
+            ('loyalty_replica_lag_seconds', 'gauge', 'Last sampled replica lag (-1 when unreachable).',
+             [({}, -1 if self._lag is None else f"{self._lag:.3f}")]),
+        ]
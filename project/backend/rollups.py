@@ -0,0 +1,243 @@
+"""
+Daily rollups behind the time-series dashboards.
+
+migrations/0007_daily_rollups.sql keeps three compact tables in step with
+the raw tables. Statement-level triggers apply each write's delta in the same
+transaction, whichever code path made it:
+
+    daily_rollups            per UTC day: orders, order total / subtotal, referrals, referral points
+    daily_points_rollup      per UTC day, transaction type and redeemed reward: points earned /
+                             redeemed, transaction count
+    customer_monthly_orders  per month and customer: orders, order total
+
+A period query sums at most a few hundred day rows; months, quarters and
+years are re-aggregations of the same rows. Distinct and repeat customer
+counts come from the monthly table, so they always cover whole months (the
+financial quarters they are used for are month-aligned). Day and month
+boundaries are UTC and every period includes its end day in full.
+
+rebuild() recomputes all rollups from the raw tables, briefly blocking
+writers; verify() compares recent days against the raw tables:
+    python rollups.py verify [--days 35]
+    python rollups.py rebuild
+"""
+import os
+import sys
+import logging
+from datetime import date, datetime, timedelta
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+logger = logging.getLogger(__name__)
+
+EARN_TYPES = ('earn_points', 'welcome_bonus')
+REDEEM_TYPE = 'redeem_points'
+
+PERIOD_SQL = """
+    SELECT o.orders, o.order_total, o.order_subtotal, o.referrals, o.referral_points,
+           p.points_earned, p.points_redeemed, c.active_customers, c.repeat_customers
+    FROM (
+        SELECT COALESCE(SUM(orders), 0)::bigint AS orders,
+               COALESCE(SUM(order_total), 0) AS order_total,
+               COALESCE(SUM(order_subtotal), 0) AS order_subtotal,
+               COALESCE(SUM(referrals), 0)::bigint AS referrals,
+               COALESCE(SUM(referral_points), 0)::bigint AS referral_points
+        FROM daily_rollups
+        WHERE day BETWEEN %(start)s AND %(end)s
+    ) o, (
+        SELECT COALESCE(SUM(points_earned), 0)::bigint AS points_earned,
+               COALESCE(SUM(points_redeemed), 0)::bigint AS points_redeemed
+        FROM daily_points_rollup
+        WHERE day BETWEEN %(start)s AND %(end)s
+    ) p, (
+        SELECT COUNT(*) FILTER (WHERE orders > 0) AS active_customers,
+               COUNT(*) FILTER (WHERE orders > 1) AS repeat_customers
+        FROM (
+            SELECT SUM(orders) AS orders
+            FROM customer_monthly_orders
+            WHERE month BETWEEN date_trunc('month', %(start)s::date)::date AND %(end)s
+            GROUP BY customer_id
+        ) per_customer
+    ) c
+"""
+
+MONTHLY_SQL = """
+    SELECT month, SUM(earned)::bigint AS earned, SUM(redeemed)::bigint AS redeemed, SUM(sales) AS sales
+    FROM (
+        SELECT date_trunc('month', day)::date AS month,
+               CASE WHEN lower(type) IN %(earn_types)s THEN points_earned ELSE 0 END AS earned,
+               CASE WHEN lower(type) = %(redeem_type)s THEN points_redeemed ELSE 0 END AS redeemed,
+               0 AS sales
+        FROM daily_points_rollup
+        WHERE day >= %(start)s AND day < %(end)s
+        UNION ALL
+        SELECT date_trunc('month', day)::date, 0, 0, order_subtotal
+        FROM daily_rollups
+        WHERE day >= %(start)s AND day < %(end)s
+    ) s
+    GROUP BY month
+"""
+
+REWARDS_SQL = """
+    SELECT reward_id, SUM(transactions)::bigint AS redemptions
+    FROM daily_points_rollup
+    WHERE type = %s AND reward_id <> ''
+    GROUP BY reward_id
+    HAVING SUM(transactions) > 0
+"""
+
+# Per-day rollup values next to the same values computed from the raw tables
+VERIFY_SQL = """
+    WITH days AS (
+        SELECT generate_series(%(start)s::date, %(end)s::date, interval '1 day')::date AS day
+    ),
+    raw_orders AS (
+        SELECT (date AT TIME ZONE 'UTC')::date AS day, COUNT(*) AS orders, COALESCE(SUM(total), 0) AS total
+        FROM orders
+        WHERE date >= %(start)s::date::timestamp AT TIME ZONE 'UTC' AND date < (%(end)s::date + 1)::timestamp AT TIME ZONE 'UTC'
+        GROUP BY 1
+    ),
+    raw_points AS (
+        SELECT (date AT TIME ZONE 'UTC')::date AS day, COUNT(*) AS transactions,
+               SUM(GREATEST(COALESCE(points, 0), 0)) AS earned, SUM(GREATEST(-COALESCE(points, 0), 0)) AS redeemed
+        FROM transactions
+        WHERE date >= %(start)s::date::timestamp AT TIME ZONE 'UTC' AND date < (%(end)s::date + 1)::timestamp AT TIME ZONE 'UTC'
+        GROUP BY 1
+    ),
+    raw_referrals AS (
+        SELECT (date AT TIME ZONE 'UTC')::date AS day, COUNT(*) AS referrals
+        FROM referrals
+        WHERE date >= %(start)s::date::timestamp AT TIME ZONE 'UTC' AND date < (%(end)s::date + 1)::timestamp AT TIME ZONE 'UTC'
+        GROUP BY 1
+    ),
+    rolled_points AS (
+        SELECT day, SUM(transactions) AS transactions, SUM(points_earned) AS earned, SUM(points_redeemed) AS redeemed
+        FROM daily_points_rollup
+        WHERE day BETWEEN %(start)s AND %(end)s
+        GROUP BY day
+    )
+    SELECT d.day,
+           COALESCE(r.orders, 0) AS rollup_orders, COALESCE(ro.orders, 0) AS raw_orders,
+           COALESCE(r.order_total, 0) AS rollup_total, COALESCE(ro.total, 0) AS raw_total,
+           COALESCE(r.referrals, 0) AS rollup_referrals, COALESCE(rr.referrals, 0) AS raw_referrals,
+           COALESCE(p.transactions, 0) AS rollup_transactions, COALESCE(rp.transactions, 0) AS raw_transactions,
+           COALESCE(p.earned, 0) AS rollup_earned, COALESCE(rp.earned, 0) AS raw_earned,
+           COALESCE(p.redeemed, 0) AS rollup_redeemed, COALESCE(rp.redeemed, 0) AS raw_redeemed
+    FROM days d
+    LEFT JOIN daily_rollups r ON r.day = d.day
+    LEFT JOIN raw_orders ro ON ro.day = d.day
+    LEFT JOIN raw_referrals rr ON rr.day = d.day
+    LEFT JOIN rolled_points p ON p.day = d.day
+    LEFT JOIN raw_points rp ON rp.day = d.day
+    ORDER BY d.day
+"""
+VERIFY_COLUMNS = ('orders', 'total', 'referrals', 'transactions', 'earned', 'redeemed')
+
+
+def _day(value):
+    return value.date() if isinstance(value, datetime) else value
+
+
+def _check(response):
+    if 'error' in response:
+        raise RuntimeError(f"Rollup query failed: {response['error']}")
+    return response['data']
+
+
+def period_totals(run_query, start, end):
+    """
+    Totals for the days start..end inclusive (dates or datetimes, in UTC).
+    active_customers / repeat_customers cover the whole months involved.
+    """
+    row = _check(run_query(PERIOD_SQL, {'start': _day(start), 'end': _day(end)}))[0]
+    return {
+        'orders': row['orders'],
+        'orderTotal': float(row['order_total']),
+        'orderSubtotal': float(row['order_subtotal']),
+        'referrals': row['referrals'],
+        'referralPoints': row['referral_points'],
+        'pointsEarned': row['points_earned'],
+        'pointsRedeemed': row['points_redeemed'],
+        'activeCustomers': row['active_customers'],
+        'repeatCustomers': row['repeat_customers'],
+    }
+
+
+def monthly_series(run_query, months):
+    """
+    Points earned (earn_points / welcome_bonus), points redeemed
+    (redeem_points) and order subtotal per month, in the order of months
+    (first-of-month dates); months without activity are zero.
+    """
+    if not months:
+        return []
+    first, last = min(months), max(months)
+    end = date(last.year + (last.month == 12), last.month % 12 + 1, 1)
+    rows = _check(run_query(MONTHLY_SQL, {
+        'start': first, 'end': end, 'earn_types': EARN_TYPES, 'redeem_type': REDEEM_TYPE
+    }))
+    by_month = {row['month']: row for row in rows}
+    series = []
+    for month in months:
+        row = by_month.get(month)
+        series.append({
+            'earned': row['earned'] if row else 0,
+            'redeemed': row['redeemed'] if row else 0,
+            'sales': float(row['sales']) if row else 0.0,
+        })
+    return series
+
+
+def reward_redemptions(run_query):
+    """All-time redeem_points transaction counts by the reward named in their context."""
+    return {row['reward_id']: row['redemptions'] for row in _check(run_query(REWARDS_SQL, (REDEEM_TYPE,)))}
+
+
+def rebuild(conn):
+    """Recomputes every rollup from the raw tables in one transaction."""
+    with conn.cursor() as cur:
+        cur.execute("SELECT rebuild_rollups()")
+    conn.commit()
+
+
+def verify(conn, days=35):
+    """Returns the days in the last `days` whose rollups disagree with the raw tables."""
+    end = datetime.utcnow().date()
+    start = end - timedelta(days=days - 1)
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(VERIFY_SQL, {'start': start, 'end': end})
+        rows = cur.fetchall()
+    conn.rollback()
+    return [
+        row for row in rows
+        if any(row[f'rollup_{column}'] != row[f'raw_{column}'] for column in VERIFY_COLUMNS)
+    ]
+
+
+def main(argv):
+    from dotenv import load_dotenv
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+    database_url = os.getenv('DATABASE_URL')
+    if not database_url:
+        logger.error("DATABASE_URL not set")
+        return 1
+    command = argv[1] if len(argv) > 1 else 'verify'
+    conn = psycopg2.connect(database_url)
+    if command == 'rebuild':
+        rebuild(conn)
+        logger.info("Rollups rebuilt")
+        return 0
+    if command == 'verify':
+        days = int(argv[argv.index('--days') + 1]) if '--days' in argv else 35
+        mismatches = verify(conn, days)
+        for row in mismatches:
+            logger.error(f"Rollup mismatch on {row['day']}: {dict(row)}")
+        logger.info(f"Verified {days} days: {len(mismatches)} mismatched")
+        return 1 if mismatches else 0
+    print(__doc__)
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
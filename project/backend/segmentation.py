@@ -0,0 +1,323 @@
+"""
+Segment membership engine.
+
+Each row in `segments` with a non-null `rules` JSON object is evaluated in
+`priority` order (lowest first); a customer joins the first segment whose
+rules all match. Supported rule keys:
+
+    min_spend / max_spend                 sum of positive transaction amounts
+    tiers                                 list of tier names, e.g. ["Gold", "Silver"]
+    min_recency_days / max_recency_days   days since the last transaction or order
+    min_frequency / max_frequency         number of orders
+    min_monetary / max_monetary           sum of order totals
+    min_rfm / max_rfm                     R+F+M quintile score, 3..15
+    min_points / max_points               current points balance
+
+An empty object matches everyone, which makes a catch-all segment.
+
+Per-customer features are computed in one set-based query and streamed
+through a server-side cursor; memberships are written back with batched
+upserts. A full run re-evaluates every customer, refreshes the RFM quintile
+breakpoints and deletes memberships that no longer match. An incremental run
+re-evaluates only customers with transactions, orders or sign-ups since the
+last run's watermark, scored against the stored breakpoints. Both finish by
+refreshing the count / avg_spend / avg_points / retention_rate columns of
+`segments` from the per-member features stored in `user_segments`.
+
+Tables and columns are created by migrations/0003_segmentation.sql.
+
+Usage:
+    python segmentation.py [--full]
+"""
+import os
+import sys
+import json
+import time
+import bisect
+import logging
+from datetime import datetime, timedelta
+import pytz
+import psycopg2
+from psycopg2.extras import RealDictCursor, execute_values
+
+logger = logging.getLogger(__name__)
+
+UTC = pytz.UTC
+BATCH_SIZE = int(os.getenv('SEGMENTATION_BATCH_SIZE', '5000'))
+FULL_RUN_INTERVAL_HOURS = float(os.getenv('SEGMENTATION_FULL_RUN_HOURS', '24'))
+ACTIVE_DAYS = 90
+# Re-read this much activity before the watermark to cover writes that committed late
+WATERMARK_OVERLAP = timedelta(minutes=5)
+
+RANGE_RULES = {
+    'spend': 'spend',
+    'recency_days': 'recency_days',
+    'frequency': 'frequency',
+    'monetary': 'monetary',
+    'rfm': 'rfm_score',
+    'points': 'points',
+}
+
+FEATURES_SQL = """
+    WITH t AS (
+        SELECT customer_id,
+               SUM(amount) FILTER (WHERE amount > 0) AS spend,
+               MAX(date) AS last_transaction
+        FROM transactions
+        {transaction_filter}
+        GROUP BY customer_id
+    ), o AS (
+        SELECT customer_id, COUNT(*) AS frequency, SUM(total) AS monetary, MAX(date) AS last_order
+        FROM orders
+        {order_filter}
+        GROUP BY customer_id
+    )
+    SELECT u.id, u.tier, COALESCE(u.points_balance, 0) AS points,
+           COALESCE(t.spend, 0) AS spend,
+           COALESCE(o.frequency, 0) AS frequency,
+           COALESCE(o.monetary, 0) AS monetary,
+           GREATEST(t.last_transaction, o.last_order) AS last_activity
+    FROM users u
+    LEFT JOIN t ON t.customer_id = u.id
+    LEFT JOIN o ON o.customer_id = u.id
+    {user_filter}
+"""
+
+BREAKPOINTS_SQL = """
+    WITH f AS ({features})
+    SELECT percentile_cont(ARRAY[0.2, 0.4, 0.6, 0.8]) WITHIN GROUP (ORDER BY frequency) AS frequency,
+           percentile_cont(ARRAY[0.2, 0.4, 0.6, 0.8]) WITHIN GROUP (ORDER BY monetary) AS monetary,
+           percentile_cont(ARRAY[0.2, 0.4, 0.6, 0.8]) WITHIN GROUP (ORDER BY EXTRACT(EPOCH FROM last_activity::timestamptz)) AS last_activity
+    FROM f
+"""
+
+CHANGED_CUSTOMERS_SQL = """
+    SELECT customer_id FROM transactions WHERE date >= %(since)s
+    UNION
+    SELECT customer_id FROM orders WHERE date >= %(since)s
+    UNION
+    SELECT id FROM users WHERE created_at >= %(since)s
+"""
+
+UPSERT_SQL = """
+    INSERT INTO user_segments (customer_id, segment_id, spend, points, active, evaluated_at)
+    VALUES %s
+    ON CONFLICT (customer_id) DO UPDATE
+    SET segment_id = EXCLUDED.segment_id, spend = EXCLUDED.spend, points = EXCLUDED.points,
+        active = EXCLUDED.active, evaluated_at = EXCLUDED.evaluated_at
+"""
+
+SUMMARY_SQL = """
+    UPDATE segments s
+    SET count = COALESCE(agg.count, 0),
+        avg_spend = COALESCE(agg.avg_spend, 0),
+        avg_points = COALESCE(agg.avg_points, 0),
+        retention_rate = COALESCE(agg.retention_rate, 0)
+    FROM segments s2
+    LEFT JOIN (
+        SELECT segment_id, COUNT(*) AS count,
+               ROUND(AVG(spend), 2) AS avg_spend,
+               ROUND(AVG(points), 2) AS avg_points,
+               ROUND(100.0 * COUNT(*) FILTER (WHERE active) / COUNT(*), 2) AS retention_rate
+        FROM user_segments
+        GROUP BY segment_id
+    ) agg ON agg.segment_id = s2.id
+    WHERE s.id = s2.id AND s2.rules IS NOT NULL
+      -- Unchanged rows are left alone so the segments data version only moves on real changes
+      AND (s.count, s.avg_spend, s.avg_points, s.retention_rate) IS DISTINCT FROM
+          (COALESCE(agg.count, 0), COALESCE(agg.avg_spend, 0), COALESCE(agg.avg_points, 0), COALESCE(agg.retention_rate, 0))
+"""
+
+
+def compile_rules(rules):
+    """
+    Turns a segment's rule object into a single predicate over a feature dict.
+    """
+    checks = []
+    for key, feature in RANGE_RULES.items():
+        if rules.get(f'min_{key}') is not None:
+            low = float(rules[f'min_{key}'])
+            checks.append(lambda f, feature=feature, low=low: f[feature] is not None and f[feature] >= low)
+        if rules.get(f'max_{key}') is not None:
+            high = float(rules[f'max_{key}'])
+            checks.append(lambda f, feature=feature, high=high: f[feature] is not None and f[feature] <= high)
+    if rules.get('tiers'):
+        tiers = frozenset(rules['tiers'])
+        checks.append(lambda f: f['tier'] in tiers)
+    unknown = set(rules) - {f'{bound}_{key}' for key in RANGE_RULES for bound in ('min', 'max')} - {'tiers'}
+    if unknown:
+        raise ValueError(f"Unknown segment rule keys: {', '.join(sorted(unknown))}")
+    return lambda f: all(check(f) for check in checks)
+
+
+def _to_datetime(value):
+    if value is None or isinstance(value, datetime):
+        return value
+    try:
+        dt = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+        return dt if dt.tzinfo else dt.replace(tzinfo=UTC)
+    except ValueError:
+        return None
+
+
+def _quintile(breakpoints, value):
+    if value is None or not breakpoints:
+        return 1
+    return bisect.bisect_right(breakpoints, value) + 1
+
+
+class SegmentEngine:
+    def __init__(self, connect, batch_size=BATCH_SIZE):
+        self.connect = connect
+        self.batch_size = batch_size
+
+    def load_segments(self, cur):
+        cur.execute("SELECT id, rules, priority FROM segments WHERE rules IS NOT NULL ORDER BY priority, id")
+        compiled = []
+        for row in cur.fetchall():
+            rules = row['rules'] if isinstance(row['rules'], dict) else json.loads(row['rules'])
+            compiled.append((row['id'], compile_rules(rules)))
+        return compiled
+
+    def load_state(self, cur):
+        cur.execute("SELECT activity_watermark, rfm_breakpoints, last_full_run_at FROM segmentation_state WHERE id = 1")
+        return cur.fetchone()
+
+    def run(self, full=None):
+        """
+        Runs a full evaluation when requested, when no previous full run
+        exists or when the last one is older than SEGMENTATION_FULL_RUN_HOURS;
+        otherwise an incremental one. Returns a summary dict.
+        """
+        started = time.perf_counter()
+        run_started_at = datetime.now(UTC)
+        conn = self.connect()
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                segments = self.load_segments(cur)
+                state = self.load_state(cur)
+            if not segments:
+                return {'mode': 'none', 'evaluated': 0, 'message': 'No segments have rules'}
+
+            if full is None:
+                full = (
+                    state is None or state['last_full_run_at'] is None or
+                    run_started_at - state['last_full_run_at'] > timedelta(hours=FULL_RUN_INTERVAL_HOURS)
+                )
+
+            if full:
+                breakpoints = self.compute_breakpoints(conn)
+                evaluated, assigned = self.evaluate(conn, segments, breakpoints, run_started_at, customer_ids=None)
+                with conn.cursor() as cur:
+                    # Customers that matched nothing (or were deleted) were not touched this run
+                    cur.execute("DELETE FROM user_segments WHERE evaluated_at IS NULL OR evaluated_at < %s", (run_started_at,))
+            else:
+                breakpoints = state['rfm_breakpoints'] or {}
+                since = (state['activity_watermark'] or run_started_at) - WATERMARK_OVERLAP
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    cur.execute(CHANGED_CUSTOMERS_SQL, {'since': since.isoformat()})
+                    changed = [row['customer_id'] for row in cur.fetchall() if row['customer_id'] is not None]
+                evaluated, assigned = 0, 0
+                for start in range(0, len(changed), self.batch_size):
+                    batch = changed[start:start + self.batch_size]
+                    batch_evaluated, batch_assigned = self.evaluate(conn, segments, breakpoints, run_started_at, customer_ids=batch)
+                    evaluated += batch_evaluated
+                    assigned += batch_assigned
+
+            with conn.cursor() as cur:
+                cur.execute(SUMMARY_SQL)
+                cur.execute("""
+                    INSERT INTO segmentation_state (id, activity_watermark, rfm_breakpoints, last_full_run_at, last_incremental_run_at)
+                    VALUES (1, %(now)s, %(breakpoints)s, CASE WHEN %(full)s THEN %(now)s END, CASE WHEN %(full)s THEN NULL ELSE %(now)s END)
+                    ON CONFLICT (id) DO UPDATE
+                    SET activity_watermark = EXCLUDED.activity_watermark,
+                        rfm_breakpoints = EXCLUDED.rfm_breakpoints,
+                        last_full_run_at = COALESCE(EXCLUDED.last_full_run_at, segmentation_state.last_full_run_at),
+                        last_incremental_run_at = COALESCE(EXCLUDED.last_incremental_run_at, segmentation_state.last_incremental_run_at)
+                """, {'now': run_started_at, 'breakpoints': json.dumps(breakpoints), 'full': full})
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        duration_ms = round((time.perf_counter() - started) * 1000, 2)
+        logger.info(f"Segmentation {'full' if full else 'incremental'} run: {evaluated} evaluated, {assigned} assigned in {duration_ms}ms")
+        return {'mode': 'full' if full else 'incremental', 'evaluated': evaluated, 'assigned': assigned, 'durationMs': duration_ms}
+
+    def compute_breakpoints(self, conn):
+        features = FEATURES_SQL.format(transaction_filter='', order_filter='', user_filter='')
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(BREAKPOINTS_SQL.format(features=features))
+            row = cur.fetchone()
+        return {key: [float(v) for v in (row[key] or [])] for key in ('frequency', 'monetary', 'last_activity')}
+
+    def evaluate(self, conn, segments, breakpoints, evaluated_at, customer_ids=None):
+        if customer_ids is None:
+            sql = FEATURES_SQL.format(transaction_filter='', order_filter='', user_filter='')
+            params = None
+        else:
+            sql = FEATURES_SQL.format(
+                transaction_filter='WHERE customer_id = ANY(%(ids)s)',
+                order_filter='WHERE customer_id = ANY(%(ids)s)',
+                user_filter='WHERE u.id = ANY(%(ids)s)'
+            )
+            params = {'ids': customer_ids}
+
+        active_since = evaluated_at - timedelta(days=ACTIVE_DAYS)
+        evaluated = 0
+        assigned = 0
+        rows = []
+        unmatched = []
+        # A named (server-side) cursor streams features without loading every customer at once
+        with conn.cursor(name='segment_features', cursor_factory=RealDictCursor) as cur:
+            cur.itersize = self.batch_size
+            cur.execute(sql, params)
+            with conn.cursor() as write_cur:
+                for feature in cur:
+                    evaluated += 1
+                    last_activity = _to_datetime(feature['last_activity'])
+                    feature['spend'] = float(feature['spend'])
+                    feature['monetary'] = float(feature['monetary'])
+                    feature['recency_days'] = (evaluated_at - last_activity).days if last_activity else None
+                    feature['rfm_score'] = (
+                        _quintile(breakpoints.get('last_activity'), last_activity.timestamp() if last_activity else None) +
+                        _quintile(breakpoints.get('frequency'), feature['frequency']) +
+                        _quintile(breakpoints.get('monetary'), feature['monetary'])
+                    )
+                    segment_id = next((sid for sid, matches in segments if matches(feature)), None)
+                    if segment_id is None:
+                        if customer_ids is not None:
+                            unmatched.append(feature['id'])
+                        continue
+                    assigned += 1
+                    rows.append((
+                        feature['id'], segment_id, round(feature['spend'], 2), feature['points'],
+                        bool(last_activity and last_activity >= active_since), evaluated_at
+                    ))
+                    if len(rows) >= self.batch_size:
+                        execute_values(write_cur, UPSERT_SQL, rows, page_size=self.batch_size)
+                        rows = []
+                if rows:
+                    execute_values(write_cur, UPSERT_SQL, rows, page_size=self.batch_size)
+                if unmatched and customer_ids is not None:
+                    write_cur.execute("DELETE FROM user_segments WHERE customer_id = ANY(%s)", (unmatched,))
+        return evaluated, assigned
+
+
+def main(argv):
+    from dotenv import load_dotenv
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+    database_url = os.getenv('DATABASE_URL')
+    if not database_url:
+        logger.error("DATABASE_URL not set")
+        return 1
+    engine = SegmentEngine(lambda: psycopg2.connect(database_url))
+    print(json.dumps(engine.run(full=True if '--full' in argv else None)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
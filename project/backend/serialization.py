@@ -0,0 +1,176 @@
+"""
+Response encoding for the API.
+
+dumps() uses orjson when it is installed and the stdlib encoder otherwise.
+Both encode the values psycopg2 hands back (Decimal as a JSON number,
+datetime/date as ISO 8601) without a per-handler conversion pass.
+FastJSONProvider plugs the encoder into Flask so every jsonify() call uses it.
+
+json_response() is for the handlers that return very large lists: above
+JSON_STREAM_MIN_ITEMS it streams the body in chunks with chunked transfer
+encoding rather than building one big string. compress_response() applies
+gzip or brotli (when the brotli package is installed) per Accept-Encoding,
+to buffered and streamed responses alike.
+"""
+import os
+import json
+import gzip
+import uuid
+import zlib
+import decimal
+from datetime import date, datetime, time as dt_time
+from flask import Response, current_app, request
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+JSON_BACKEND = os.getenv('JSON_BACKEND', 'orjson' if orjson else 'stdlib')
+JSON_STREAM_MIN_ITEMS = int(os.getenv('JSON_STREAM_MIN_ITEMS', '5000'))
+JSON_STREAM_CHUNK_ITEMS = int(os.getenv('JSON_STREAM_CHUNK_ITEMS', '1000'))
+COMPRESS_MIN_BYTES = int(os.getenv('COMPRESS_MIN_BYTES', '1024'))
+COMPRESS_LEVEL = int(os.getenv('COMPRESS_LEVEL', '5'))
+
+
+def _default(obj):
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    if isinstance(obj, (datetime, date, dt_time)):
+        return obj.isoformat()
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+if JSON_BACKEND == 'orjson' and orjson:
+    _ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS
+
+    def dumps(obj):
+        return orjson.dumps(obj, default=_default, option=_ORJSON_OPTIONS)
+else:
+    _encoder = json.JSONEncoder(default=_default, separators=(',', ':'), ensure_ascii=False)
+
+    def dumps(obj):
+        return _encoder.encode(obj).encode('utf-8')
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider backed by dumps(); keys keep insertion order.
+    """
+
+    def dumps(self, obj, **kwargs):
+        return dumps(obj).decode('utf-8')
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps(obj), mimetype=self.mimetype)
+
+
+def iter_json(obj, chunk_items=JSON_STREAM_CHUNK_ITEMS):
+    """
+    Yields the JSON encoding of obj in pieces. Top-level lists, and lists
+    that are direct values of a top-level dict, are emitted chunk_items
+    elements at a time; everything else is encoded in one piece.
+    """
+    if isinstance(obj, list):
+        yield from _iter_list(obj, chunk_items)
+    elif isinstance(obj, dict):
+        yield b'{'
+        for i, (key, value) in enumerate(obj.items()):
+            yield (b',' if i else b'') + dumps(str(key)) + b':'
+            if isinstance(value, list):
+                yield from _iter_list(value, chunk_items)
+            else:
+                yield dumps(value)
+        yield b'}'
+    else:
+        yield dumps(obj)
+
+
+def _iter_list(items, chunk_items):
+    if not items:
+        yield b'[]'
+        return
+    for start in range(0, len(items), chunk_items):
+        chunk = dumps(items[start:start + chunk_items])
+        # Strip the chunk's own brackets and join chunks with commas
+        prefix = b'[' if start == 0 else b','
+        suffix = b']' if start + chunk_items >= len(items) else b''
+        yield prefix + chunk[1:-1] + suffix
+
+
+def _largest_list(obj):
+    if isinstance(obj, list):
+        return len(obj)
+    if isinstance(obj, dict):
+        return max((len(v) for v in obj.values() if isinstance(v, list)), default=0)
+    return 0
+
+
+def json_response(obj, status=200):
+    """
+    jsonify() replacement for large payloads: streams the body when the
+    payload holds a list of at least JSON_STREAM_MIN_ITEMS items.
+    """
+    if _largest_list(obj) < JSON_STREAM_MIN_ITEMS:
+        return current_app.response_class(dumps(obj), status=status, mimetype='application/json')
+    return Response(iter_json(obj), status=status, mimetype='application/json')
+
+
+def _choose_encoding():
+    # Parsed with q-values: 'gzip;q=0' refuses gzip; equal preferences favour br
+    return request.accept_encodings.best_match(['br', 'gzip'] if brotli else ['gzip'])
+
+
+def _gzip_stream(chunks):
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _brotli_stream(chunks):
+    compressor = brotli.Compressor(quality=COMPRESS_LEVEL)
+    for chunk in chunks:
+        data = compressor.process(chunk)
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+def compress_response(response):
+    if response.status_code < 200 or response.status_code in (204, 304) or 'Content-Encoding' in response.headers:
+        return response
+    if response.mimetype not in ('application/json', 'text/plain'):
+        return response
+    encoding = _choose_encoding()
+    if not encoding:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    if response.is_streamed:
+        chunks = response.response
+        response.response = _brotli_stream(chunks) if encoding == 'br' else _gzip_stream(chunks)
+        response.headers.pop('Content-Length', None)
+    else:
+        body = response.get_data()
+        if len(body) < COMPRESS_MIN_BYTES:
+            return response
+        if encoding == 'br':
+            response.set_data(brotli.compress(body, quality=COMPRESS_LEVEL))
+        else:
+            response.set_data(gzip.compress(body, compresslevel=COMPRESS_LEVEL))
+    response.headers['Content-Encoding'] = encoding
+    return response
@@ -0,0 +1,353 @@
+"""
+Mergeable per-day sketches for large-scale KPIs.
+
+Two sketch types, both built from one day of rows and merged across any
+range of days without going back to the raw tables:
+
+    HyperLogLog      distinct counts (active customers) in 2**SKETCH_HLL_PRECISION
+                     one-byte registers; standard error about 1.04 / sqrt(registers),
+                     1.6% at the default precision of 12 (4 KB)
+    QuantileSketch   quantiles with a relative-error guarantee (DDSketch-style
+                     logarithmic buckets): every reported quantile is within
+                     SKETCH_RELATIVE_ACCURACY of a value at that rank. Count, sum,
+                     min and max are exact.
+
+SketchStore keeps one row per (metric, UTC day) in daily_sketches:
+
+    active_customers   HyperLogLog of orders.customer_id
+    order_value        QuantileSketch of orders.total
+    clv                QuantileSketch of ml_predictions.clv_predicted, by prediction_date
+
+Each sketch records how many source rows it was built from and the sum of
+their value column (order totals, CLV). refresh() compares both with the
+current per-day figures (daily_rollups for orders, a grouped count and sum
+for predictions) and rebuilds only the days that differ, so an edited total
+or re-scored prediction is picked up as well as added and deleted rows;
+today is rebuilt whenever it changes. An edit that keeps a day's count and
+sum, such as an order moved to another customer, is not detected: delete
+that day's daily_sketches rows to force a rebuild. Source rows are streamed through a
+server-side cursor, so memory is bounded by the sketches of the rebuilt days.
+
+KPI_SKETCHES=1 switches kpis() to the sketches for active customers and
+average CLV; /dashboard/kpis/distribution serves percentiles and distinct
+counts for any period. period_summary() reads the sketches back on the
+primary connection that refreshed them, never on a replica that may not
+have the rebuilt days yet.
+
+Tables are created by migrations/0010_daily_sketches.sql and
+migrations/0015_daily_sketch_checksum.sql.
+"""
+import os
+import math
+import json
+import zlib
+import hashlib
+import logging
+from decimal import Decimal
+import psycopg2
+from psycopg2.extras import RealDictCursor, execute_values
+
+logger = logging.getLogger(__name__)
+
+HLL_PRECISION = int(os.getenv('SKETCH_HLL_PRECISION', '12'))
+RELATIVE_ACCURACY = float(os.getenv('SKETCH_RELATIVE_ACCURACY', '0.01'))
+STREAM_BATCH_SIZE = 10000
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class HyperLogLog:
+    def __init__(self, precision=HLL_PRECISION, registers=None):
+        self.precision = precision
+        self.registers = bytearray(registers) if registers is not None else bytearray(1 << precision)
+
+    def add(self, value):
+        h = int.from_bytes(hashlib.blake2b(str(value).encode('utf-8'), digest_size=8).digest(), 'big')
+        index = h >> (64 - self.precision)
+        # Position of the first set bit in the remaining 64 - precision bits
+        rest = (h << self.precision) & 0xFFFFFFFFFFFFFFFF
+        rank = 64 - self.precision + 1 if rest == 0 else 64 - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError(f"Cannot merge HyperLogLog precision {other.precision} into {self.precision}")
+        # Register-wise max on the registers as one big integer (SWAR): ranks stay below 128,
+        # so (a | 0x80) - b never borrows across bytes and leaves the high bit set where a >= b
+        size = len(self.registers)
+        high = int.from_bytes(b'\x80' * size, 'big')
+        a = int.from_bytes(self.registers, 'big')
+        b = int.from_bytes(other.registers, 'big')
+        keep = (((a | high) - b) & high) >> 7
+        keep *= 0xFF
+        self.registers = bytearray(((a & keep) | (b & ~keep)).to_bytes(size, 'big'))
+        return self
+
+    def count(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        # Linear counting is more accurate while many registers are still empty
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+    def to_bytes(self):
+        return zlib.compress(bytes([self.precision]) + bytes(self.registers))
+
+    @classmethod
+    def from_bytes(cls, data):
+        raw = zlib.decompress(bytes(data))
+        return cls(raw[0], raw[1:])
+
+
+class QuantileSketch:
+    # Values at or below this are counted in the zero bucket
+    MIN_VALUE = 1e-9
+
+    def __init__(self, relative_accuracy=RELATIVE_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.bins = {}
+        self.zero = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        value = float(value)
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if value <= self.MIN_VALUE:
+            self.zero += 1
+        else:
+            key = math.ceil(math.log(value) / self.log_gamma)
+            self.bins[key] = self.bins.get(key, 0) + 1
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Cannot merge quantile sketches with different accuracy")
+        for key, count in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0) + count
+        self.zero += other.zero
+        self.count += other.count
+        self.sum += other.sum
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+        return self
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero
+        if rank < seen:
+            return max(self.min, 0.0)
+        for key in sorted(self.bins):
+            seen += self.bins[key]
+            if rank < seen:
+                value = 2 * self.gamma ** key / (self.gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def summary(self, quantiles=QUANTILES):
+        result = {
+            'count': self.count,
+            'mean': round(self.sum / self.count, 2) if self.count else 0,
+            'min': self.min,
+            'max': self.max,
+        }
+        for q in quantiles:
+            value = self.quantile(q)
+            result[f"p{round(q * 100):d}"] = round(value, 2) if value is not None else None
+        return result
+
+    def to_bytes(self):
+        return zlib.compress(json.dumps({
+            'a': self.relative_accuracy, 'b': self.bins, 'z': self.zero,
+            'n': self.count, 's': self.sum, 'min': self.min, 'max': self.max,
+        }, separators=(',', ':')).encode('utf-8'))
+
+    @classmethod
+    def from_bytes(cls, data):
+        state = json.loads(zlib.decompress(bytes(data)))
+        sketch = cls(state['a'])
+        sketch.bins = {int(key): count for key, count in state['b'].items()}
+        sketch.zero, sketch.count, sketch.sum = state['z'], state['n'], state['s']
+        sketch.min, sketch.max = state['min'], state['max']
+        return sketch
+
+
+# metric -> (sketch class, source, column of the source row it reads)
+METRICS = {
+    'active_customers': (HyperLogLog, 'orders', 'customer_id'),
+    'order_value': (QuantileSketch, 'orders', 'total'),
+    'clv': (QuantileSketch, 'predictions', 'clv_predicted'),
+}
+
+SOURCES = {
+    'orders': {
+        'counts': """
+            SELECT day, orders AS rows, order_total AS checksum
+            FROM daily_rollups WHERE day BETWEEN %(start)s AND %(end)s
+        """,
+        'checksum': 'total',
+        'rows': """
+            SELECT (date AT TIME ZONE 'UTC')::date AS day, customer_id, total
+            FROM orders
+            WHERE date >= %(start)s::date::timestamp AT TIME ZONE 'UTC' AND date < (%(end)s::date + 1)::timestamp AT TIME ZONE 'UTC'
+              AND (date AT TIME ZONE 'UTC')::date = ANY(%(days)s)
+        """,
+    },
+    'predictions': {
+        'counts': """
+            SELECT (prediction_date AT TIME ZONE 'UTC')::date AS day, COUNT(*) AS rows,
+                   COALESCE(SUM(clv_predicted), 0) AS checksum
+            FROM ml_predictions
+            WHERE prediction_date >= %(start)s::date::timestamp AT TIME ZONE 'UTC'
+              AND prediction_date < (%(end)s::date + 1)::timestamp AT TIME ZONE 'UTC'
+            GROUP BY 1
+        """,
+        'checksum': 'clv_predicted',
+        'rows': """
+            SELECT (prediction_date AT TIME ZONE 'UTC')::date AS day, clv_predicted
+            FROM ml_predictions
+            WHERE prediction_date >= %(start)s::date::timestamp AT TIME ZONE 'UTC'
+              AND prediction_date < (%(end)s::date + 1)::timestamp AT TIME ZONE 'UTC'
+              AND (prediction_date AT TIME ZONE 'UTC')::date = ANY(%(days)s)
+        """,
+    },
+}
+
+UPSERT_SQL = """
+    INSERT INTO daily_sketches (day, metric, sketch, rows, checksum, computed_at) VALUES %s
+    ON CONFLICT (metric, day) DO UPDATE
+    SET sketch = EXCLUDED.sketch, rows = EXCLUDED.rows, checksum = EXCLUDED.checksum,
+        computed_at = EXCLUDED.computed_at
+"""
+
+
+def _day(value):
+    return value.date() if hasattr(value, 'date') else value
+
+
+class SketchStore:
+    def __init__(self, connect, run_query):
+        self.connect = connect
+        self.run_query = run_query
+
+    def refresh(self, start, end, conn=None):
+        """
+        Rebuilds the sketches of days start..end (inclusive, UTC) that are
+        missing or stale; returns how many. Commits on conn when given,
+        otherwise on a connection of its own.
+        """
+        start, end = _day(start), _day(end)
+        rebuilt = 0
+        own = conn is None
+        conn = self.connect() if own else conn
+        try:
+            for source, queries in SOURCES.items():
+                metrics = [name for name, (_, metric_source, _) in METRICS.items() if metric_source == source]
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    cur.execute(queries['counts'], {'start': start, 'end': end})
+                    current = {row['day']: (row['rows'], row['checksum']) for row in cur.fetchall() if row['rows']}
+                    cur.execute("""
+                        SELECT day, rows, checksum FROM daily_sketches WHERE metric = %s AND day BETWEEN %s AND %s
+                    """, (metrics[0], start, end))
+                    stored = {row['day']: (row['rows'], row['checksum']) for row in cur.fetchall()}
+                stale = sorted(day for day, figures in current.items() if stored.get(day) != figures)
+                vanished = [day for day in stored if day not in current]
+                if stale:
+                    self.build(conn, source, metrics, stale, queries['rows'], queries['checksum'])
+                    rebuilt += len(stale)
+                if vanished:
+                    with conn.cursor() as cur:
+                        cur.execute("DELETE FROM daily_sketches WHERE metric = ANY(%s) AND day = ANY(%s)", (metrics, vanished))
+                conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            if own:
+                conn.close()
+        if rebuilt:
+            logger.info(f"Sketches rebuilt for {rebuilt} source days between {start} and {end}")
+        return rebuilt
+
+    def build(self, conn, source, metrics, days, rows_sql, checksum_column):
+        sketches = {day: {name: METRICS[name][0]() for name in metrics} for day in days}
+        counts = dict.fromkeys(days, 0)
+        checksums = dict.fromkeys(days, Decimal(0))
+        # Tuple rows from a named cursor: open_connection() may default to RealDictCursor
+        with conn.cursor(name=f"sketch_{source}", cursor_factory=psycopg2.extensions.cursor) as cur:
+            cur.itersize = STREAM_BATCH_SIZE
+            cur.execute(rows_sql, {'start': days[0], 'end': days[-1], 'days': days})
+            columns = None
+            for row in cur:
+                if columns is None:
+                    columns = {desc[0]: i for i, desc in enumerate(cur.description)}
+                day = row[0]
+                counts[day] += 1
+                if row[columns[checksum_column]] is not None:
+                    checksums[day] += row[columns[checksum_column]]
+                for name in metrics:
+                    value = row[columns[METRICS[name][2]]]
+                    if value is not None:
+                        sketches[day][name].add(value)
+        with conn.cursor() as cur:
+            execute_values(cur, UPSERT_SQL, [
+                (day, name, psycopg2.Binary(sketch.to_bytes()), counts[day], checksums[day])
+                for day, by_metric in sketches.items() for name, sketch in by_metric.items()
+            ], template="(%s, %s, %s, %s, %s, now())")
+
+    def merged(self, start, end, metrics=tuple(METRICS), conn=None):
+        """
+        One sketch per metric covering days start..end inclusive, plus the
+        bytes read. Reads on conn when given, otherwise through run_query.
+        """
+        sql = """
+            SELECT metric, sketch FROM daily_sketches
+            WHERE metric = ANY(%s) AND day BETWEEN %s AND %s
+        """
+        params = (list(metrics), _day(start), _day(end))
+        if conn is None:
+            response = self.run_query(sql, params)
+            if 'error' in response:
+                raise RuntimeError(f"Sketch query failed: {response['error']}")
+            rows = response['data']
+        else:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(sql, params)
+                rows = cur.fetchall()
+            conn.commit()
+        merged = {name: METRICS[name][0]() for name in metrics}
+        size = 0
+        for row in rows:
+            size += len(row['sketch'])
+            merged[row['metric']].merge(METRICS[row['metric']][0].from_bytes(row['sketch']))
+        return merged, size
+
+    def period_summary(self, start, end):
+        """Distinct active customers and order value / CLV distributions for days start..end."""
+        # Same connection for both: under @prefer_replica run_query could read a replica behind the refresh
+        conn = self.connect()
+        try:
+            self.refresh(start, end, conn)
+            merged, size = self.merged(start, end, conn=conn)
+        finally:
+            conn.close()
+        return {
+            'start': _day(start).isoformat(),
+            'end': _day(end).isoformat(),
+            'activeCustomers': merged['active_customers'].count(),
+            'orderValue': merged['order_value'].summary(),
+            'clv': merged['clv'].summary(),
+            'sketchBytes': size,
+        }
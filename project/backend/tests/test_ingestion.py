@@ -0,0 +1,124 @@
+"""
+Unit tests for ingestion.py: event validation bounds, and a flush that
+isolates events the database refuses instead of retrying their batch.
+
+Usage:
+    python -m pytest tests/test_ingestion.py
+"""
+import os
+import sys
+from datetime import datetime
+
+import psycopg2
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ingestion import IngestionBuffer, validate_event, MAX_AMOUNT, MAX_POINTS, UTC  # noqa: E402
+
+NOW = datetime(2026, 1, 1, tzinfo=UTC)
+
+
+def purchase(event_id, amount=10.0, **fields):
+    return dict({'event_id': event_id, 'customer_id': 'CUST0000001', 'type': 'purchase', 'amount': amount}, **fields)
+
+
+@pytest.mark.parametrize('event', [
+    purchase('inf', float('inf')),
+    purchase('nan', float('nan')),
+    purchase('huge', 1e11),
+    purchase('huge-int', 10 ** 400),
+    purchase('subtotal', subtotal=MAX_AMOUNT * 2),
+    purchase('points', points=MAX_POINTS + 1),
+    {'event_id': 'earn', 'customer_id': 'CUST0000001', 'type': 'earn', 'points': 2 ** 40},
+])
+def test_out_of_range_values_are_invalid(event):
+    with pytest.raises(ValueError):
+        validate_event(event, NOW)
+
+
+def test_derived_points_are_bounded(monkeypatch):
+    monkeypatch.setattr('ingestion.POINTS_PER_UNIT', 1000.0)
+    with pytest.raises(ValueError):
+        validate_event(purchase('derived', MAX_AMOUNT), NOW)
+
+
+def test_largest_values_are_valid():
+    event = validate_event(purchase('max', MAX_AMOUNT, points=MAX_POINTS, subtotal=MAX_AMOUNT), NOW)
+    assert (event['amount'], event['points'], event['subtotal']) == (MAX_AMOUNT, MAX_POINTS, MAX_AMOUNT)
+
+
+def test_submit_reports_infinity_as_invalid():
+    buffer = IngestionBuffer(connect=None)
+    result = buffer.submit([purchase('ok'), purchase('inf', float('inf'))])
+    assert result['accepted'] == ['ok']
+    assert [item['event_id'] for item in result['invalid']] == ['inf']
+
+
+class FakeDatabase:
+    """Stands in for apply() / reject(): refuses any batch holding a poison event, like Postgres would."""
+
+    def __init__(self, poison, down=False):
+        self.poison = poison
+        self.down = down
+        self.applied = []
+        self.rejected = {}
+
+    def apply(self, batch):
+        if self.down:
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+        if any(event['event_id'] in self.poison for event in batch):
+            raise psycopg2.DataError("integer out of range")
+        self.applied.extend(event['event_id'] for event in batch)
+        return {event['event_id']: ('applied', None) for event in batch}, list(batch)
+
+    def reject(self, event, error):
+        self.rejected[event['event_id']] = str(error)
+        return {event['event_id']: ('rejected', str(error))}, []
+
+
+def buffer_with(database, flush_size):
+    buffer = IngestionBuffer(connect=None, flush_size=flush_size)
+    buffer.apply = database.apply
+    buffer.reject = database.reject
+    return buffer
+
+
+def drain(buffer):
+    while buffer.depth():
+        with buffer._condition:
+            batch = [buffer._queue.popleft() for _ in range(min(buffer.flush_size, len(buffer._queue)))]
+        buffer.flush(batch)
+
+
+def test_poison_event_does_not_block_the_buffer():
+    database = FakeDatabase(poison={'bad'})
+    buffer = buffer_with(database, flush_size=8)
+    buffer.submit([purchase(f"good-{n}") for n in range(3)] + [purchase('bad')] + [purchase(f"good-{n}") for n in range(3, 7)])
+    buffer.submit([purchase(f"later-{n}") for n in range(5)])
+    drain(buffer)
+
+    assert set(database.applied) == {f"good-{n}" for n in range(7)} | {f"later-{n}" for n in range(5)}
+    # Arrival order is kept around the rejected event
+    assert database.applied[:7] == [f"good-{n}" for n in range(7)]
+    assert list(database.rejected) == ['bad']
+    assert buffer.depth() == 0 and not buffer._pending_ids
+    assert buffer._retry_delay == 0.0
+    assert (buffer.stats['applied'], buffer.stats['rejected'], buffer.stats['flush_failures']) == (12, 1, 0)
+
+
+def test_connection_error_requeues_batch():
+    database = FakeDatabase(poison=set(), down=True)
+    buffer = buffer_with(database, flush_size=4)
+    buffer.submit([purchase(f"e{n}") for n in range(3)])
+    with buffer._condition:
+        batch = list(buffer._queue)
+        buffer._queue.clear()
+    assert buffer.flush(batch) is None
+    assert [event['event_id'] for event in buffer._queue] == ['e0', 'e1', 'e2']
+    assert buffer.stats['flush_failures'] == 1 and buffer._retry_delay > 0
+    assert not database.rejected
+
+    database.down = False
+    drain(buffer)
+    assert database.applied == ['e0', 'e1', 'e2']
+    assert buffer.depth() == 0 and not buffer._pending_ids
@@ -0,0 +1,64 @@
+"""
+Unit tests for migrate.split_statements: semicolons inside quoted text and
+comments must not split a statement.
+
+Usage:
+    python -m pytest tests/test_migrate.py
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from migrate import load_migrations, split_statements  # noqa: E402
+
+
+def test_semicolon_in_string_literal():
+    sql = """
+        CREATE TABLE notes (body TEXT DEFAULT 'a; b');
+        COMMENT ON TABLE notes IS 'Free text; it''s kept; as is';
+    """
+    assert split_statements(sql) == [
+        "CREATE TABLE notes (body TEXT DEFAULT 'a; b')",
+        "COMMENT ON TABLE notes IS 'Free text; it''s kept; as is'",
+    ]
+
+
+def test_escape_string_and_quoted_identifier():
+    sql = r"""INSERT INTO t ("odd;name") VALUES (E'it\'s; fine');SELECT 1;"""
+    assert split_statements(sql) == [r"""INSERT INTO t ("odd;name") VALUES (E'it\'s; fine')""", "SELECT 1"]
+
+
+def test_comments_are_dropped():
+    sql = """
+        -- migrate:no-transaction
+        -- Leading comment; with a semicolon
+        CREATE INDEX a ON t (x); -- note; more
+        CREATE INDEX b ON t (y) /* inline; /* nested; */ still comment; */ WHERE y > 0;
+        -- trailing comment; nothing after it
+    """
+    assert split_statements(sql) == [
+        "CREATE INDEX a ON t (x)",
+        "CREATE INDEX b ON t (y)   WHERE y > 0",
+    ]
+
+
+def test_dollar_quoted_body_keeps_its_contents():
+    body = """$$
+BEGIN
+    -- not a statement; kept in the body
+    RAISE NOTICE 'done; really';
+END
+$$"""
+    sql = f"CREATE FUNCTION f() RETURNS void LANGUAGE plpgsql AS {body};\nSELECT f();"
+    assert split_statements(sql) == [f"CREATE FUNCTION f() RETURNS void LANGUAGE plpgsql AS {body}", "SELECT f()"]
+
+
+def test_apostrophe_in_comment_does_not_open_a_literal():
+    sql = "-- don't split here\nSELECT 1; -- it's done\nSELECT 2;"
+    assert split_statements(sql) == ["SELECT 1", "SELECT 2"]
+
+
+def test_shipped_migrations_have_no_comment_only_statements():
+    for migration in load_migrations():
+        for statement in split_statements(migration['sql']):
+            assert not statement.startswith('--'), (migration['name'], statement)
@@ -0,0 +1,141 @@
+"""
+Unit tests for the sketches in sketches.py: the SWAR register merge of
+HyperLogLog, QuantileSketch error bounds, and the to_bytes / from_bytes
+round trips that daily_sketches relies on.
+
+Usage:
+    python -m pytest tests/test_sketches.py
+"""
+import os
+import sys
+import math
+import random
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sketches import HyperLogLog, QuantileSketch  # noqa: E402
+
+
+def random_hll(rng, precision, max_rank):
+    return HyperLogLog(precision, bytes(rng.randint(0, max_rank) for _ in range(1 << precision)))
+
+
+@pytest.mark.parametrize('precision', [4, 8, 12])
+def test_hll_merge_is_registerwise_max(precision):
+    rng = random.Random(precision)
+    # 64 - precision + 1 is the highest rank add() can store
+    for _ in range(20):
+        a = random_hll(rng, precision, 64 - precision + 1)
+        b = random_hll(rng, precision, 64 - precision + 1)
+        expected = bytearray(max(x, y) for x, y in zip(a.registers, b.registers))
+        assert a.merge(b).registers == expected
+
+
+def test_hll_merge_equal_and_empty_registers():
+    a = HyperLogLog(8, bytes([5] * 256))
+    assert a.merge(HyperLogLog(8, bytes([5] * 256))).registers == bytearray([5] * 256)
+    assert a.merge(HyperLogLog(8)).registers == bytearray([5] * 256)
+    assert HyperLogLog(8).merge(a).registers == bytearray([5] * 256)
+
+
+def test_hll_merge_matches_union():
+    left, right, union = HyperLogLog(), HyperLogLog(), HyperLogLog()
+    for n in range(30000):
+        (left if n % 3 else right).add(f"CUST{n:07d}")
+        union.add(f"CUST{n:07d}")
+    # Overlap: the same customers seen on both sides count once
+    for n in range(0, 30000, 7):
+        right.add(f"CUST{n:07d}")
+    assert left.merge(right).registers == union.registers
+
+
+def test_hll_merge_rejects_other_precision():
+    with pytest.raises(ValueError):
+        HyperLogLog(10).merge(HyperLogLog(12))
+
+
+@pytest.mark.parametrize('distinct', [100, 5000, 200000])
+def test_hll_count_error(distinct):
+    hll = HyperLogLog()
+    for n in range(distinct):
+        hll.add(n)
+        hll.add(n)
+    standard_error = 1.04 / math.sqrt(len(hll.registers))
+    assert abs(hll.count() - distinct) <= 4 * standard_error * distinct
+
+
+def test_hll_round_trip():
+    rng = random.Random(1)
+    hll = random_hll(rng, 12, 53)
+    restored = HyperLogLog.from_bytes(hll.to_bytes())
+    assert restored.precision == 12
+    assert restored.registers == hll.registers
+    assert restored.count() == hll.count()
+
+
+def exact_quantile(values, q):
+    # The value quantile() targets: rank q * (n - 1), rounded down
+    return sorted(values)[int(q * (len(values) - 1))]
+
+
+@pytest.mark.parametrize('accuracy', [0.01, 0.05])
+def test_quantile_relative_error(accuracy):
+    rng = random.Random(2)
+    values = [round(rng.lognormvariate(4, 1.5), 2) for _ in range(20000)] + [0.0] * 500
+    sketch = QuantileSketch(accuracy)
+    for value in values:
+        sketch.add(value)
+    for q in (0.0, 0.01, 0.25, 0.5, 0.9, 0.99, 0.999, 1.0):
+        exact = exact_quantile(values, q)
+        assert abs(sketch.quantile(q) - exact) <= accuracy * exact + 1e-9, q
+    assert sketch.count == len(values)
+    assert sketch.min == 0.0 and sketch.max == max(values)
+    assert sketch.sum == pytest.approx(sum(values))
+
+
+def test_quantile_merge_matches_combined():
+    rng = random.Random(3)
+    days = [[rng.uniform(1, 2000) for _ in range(rng.randint(0, 3000))] for _ in range(7)]
+    merged, combined = QuantileSketch(), QuantileSketch()
+    for day in days:
+        sketch = QuantileSketch()
+        for value in day:
+            sketch.add(value)
+            combined.add(value)
+        merged.merge(sketch)
+    assert merged.bins == combined.bins
+    assert (merged.count, merged.min, merged.max) == (combined.count, combined.min, combined.max)
+    assert merged.summary() == combined.summary()
+
+
+def test_quantile_empty_and_single():
+    sketch = QuantileSketch()
+    assert sketch.quantile(0.5) is None
+    assert sketch.summary()['mean'] == 0
+    sketch.add(42.5)
+    assert sketch.quantile(0.0) == sketch.quantile(1.0) == 42.5
+
+
+def test_quantile_merge_rejects_other_accuracy():
+    with pytest.raises(ValueError):
+        QuantileSketch(0.01).merge(QuantileSketch(0.02))
+
+
+def test_quantile_round_trip():
+    rng = random.Random(4)
+    sketch = QuantileSketch()
+    for _ in range(5000):
+        sketch.add(rng.expovariate(0.01))
+    sketch.add(0)
+    restored = QuantileSketch.from_bytes(sketch.to_bytes())
+    assert restored.bins == sketch.bins
+    assert (restored.zero, restored.count, restored.sum, restored.min, restored.max) == \
+        (sketch.zero, sketch.count, sketch.sum, sketch.min, sketch.max)
+    assert restored.relative_accuracy == sketch.relative_accuracy
+    assert restored.summary() == sketch.summary()
+
+
+def test_empty_quantile_round_trip():
+    restored = QuantileSketch.from_bytes(QuantileSketch().to_bytes())
+    assert restored.count == 0 and restored.quantile(0.5) is None
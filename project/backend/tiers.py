@@ -0,0 +1,212 @@
+"""
+Tier recalculation engine.
+
+Tiers are driven by lifetime `users.points_earned` against configurable
+thresholds (TIER_THRESHOLDS, default "Bronze:0,Silver:1000,Gold:2000").
+recalculate_all() moves every customer in one set-based UPDATE that only
+touches rows whose tier actually changes; recalculate() does the same for a
+handful of customers after a ledger write. Both return the tier-change
+events, which are also passed to the on_change callback (the Socket.IO
+broadcaster in app.py).
+
+Usage:
+    python tiers.py
+"""
+import os
+import sys
+import json
+import time
+import logging
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+logger = logging.getLogger(__name__)
+
+# Above this many changes a full run emits one summary event instead of one per customer
+MAX_CHANGE_EVENTS = int(os.getenv('TIER_MAX_CHANGE_EVENTS', '1000'))
+
+
+def parse_thresholds(value):
+    """
+    Parses "Bronze:0,Silver:1000,Gold:2000" into [('Bronze', 0), ...] sorted by points.
+    """
+    thresholds = []
+    for part in value.split(','):
+        name, points = part.split(':')
+        thresholds.append((name.strip(), int(points)))
+    thresholds.sort(key=lambda t: t[1])
+    if not thresholds or thresholds[0][1] != 0:
+        raise ValueError("The lowest tier threshold must be 0")
+    return thresholds
+
+
+TIER_THRESHOLDS = parse_thresholds(os.getenv('TIER_THRESHOLDS', 'Bronze:0,Silver:1000,Gold:2000'))
+
+
+def tier_for(points, thresholds=TIER_THRESHOLDS):
+    tier = thresholds[0][0]
+    for name, minimum in thresholds:
+        if (points or 0) >= minimum:
+            tier = name
+    return tier
+
+
+def tier_progress(points, thresholds=TIER_THRESHOLDS):
+    """
+    Progress towards the next tier for a points_earned total.
+    """
+    points = points or 0
+    current = tier_for(points, thresholds)
+    index = [name for name, _ in thresholds].index(current)
+    if index == len(thresholds) - 1:
+        return {'nextTier': None, 'pointsToNext': 0, 'progressPercentage': 100}
+    next_name, next_minimum = thresholds[index + 1]
+    return {
+        'nextTier': next_name,
+        'pointsToNext': max(0, next_minimum - points),
+        'progressPercentage': min(100, points / next_minimum * 100)
+    }
+
+
+def _case_sql(thresholds):
+    # Highest threshold first so the first matching WHEN wins
+    whens = ' '.join(
+        f"WHEN COALESCE(points_earned, 0) >= %(min_{i})s THEN %(tier_{i})s"
+        for i in reversed(range(len(thresholds)))
+    )
+    params = {}
+    for i, (name, minimum) in enumerate(thresholds):
+        params[f'min_{i}'] = minimum
+        params[f'tier_{i}'] = name
+    return f"CASE {whens} END", params
+
+
+def recalculation_sql(thresholds, customer_filter=False):
+    case, params = _case_sql(thresholds)
+    where = "AND id = ANY(%(ids)s)" if customer_filter else ''
+    sql = f"""
+        WITH changed AS (
+            SELECT id, tier AS old_tier, {case} AS new_tier
+            FROM users
+            WHERE tier IS DISTINCT FROM ({case}) {where}
+            FOR UPDATE
+        )
+        UPDATE users u
+        SET tier = c.new_tier
+        FROM changed c
+        WHERE u.id = c.id
+        RETURNING u.id, c.old_tier, c.new_tier
+    """
+    return sql, params
+
+
+def summary_sql(thresholds):
+    """
+    Full-table variant that returns one row per (old_tier, new_tier) pair with
+    at most MAX_CHANGE_EVENTS + 1 sample ids, so a million changes stay in the database.
+    """
+    sql, params = recalculation_sql(thresholds)
+    params['sample'] = MAX_CHANGE_EVENTS + 1
+    return f"""
+        WITH updated AS ({sql})
+        SELECT old_tier, new_tier, COUNT(*) AS changed, (array_agg(id))[1:%(sample)s] AS ids
+        FROM updated
+        GROUP BY old_tier, new_tier
+    """, params
+
+
+class TierEngine:
+    def __init__(self, connect=None, run_query=None, thresholds=None, on_change=None):
+        self.connect = connect
+        self.run_query = run_query
+        self.thresholds = thresholds or TIER_THRESHOLDS
+        self.on_change = on_change
+        self._rank = {name: i for i, (name, _) in enumerate(self.thresholds)}
+
+    def _events(self, rows):
+        return [
+            {
+                'customerId': row['id'],
+                'oldTier': row['old_tier'],
+                'newTier': row['new_tier'],
+                'direction': 'upgrade' if self._rank.get(row['new_tier'], 0) > self._rank.get(row['old_tier'], -1) else 'downgrade'
+            }
+            for row in rows
+        ]
+
+    def _publish(self, events):
+        if self.on_change and events:
+            try:
+                self.on_change(events)
+            except Exception as e:
+                logger.error(f"Tier change callback failed: {str(e)}")
+
+    def recalculate_all(self):
+        """
+        Recalculates every customer in a single statement on a dedicated connection.
+        """
+        started = time.perf_counter()
+        sql, params = summary_sql(self.thresholds)
+        conn = self.connect()
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(sql, params)
+                groups = cur.fetchall()
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        changed = sum(group['changed'] for group in groups)
+        upgrades = sum(
+            group['changed'] for group in groups
+            if self._rank.get(group['new_tier'], 0) > self._rank.get(group['old_tier'], -1)
+        )
+        if changed > MAX_CHANGE_EVENTS:
+            self._publish([{'type': 'bulk', 'changed': changed}])
+        else:
+            self._publish(self._events([
+                {'id': customer_id, 'old_tier': group['old_tier'], 'new_tier': group['new_tier']}
+                for group in groups for customer_id in group['ids']
+            ]))
+        duration_ms = round((time.perf_counter() - started) * 1000, 2)
+        logger.info(f"Tier recalculation: {changed} customers changed tier in {duration_ms}ms")
+        return {
+            'changed': changed,
+            'upgrades': upgrades,
+            'downgrades': changed - upgrades,
+            'durationMs': duration_ms
+        }
+
+    def recalculate(self, customer_ids):
+        """
+        Recalculates specific customers through run_query, e.g. after a ledger write.
+        """
+        sql, params = recalculation_sql(self.thresholds, customer_filter=True)
+        params['ids'] = list(customer_ids)
+        response = self.run_query(sql, params, commit=True)
+        if 'error' in response:
+            logger.error(f"Tier recalculation failed for {customer_ids}: {response['error']}")
+            return []
+        events = self._events(response['data'])
+        self._publish(events)
+        return events
+
+
+def main():
+    from dotenv import load_dotenv
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+    database_url = os.getenv('DATABASE_URL')
+    if not database_url:
+        logger.error("DATABASE_URL not set")
+        return 1
+    engine = TierEngine(connect=lambda: psycopg2.connect(database_url))
+    print(json.dumps(engine.recalculate_all()))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())